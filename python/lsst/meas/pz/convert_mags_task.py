@@ -0,0 +1,168 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "ConvertMagsConfig",
+    "ConvertMagsConnections",
+    "ConvertMagsTask",
+]
+
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+from astropy.table import Table
+from lsst.pipe.base import (
+    InputQuantizedConnection,
+    OutputQuantizedConnection,
+    PipelineTask,
+    PipelineTaskConfig,
+    PipelineTaskConnections,
+    QuantumContext,
+    Struct,
+)
+from lsst.pipe.base import connectionTypes as cT
+
+from .estimate_pz_task import EstimatePZTaskConnections
+from .extensions.algo_registry import pz_algo_registry
+
+
+class ConvertMagsConnections(
+    PipelineTaskConnections,
+    dimensions=EstimatePZTaskConnections.dimensions,
+):
+    objectTable = cT.Input(
+        doc="Object table with the fluxes to convert",
+        name="objectTable",
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+        deferLoad=True,
+    )
+    pzMags = cT.Output(
+        doc="Converted magnitudes, magnitude errors and band flags, for the p(z) estimators",
+        name="pz_mags",
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+
+
+class ConvertMagsConfig(PipelineTaskConfig, pipelineConnections=ConvertMagsConnections):
+    """Config for ConvertMagsTask
+
+    The conversion is that of the ``pz_algo`` algorithm SubTask, which
+    must be set up with the same column names and dereddening as the
+    estimators that read the converted magnitudes, e.g. with the same
+    survey preset.
+    """
+
+    pz_algo = pz_algo_registry.makeField(
+        doc="Algorithm SubTask whose photometry conversion is used",
+    )
+    id_column = pexConfig.Field(
+        doc="Object ID column copied to the output",
+        dtype=str,
+        default="objectId",
+        optional=True,
+    )
+    flag_column = pexConfig.Field(
+        doc="Output column with one bit per band, in bands_to_convert order, set when the "
+        "magnitude or its error is not usable: not finite, or the non-detection value",
+        dtype=str,
+        default="pz_band_flags",
+    )
+    precision = pexConfig.ChoiceField(
+        doc="Floating point precision of the stored magnitudes and errors",
+        dtype=str,
+        default="float32",
+        allowed={
+            "float32": "Single precision, half the size; well below the photometric errors",
+            "float64": "Double precision, the same values the estimators compute themselves",
+        },
+    )
+
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.pz_algo.name = next(
+            algo_name for algo_name in ["dnf", "fzboost", "gpz", "tpz", "cmnn", "lephare"]
+            if algo_name in pz_algo_registry
+        )
+
+
+class ConvertMagsTask(PipelineTask):
+    """Task that converts object table fluxes to p(z) input magnitudes
+
+    The estimator tasks can read its output, with use_converted_mags,
+    instead of converting the fluxes of the object table themselves,
+    so the conversion runs once rather than once per algorithm and rerun.
+    """
+
+    ConfigClass = ConvertMagsConfig
+    _DefaultName = "convertMags"
+
+    def __init__(self, initInputs: dict[str, Any] | None = None, **kwargs: Any):
+        super().__init__(initInputs=initInputs, **kwargs)
+        self.pz_algo = self.config.pz_algo.apply(name="pz_algo", parentTask=self)
+
+    def col_names(self) -> list[str]:
+        """Return the input columns needed for the conversion"""
+        col_names = list(self.pz_algo.col_names())
+        if self.config.id_column is not None and self.config.id_column not in col_names:
+            col_names.append(self.config.id_column)
+        return col_names
+
+    def runQuantum(
+        self,
+        butlerQC: QuantumContext,
+        inputRefs: InputQuantizedConnection,
+        outputRefs: OutputQuantizedConnection,
+    ) -> None:
+        inputs = butlerQC.get(inputRefs)
+        fluxes = inputs["objectTable"].get(parameters=dict(columns=self.col_names()))
+        outputs = self.run(fluxes)
+        butlerQC.put(outputs, outputRefs)
+
+    def run(self, fluxes: Table) -> Struct:
+        """Convert fluxes to magnitudes
+
+        Parameters
+        ----------
+        fluxes
+            Input catalog, with the columns given by `col_names`
+
+        Returns
+        -------
+        result
+            Struct with ``pzMags``: the id column, every column returned by
+            the algorithm's ``convert``, and the band flags
+        """
+        mags = self.pz_algo.convert(fluxes)
+        dtype = np.dtype(self.config.precision)
+
+        out = Table()
+        if self.config.id_column is not None:
+            out[self.config.id_column] = np.asarray(fluxes[self.config.id_column])
+        for key, val in mags.items():
+            val = np.asarray(val)
+            out[key] = val.astype(dtype) if np.issubdtype(val.dtype, np.floating) else val
+
+        out[self.config.flag_column] = self.pz_algo.band_flags(mags)
+        out.meta["pz_bands"] = list(self.pz_algo.config.bands_to_convert)
+        return Struct(pzMags=out)
@@ -26,18 +26,26 @@ __all__ = [
     "EstimatePZCMNNConfig",
 ]
 
-from rail.estimation.algos.cmnn import CMNNEstimator
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from rail.core.model import Model
+from rail.estimation.algos.cmnn import CMNNEstimator, _computecolordata
 from rail.estimation.estimator import CatEstimator
 
-from .estimate_pz_task import (
-    EstimatePZAlgoConfigBase,
-    EstimatePZAlgoTask,
-    EstimatePZTask,
-    EstimatePZTaskConfig,
+from .extensions.ann_index import ApproxNeighborsConfig, IVFIndex
+from .extensions.cmnn_approx import cmnn_estimate
+from .extensions.estimate_pz_task_base import (
+    EstimatePZExtAlgoConfigBase,
+    EstimatePZExtAlgoTask,
+    EstimatePZExtTask,
+    EstimatePZExtTaskConfig,
 )
 
 
-class EstimatePZCMNNAlgoConfig(EstimatePZAlgoConfigBase):
+class EstimatePZCMNNAlgoConfig(EstimatePZExtAlgoConfigBase):
     """Config for EstimatePZCMNNAlgoTask
 
     This will select and configure the CMNNEstimator p(z)
@@ -45,15 +53,30 @@ class EstimatePZCMNNAlgoConfig(EstimatePZAlgoConfigBase):
 
     """
 
+    approx_neighbors = pexConfig.ConfigField(
+        doc="Approximate search for the color matched training galaxies",
+        dtype=ApproxNeighborsConfig,
+    )
+
     @classmethod
     def estimator_class(cls) -> type[CatEstimator]:
         return CMNNEstimator
 
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.stage_name = "cmnn"
+        self.output_mode = "return"
+        self.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+        self.bands = self.get_mag_name_list()
+        self.err_bands = self.get_mag_err_name_list()
+        self.mag_limits = self.get_mag_lim_dict()
+        self.band_a_env = self.get_band_a_env_dict()
+
 
 EstimatePZCMNNAlgoConfig._make_fields()
 
 
-class EstimatePZCMNNAlgoTask(EstimatePZAlgoTask):
+class EstimatePZCMNNAlgoTask(EstimatePZExtAlgoTask):
     """SubTask that runs RAIL CMNN algorithm for p(z) estimation
 
     See https://github.com/LSSTDESC/rail_cmnn/blob/main/src/rail/estimation/algos/cmnn.py  # noqa
@@ -64,8 +87,69 @@ class EstimatePZCMNNAlgoTask(EstimatePZAlgoTask):
     ConfigClass = EstimatePZCMNNAlgoConfig
     _DefaultName = "estimatePZCMNNAlgo"
 
-
-class EstimatePZCMNNConfig(EstimatePZTaskConfig):
+    def __init__(self, initInputs: dict[str, Any] | None = None, **kwargs: Any):
+        super().__init__(initInputs=initInputs, **kwargs)
+        self._index: IVFIndex | None = None
+        self._index_stage: CatEstimator | None = None
+
+    def get_stage(self, pz_model: Model) -> CatEstimator:
+        stage = super().get_stage(pz_model)
+        approx_config = self.config.approx_neighbors
+        if not approx_config.enabled:
+            return stage
+        if stage.model is None:
+            stage.open_model(**stage.config)
+        if self._index_stage is not stage:
+            self._index_stage = stage
+            self._index = IVFIndex(
+                stage.train_color,
+                n_cells=approx_config.n_cells,
+                n_probe=approx_config.n_probe,
+                seed=approx_config.seed,
+            )
+        return stage
+
+    def estimate_mags(self, pz_model: Model, mags: dict[str, np.ndarray], n_rows: int) -> qp.Ensemble:
+        if not self.config.approx_neighbors.enabled:
+            return super().estimate_mags(pz_model, mags, n_rows)
+
+        stage = self.get_stage(pz_model)
+        stage_config = stage.config
+        # Replace the non-detections as CMNNEstimator does, on copies
+        data = {
+            col_: np.array(mags[col_], dtype=float)
+            for col_ in stage_config.bands + stage_config.err_bands
+        }
+        for col_, err_ in zip(stage_config.bands, stage_config.err_bands):
+            if np.isnan(stage_config.nondetect_val):
+                mask = np.isnan(data[col_])
+            else:
+                mask = np.isclose(data[col_], stage_config.nondetect_val)
+            data[col_][mask] = stage_config.mag_limits[col_] if stage.nondet_choice else np.nan
+            data[err_][mask] = 1.0 if stage.nondet_choice else np.nan
+        test_color, test_err = _computecolordata(data, stage_config.bands, stage_config.err_bands)
+
+        estimates = cmnn_estimate(
+            self._index,
+            stage.truez,
+            stage.nondet_choice,
+            test_color,
+            test_err,
+            stage_config,
+            seed=stage_config.seed,
+        )
+        pz_ensemble = qp.Ensemble(
+            qp.stats.norm,
+            data=dict(
+                loc=estimates["zmode"][:, np.newaxis],
+                scale=estimates["scale"][:, np.newaxis],
+            ),
+        )
+        pz_ensemble.set_ancil({key_: estimates[key_] for key_ in ["ncolors", "zmode", "Ncm"]})
+        return self._finish_stage_output(stage, pz_ensemble, mags, n_rows)
+
+
+class EstimatePZCMNNConfig(EstimatePZExtTaskConfig):
     """Config for EstimatePZCMNNTask
 
     Overrides setDefaults to use CMNN algorithm
@@ -73,16 +157,9 @@ class EstimatePZCMNNConfig(EstimatePZTaskConfig):
 
     def setDefaults(self) -> None:
         self.pz_algo.retarget(EstimatePZCMNNAlgoTask)
-        self.pz_algo.stage_name = "cmnn"
-        self.pz_algo.output_mode = "return"
-        self.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-        self.pz_algo.bands = self.pz_algo.get_mag_name_list()
-        self.pz_algo.err_bands = self.pz_algo.get_mag_err_name_list()
-        self.pz_algo.mag_limits = self.pz_algo.get_mag_lim_dict()
-        self.pz_algo.band_a_env = self.pz_algo.get_band_a_env_dict()
 
 
-class EstimatePZCMNNTask(EstimatePZTask):
+class EstimatePZCMNNTask(EstimatePZExtTask):
     """Task that runs RAIL CMNN algorithm for p(z) estimation"""
 
     ConfigClass = EstimatePZCMNNConfig
@@ -0,0 +1,208 @@
+# This file is part of meas_pz.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "EstimatePZConsensusConfig",
+    "EstimatePZConsensusTask",
+]
+
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from astropy.table import Table
+from lsst.pipe.base import (
+    InputQuantizedConnection,
+    OutputQuantizedConnection,
+    PipelineTask,
+    PipelineTaskConfig,
+    QuantumContext,
+    Struct,
+)
+from lsst.pipe.base import connectionTypes as cT
+from rail.core.model import Model
+
+from .estimate_pz_task import EstimatePZTaskConnections
+from .extensions.algo_registry import pz_algo_registry
+from .extensions.consensus import combine_pdfs
+from .extensions.pdf_grid import pdfs_on_grid
+
+
+def _model_connection(algo_name: str) -> cT.PrerequisiteInput:
+    return cT.PrerequisiteInput(
+        doc=f"Model for {algo_name} p(z) estimation",
+        name=f"pzModel_{algo_name}",
+        storageClass="PZModel",
+        dimensions=["instrument"],
+        isCalibration=True,
+    )
+
+
+def _ensemble_connection(algo_name: str) -> cT.Output:
+    return cT.Output(
+        doc=f"Per-object p(z) estimates from {algo_name}, only written if write_algo_ensembles is set",
+        name=f"pz_estimate_{algo_name}",
+        storageClass="QPEnsemble",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+
+
+class EstimatePZConsensusConnections(EstimatePZTaskConnections):
+    pzModel_cmnn = _model_connection("cmnn")
+    pzModel_dnf = _model_connection("dnf")
+    pzModel_fzboost = _model_connection("fzboost")
+    pzModel_gpz = _model_connection("gpz")
+    pzModel_lephare = _model_connection("lephare")
+    pzModel_tpz = _model_connection("tpz")
+
+    pzEnsemble_cmnn = _ensemble_connection("cmnn")
+    pzEnsemble_dnf = _ensemble_connection("dnf")
+    pzEnsemble_fzboost = _ensemble_connection("fzboost")
+    pzEnsemble_gpz = _ensemble_connection("gpz")
+    pzEnsemble_lephare = _ensemble_connection("lephare")
+    pzEnsemble_tpz = _ensemble_connection("tpz")
+
+    pzDisagreement = cT.Output(
+        doc="Per-object disagreement metrics between the p(z) algorithms",
+        name="pz_disagreement",
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+
+    def __init__(self, *, config: "EstimatePZConsensusConfig"):
+        super().__init__(config=config)
+        # Replaced by the per-algorithm models
+        del self.pzModel
+        for algo_name in ["cmnn", "dnf", "fzboost", "gpz", "lephare", "tpz"]:
+            if algo_name not in config.algorithms.names:
+                delattr(self, f"pzModel_{algo_name}")
+            if algo_name not in config.algorithms.names or not config.write_algo_ensembles:
+                delattr(self, f"pzEnsemble_{algo_name}")
+
+
+class EstimatePZConsensusConfig(PipelineTaskConfig, pipelineConnections=EstimatePZConsensusConnections):
+    """Config for EstimatePZConsensusTask
+
+    The consensus p(z) is written as pzEnsemble.
+    """
+
+    algorithms = pz_algo_registry.makeField(
+        doc="p(z) estimation algorithms to combine",
+        multi=True,
+    )
+    weights = pexConfig.DictField(
+        doc="Weight of each algorithm in the consensus; algorithms not listed get a weight of 1",
+        keytype=str,
+        itemtype=float,
+        default={},
+    )
+    zmin = pexConfig.Field(doc="Lower edge of the common redshift grid", dtype=float, default=0.0)
+    zmax = pexConfig.Field(doc="Upper edge of the common redshift grid", dtype=float, default=3.0)
+    nzbins = pexConfig.Field(doc="Number of points in the common redshift grid", dtype=int, default=301)
+    write_algo_ensembles = pexConfig.Field(
+        doc="Also write the p(z) estimates of each algorithm",
+        dtype=bool,
+        default=False,
+    )
+    id_column = pexConfig.Field(
+        doc="Object ID column copied to the disagreement metrics",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.algorithms.names = [
+            algo_name for algo_name in ["dnf", "fzboost", "gpz", "tpz"] if algo_name in pz_algo_registry
+        ]
+
+    def validate(self) -> None:
+        super().validate()
+        if not self.algorithms.names:
+            raise ValueError("Need at least one algorithm to build a consensus")
+
+
+class EstimatePZConsensusTask(PipelineTask):
+    """Task that runs several p(z) algorithms and combines their estimates
+
+    All of the algorithms are run in the same quantum, on the same
+    catalog, and their PDFs are resampled to a common grid in memory.
+    Only the weighted consensus and the disagreement metrics are
+    written, unless write_algo_ensembles is set.
+    """
+
+    ConfigClass = EstimatePZConsensusConfig
+    _DefaultName = "estimatePZConsensus"
+
+    def __init__(self, initInputs: dict[str, Any] | None = None, **kwargs: Any):
+        super().__init__(initInputs=initInputs, **kwargs)
+        self.algo_tasks = {}
+        for algo_name in self.config.algorithms.names:
+            self.algo_tasks[algo_name] = self.config.algorithms.registry[algo_name](
+                config=self.config.algorithms[algo_name],
+                name=f"pz_{algo_name}",
+                parentTask=self,
+            )
+
+    def col_names(self) -> list[str]:
+        """Return the union of the columns needed by all the algorithms"""
+        col_names = [] if self.config.id_column is None else [self.config.id_column]
+        for algo_task in self.algo_tasks.values():
+            col_names += [col_ for col_ in algo_task.col_names() if col_ not in col_names]
+        return col_names
+
+    def runQuantum(
+        self,
+        butlerQC: QuantumContext,
+        inputRefs: InputQuantizedConnection,
+        outputRefs: OutputQuantizedConnection,
+    ) -> None:
+        inputs = butlerQC.get(inputRefs)
+        pz_models = {algo_name: inputs.pop(f"pzModel_{algo_name}") for algo_name in self.algo_tasks}
+        # What is left is the deferred handle to the input catalog
+        (catalog_handle,) = inputs.values()
+        fluxes = catalog_handle.get(parameters=dict(columns=self.col_names()))
+        outputs = self.run(pz_models, fluxes)
+        butlerQC.put(outputs, outputRefs)
+
+    def run(self, pz_models: dict[str, Model], fluxes: Table) -> Struct:
+        zgrid = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins)
+        ret_struct = Struct()
+        pdfs = {}
+        for algo_name, algo_task in self.algo_tasks.items():
+            algo_ensemble = algo_task.estimate(pz_models[algo_name], fluxes)
+            pdfs[algo_name] = pdfs_on_grid(algo_ensemble, zgrid)
+            if self.config.write_algo_ensembles:
+                setattr(ret_struct, f"pzEnsemble_{algo_name}", algo_ensemble)
+            del algo_ensemble
+
+        consensus, metrics = combine_pdfs(pdfs, zgrid, dict(self.config.weights))
+        del pdfs
+        if self.config.id_column is not None:
+            metrics.add_column(np.asarray(fluxes[self.config.id_column]), name=self.config.id_column, index=0)
+
+        pz_ensemble = qp.Ensemble(qp.interp, data=dict(xvals=zgrid, yvals=consensus))
+        pz_ensemble.set_ancil(dict(zmode=np.asarray(metrics["z_consensus_mode"])))
+        ret_struct.pzEnsemble = pz_ensemble
+        ret_struct.pzDisagreement = metrics
+        return ret_struct
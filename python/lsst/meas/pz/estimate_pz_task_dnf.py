@@ -26,18 +26,21 @@ __all__ = [
     "EstimatePZDNFConfig",
 ]
 
+import lsst.pex.config as pexConfig
+from rail.core.model import Model
 from rail.estimation.algos.dnf import DNFEstimator
 from rail.estimation.estimator import CatEstimator
 
-from .estimate_pz_task import (
-    EstimatePZAlgoConfigBase,
-    EstimatePZAlgoTask,
-    EstimatePZTask,
-    EstimatePZTaskConfig,
+from .extensions.ann_index import ApproxNeighborsConfig, IVFIndex
+from .extensions.estimate_pz_task_base import (
+    EstimatePZExtAlgoConfigBase,
+    EstimatePZExtAlgoTask,
+    EstimatePZExtTask,
+    EstimatePZExtTaskConfig,
 )
 
 
-class EstimatePZDNFAlgoConfig(EstimatePZAlgoConfigBase):
+class EstimatePZDNFAlgoConfig(EstimatePZExtAlgoConfigBase):
     """Config for EstimatePZDNFAlgoTask
 
     This will select and configure the DNFEstimator p(z)
@@ -45,15 +48,30 @@ class EstimatePZDNFAlgoConfig(EstimatePZAlgoConfigBase):
 
     """
 
+    approx_neighbors = pexConfig.ConfigField(
+        doc="Approximate search for the preselected training neighbours",
+        dtype=ApproxNeighborsConfig,
+    )
+
     @classmethod
     def estimator_class(cls) -> type[CatEstimator]:
         return DNFEstimator
 
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.stage_name = "dnf"
+        self.output_mode = "return"
+        self.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+        self.bands = self.get_mag_name_list()
+        self.err_bands = self.get_mag_err_name_list()
+        self.mag_limits = self.get_mag_lim_dict()
+        self.band_a_env = self.get_band_a_env_dict()
+
 
 EstimatePZDNFAlgoConfig._make_fields()
 
 
-class EstimatePZDNFAlgoTask(EstimatePZAlgoTask):
+class EstimatePZDNFAlgoTask(EstimatePZExtAlgoTask):
     """SubTask that runs RAIL DNF algorithm for p(z) estimation
 
     See https://github.com/LSSTDESC/rail_dnf/blob/main/src/rail/estimation/algos/dnf.py  # noqa
@@ -64,8 +82,26 @@ class EstimatePZDNFAlgoTask(EstimatePZAlgoTask):
     ConfigClass = EstimatePZDNFAlgoConfig
     _DefaultName = "estimatePZDNFAlgo"
 
-
-class EstimatePZDNFConfig(EstimatePZTaskConfig):
+    def get_stage(self, pz_model: Model) -> CatEstimator:
+        stage = super().get_stage(pz_model)
+        approx_config = self.config.approx_neighbors
+        if not approx_config.enabled:
+            return stage
+        if stage.model is None:
+            stage.open_model(**stage.config)
+        if not isinstance(stage.clf, IVFIndex):
+            # DNF only uses the kneighbors method of its fitted scikit-learn
+            # estimator, which the index provides
+            stage.clf = IVFIndex(
+                stage.train_mag,
+                n_cells=approx_config.n_cells,
+                n_probe=approx_config.n_probe,
+                seed=approx_config.seed,
+            )
+        return stage
+
+
+class EstimatePZDNFConfig(EstimatePZExtTaskConfig):
     """Config for EstimatePZDNFTask
 
     Overrides setDefaults to use DNF algorithm
@@ -73,16 +109,9 @@ class EstimatePZDNFConfig(EstimatePZTaskConfig):
 
     def setDefaults(self) -> None:
         self.pz_algo.retarget(EstimatePZDNFAlgoTask)
-        self.pz_algo.stage_name = "dnf"
-        self.pz_algo.output_mode = "return"
-        self.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-        self.pz_algo.bands = self.pz_algo.get_mag_name_list()
-        self.pz_algo.err_bands = self.pz_algo.get_mag_err_name_list()
-        self.pz_algo.mag_limits = self.pz_algo.get_mag_lim_dict()
-        self.pz_algo.band_a_env = self.pz_algo.get_band_a_env_dict()
 
 
-class EstimatePZDNFTask(EstimatePZTask):
+class EstimatePZDNFTask(EstimatePZExtTask):
     """Task that runs RAIL DNF algorithm for p(z) estimation"""
 
     ConfigClass = EstimatePZDNFConfig
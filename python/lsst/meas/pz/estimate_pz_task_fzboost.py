@@ -26,18 +26,26 @@ __all__ = [
     "EstimatePZFZBoostConfig",
 ]
 
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from rail.core.model import Model
 from rail.estimation.algos.flexzboost import FlexZBoostEstimator
 from rail.estimation.estimator import CatEstimator
 
-from .estimate_pz_task import (
-    EstimatePZAlgoConfigBase,
-    EstimatePZAlgoTask,
-    EstimatePZTask,
-    EstimatePZTaskConfig,
+from .extensions.estimate_pz_task_base import (
+    EstimatePZExtAlgoConfigBase,
+    EstimatePZExtAlgoTask,
+    EstimatePZExtTask,
+    EstimatePZExtTaskConfig,
 )
+from .extensions.flexcode_batch import BatchedFlexCodeModel
+from .extensions.pdf_grid import grid_ensemble, normalize_pdfs
 
 
-class EstimatePZFZBoostAlgoConfig(EstimatePZAlgoConfigBase):
+class EstimatePZFZBoostAlgoConfig(EstimatePZExtAlgoConfigBase):
     """Config for EstimatePZFZBoostAlgoTask
 
     This will select and configure the FlexZBoostEstimator p(z)
@@ -45,15 +53,38 @@ class EstimatePZFZBoostAlgoConfig(EstimatePZAlgoConfigBase):
 
     """
 
+    batched_predict = pexConfig.Field(
+        doc="Evaluate the conditional densities of a whole chunk at once, with a cached "
+        "basis matrix and vectorized post-processing, instead of row by row in flexcode",
+        dtype=bool,
+        default=True,
+    )
+
     @classmethod
     def estimator_class(cls) -> type[CatEstimator]:
         return FlexZBoostEstimator
 
+    def supports_float32(self) -> bool:
+        # Only the batched densities are computed in our floating point
+        # type; flexcode itself works in float64
+        return self.batched_predict
+
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.stage_name = "fzboost"
+        self.output_mode = "return"
+        self.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+        self.ref_band = self.mag_template.format(band='i')
+        self.bands = self.get_mag_name_list()
+        self.err_bands = self.get_mag_err_name_list()
+        self.mag_limits = self.get_mag_lim_dict()
+        self.band_a_env = self.get_band_a_env_dict()
+
 
 EstimatePZFZBoostAlgoConfig._make_fields()
 
 
-class EstimatePZFZBoostAlgoTask(EstimatePZAlgoTask):
+class EstimatePZFZBoostAlgoTask(EstimatePZExtAlgoTask):
     """SubTask that runs RAIL FZBoost algorithm for p(z) estimation
 
     See https://github.com/LSSTDESC/rail_flexzboost/blob/main/src/rail/estimation/algos/flexzboost.py.py  # noqa
@@ -63,9 +94,108 @@ class EstimatePZFZBoostAlgoTask(EstimatePZAlgoTask):
 
     ConfigClass = EstimatePZFZBoostAlgoConfig
     _DefaultName = "estimatePZFZBoostAlgo"
-
-
-class EstimatePZFZBoostConfig(EstimatePZTaskConfig):
+    small_batch_latency_ms = 20.0
+    # The basis expansion, the densities and the normalization temporaries
+    grid_arrays_per_object = 8
+
+    def get_stage(self, pz_model: Model) -> CatEstimator:
+        stage = super().get_stage(pz_model)
+        if self.config.batched_predict and not isinstance(stage.model, BatchedFlexCodeModel):
+            if stage.model is None:
+                stage.open_model(**stage.config)
+            stage.model = BatchedFlexCodeModel(stage.model, dtype=self.dtype)
+        return stage
+
+    def _color_features(self, stage_config: Any, mags: np.ndarray, mag_errs: np.ndarray) -> np.ndarray:
+        """Build the FlexZBoost features from magnitude and error arrays
+
+        This matches the non-detection replacement and
+        `rail.estimation.algos.flexzboost.make_color_data` in
+        `FlexZBoostEstimator`, without modifying the inputs.
+        """
+        mag_names, err_names = self.array_columns()
+        bands = list(stage_config.bands)
+        band_mags = mags[:, [mag_names.index(band_) for band_ in bands]]
+        band_errs = mag_errs[:, [err_names.index(band_) for band_ in stage_config.err_bands]]
+        if np.isnan(stage_config.nondetect_val):
+            nondetect = np.isnan(band_mags)
+        else:
+            nondetect = np.isclose(band_mags, stage_config.nondetect_val, atol=0.01)
+        np.copyto(band_mags, np.array([stage_config.mag_limits[band_] for band_ in bands]), where=nondetect)
+        band_errs[nondetect] = 1.0
+
+        colors = band_mags[:, :-1] - band_mags[:, 1:]
+        ref_mag = band_mags[:, [bands.index(stage_config.ref_band)]]
+        if not stage_config.include_mag_err:
+            return np.hstack([ref_mag, colors])
+        color_errs = np.sqrt(band_errs[:, :-1] ** 2 + band_errs[:, 1:] ** 2)
+        # Each color is followed by its error
+        return np.hstack([ref_mag, np.stack([colors, color_errs], axis=2).reshape(len(mags), -1)])
+
+    def _has_fast_path(self, stage: CatEstimator, zgrid: np.ndarray) -> bool:
+        """Whether the batched model can write the densities on a grid
+        directly
+
+        The fast path evaluates the densities within the redshift range of
+        the model, which must then be the range of the grid.
+        """
+        return (
+            self.config.batched_predict
+            and stage.config.qp_representation == "interp"
+            and np.isclose(stage.model.z_min, zgrid[0])
+            and np.isclose(stage.model.z_max, zgrid[-1])
+        )
+
+    def estimate_mags(self, pz_model: Model, mags: dict[str, np.ndarray], n_rows: int) -> qp.Ensemble:
+        stage = self.get_stage(pz_model)
+        if self.config.zgrid_path is None or not self._has_fast_path(stage, self.output_zgrid):
+            return super().estimate_mags(pz_model, mags, n_rows)
+        # Evaluate on the non-uniform grid rather than resample the
+        # densities of the stage
+        out = np.empty((n_rows, self.output_zgrid.size), dtype=self.dtype)
+        return self.estimate_mags_into(pz_model, mags, n_rows, out)
+
+    def estimate_mags_into(
+        self,
+        pz_model: Model,
+        mags: dict[str, np.ndarray],
+        n_rows: int,
+        out: np.ndarray,
+    ) -> qp.Ensemble:
+        stage = self.get_stage(pz_model)
+        zgrid = self.output_zgrid
+        if not self._has_fast_path(stage, zgrid) or out.shape != (n_rows, zgrid.size):
+            return super().estimate_mags_into(pz_model, mags, n_rows, out)
+
+        mag_names, err_names = self.array_columns()
+        features = self._color_features(
+            stage.config,
+            np.column_stack([mags[name_] for name_ in mag_names]),
+            np.column_stack([mags[name_] for name_ in err_names]),
+        )
+        # The evenly spaced grid keeps the exact flexcode post-processing
+        z_grid = None if self.config.zgrid_path is None else zgrid
+        stage.model.predict(features, zgrid.size, out=out, z_grid=z_grid)
+        normalize_pdfs(out, zgrid)
+        return self._finish_stage_output(stage, grid_ensemble(zgrid, out), mags, n_rows)
+
+    def estimate_array(
+        self,
+        pz_model: Model,
+        mags: np.ndarray,
+        mag_errs: np.ndarray,
+        out: np.ndarray | None = None,
+    ) -> np.ndarray:
+        stage = self.get_stage(pz_model)
+        if not self._has_fast_path(stage, self.zgrid):
+            return super().estimate_array(pz_model, mags, mag_errs, out=out)
+
+        features = self._color_features(stage.config, mags, mag_errs)
+        cdes, _ = stage.model.predict(features, self.zgrid.size, out=out)
+        return normalize_pdfs(cdes, self.zgrid)
+
+
+class EstimatePZFZBoostConfig(EstimatePZExtTaskConfig):
     """Config for EstimatePZFZBoostTask
 
     Overrides setDefaults to use FZBoost algorithm
@@ -73,17 +203,9 @@ class EstimatePZFZBoostConfig(EstimatePZTaskConfig):
 
     def setDefaults(self) -> None:
         self.pz_algo.retarget(EstimatePZFZBoostAlgoTask)
-        self.pz_algo.stage_name = "fzboost"
-        self.pz_algo.output_mode = "return"
-        self.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-        self.pz_algo.ref_band = self.pz_algo.mag_template.format(band='i')
-        self.pz_algo.bands = self.pz_algo.get_mag_name_list()
-        self.pz_algo.err_bands = self.pz_algo.get_mag_err_name_list()
-        self.pz_algo.mag_limits = self.pz_algo.get_mag_lim_dict()
-        self.pz_algo.band_a_env = self.pz_algo.get_band_a_env_dict()
 
 
-class EstimatePZFZBoostTask(EstimatePZTask):
+class EstimatePZFZBoostTask(EstimatePZExtTask):
     """Task that runs RAIL FZBoost algorithm for p(z) estimation"""
 
     ConfigClass = EstimatePZFZBoostConfig
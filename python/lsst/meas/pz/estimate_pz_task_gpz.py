@@ -26,18 +26,26 @@ __all__ = [
     "EstimatePZGPZConfig",
 ]
 
+from collections.abc import Mapping
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from rail.core.model import Model
 from rail.estimation.algos.gpz import GPzEstimator
 from rail.estimation.estimator import CatEstimator
 
-from .estimate_pz_task import (
-    EstimatePZAlgoConfigBase,
-    EstimatePZAlgoTask,
-    EstimatePZTask,
-    EstimatePZTaskConfig,
+from .extensions.estimate_pz_task_base import (
+    EstimatePZExtAlgoConfigBase,
+    EstimatePZExtAlgoTask,
+    EstimatePZExtTask,
+    EstimatePZExtTaskConfig,
 )
+from .extensions.gpz_batch import gaussian_mode, gaussian_pdfs, predict_gaussian, prepare_features
 
 
-class EstimatePZGPZAlgoConfig(EstimatePZAlgoConfigBase):
+class EstimatePZGPZAlgoConfig(EstimatePZExtAlgoConfigBase):
     """Config for EstimatePZGPZAlgoTask
 
     This will select and configure the GPzEstimator p(z)
@@ -45,15 +53,44 @@ class EstimatePZGPZAlgoConfig(EstimatePZAlgoConfigBase):
 
     """
 
+    batched_predict = pexConfig.Field(
+        doc="Prepare the features and predict with array operations on the whole chunk, "
+        "instead of going through GPzEstimator",
+        dtype=bool,
+        default=True,
+    )
+    predict_block_size = pexConfig.Field(
+        doc="Number of objects predicted together when batched_predict is set",
+        dtype=int,
+        default=10000,
+    )
+
     @classmethod
     def estimator_class(cls) -> type[CatEstimator]:
         return GPzEstimator
 
+    def supports_float32(self) -> bool:
+        # Only the batched prediction runs in our floating point type;
+        # GPzEstimator works in float64
+        return self.batched_predict
+
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.stage_name = "gpz"
+        self.output_mode = "return"
+        self.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+        self.ref_band = self.mag_template.format(band='i')
+        self.bands = self.get_mag_name_list()
+        self.err_bands = self.get_mag_err_name_list()
+        self.mag_limits = self.get_mag_lim_dict()
+        self.band_a_env = self.get_band_a_env_dict()
+        self.replace_error_vals = [0.1, 0.1, 0.1, 0.1, 0.1, 0.1]
+
 
 EstimatePZGPZAlgoConfig._make_fields()
 
 
-class EstimatePZGPZAlgoTask(EstimatePZAlgoTask):
+class EstimatePZGPZAlgoTask(EstimatePZExtAlgoTask):
     """SubTask that runs RAIL GPZ algorithm for p(z) estimation
 
     See https://github.com/LSSTDESC/rail_gpz_v1/blob/src/rail/estimation/algos/gpz.py  # noqa
@@ -63,9 +100,82 @@ class EstimatePZGPZAlgoTask(EstimatePZAlgoTask):
 
     ConfigClass = EstimatePZGPZAlgoConfig
     _DefaultName = "estimatePZGPZAlgo"
-
-
-class EstimatePZGPZConfig(EstimatePZTaskConfig):
+    small_batch_latency_ms = 5.0
+
+    def __init__(self, initInputs: dict[str, Any] | None = None, **kwargs: Any):
+        super().__init__(initInputs=initInputs, **kwargs)
+        self._features: np.ndarray | None = None
+
+    def _get_features_buffer(self, n_rows: int, n_features: int) -> np.ndarray:
+        """Return a feature array for n_rows objects, reusing the last one"""
+        if (
+            self._features is None
+            or self._features.shape[0] < n_rows
+            or self._features.shape[1] != n_features
+            or self._features.dtype != self.dtype
+        ):
+            self._features = np.empty((n_rows, n_features), dtype=self.dtype)
+        return self._features[:n_rows]
+
+    def _predict(
+        self,
+        pz_model: Model,
+        mags: Mapping[str, np.ndarray],
+        n_rows: int,
+    ) -> tuple[CatEstimator, np.ndarray, np.ndarray]:
+        """Return the warm stage, and the predicted means and variances"""
+        stage = self.get_stage(pz_model)
+        if stage.model is None:
+            stage.open_model(**stage.config)
+        stage_config = stage.config
+        features = prepare_features(
+            mags,
+            stage_config.bands,
+            stage_config.err_bands,
+            stage_config.nondetect_val,
+            stage_config.mag_limits,
+            stage_config.log_errors,
+            stage_config.replace_error_vals,
+            out=self._get_features_buffer(n_rows, 2 * len(stage_config.bands)),
+        )
+        mean, var = predict_gaussian(
+            stage.model, features, block_size=self.config.predict_block_size, dtype=self.dtype
+        )
+        return stage, mean, var
+
+    def estimate_mags(self, pz_model: Model, mags: dict[str, np.ndarray], n_rows: int) -> qp.Ensemble:
+        if not self.config.batched_predict:
+            return super().estimate_mags(pz_model, mags, n_rows)
+
+        stage, mean, var = self._predict(pz_model, mags, n_rows)
+        pz_ensemble = qp.Ensemble(
+            qp.stats.norm,
+            data=dict(loc=mean[:, np.newaxis], scale=np.sqrt(var)[:, np.newaxis]),
+        )
+        pz_ensemble.set_ancil(dict(zmode=gaussian_mode(mean, self.zgrid)[:, np.newaxis]))
+        return self._finish_stage_output(stage, pz_ensemble, mags, n_rows)
+
+    def estimate_array(
+        self,
+        pz_model: Model,
+        mags: np.ndarray,
+        mag_errs: np.ndarray,
+        out: np.ndarray | None = None,
+    ) -> np.ndarray:
+        if not self.config.batched_predict:
+            return super().estimate_array(pz_model, mags, mag_errs, out=out)
+
+        # prepare_features leaves its inputs alone, so views are enough
+        mag_names, err_names = self.array_columns()
+        columns = {name_: mags[:, idx_] for idx_, name_ in enumerate(mag_names)}
+        columns.update({name_: mag_errs[:, idx_] for idx_, name_ in enumerate(err_names)})
+        _, mean, var = self._predict(pz_model, columns, mags.shape[0])
+        if out is None:
+            out = np.empty((mags.shape[0], self.zgrid.size), dtype=self.dtype)
+        return gaussian_pdfs(mean, var, self.zgrid, out=out)
+
+
+class EstimatePZGPZConfig(EstimatePZExtTaskConfig):
     """Config for EstimatePZGPZTask
 
     Overrides setDefaults to use GPZ algorithm
@@ -73,18 +183,9 @@ class EstimatePZGPZConfig(EstimatePZTaskConfig):
 
     def setDefaults(self) -> None:
         self.pz_algo.retarget(EstimatePZGPZAlgoTask)
-        self.pz_algo.stage_name = "gpz"
-        self.pz_algo.output_mode = "return"
-        self.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-        self.pz_algo.ref_band = self.pz_algo.mag_template.format(band='i')
-        self.pz_algo.bands = self.pz_algo.get_mag_name_list()
-        self.pz_algo.err_bands = self.pz_algo.get_mag_err_name_list()
-        self.pz_algo.mag_limits = self.pz_algo.get_mag_lim_dict()
-        self.pz_algo.band_a_env = self.pz_algo.get_band_a_env_dict()
-        self.pz_algo.replace_error_vals = [0.1, 0.1, 0.1, 0.1, 0.1, 0.1]
-
-
-class EstimatePZGPZTask(EstimatePZTask):
+
+
+class EstimatePZGPZTask(EstimatePZExtTask):
     """Task that runs RAIL GPZ algorithm for p(z) estimation"""
 
     ConfigClass = EstimatePZGPZConfig
@@ -26,18 +26,33 @@ __all__ = [
     "EstimatePZLephareConfig",
 ]
 
+import os
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from rail.core.model import Model
 from rail.estimation.algos.lephare import LephareEstimator
 from rail.estimation.estimator import CatEstimator
 
-from .estimate_pz_task import (
-    EstimatePZAlgoConfigBase,
-    EstimatePZAlgoTask,
-    EstimatePZTask,
-    EstimatePZTaskConfig,
+from .extensions.estimate_pz_task_base import (
+    EstimatePZExtAlgoConfigBase,
+    EstimatePZExtAlgoTask,
+    EstimatePZExtTask,
+    EstimatePZExtTaskConfig,
+)
+from .extensions.pdf_grid import grid_ensemble
+from .extensions.template_fit import (
+    TemplateGrid,
+    build_lephare_grid,
+    fit_block_bytes,
+    fit_template_grid,
+    library_key,
 )
 
 
-class EstimatePZLephareAlgoConfig(EstimatePZAlgoConfigBase):
+class EstimatePZLephareAlgoConfig(EstimatePZExtAlgoConfigBase):
     """Config for EstimatePZLephareAlgoTask
 
     This will select and configure the LephareEstimator p(z)
@@ -45,15 +60,60 @@ class EstimatePZLephareAlgoConfig(EstimatePZAlgoConfigBase):
 
     """
 
+    fit_method = pexConfig.ChoiceField(
+        doc="How to fit the templates",
+        dtype=str,
+        default="lephare",
+        allowed={
+            "lephare": "Run the Lephare library through the RAIL estimator",
+            "template_grid": "Vectorized chi-square fit against the model magnitude grid of the "
+            "Lephare library of the model.  This is a different estimator from Lephare: it applies "
+            "no Lephare priors and treats upper limits as missing bands, so its p(z) differ from "
+            "those of the 'lephare' method and must be validated on their own",
+        },
+    )
+    template_grid_path = pexConfig.Field(
+        doc="Path, without extension, of the model magnitude grid used with "
+        "fit_method='template_grid'; it is memory-mapped if it exists, and built from the "
+        "library of the model and written there otherwise.  A grid written for another "
+        "library or other bands is refused.  If not set the grid is built in memory by each "
+        "process",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    fit_block_size = pexConfig.Field(
+        doc="Number of objects fit together with fit_method='template_grid'; each of the "
+        "fit_n_workers threads holds about 200 kB of temporaries per object of its block, which "
+        "counts against memory_budget_mb",
+        dtype=int,
+        default=10000,
+    )
+    fit_n_workers = pexConfig.Field(
+        doc="Number of threads fitting blocks of objects with fit_method='template_grid'",
+        dtype=int,
+        default=1,
+    )
+
     @classmethod
     def estimator_class(cls) -> type[CatEstimator]:
         return LephareEstimator
 
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.stage_name = "lephare"
+        self.output_mode = "return"
+        self.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+        self.bands = self.get_mag_name_list()
+        self.err_bands = self.get_mag_err_name_list()
+        self.mag_limits = self.get_mag_lim_dict()
+        self.band_a_env = self.get_band_a_env_dict()
+
 
 EstimatePZLephareAlgoConfig._make_fields()
 
 
-class EstimatePZLephareAlgoTask(EstimatePZAlgoTask):
+class EstimatePZLephareAlgoTask(EstimatePZExtAlgoTask):
     """SubTask that runs RAIL Lephare algorithm for p(z) estimation
 
     See https://github.com/LSSTDESC/rail_lephare/blob/src/rail/estimation/algos/lephare.py  # noqa
@@ -62,13 +122,112 @@ class EstimatePZLephareAlgoTask(EstimatePZAlgoTask):
     Lephare estimates the p(z) distribution by taking
     a weighted mixture of the nearest neigheboors in
     color space.
+
+    With ``fit_method="template_grid"`` the p(z) come instead from a
+    chi-square fit of the galaxy templates of the Lephare library,
+    marginalized over templates with flat priors.  Lephare priors are not
+    applied and magnitudes at ``nondetect_val`` are dropped rather than
+    used as upper limits, so this is a different estimator, not a faster
+    implementation of Lephare.
     """
 
     ConfigClass = EstimatePZLephareAlgoConfig
     _DefaultName = "estimatePZLephareAlgo"
 
-
-class EstimatePZLephareConfig(EstimatePZTaskConfig):
+    # The Lephare fit keeps likelihoods per template family on the redshift
+    # grid; the template grid fit adds fixed size temporaries instead, see
+    # chunk_overhead_bytes
+    grid_arrays_per_object = 16
+
+    def __init__(self, initInputs: dict[str, Any] | None = None, **kwargs: Any):
+        super().__init__(initInputs=initInputs, **kwargs)
+        self._template_grid: TemplateGrid | None = None
+        self._template_grid_model: Model | None = None
+
+    def template_grid(self, pz_model: Model) -> TemplateGrid:
+        """Return the model magnitude grid of the Lephare library of a model
+
+        The grid is read from ``template_grid_path`` if it exists there,
+        and otherwise built from the library the model was prepared with,
+        through the estimator stage, which points Lephare at the run
+        directory of the model.
+
+        Raises
+        ------
+        ValueError
+            Raised if the grid at ``template_grid_path`` was built from
+            another library or for other bands.
+        """
+        path = self.config.template_grid_path
+        if self._template_grid is None or self._template_grid_model is not pz_model:
+            stage = self.get_stage(pz_model)
+            bands = list(self.config.bands)
+            if path is not None and os.path.exists(f"{path}.npy"):
+                grid = TemplateGrid.load(path)
+                if grid.key != library_key(stage.lephare_config, bands):
+                    raise ValueError(
+                        f"Template grid {path} was not built from the library of this model "
+                        f"for bands {bands}; remove it or set another template_grid_path"
+                    )
+            else:
+                grid = build_lephare_grid(stage.lephare_config, bands)
+                if path is not None:
+                    grid.save(path)
+                    grid = TemplateGrid.load(path)
+            self._template_grid = grid
+            self._template_grid_model = pz_model
+        return self._template_grid
+
+    def chunk_overhead_bytes(self) -> int:
+        if self.config.fit_method == "lephare":
+            return super().chunk_overhead_bytes()
+        n_z = 0 if self._template_grid is None else self._template_grid.zgrid.size
+        return self.config.fit_n_workers * fit_block_bytes(self.config.fit_block_size, n_z)
+
+    def _fit_templates(
+        self,
+        pz_model: Model,
+        mags: dict[str, np.ndarray],
+        out: np.ndarray | None = None,
+    ) -> qp.Ensemble:
+        """Estimate by fitting the template grid, optionally into ``out``"""
+        grid = self.template_grid(pz_model)
+        if grid.bands != list(self.config.bands):
+            raise ValueError(
+                f"Template grid bands {grid.bands} do not match configured bands {list(self.config.bands)}"
+            )
+        zgrid = self.output_zgrid
+        pdfs = fit_template_grid(
+            grid,
+            np.column_stack([mags[band_] for band_ in self.config.bands]),
+            np.column_stack([mags[band_] for band_ in self.config.err_bands]),
+            zgrid,
+            nondetect_val=getattr(self.config, "nondetect_val", 99.0),
+            block_size=self.config.fit_block_size,
+            n_workers=self.config.fit_n_workers,
+            out=out,
+        )
+        # The fitted PDFs are already normalized
+        return grid_ensemble(zgrid, pdfs, dict(zmode=zgrid[np.argmax(pdfs, axis=1)]))
+
+    def estimate_mags(self, pz_model: Model, mags: dict[str, np.ndarray], n_rows: int) -> qp.Ensemble:
+        if self.config.fit_method == "lephare":
+            return super().estimate_mags(pz_model, mags, n_rows)
+        return self._fit_templates(pz_model, mags)
+
+    def estimate_mags_into(
+        self,
+        pz_model: Model,
+        mags: dict[str, np.ndarray],
+        n_rows: int,
+        out: np.ndarray,
+    ) -> qp.Ensemble:
+        if self.config.fit_method == "lephare":
+            return super().estimate_mags_into(pz_model, mags, n_rows, out)
+        return self._fit_templates(pz_model, mags, out=out)
+
+
+class EstimatePZLephareConfig(EstimatePZExtTaskConfig):
     """Config for EstimatePZLephareTask
 
     Overrides setDefaults to use Lephare algorithm
@@ -76,16 +235,9 @@ class EstimatePZLephareConfig(EstimatePZTaskConfig):
 
     def setDefaults(self) -> None:
         self.pz_algo.retarget(EstimatePZLephareAlgoTask)
-        self.pz_algo.stage_name = "lephare"
-        self.pz_algo.output_mode = "return"
-        self.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-        self.pz_algo.bands = self.pz_algo.get_mag_name_list()
-        self.pz_algo.err_bands = self.pz_algo.get_mag_err_name_list()
-        self.pz_algo.mag_limits = self.pz_algo.get_mag_lim_dict()
-        self.pz_algo.band_a_env = self.pz_algo.get_band_a_env_dict()
 
 
-class EstimatePZLephareTask(EstimatePZTask):
+class EstimatePZLephareTask(EstimatePZExtTask):
     """Task that runs RAIL Lephare algorithm for p(z) estimation"""
 
     ConfigClass = EstimatePZLephareConfig
@@ -29,15 +29,15 @@ __all__ = [
 from rail.estimation.algos.tpz_lite import TPZliteEstimator
 from rail.estimation.estimator import CatEstimator
 
-from .estimate_pz_task import (
-    EstimatePZAlgoConfigBase,
-    EstimatePZAlgoTask,
-    EstimatePZTask,
-    EstimatePZTaskConfig,
+from .extensions.estimate_pz_task_base import (
+    EstimatePZExtAlgoConfigBase,
+    EstimatePZExtAlgoTask,
+    EstimatePZExtTask,
+    EstimatePZExtTaskConfig,
 )
 
 
-class EstimatePZTPZAlgoConfig(EstimatePZAlgoConfigBase):
+class EstimatePZTPZAlgoConfig(EstimatePZExtAlgoConfigBase):
     """Config for EstimatePZTPZAlgoTask
 
     This will select and configure the TPZliteEstimator p(z)
@@ -51,11 +51,19 @@ class EstimatePZTPZAlgoConfig(EstimatePZAlgoConfigBase):
     def estimator_class(cls) -> type[CatEstimator]:
         return TPZliteEstimator
 
+    def setDefaults(self) -> None:
+        super().setDefaults()
+        self.stage_name = "tpz"
+        self.output_mode = "return"
+        self.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+        self.mag_limits = self.get_mag_lim_dict()
+        self.band_a_env = self.get_band_a_env_dict()
+
 
 EstimatePZTPZAlgoConfig._make_fields()
 
 
-class EstimatePZTPZAlgoTask(EstimatePZAlgoTask):
+class EstimatePZTPZAlgoTask(EstimatePZExtAlgoTask):
     """SubTask that runs RAIL TPZ algorithm for p(z) estimation
 
     See https://github.com/LSSTDESC/rail_tpz/blob/src/rail/estimation/algos/tpz_lite.py  # noqa
@@ -66,7 +74,7 @@ class EstimatePZTPZAlgoTask(EstimatePZAlgoTask):
     _DefaultName = "estimatePZTPZAlgo"
 
 
-class EstimatePZTPZConfig(EstimatePZTaskConfig):
+class EstimatePZTPZConfig(EstimatePZExtTaskConfig):
     """Config for EstimatePZTPZTask
 
     Overrides setDefaults to use TPZ algorithm
@@ -74,14 +82,9 @@ class EstimatePZTPZConfig(EstimatePZTaskConfig):
 
     def setDefaults(self) -> None:
         self.pz_algo.retarget(EstimatePZTPZAlgoTask)
-        self.pz_algo.stage_name = "tpz"
-        self.pz_algo.output_mode = "return"
-        self.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-        self.pz_algo.mag_limits = self.pz_algo.get_mag_lim_dict()
-        self.pz_algo.band_a_env = self.pz_algo.get_band_a_env_dict()
 
 
-class EstimatePZTPZTask(EstimatePZTask):
+class EstimatePZTPZTask(EstimatePZExtTask):
     """Task that runs RAIL TPZ algorithm for p(z) estimation"""
 
     ConfigClass = EstimatePZTPZConfig
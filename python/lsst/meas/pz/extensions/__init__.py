@@ -20,3 +20,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from .version import *  # Generated by sconsUtils
+from .dataset_names import *
+from .hdf5_layout import *
+from .sharded_ensemble import *
+from .nz_accumulator import *
+from .estimate_pz_task_base import *
+from .reduce_nz_task import *
+from .subquanta import *
+from .pz_index import *
+from .pdf_grid import *
+from .consensus import *
+from .resources import *
+from .background_writer import *
+from .openmetrics import *
+from .template_fit import *
+from .ann_index import *
+from .presets import *
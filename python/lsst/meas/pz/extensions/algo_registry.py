@@ -0,0 +1,80 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Registry of the wrapped p(z) estimation algorithms.
+
+Each algorithm is registered under its short name if its RAIL package can
+be imported, so configs and tools that select algorithms by name only
+offer those that can run.  This module imports the wrapper task modules,
+so it is not imported by the package ``__init__``.
+"""
+
+__all__ = [
+    "pz_algo_registry",
+]
+
+import lsst.pex.config as pexConfig
+
+pz_algo_registry = pexConfig.makeRegistry(
+    doc="Registry of the wrapped algorithm specific p(z) estimation SubTasks"
+)
+
+try:
+    from ..estimate_pz_task_cmnn import EstimatePZCMNNAlgoTask
+
+    pz_algo_registry.register("cmnn", EstimatePZCMNNAlgoTask)
+except ImportError:
+    pass
+
+try:
+    from ..estimate_pz_task_dnf import EstimatePZDNFAlgoTask
+
+    pz_algo_registry.register("dnf", EstimatePZDNFAlgoTask)
+except ImportError:
+    pass
+
+try:
+    from ..estimate_pz_task_fzboost import EstimatePZFZBoostAlgoTask
+
+    pz_algo_registry.register("fzboost", EstimatePZFZBoostAlgoTask)
+except ImportError:
+    pass
+
+try:
+    from ..estimate_pz_task_gpz import EstimatePZGPZAlgoTask
+
+    pz_algo_registry.register("gpz", EstimatePZGPZAlgoTask)
+except ImportError:
+    pass
+
+try:
+    from ..estimate_pz_task_lephare import EstimatePZLephareAlgoTask
+
+    pz_algo_registry.register("lephare", EstimatePZLephareAlgoTask)
+except ImportError:
+    pass
+
+try:
+    from ..estimate_pz_task_tpz import EstimatePZTPZAlgoTask
+
+    pz_algo_registry.register("tpz", EstimatePZTPZAlgoTask)
+except ImportError:
+    pass
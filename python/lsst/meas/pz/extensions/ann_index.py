@@ -0,0 +1,309 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Approximate nearest neighbour search for the kNN based estimators.
+
+`IVFIndex` is an inverted file index: the training points are clustered
+with k-means, and a query only looks at the points of the ``n_probe``
+cells whose centers are closest to it.  ``n_probe`` trades accuracy for
+speed: probing every cell gives the exact answer.
+"""
+
+__all__ = [
+    "ApproxNeighborsConfig",
+    "IVFIndex",
+]
+
+import lsst.pex.config as pexConfig
+import numpy as np
+
+
+class ApproxNeighborsConfig(pexConfig.Config):
+    """Config for the approximate neighbour search of the kNN estimators"""
+
+    enabled = pexConfig.Field(
+        doc="Search neighbours with an approximate index instead of an exact search",
+        dtype=bool,
+        default=False,
+    )
+    n_cells = pexConfig.Field(
+        doc="Number of k-means cells of the index; 0 uses the square root of the training set size",
+        dtype=int,
+        default=0,
+    )
+    n_probe = pexConfig.Field(
+        doc="Number of cells searched per object; larger values are slower and closer to exact",
+        dtype=int,
+        default=8,
+    )
+    seed = pexConfig.Field(doc="Random seed for the k-means initialization", dtype=int, default=1234)
+
+    def validate(self) -> None:
+        super().validate()
+        if self.n_cells < 0 or self.n_probe < 1:
+            raise ValueError(f"Invalid n_cells={self.n_cells} or n_probe={self.n_probe}")
+
+
+def _sq_dist(x: np.ndarray, y: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+    """Squared distances between the rows of x and y
+
+    The optional weights apply to each coordinate, per row of x.
+    """
+    if weights is None:
+        weights = np.ones_like(x)
+    return (
+        np.sum(weights * x**2, axis=1)[:, np.newaxis]
+        - 2.0 * (weights * x) @ y.T
+        + weights @ (y**2).T
+    )
+
+
+def _fill_nan(points: np.ndarray, fill: np.ndarray) -> np.ndarray:
+    """Replace NaN coordinates by the matching value of fill"""
+    return np.where(np.isnan(points), fill, points)
+
+
+def _assign(
+    points: np.ndarray,
+    centers: np.ndarray,
+    fill: np.ndarray,
+    block_size: int = 8192,
+) -> np.ndarray:
+    """Return the index of the closest center of each point
+
+    NaN coordinates are replaced by those of ``fill``, one block of points
+    at a time.
+    """
+    labels = np.empty(points.shape[0], dtype=np.int64)
+    for start in range(0, points.shape[0], block_size):
+        block = _fill_nan(points[start:start + block_size], fill)
+        labels[start:start + block_size] = np.argmin(_sq_dist(block, centers), axis=1)
+    return labels
+
+
+class IVFIndex:
+    """Inverted file index over a set of points
+
+    Parameters
+    ----------
+    points
+        Points to index, shape ``(n_points, n_dim)``; they are kept without
+        a copy if already float64.  NaN coordinates are replaced by the
+        mean of their column for the clustering and the distances
+
+    n_cells
+        Number of k-means cells; 0 uses the square root of ``n_points``
+
+    n_probe
+        Default number of cells searched per query
+
+    n_iter
+        Number of k-means iterations
+
+    seed
+        Random seed for the choice of initial centers
+    """
+
+    def __init__(
+        self,
+        points: np.ndarray,
+        n_cells: int = 0,
+        n_probe: int = 8,
+        n_iter: int = 10,
+        seed: int = 1234,
+    ):
+        self.points = np.asarray(points, dtype=float)
+        self.n_probe = n_probe
+        n_points = self.points.shape[0]
+        self._col_means = np.nanmean(self.points, axis=0)
+        n_cells = min(n_cells or int(np.ceil(np.sqrt(n_points))), n_points)
+
+        # Fit the centers on a subsample, then assign every point
+        rng = np.random.default_rng(seed)
+        sample = self._filled(rng.choice(n_points, size=min(n_points, 256 * n_cells), replace=False))
+        centers = sample[rng.choice(sample.shape[0], size=n_cells, replace=False)]
+        for _ in range(n_iter):
+            labels = _assign(sample, centers, self._col_means)
+            counts = np.bincount(labels, minlength=n_cells)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, sample)
+            filled = counts > 0
+            centers[filled] = sums[filled] / counts[filled, np.newaxis]
+        self.centers = centers
+
+        labels = _assign(self.points, centers, self._col_means)
+        self._order = np.argsort(labels, kind="stable")
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_cells))])
+
+    @property
+    def n_cells(self) -> int:
+        """Number of cells"""
+        return self.centers.shape[0]
+
+    def _filled(self, rows: np.ndarray) -> np.ndarray:
+        """Return some points, with their NaN coordinates filled"""
+        return _fill_nan(self.points[rows], self._col_means)
+
+    def cell_members(self, cell: int) -> np.ndarray:
+        """Return the indices of the points in a cell"""
+        return self._order[self._offsets[cell]:self._offsets[cell + 1]]
+
+    def probe(
+        self,
+        queries: np.ndarray,
+        n_probe: int | None = None,
+        weights: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Return the ``n_probe`` cells closest to each query
+
+        Parameters
+        ----------
+        queries
+            Query points, shape ``(n_queries, n_dim)``
+
+        n_probe
+            Number of cells to return per query; defaults to ``self.n_probe``
+
+        weights
+            Optional per-query weights of each coordinate in the distance,
+            shape ``(n_queries, n_dim)``; NaN query coordinates get no weight
+
+        Returns
+        -------
+        cells
+            Cell indices, shape ``(n_queries, n_probe)``, closest first
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_cells)
+        if weights is None:
+            weights = np.ones_like(queries)
+        weights = np.where(np.isnan(queries), 0.0, weights)
+        queries = np.nan_to_num(queries)
+        cells = np.empty((queries.shape[0], n_probe), dtype=np.int64)
+        for start in range(0, queries.shape[0], 8192):
+            block = slice(start, start + 8192)
+            dist = _sq_dist(queries[block], self.centers, weights[block])
+            closest = np.argpartition(dist, n_probe - 1, axis=1)[:, :n_probe]
+            order = np.argsort(np.take_along_axis(dist, closest, axis=1), axis=1)
+            cells[block] = np.take_along_axis(closest, order, axis=1)
+        return cells
+
+    def candidates(self, cells: np.ndarray) -> np.ndarray:
+        """Return the indices of the points in a set of cells"""
+        return np.concatenate([self.cell_members(cell_) for cell_ in cells])
+
+    def kneighbors(
+        self,
+        queries: np.ndarray,
+        n_neighbors: int = 5,
+        return_distance: bool = True,
+        n_probe: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray] | np.ndarray:
+        """Find approximate euclidean nearest neighbours
+
+        This follows `sklearn.neighbors.KNeighborsMixin.kneighbors`, so the
+        index can stand in for a fitted scikit-learn estimator.  Queries
+        whose probed cells hold fewer than ``n_neighbors`` points are
+        searched exactly.
+
+        As in scikit-learn, the queries must not have NaN coordinates.
+
+        Parameters
+        ----------
+        queries
+            Query points, shape ``(n_queries, n_dim)``
+
+        n_neighbors
+            Number of neighbours to return per query
+
+        return_distance
+            Return the distances as well as the indices
+
+        n_probe
+            Number of cells searched per query; defaults to ``self.n_probe``
+
+        Returns
+        -------
+        distances
+            Distances to the neighbours, shape ``(n_queries, n_neighbors)``,
+            closest first; only returned if ``return_distance``
+
+        indices
+            Indices of the neighbours, shape ``(n_queries, n_neighbors)``
+
+        Raises
+        ------
+        ValueError
+            If a query has NaN coordinates
+        """
+        queries = np.asarray(queries, dtype=float)
+        bad_rows = np.flatnonzero(np.isnan(queries).any(axis=1))
+        if bad_rows.size:
+            raise ValueError(f"Queries contain NaN, e.g. in row {bad_rows[0]} of {bad_rows.size} such rows")
+        n_queries = queries.shape[0]
+        n_neighbors = min(n_neighbors, self.points.shape[0])
+        best_dist = np.full((n_queries, n_neighbors), np.inf)
+        best_idx = np.zeros((n_queries, n_neighbors), dtype=np.int64)
+
+        # Group the queries by probed cell, and search one cell at a time
+        cells = self.probe(queries, n_probe)
+        n_probe = cells.shape[1]
+        cells = cells.ravel()
+        by_cell = np.argsort(cells, kind="stable")
+        cell_bounds = np.searchsorted(cells[by_cell], np.arange(self.n_cells + 1))
+        for cell in range(self.n_cells):
+            rows = by_cell[cell_bounds[cell]:cell_bounds[cell + 1]] // n_probe
+            members = self.cell_members(cell)
+            if not rows.size or not members.size:
+                continue
+            self._update_best(queries, rows, members, best_dist, best_idx)
+
+        short = np.flatnonzero(np.isinf(best_dist).any(axis=1))
+        for start in range(0, short.size, 1024):
+            rows = short[start:start + 1024]
+            best_dist[rows] = np.inf
+            for first in range(0, self.points.shape[0], 8192):
+                members = np.arange(first, min(first + 8192, self.points.shape[0]))
+                self._update_best(queries, rows, members, best_dist, best_idx)
+
+        order = np.argsort(best_dist, axis=1)
+        best_idx = np.take_along_axis(best_idx, order, axis=1)
+        if not return_distance:
+            return best_idx
+        best_dist = np.sqrt(np.maximum(np.take_along_axis(best_dist, order, axis=1), 0.0))
+        return best_dist, best_idx
+
+    def _update_best(
+        self,
+        queries: np.ndarray,
+        rows: np.ndarray,
+        members: np.ndarray,
+        best_dist: np.ndarray,
+        best_idx: np.ndarray,
+    ) -> None:
+        """Merge some points into the nearest neighbours found for some
+        queries, in place
+        """
+        n_neighbors = best_dist.shape[1]
+        dist = np.hstack([best_dist[rows], _sq_dist(queries[rows], self._filled(members))])
+        idx = np.hstack([best_idx[rows], np.broadcast_to(members, (rows.size, members.size))])
+        keep = np.argpartition(dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        best_dist[rows] = np.take_along_axis(dist, keep, axis=1)
+        best_idx[rows] = np.take_along_axis(idx, keep, axis=1)
@@ -0,0 +1,145 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Writes of finished outputs overlapped with further computation.
+
+`BackgroundWriter` runs the calls given to `BackgroundWriter.submit` in
+order on a single background thread, so that the serialization,
+compression and disk I/O of a chunk overlap with the estimation of the
+next one.  The queue of pending writes is bounded: when it is full,
+`~BackgroundWriter.submit` blocks, which keeps the memory held by
+finished chunks bounded too.
+"""
+
+__all__ = [
+    "BackgroundWriter",
+]
+
+import queue
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+_STOP = None
+
+
+class BackgroundWriter:
+    """Run write calls in order on a background thread
+
+    The first call that raises stops the writer: later calls are dropped,
+    and the exception is raised again by the next `submit` or by `close`.
+
+    Parameters
+    ----------
+    max_pending
+        Maximum number of calls waiting to run; 0 runs every call in
+        `submit`, without a thread
+    """
+
+    def __init__(self, max_pending: int = 2):
+        self.max_pending = max_pending
+        # Time spent in the submitted calls, and waiting for the writer
+        self.write_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._error: BaseException | None = None
+        self._thread: threading.Thread | None = None
+        if max_pending > 0:
+            self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+            self._thread = threading.Thread(target=self._run, name="BackgroundWriter", daemon=True)
+            self._thread.start()
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        # Keep the original exception, if any, over one from the writer
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+
+    def _call(self, func: Callable[..., Any], args: tuple, kwargs: dict[str, Any]) -> None:
+        start = time.perf_counter()
+        try:
+            func(*args, **kwargs)
+        finally:
+            self.write_seconds += time.perf_counter() - start
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if self._error is None:
+                    self._call(*item)
+            except BaseException as err:
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        """Queue ``func(*args, **kwargs)``, waiting if the queue is full
+
+        The arguments must not be modified by the caller afterwards.
+
+        Raises
+        ------
+        Exception
+            The exception raised by an earlier call, if any
+        """
+        self._raise_error()
+        if self._thread is None:
+            self._call(func, args, kwargs)
+            return
+        start = time.perf_counter()
+        self._queue.put((func, args, kwargs))
+        self.wait_seconds += time.perf_counter() - start
+
+    def flush(self) -> None:
+        """Wait for the queued calls to finish, and raise their error if any"""
+        if self._thread is not None:
+            start = time.perf_counter()
+            self._queue.join()
+            self.wait_seconds += time.perf_counter() - start
+        self._raise_error()
+
+    def close(self) -> None:
+        """Finish the queued calls and stop the thread
+
+        Raises
+        ------
+        Exception
+            The exception raised by a call, if any
+        """
+        if self._thread is not None:
+            start = time.perf_counter()
+            self._queue.put(_STOP)
+            self._thread.join()
+            self.wait_seconds += time.perf_counter() - start
+            self._thread = None
+        self._raise_error()
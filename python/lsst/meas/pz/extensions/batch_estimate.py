@@ -0,0 +1,542 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Run a wrapped p(z) estimator over parquet files, without a butler.
+
+Every input file is read in chunks of rows, projected onto the columns
+the algorithm needs.  The p(z) of each chunk are written as one shard of
+a `sharded_ensemble` per input file, with their ancillary data, and the
+object IDs and modes as a parquet table of point estimates next to it.
+Both are written by a `background_writer.BackgroundWriter` while the
+next chunk is estimated.  Files are spread over a pool of worker
+processes, each of which loads the model once, or the chunks of each
+file over the workers of a `distributed.DistributedEstimator`.
+
+The point estimate table is written last, and atomically, so it marks
+a finished file: files that already have one are skipped, which makes
+an interrupted batch cheap to resume.  A file without rows gets an empty
+point estimate table and no ensemble.
+
+The outputs are named after the input file names, so the inputs of a
+batch must have distinct names, even if they are in different
+directories.
+"""
+
+__all__ = [
+    "BatchEstimateResult",
+    "check_output_names",
+    "estimate_file",
+    "find_input_files",
+    "make_algo_task",
+    "output_paths",
+    "run_batch",
+]
+
+import glob
+import logging
+import os
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from multiprocessing import get_context
+from typing import Any
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import qp
+from astropy.table import Table
+from rail.core.model import Model
+
+from .algo_registry import pz_algo_registry
+from .background_writer import BackgroundWriter
+from .distributed import DistributedEstimator
+from .estimate_pz_task_base import EstimatePZExtAlgoTask
+from .hdf5_layout import Hdf5LayoutConfig
+from .presets import apply_preset
+from .resources import thread_budget
+from .sharded_ensemble import finalize_manifest, write_ensemble_shard
+
+_LOG = logging.getLogger(__name__)
+
+# State of a worker process, set up once by _init_worker
+_worker_state: dict[str, Any] = {}
+
+
+@dataclass
+class BatchEstimateResult:
+    """Outcome of the estimation of a single input file"""
+
+    input_path: str
+    """Input parquet file"""
+
+    n_rows: int = 0
+    """Number of objects estimated"""
+
+    n_chunks: int = 0
+    """Number of chunks, i.e. of ensemble shards, written"""
+
+    elapsed: float = 0.0
+    """Wall clock time spent on the file, in seconds"""
+
+    write_wait: float = 0.0
+    """Time the estimation waited for the background writes, in seconds"""
+
+    skipped: bool = False
+    """Whether the file was skipped because its outputs already exist"""
+
+    error: str | None = None
+    """Error message, if the estimation failed"""
+
+
+def find_input_files(patterns: Iterable[str]) -> list[str]:
+    """Expand glob patterns into a sorted list of distinct files
+
+    Parameters
+    ----------
+    patterns
+        Glob patterns; ``**`` matches any number of directories
+
+    Returns
+    -------
+    paths
+        Matching files
+    """
+    paths = set()
+    for pattern in patterns:
+        paths.update(path_ for path_ in glob.glob(pattern, recursive=True) if os.path.isfile(path_))
+    return sorted(paths)
+
+
+def _output_stem(input_path: str) -> str:
+    return os.path.splitext(os.path.basename(input_path))[0]
+
+
+def output_paths(input_path: str, output_dir: str) -> tuple[str, str]:
+    """Return the output locations for an input file
+
+    Parameters
+    ----------
+    input_path
+        Input parquet file
+
+    output_dir
+        Directory holding the outputs of the batch
+
+    Returns
+    -------
+    ensemble_base_path
+        Path prefix of the sharded ensemble, see `sharded_ensemble`
+
+    point_estimates_path
+        Path of the point estimate table
+    """
+    stem = _output_stem(input_path)
+    return os.path.join(output_dir, f"{stem}_pz"), os.path.join(output_dir, f"{stem}_pz_point.parq")
+
+
+def check_output_names(input_paths: Iterable[str]) -> None:
+    """Check that input files do not share outputs
+
+    Parameters
+    ----------
+    input_paths
+        Input parquet files of a batch
+
+    Raises
+    ------
+    ValueError
+        If several input files have the same name, and so the same
+        outputs
+    """
+    paths_by_stem: dict[str, list[str]] = {}
+    for input_path in input_paths:
+        paths_by_stem.setdefault(_output_stem(input_path), []).append(input_path)
+    duplicates = sorted(paths_ for paths_ in paths_by_stem.values() if len(paths_) > 1)
+    if duplicates:
+        raise ValueError(f"Input files with the same name would write the same outputs: {duplicates}")
+
+
+def make_algo_task(
+    algo_name: str,
+    preset: str | None = None,
+    overrides: dict[str, Any] | None = None,
+) -> EstimatePZExtAlgoTask:
+    """Build the algorithm SubTask for a registered algorithm
+
+    Parameters
+    ----------
+    algo_name
+        Name of the algorithm in
+        `lsst.meas.pz.extensions.algo_registry.pz_algo_registry`
+
+    preset
+        Name of the survey preset applied to the config, if any
+
+    overrides
+        Config values set after the preset, keyed by field name
+
+    Returns
+    -------
+    algo_task
+        The configured SubTask
+    """
+    if algo_name not in pz_algo_registry:
+        raise ValueError(f"Unknown or unavailable algorithm {algo_name}, expected one of "
+                         f"{sorted(pz_algo_registry)}")
+    algo_class = pz_algo_registry[algo_name]
+    config = algo_class.ConfigClass()
+    if preset is not None:
+        apply_preset(config, preset)
+    for key, val in (overrides or {}).items():
+        setattr(config, key, val)
+    config.validate()
+    return algo_class(config=config)
+
+
+def _point_schema(parquet_file: pq.ParquetFile, id_column: str | None) -> pa.Schema:
+    """Return the schema of the point estimate table of an input file"""
+    schema = pa.schema([("zmode", pa.float64())])
+    if id_column is not None:
+        schema = schema.insert(0, parquet_file.schema_arrow.field(id_column))
+    return schema
+
+
+def _point_estimates(
+    pz_ensemble: qp.Ensemble,
+    object_ids: np.ndarray | None,
+    schema: pa.Schema,
+    zgrid: np.ndarray,
+) -> pa.Table:
+    """Gather the point estimates of a chunk in a table with ``schema``"""
+    ancil = pz_ensemble.ancil or {}
+    if "zmode" in ancil:
+        zmode = np.ravel(ancil["zmode"])
+    else:
+        zmode = np.ravel(pz_ensemble.mode(grid=zgrid))
+    columns = dict(zmode=zmode)
+    if object_ids is not None:
+        columns[schema.names[0]] = object_ids
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+def estimate_file(
+    algo_task: EstimatePZExtAlgoTask,
+    pz_model: Model,
+    input_path: str,
+    output_dir: str,
+    chunk_size: int = 100000,
+    id_column: str | None = "objectId",
+    overwrite: bool = False,
+    executor: DistributedEstimator | None = None,
+    write_queue_size: int = 2,
+    layout: Hdf5LayoutConfig | None = None,
+) -> BatchEstimateResult:
+    """Estimate the p(z) of all the objects of a parquet file
+
+    Parameters
+    ----------
+    algo_task
+        Algorithm SubTask, e.g. from `make_algo_task`
+
+    pz_model
+        Model for the algorithm
+
+    input_path
+        Input parquet file
+
+    output_dir
+        Directory for the outputs, see `output_paths`
+
+    chunk_size
+        Maximum number of rows read and estimated at once
+
+    id_column
+        Object ID column copied to the outputs; `None` to copy none
+
+    overwrite
+        Redo files whose outputs already exist
+
+    executor
+        Pool of workers estimating the chunks, which must be set up with
+        the same algorithm config and model; `None` estimates them here
+
+    write_queue_size
+        Maximum number of estimated chunks waiting to be written while
+        the next one is estimated; 0 writes each chunk before estimating
+        the next
+
+    layout
+        Chunking and compression of the ensemble shards; `None` writes
+        them with `qp.Ensemble.write_to`
+
+    Returns
+    -------
+    result
+        Summary of the work done
+    """
+    result = BatchEstimateResult(input_path=input_path)
+    base_path, point_path = output_paths(input_path, output_dir)
+    if os.path.exists(point_path) and not overwrite:
+        result.skipped = True
+        return result
+
+    start = time.perf_counter()
+    with pq.ParquetFile(input_path) as parquet_file:
+        columns = list(algo_task.col_names())
+        if id_column is not None and id_column not in columns:
+            columns.append(id_column)
+        zgrid = np.linspace(algo_task.config.zmin, algo_task.config.zmax, algo_task.config.nzbins)
+        point_schema = _point_schema(parquet_file, id_column)
+
+        # Sidecars left by an interrupted run would be merged with ours
+        for stale_path in glob.glob(f"{glob.escape(base_path)}_*.shard.json"):
+            os.unlink(stale_path)
+
+        tmp_point_path = f"{point_path}.tmp"
+        writer = None
+        chunk_ids: deque[tuple[int, np.ndarray | None]] = deque()
+
+        def read_chunks() -> Iterator[Table]:
+            for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+                fluxes = Table(
+                    {name_: batch.column(name_).to_numpy(zero_copy_only=False) for name_ in columns}
+                )
+                chunk_ids.append((len(fluxes), None if id_column is None else np.asarray(fluxes[id_column])))
+                yield fluxes
+
+        if executor is None:
+            pz_ensembles = (algo_task.estimate(pz_model, fluxes) for fluxes in read_chunks())
+        else:
+            pz_ensembles = executor.estimate_chunks(algo_task.convert(fluxes) for fluxes in read_chunks())
+
+        def write_chunk(pz_ensemble: qp.Ensemble, index: int, row_offset: int, object_ids: Any) -> None:
+            nonlocal writer
+            write_ensemble_shard(
+                pz_ensemble,
+                base_path,
+                index,
+                row_offset=row_offset,
+                object_ids=object_ids,
+                id_column=id_column or "objectId",
+                layout=layout,
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_point_path, point_schema)
+            writer.write_table(_point_estimates(pz_ensemble, object_ids, point_schema, zgrid))
+
+        try:
+            with BackgroundWriter(write_queue_size) as background:
+                for pz_ensemble in pz_ensembles:
+                    n_rows, object_ids = chunk_ids.popleft()
+                    background.submit(write_chunk, pz_ensemble, result.n_chunks, result.n_rows, object_ids)
+                    result.n_rows += n_rows
+                    result.n_chunks += 1
+        finally:
+            if writer is not None:
+                writer.close()
+        # Only complete once the writer has been closed by the with block
+        result.write_wait = background.wait_seconds
+
+        if result.n_chunks:
+            finalize_manifest(base_path)
+        else:
+            # Nothing to put in an ensemble, but the empty point estimate
+            # table still marks the file as done
+            pq.write_table(point_schema.empty_table(), tmp_point_path)
+        os.replace(tmp_point_path, point_path)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _init_worker(
+    algo_name: str,
+    model_path: str,
+    preset: str | None,
+    overrides: dict[str, Any],
+    num_threads: int,
+) -> None:
+    """Build the SubTask and load the model, once per worker process"""
+    _worker_state.update(
+        algo_task=make_algo_task(algo_name, preset, overrides),
+        pz_model=Model.read(model_path),
+        num_threads=num_threads,
+    )
+
+
+def _run_one(input_path: str, output_dir: str, **kwargs: Any) -> BatchEstimateResult:
+    """Estimate one file with the state of the current worker"""
+    try:
+        with thread_budget(_worker_state["num_threads"]):
+            return estimate_file(
+                _worker_state["algo_task"],
+                _worker_state["pz_model"],
+                input_path,
+                output_dir,
+                **kwargs,
+            )
+    except Exception as err:
+        return BatchEstimateResult(input_path=input_path, error=f"{type(err).__name__}: {err}")
+
+
+def run_batch(
+    input_paths: list[str],
+    algo_name: str,
+    model_path: str,
+    output_dir: str,
+    preset: str | None = None,
+    overrides: dict[str, Any] | None = None,
+    n_workers: int = 1,
+    num_threads: int = 0,
+    chunk_size: int = 100000,
+    id_column: str | None = "objectId",
+    overwrite: bool = False,
+    executor: DistributedEstimator | None = None,
+    write_queue_size: int = 2,
+    layout: Hdf5LayoutConfig | None = None,
+) -> list[BatchEstimateResult]:
+    """Estimate the p(z) of all the objects of many parquet files
+
+    A failure on one file is reported in its result, and does not stop
+    the others.
+
+    Parameters
+    ----------
+    input_paths
+        Input parquet files
+
+    algo_name
+        Name of the registered algorithm
+
+    model_path
+        Path of the pickled model
+
+    output_dir
+        Directory for the outputs; it is created if needed
+
+    preset
+        Name of the survey preset, see `presets.survey_presets`
+
+    overrides
+        Config values set after the preset, keyed by field name
+
+    n_workers
+        Number of worker processes; 1 runs everything in this process
+
+    num_threads
+        Maximum number of threads each worker lets BLAS, OpenMP and
+        similar libraries use; 0 splits the CPUs between the workers
+
+    chunk_size
+        Maximum number of rows read and estimated at once by a worker
+
+    id_column
+        Object ID column copied to the outputs; `None` to copy none
+
+    overwrite
+        Redo files whose outputs already exist
+
+    executor
+        Pool of workers, set up with the same algorithm, preset, overrides
+        and model, estimating the chunks of one file at a time; replaces
+        ``n_workers``
+
+    write_queue_size
+        Maximum number of estimated chunks of a file waiting to be written;
+        0 writes each chunk before estimating the next
+
+    layout
+        Chunking and compression of the ensemble shards; `None` writes
+        them with `qp.Ensemble.write_to`
+
+    Returns
+    -------
+    results
+        One result per input file, in completion order
+
+    Raises
+    ------
+    ValueError
+        Raised by `check_output_names`
+    """
+    check_output_names(input_paths)
+    os.makedirs(output_dir, exist_ok=True)
+    if num_threads <= 0:
+        num_threads = max(1, (os.cpu_count() or 1) // max(n_workers, 1))
+    init_args = (algo_name, model_path, preset, overrides or {}, num_threads)
+    run_kwargs = dict(
+        chunk_size=chunk_size,
+        id_column=id_column,
+        overwrite=overwrite,
+        write_queue_size=write_queue_size,
+        layout=layout,
+    )
+
+    results = []
+    if executor is not None:
+        _worker_state.update(
+            algo_task=make_algo_task(algo_name, preset, overrides), pz_model=None, num_threads=num_threads
+        )
+        for input_path in input_paths:
+            results.append(_run_one(input_path, output_dir, executor=executor, **run_kwargs))
+            _log_result(results[-1], len(results), len(input_paths))
+        return results
+
+    if n_workers <= 1:
+        _init_worker(*init_args)
+        for input_path in input_paths:
+            results.append(_run_one(input_path, output_dir, **run_kwargs))
+            _log_result(results[-1], len(results), len(input_paths))
+        return results
+
+    # Spawn rather than fork, so that the workers do not inherit the
+    # thread pools of libraries already loaded in this process
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=get_context("spawn"),
+        initializer=_init_worker,
+        initargs=init_args,
+    ) as executor:
+        futures = [executor.submit(_run_one, path_, output_dir, **run_kwargs) for path_ in input_paths]
+        for future in as_completed(futures):
+            results.append(future.result())
+            _log_result(results[-1], len(results), len(input_paths))
+    return results
+
+
+def _log_result(result: BatchEstimateResult, n_done: int, n_total: int) -> None:
+    if result.error is not None:
+        _LOG.error("[%d/%d] %s failed: %s", n_done, n_total, result.input_path, result.error)
+    elif result.skipped:
+        _LOG.info("[%d/%d] %s already done, skipped", n_done, n_total, result.input_path)
+    else:
+        _LOG.info(
+            "[%d/%d] %s: %d objects in %d chunks, %.1f s, %.1f s waiting for writes",
+            n_done,
+            n_total,
+            result.input_path,
+            result.n_rows,
+            result.n_chunks,
+            result.elapsed,
+            result.write_wait,
+        )
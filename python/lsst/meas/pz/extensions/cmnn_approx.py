@@ -0,0 +1,140 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Color matched nearest neighbour estimates using an approximate index.
+
+This follows `rail.estimation.algos.cmnn.CMNNEstimator`, except that the
+Mahalanobis distances of each object are only computed for the training
+galaxies in the index cells closest to it, rather than for the whole
+training set.
+"""
+
+__all__ = [
+    "cmnn_estimate",
+]
+
+from typing import Any
+
+import numpy as np
+from scipy.stats import chi2
+
+from .ann_index import IVFIndex
+
+
+def cmnn_estimate(
+    index: IVFIndex,
+    truez: np.ndarray,
+    nondet_choice: bool,
+    test_color: np.ndarray,
+    test_err: np.ndarray,
+    config: Any,
+    seed: int,
+) -> dict[str, np.ndarray]:
+    """Compute CMNN redshifts and widths, searching only nearby index cells
+
+    Parameters
+    ----------
+    index
+        Index over the training colors
+
+    truez
+        Redshifts of the training galaxies
+
+    nondet_choice
+        Whether the model replaced non-detections by limiting magnitudes,
+        rather than by NaN
+
+    test_color, test_err
+        Colors and color errors of the objects, shape ``(n_obj, n_colors)``
+
+    config
+        Config of the `CMNNEstimator` stage, giving the selection parameters
+
+    seed
+        Seed of the random choices of selection modes 0 and 2
+
+    Returns
+    -------
+    estimates
+        ``zmode``, ``scale``, ``Ncm`` and ``ncolors`` for every object
+    """
+    train_color = index.points
+    n_obj, n_colors = test_color.shape
+    min_n = config.min_n
+    nondet_dof = len(config.bands) - 1
+    thresh_table = np.zeros(max(n_colors, nondet_dof) + 1)
+    thresh_table[1:] = chi2.ppf(config.ppf_value, np.arange(1, thresh_table.size))
+    rng = np.random.default_rng(seed=seed)
+
+    zmode = np.zeros(n_obj)
+    scale = np.zeros(n_obj)
+    n_cm = np.zeros(n_obj, dtype=int)
+    n_colors_used = np.zeros(n_obj, dtype=int)
+    cells = index.probe(test_color, weights=1.0 / test_err**2)
+    for ii in range(n_obj):
+        candidates = index.candidates(cells[ii])
+        dist = np.nansum((test_color[ii] - train_color[candidates]) ** 2 / test_err[ii] ** 2, axis=1)
+        cand_z = truez[candidates]
+        if nondet_choice:
+            dof = nondet_dof
+            threshold = thresh_table[dof]
+            n_colors_used[ii] = dof
+        else:
+            dof = np.sum(~np.isnan(test_color[ii]) & ~np.isnan(train_color[candidates]), axis=1)
+            threshold = thresh_table[dof]
+            n_colors_used[ii] = np.sum(~np.isnan(test_color[ii]))
+
+        matched = np.flatnonzero(
+            (threshold > config.min_thresh) & (dist > config.min_dist) & (dist <= threshold)
+        )
+        if matched.size >= min_n:
+            scale[ii] = np.std(cand_z[matched])
+            if config.selection_mode == 0:
+                zmode[ii] = cand_z[rng.choice(matched)]
+            elif config.selection_mode == 1:
+                best = matched[dist[matched] == np.min(dist[matched])]
+                zmode[ii] = cand_z[best[0] if best.size == 1 else rng.choice(best)]
+            else:
+                weights = 1.0 / dist[matched]
+                zmode[ii] = cand_z[rng.choice(matched, p=weights / weights.sum())]
+            n_cm[ii] = matched.size
+            continue
+
+        # Not enough matches within the threshold: use the min_n nearest
+        # neighbours, and inflate the width accordingly
+        valid = np.flatnonzero((threshold > 1e-4) & (dist > 1e-4))
+        if not valid.size:
+            zmode[ii] = config.bad_redshift_val
+            scale[ii] = config.bad_redshift_err
+            continue
+        nearest = valid[np.argsort(dist[valid])[:min_n]]
+        near_dist, near_z = dist[nearest], cand_z[nearest]
+        lim_dof = dof if nondet_choice else dof[nearest][-1]
+        scale[ii] = np.std(near_z) * chi2.cdf(near_dist[-1], lim_dof) / config.ppf_value
+        if config.selection_mode == 0:
+            zmode[ii] = near_z[rng.choice(near_z.size)]
+        elif config.selection_mode == 1:
+            zmode[ii] = near_z[0]
+        else:
+            weights = 1.0 / near_dist
+            zmode[ii] = near_z[rng.choice(near_z.size, p=weights / weights.sum())]
+        n_cm[ii] = min_n
+    return dict(zmode=zmode, scale=scale, Ncm=n_cm, ncolors=n_colors_used)
@@ -0,0 +1,102 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "combine_pdfs",
+]
+
+import warnings
+
+import numpy as np
+from astropy.table import Table
+
+
+def combine_pdfs(
+    pdfs: dict[str, np.ndarray],
+    zgrid: np.ndarray,
+    weights: dict[str, float] | None = None,
+) -> tuple[np.ndarray, Table]:
+    """Build a weighted consensus of several p(z) estimates of the same objects
+
+    Parameters
+    ----------
+    pdfs
+        Normalized PDFs on ``zgrid``, each of shape ``(n_obj, n_grid)``,
+        keyed by algorithm name
+
+    zgrid
+        Common redshift grid
+
+    weights
+        Weight of each algorithm in the consensus; algorithms that are
+        missing from ``weights`` get a weight of one.  Objects for which
+        an algorithm returned an empty PDF do not use that algorithm.
+
+    Returns
+    -------
+    consensus
+        Normalized consensus PDFs, shape ``(n_obj, n_grid)``
+
+    metrics
+        Per-object disagreement metrics: the consensus mode and mean, the
+        mode of each algorithm, the scatter of those modes in units of
+        ``1 + z`` of their median, their maximum separation in units of
+        ``1 + z`` of the consensus mode, and the mean and maximum
+        Hellinger distance between each algorithm and the consensus
+    """
+    if not pdfs:
+        raise ValueError("Need at least one set of PDFs to build a consensus")
+    weights = weights or {}
+    names = list(pdfs.keys())
+    stack = np.stack([pdfs[name_] for name_ in names])
+    algo_weights = np.array([weights.get(name_, 1.0) for name_ in names], dtype=stack.dtype)
+    dz = np.gradient(zgrid)
+
+    # Per-object weights, dropping algorithms that gave nothing for an object
+    valid = stack.sum(axis=2) > 0
+    obj_weights = np.where(valid, algo_weights[:, np.newaxis], 0.0)
+    weight_sums = obj_weights.sum(axis=0)
+    obj_weights /= np.where(weight_sums > 0, weight_sums, 1.0)
+    consensus = np.einsum("ai,aij->ij", obj_weights, stack)
+
+    modes = zgrid[np.argmax(stack, axis=2)]
+    modes = np.where(valid, modes, np.nan)
+    has_any = weight_sums > 0
+    z_cons_mode = np.where(has_any, zgrid[np.argmax(consensus, axis=1)], np.nan)
+    z_cons_mean = np.where(has_any, (consensus * zgrid) @ dz, np.nan)
+
+    hellinger = np.sqrt(np.clip(1.0 - (np.sqrt(stack * consensus[np.newaxis]) @ dz), 0.0, 1.0))
+    hellinger = np.where(valid, hellinger, np.nan)
+
+    # All-NaN columns, for objects no algorithm could handle, give NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        metrics = dict(
+            z_consensus_mode=z_cons_mode,
+            z_consensus_mean=z_cons_mean,
+            z_mode_std=np.nanstd(modes, axis=0) / (1.0 + np.nanmedian(modes, axis=0)),
+            z_mode_max_sep=(np.nanmax(modes, axis=0) - np.nanmin(modes, axis=0)) / (1.0 + z_cons_mode),
+            hellinger_mean=np.nanmean(hellinger, axis=0),
+            hellinger_max=np.nanmax(hellinger, axis=0),
+        )
+    for name_, modes_ in zip(names, modes):
+        metrics[f"z_mode_{name_}"] = modes_
+    return consensus, Table(metrics)
@@ -0,0 +1,75 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Names of the per-algorithm dataset types derived from an ensemble.
+
+Every estimator label of a pipeline writes its own ``pzEnsemble``, e.g.
+``pz_estimate_fzboost``.  The auxiliary outputs of a label are named after
+it, e.g. ``pz_nz_fzboost``, so several estimators can write them in one
+pipeline without producing the same dataset type.
+"""
+
+__all__ = [
+    "ENSEMBLE_PREFIX",
+    "INDEX_PREFIX",
+    "INDEX_RANGE_PREFIX",
+    "INDEX_TRACT_PREFIX",
+    "NZ_PREFIX",
+    "derived_name",
+]
+
+ENSEMBLE_PREFIX = "pz_estimate"
+"""Prefix of the ensemble dataset type names"""
+
+NZ_PREFIX = "pz_nz"
+"""Prefix of the stacked p(z) dataset type names"""
+
+INDEX_PREFIX = "pz_index"
+"""Prefix of the per-quantum object ID index dataset type names"""
+
+INDEX_TRACT_PREFIX = "pz_index_tract"
+"""Prefix of the per-tract object ID index dataset type names"""
+
+INDEX_RANGE_PREFIX = "pz_index_range"
+"""Prefix of the per-tract object ID range dataset type names"""
+
+
+def derived_name(ensemble_name: str, prefix: str) -> str:
+    """Return the name of a dataset type derived from an ensemble's
+
+    Parameters
+    ----------
+    ensemble_name
+        Name of the ensemble dataset type, e.g. ``pz_estimate_fzboost``
+
+    prefix
+        Prefix of the derived dataset type, e.g. ``pz_nz``
+
+    Returns
+    -------
+    name
+        ``prefix`` followed by what follows `ENSEMBLE_PREFIX` in
+        ``ensemble_name``, e.g. ``pz_nz_fzboost``, or ``ensemble_name``
+        followed by ``_<prefix>`` if it does not start with it
+    """
+    if ensemble_name.startswith(ENSEMBLE_PREFIX):
+        return prefix + ensemble_name[len(ENSEMBLE_PREFIX):]
+    return f"{ensemble_name}_{prefix}"
@@ -0,0 +1,591 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Distributed estimation of catalog chunks over worker processes.
+
+`DistributedEstimator` sends chunks of converted magnitudes to a pool of
+workers through a task queue, and yields the resulting ensembles in chunk
+order.  Each worker gets the algorithm config and the model file once,
+when it starts, and keeps a warm estimator stage for all its chunks.
+
+Two queue backends are provided:
+
+- `LocalBackend` starts the workers as local processes, and notices lost
+  workers from their exit;
+- `ManagerBackend` serves the queues over TCP with
+  `multiprocessing.managers`, for workers started on other nodes with
+  `run_remote_worker`; lost workers are noticed when their heartbeats
+  stop.
+
+The chunks of a lost worker are queued again, so a job survives the loss
+of workers as long as one is left.  So are the chunks taken from the
+queue by a worker that stopped before reporting them as started: a chunk
+is known to have been taken when a chunk queued after it starts, or when
+a worker waits for work while it is not started.  A job fails when no
+chunk starts or completes for ``progress_timeout``, e.g. when all the
+remote workers are gone.
+
+Each call of `DistributedEstimator.estimate_chunks` is a job with its own
+ID, carried by its queued chunks and by the events about them, so that
+the late results of an earlier job are never taken for those of the
+current one.  The chunks a job leaves in the queue, e.g. when it fails,
+are drained when it ends.
+"""
+
+__all__ = [
+    "DistributedEstimator",
+    "LocalBackend",
+    "ManagerBackend",
+    "QueueBackend",
+    "run_remote_worker",
+]
+
+import os
+import queue
+from abc import ABC, abstractmethod
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections.abc import Iterable, Iterator
+from multiprocessing import get_context
+from multiprocessing.managers import BaseManager
+from typing import Any
+
+import numpy as np
+import qp
+from rail.core.model import Model
+
+from .resources import thread_budget
+
+_STOP = None
+
+
+def _serialize(pz_ensemble: qp.Ensemble) -> dict[str, Any]:
+    """Convert an ensemble to plain tables, which pickle for any pdf type"""
+    return pz_ensemble.build_tables()
+
+
+def _deserialize(tables: dict[str, Any]) -> qp.Ensemble:
+    return qp.from_tables(tables)
+
+
+def _worker_loop(task_queue: Any, event_queue: Any, setup: dict[str, Any], worker_id: str) -> None:
+    """Estimate chunks from the task queue until told to stop"""
+    # Imported here, as batch_estimate uses this module
+    from .batch_estimate import make_algo_task
+
+    algo_task = make_algo_task(setup["algo_name"], setup["preset"], setup["overrides"])
+    with tempfile.NamedTemporaryFile(suffix=".pickle", delete=False) as model_file:
+        model_file.write(setup["model_bytes"])
+    try:
+        pz_model = Model.read(model_file.name)
+    finally:
+        os.unlink(model_file.name)
+
+    stop_heartbeat = threading.Event()
+
+    def heartbeat() -> None:
+        while not stop_heartbeat.wait(setup["heartbeat_interval"]):
+            event_queue.put(("heartbeat", worker_id, None, None, None))
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    event_queue.put(("ready", worker_id, None, None, None))
+    try:
+        with thread_budget(setup["num_threads"]):
+            while (item := task_queue.get()) is not _STOP:
+                job_id, chunk_index, mags = item
+                event_queue.put(("started", worker_id, job_id, chunk_index, None))
+                try:
+                    n_rows = len(next(iter(mags.values())))
+                    pz_ensemble = algo_task.estimate_mags(pz_model, mags, n_rows)
+                    event_queue.put(("done", worker_id, job_id, chunk_index, _serialize(pz_ensemble)))
+                except Exception as err:
+                    message = f"{type(err).__name__}: {err}"
+                    event_queue.put(("error", worker_id, job_id, chunk_index, message))
+    finally:
+        stop_heartbeat.set()
+
+
+def _drain(task_queue: Any) -> int:
+    """Remove the items of a queue without waiting, returning their number"""
+    n_items = 0
+    while True:
+        try:
+            task_queue.get_nowait()
+        except queue.Empty:
+            return n_items
+        n_items += 1
+
+
+class QueueBackend(ABC):
+    """Task queue connecting a `DistributedEstimator` to its workers
+
+    Sub-classes start the workers in `start`, and report the workers
+    known to be gone in `lost_workers`.
+    """
+
+    heartbeat_timeout: float = 300.0
+    """Workers silent for longer than this, in seconds, are lost"""
+
+    @abstractmethod
+    def start(self, setup: dict[str, Any]) -> None:
+        """Make the worker setup available and start the workers"""
+
+    @abstractmethod
+    def put_task(self, item: Any) -> None:
+        """Queue a ``(job_id, chunk_index, mags)`` chunk, or `None` to stop
+        a worker
+        """
+
+    @abstractmethod
+    def drain_tasks(self) -> int:
+        """Remove the chunks not taken by any worker yet, returning their
+        number
+        """
+
+    @abstractmethod
+    def get_event(self, timeout: float) -> tuple | None:
+        """Return the next ``(kind, worker_id, job_id, chunk_index,
+        payload)`` worker event, or `None` after ``timeout`` seconds
+        """
+
+    def lost_workers(self) -> set[str]:
+        """Return the workers known to have stopped"""
+        return set()
+
+    @property
+    @abstractmethod
+    def n_workers(self) -> int:
+        """Number of workers expected to serve the queue"""
+
+    def close(self) -> None:
+        """Stop the workers and release the queues"""
+
+
+class LocalBackend(QueueBackend):
+    """Task queue served by worker processes on this node
+
+    Parameters
+    ----------
+    n_workers
+        Number of worker processes
+    """
+
+    def __init__(self, n_workers: int):
+        self._n_workers = n_workers
+        # Spawn rather than fork, so that the workers do not inherit the
+        # thread pools of libraries already loaded in this process
+        self._context = get_context("spawn")
+        self._task_queue = self._context.Queue()
+        self._event_queue = self._context.Queue()
+        self.processes: dict[str, Any] = {}
+
+    def start(self, setup: dict[str, Any]) -> None:
+        for index in range(self._n_workers):
+            worker_id = f"local-{index}"
+            process = self._context.Process(
+                target=_worker_loop,
+                args=(self._task_queue, self._event_queue, setup, worker_id),
+                daemon=True,
+            )
+            process.start()
+            self.processes[worker_id] = process
+
+    def put_task(self, item: Any) -> None:
+        self._task_queue.put(item)
+
+    def drain_tasks(self) -> int:
+        return _drain(self._task_queue)
+
+    def get_event(self, timeout: float) -> tuple | None:
+        try:
+            return self._event_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def lost_workers(self) -> set[str]:
+        return {worker_id for worker_id, process in self.processes.items() if not process.is_alive()}
+
+    @property
+    def n_workers(self) -> int:
+        return self._n_workers
+
+    def close(self) -> None:
+        for _ in self.processes:
+            self._task_queue.put(_STOP)
+        for process in self.processes.values():
+            process.join(timeout=10.0)
+            if process.is_alive():
+                process.terminate()
+        self.processes.clear()
+
+
+class _QueueManager(BaseManager):
+    pass
+
+
+class ManagerBackend(QueueBackend):
+    """Task queue served over TCP to workers on any node
+
+    Workers are started separately, with `run_remote_worker` or the
+    ``pz_chunk_worker.py`` script, and may join or leave at any time.
+
+    Parameters
+    ----------
+    address
+        ``(host, port)`` to listen on; port 0 picks a free port
+
+    authkey
+        Shared secret of the driver and the workers
+
+    n_workers
+        Number of workers expected, used to size the number of chunks
+        in flight
+
+    heartbeat_timeout
+        Workers silent for longer than this, in seconds, are lost
+    """
+
+    def __init__(
+        self,
+        address: tuple[str, int] = ("", 0),
+        authkey: bytes = b"",
+        n_workers: int = 1,
+        heartbeat_timeout: float = 300.0,
+    ):
+        self._n_workers = n_workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self._task_queue: queue.Queue = queue.Queue()
+        self._event_queue: queue.Queue = queue.Queue()
+        self._setup: dict[str, Any] = {}
+        self._known_workers: set[str] = set()
+
+        manager_class = type("_DriverQueueManager", (_QueueManager,), {})
+        manager_class.register("get_task_queue", callable=lambda: self._task_queue)
+        manager_class.register("get_event_queue", callable=lambda: self._event_queue)
+        manager_class.register("get_setup", callable=lambda: self._setup)
+        self._manager = manager_class(address=address, authkey=authkey or uuid.uuid4().bytes)
+        self._server = self._manager.get_server()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self) -> tuple[str, int]:
+        """Address the workers connect to"""
+        host, port = self._server.address
+        return (host or socket.getfqdn(), port)
+
+    @property
+    def authkey(self) -> bytes:
+        """Shared secret the workers must use"""
+        return bytes(self._server.authkey)
+
+    def start(self, setup: dict[str, Any]) -> None:
+        self._setup.update(setup)
+        self._thread.start()
+
+    def put_task(self, item: Any) -> None:
+        self._task_queue.put(item)
+
+    def drain_tasks(self) -> int:
+        return _drain(self._task_queue)
+
+    def get_event(self, timeout: float) -> tuple | None:
+        try:
+            event = self._event_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._known_workers.add(event[1])
+        return event
+
+    @property
+    def n_workers(self) -> int:
+        return self._n_workers
+
+    def close(self) -> None:
+        # Workers exit when they take a stop item
+        for _ in range(max(self._n_workers, len(self._known_workers))):
+            self._task_queue.put(_STOP)
+        stop_event = getattr(self._server, "stop_event", None)
+        if stop_event is not None:
+            stop_event.set()
+
+
+def run_remote_worker(address: tuple[str, int], authkey: bytes, worker_id: str | None = None) -> None:
+    """Serve the task queue of a `ManagerBackend` until it is closed
+
+    Parameters
+    ----------
+    address
+        ``(host, port)`` of the driver
+
+    authkey
+        Shared secret of the driver
+
+    worker_id
+        Name of the worker in the driver's bookkeeping; default
+        ``<hostname>-<pid>``
+    """
+    _QueueManager.register("get_task_queue")
+    _QueueManager.register("get_event_queue")
+    _QueueManager.register("get_setup")
+    manager = _QueueManager(address=address, authkey=authkey)
+    manager.connect()
+    setup = manager.get_setup().copy()
+    _worker_loop(
+        manager.get_task_queue(),
+        manager.get_event_queue(),
+        setup,
+        worker_id or f"{socket.gethostname()}-{os.getpid()}",
+    )
+
+
+class DistributedEstimator:
+    """Estimate chunks of converted magnitudes on a pool of workers
+
+    Parameters
+    ----------
+    backend
+        Task queue and workers
+
+    algo_name
+        Name of the registered algorithm
+
+    model_path
+        Path of the pickled model, read here and sent once to each worker
+
+    preset
+        Name of the survey preset, see `presets.survey_presets`
+
+    overrides
+        Config values set after the preset, keyed by field name
+
+    num_threads
+        Maximum number of threads of BLAS, OpenMP and similar libraries,
+        per worker
+
+    max_retries
+        Number of times a chunk is queued again after losing its worker
+
+    heartbeat_interval
+        Time between two heartbeats of a worker, in seconds
+
+    progress_timeout
+        Time without any chunk started or completed, in seconds, after
+        which the estimation fails
+    """
+
+    def __init__(
+        self,
+        backend: QueueBackend,
+        algo_name: str,
+        model_path: str,
+        preset: str | None = None,
+        overrides: dict[str, Any] | None = None,
+        num_threads: int = 1,
+        max_retries: int = 3,
+        heartbeat_interval: float = 10.0,
+        progress_timeout: float = 3600.0,
+    ):
+        self.backend = backend
+        self.max_retries = max_retries
+        self.progress_timeout = progress_timeout
+        with open(model_path, "rb") as fin:
+            model_bytes = fin.read()
+        self._setup = dict(
+            algo_name=algo_name,
+            preset=preset,
+            overrides=overrides or {},
+            model_bytes=model_bytes,
+            num_threads=num_threads,
+            heartbeat_interval=heartbeat_interval,
+        )
+        self._started = False
+        self.n_requeued = 0
+
+    def __enter__(self) -> "DistributedEstimator":
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """Start the workers"""
+        if not self._started:
+            self.backend.start(self._setup)
+            self._started = True
+
+    def close(self) -> None:
+        """Stop the workers"""
+        if self._started:
+            self.backend.close()
+            self._started = False
+
+    def estimate_chunks(
+        self,
+        chunks: Iterable[dict[str, np.ndarray]],
+        max_in_flight: int | None = None,
+    ) -> Iterator[qp.Ensemble]:
+        """Estimate chunks of converted magnitudes, yielding them in order
+
+        Parameters
+        ----------
+        chunks
+            Magnitudes and magnitude errors of each chunk, as returned by
+            the algorithm's ``convert``; consumed lazily
+
+        max_in_flight
+            Maximum number of chunks queued or being estimated; default
+            twice the number of workers
+
+        Yields
+        ------
+        pz_ensemble
+            Estimates of each chunk, in the order of ``chunks``
+        """
+        self.start()
+        try:
+            yield from self._run_job(uuid.uuid4().hex, chunks, max_in_flight)
+        finally:
+            # Leave nothing of this job, e.g. after an error, for the next
+            self.backend.drain_tasks()
+
+    def _run_job(
+        self,
+        job_id: str,
+        chunks: Iterable[dict[str, np.ndarray]],
+        max_in_flight: int | None,
+    ) -> Iterator[qp.Ensemble]:
+        max_in_flight = max_in_flight or 2 * max(self.backend.n_workers, 1)
+        chunk_iter = enumerate(chunks)
+        pending: dict[int, dict[str, np.ndarray]] = {}
+        retries: dict[int, int] = {}
+        # Chunks put in the queue and not started yet, with their put
+        # order and time, and the time they were known to be taken
+        queued: dict[int, tuple[int, float]] = {}
+        taken: dict[int, float] = {}
+        assigned: dict[int, str] = {}
+        last_seen: dict[str, float] = {}
+        idle_since: dict[str, float] = {}
+        lost: set[str] = set()
+        done: dict[int, qp.Ensemble] = {}
+        next_index = 0
+        n_put = 0
+        exhausted = False
+        last_progress = time.monotonic()
+
+        def put(chunk_index: int) -> None:
+            nonlocal n_put
+            queued[chunk_index] = (n_put, time.monotonic())
+            taken.pop(chunk_index, None)
+            n_put += 1
+            self.backend.put_task((job_id, chunk_index, pending[chunk_index]))
+
+        def requeue(chunk_index: int, reason: str) -> None:
+            retries[chunk_index] = retries.get(chunk_index, 0) + 1
+            if retries[chunk_index] > self.max_retries:
+                raise RuntimeError(f"Chunk {chunk_index} {reason} {retries[chunk_index]} times")
+            self.n_requeued += 1
+            put(chunk_index)
+
+        while True:
+            while not exhausted and len(pending) + len(done) < max_in_flight:
+                try:
+                    chunk_index, mags = next(chunk_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[chunk_index] = mags
+                put(chunk_index)
+            while next_index in done:
+                yield done.pop(next_index)
+                next_index += 1
+            if exhausted and not pending and not done:
+                return
+
+            event = self.backend.get_event(timeout=1.0)
+            now = time.monotonic()
+            if event is not None:
+                kind, worker_id, event_job_id, chunk_index, payload = event
+                last_seen[worker_id] = now
+                if worker_id in lost:
+                    # Back from the dead; its chunks were already queued again
+                    lost.discard(worker_id)
+                if event_job_id is not None and event_job_id != job_id:
+                    # Left over from an earlier job, e.g. one that failed
+                    if kind == "started":
+                        idle_since.pop(worker_id, None)
+                    else:
+                        idle_since[worker_id] = now
+                elif kind == "ready":
+                    idle_since[worker_id] = now
+                elif kind == "started" and chunk_index in pending:
+                    last_progress = now
+                    idle_since.pop(worker_id, None)
+                    assigned[chunk_index] = worker_id
+                    taken.pop(chunk_index, None)
+                    if chunk_index in queued:
+                        # The queue is first in, first out, so the chunks
+                        # put before this one were taken too
+                        put_order, _ = queued.pop(chunk_index)
+                        for idx_, (order_, _) in queued.items():
+                            if order_ < put_order:
+                                taken.setdefault(idx_, now)
+                elif kind == "done" and chunk_index in pending:
+                    last_progress = now
+                    idle_since[worker_id] = now
+                    del pending[chunk_index]
+                    queued.pop(chunk_index, None)
+                    taken.pop(chunk_index, None)
+                    assigned.pop(chunk_index, None)
+                    done[chunk_index] = _deserialize(payload)
+                elif kind == "error" and chunk_index in pending:
+                    raise RuntimeError(f"Chunk {chunk_index} failed on worker {worker_id}: {payload}")
+                elif kind in ("done", "error"):
+                    idle_since[worker_id] = now
+
+            newly_lost = self.backend.lost_workers() | {
+                worker_id
+                for worker_id, seen in last_seen.items()
+                if now - seen > self.backend.heartbeat_timeout
+            }
+            for worker_id in newly_lost - lost:
+                lost.add(worker_id)
+                last_seen.pop(worker_id, None)
+                idle_since.pop(worker_id, None)
+                for chunk_index in [idx_ for idx_, wid_ in assigned.items() if wid_ == worker_id]:
+                    del assigned[chunk_index]
+                    requeue(chunk_index, "lost its worker")
+
+            # A worker waiting for work would have taken any chunk queued
+            # before it became idle
+            first_idle = min(idle_since.values(), default=np.inf)
+            for chunk_index, (_, put_time) in list(queued.items()):
+                taken_time = min(taken.get(chunk_index, np.inf), max(first_idle, put_time))
+                if now - taken_time > self.backend.heartbeat_timeout:
+                    requeue(chunk_index, "was taken and never started")
+
+            if isinstance(self.backend, LocalBackend) and len(lost) >= self.backend.n_workers:
+                raise RuntimeError("All the workers were lost")
+            if pending and now - last_progress > self.progress_timeout:
+                raise RuntimeError(f"No chunk started or completed in {self.progress_timeout:.0f} s")
@@ -0,0 +1,895 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Common base classes for the p(z) estimators wrapped in this package.
+
+These extend the `lsst.meas.pz.estimate_pz_task` classes by splitting
+estimation into an explicit photometry conversion step and an estimation
+step on the converted magnitudes, so that the outer task can do extra
+work in the same pass over the catalog.
+"""
+
+__all__ = [
+    "EstimatePZExtAlgoConfigBase",
+    "EstimatePZExtAlgoTask",
+    "EstimatePZExtTaskConnections",
+    "EstimatePZExtTaskConfig",
+    "EstimatePZExtTask",
+]
+
+import dataclasses
+import os
+import socket
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from astropy.table import Table
+from lsst.meas.pz.estimate_pz_task import (
+    EstimatePZAlgoConfigBase,
+    EstimatePZAlgoTask,
+    EstimatePZTask,
+    EstimatePZTaskConfig,
+    EstimatePZTaskConnections,
+)
+from lsst.pipe.base import (
+    InputQuantizedConnection,
+    OutputQuantizedConnection,
+    QuantumContext,
+    Struct,
+)
+from lsst.pipe.base import connectionTypes as cT
+from rail.core.model import Model
+from rail.estimation.estimator import CatEstimator
+from rail.interfaces import PZFactory
+
+from .dataset_names import INDEX_PREFIX, NZ_PREFIX, derived_name
+from .nz_accumulator import NzAccumulator, NzAccumulatorConfig
+from .openmetrics import MetricFamily, metrics_file_name, update_metrics_textfile
+from .pdf_grid import grid_ensemble, interp_to_grid, normalize_pdfs, pdf_name, pdfs_on_grid, read_zgrid
+from .pz_index import make_index_table
+from .resources import ChunkSizer, current_rss_bytes, peak_rss_bytes, thread_budget
+from .subquanta import part_name, read_subquantum_rows
+
+
+class EstimatePZExtAlgoConfigBase(EstimatePZAlgoConfigBase):
+    """Base class for configurations of the wrapped p(z) estimation algorithms
+
+    Sub-classes must implement `estimator_class` and call `_make_fields`,
+    exactly as for `EstimatePZAlgoConfigBase`.
+    """
+
+    precision = pexConfig.ChoiceField(
+        doc="Floating point precision used for the converted photometry and the output PDF grid",
+        dtype=str,
+        default="float64",
+        allowed={
+            "float64": "Double precision throughout",
+            "float32": "Single precision; only for algorithms whose inference runs in it",
+        },
+    )
+    zgrid_path = pexConfig.Field(
+        doc="Path of a non-uniform redshift grid saved with numpy.save, e.g. by pz_adaptive_grid.py, "
+        "on which gridded p(z) are stored instead of the uniform zmin..zmax grid",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+
+    def supports_float32(self) -> bool:
+        """Return whether the inference arithmetic of the algorithm stays in
+        float32 with ``precision="float32"``
+
+        Estimators that promote their inputs back to float64 return
+        `False`, so that asking them for float32 is an error rather than
+        a silent fallback.
+        """
+        return False
+
+    def validate(self) -> None:
+        super().validate()
+        if self.precision == "float32" and not self.supports_float32():
+            raise ValueError(
+                f"precision='float32' is not supported by {self.stage_name} with this configuration"
+            )
+
+
+class EstimatePZExtAlgoTask(EstimatePZAlgoTask):
+    """Base class for the wrapped algorithm specific p(z) estimation SubTasks
+
+    This keeps a warm estimator stage between calls, and exposes
+    the conversion and estimation steps separately.
+    """
+
+    ConfigClass = EstimatePZExtAlgoConfigBase
+    _DefaultName = "estimatePZExtAlgo"
+
+    small_batch_latency_ms: float | None = None
+    """Latency target of `estimate_array` on up to 100 objects with a warm
+    stage, in milliseconds, or `None` if the algorithm has no fast path;
+    checked by tests/test_extra_pz_perf.py when MEAS_PZ_CHECK_LATENCY is
+    set"""
+
+    grid_arrays_per_object: int = 4
+    """Rough number of redshift grid length float64 arrays held per object
+    at the peak of `estimate_mags`, used by `bytes_per_object`"""
+
+    def __init__(self, initInputs: dict[str, Any] | None = None, **kwargs: Any):
+        super().__init__(initInputs=initInputs, **kwargs)
+        self._estimator_stage: CatEstimator | None = None
+        self._estimator_model: Model | None = None
+        self._zgrid: np.ndarray | None = None
+        self._output_zgrid: np.ndarray | None = None
+        self.model_load_seconds = 0.0
+
+    def _get_stage_config(self) -> dict[str, Any]:
+        """Extract the estimator stage parameters from our config"""
+        stage_class = self.config.estimator_class()
+        config_dict = self.config.toDict()
+        stage_config = {
+            key: val
+            for key, val in config_dict.items()
+            if key in stage_class.config_options and val is not None
+        }
+        stage_config["output_mode"] = self.config.output_mode
+        return stage_config
+
+    def get_stage(self, pz_model: Model) -> CatEstimator:
+        """Return the estimator stage for a model, building it if needed
+
+        The stage is cached, so repeated calls with the same model
+        do not unpickle or re-initialize anything.
+        """
+        if self._estimator_stage is None or self._estimator_model is not pz_model:
+            start = time.perf_counter()
+            self._estimator_stage = PZFactory.build_stage_instance(
+                self.config.stage_name,
+                self.config.estimator_class(),
+                model_path=pz_model.data,
+                **self._get_stage_config(),
+            )
+            self._estimator_model = pz_model
+            self.model_load_seconds += time.perf_counter() - start
+        return self._estimator_stage
+
+    @property
+    def dtype(self) -> type[np.floating]:
+        """Floating point type used for the hot arithmetic of this algorithm"""
+        if self.config.precision == "float32":
+            return np.float32
+        return np.float64
+
+    def _cast_ensemble(self, pz_ensemble: qp.Ensemble) -> qp.Ensemble:
+        """Store a gridded output ensemble on `output_zgrid`, in our floating
+        point type
+        """
+        if pdf_name(pz_ensemble) != "interp":
+            return pz_ensemble
+        xvals = np.asarray(pz_ensemble.metadata["xvals"]).ravel()
+        yvals = np.atleast_2d(pz_ensemble.objdata["yvals"])
+        zgrid = self.output_zgrid
+        on_zgrid = xvals.shape == zgrid.shape and np.allclose(xvals, zgrid)
+        if self.config.zgrid_path is not None and not on_zgrid:
+            # Stages that only evaluate on their own grid are resampled
+            pdfs = normalize_pdfs(interp_to_grid(xvals, yvals, zgrid), zgrid)
+            return grid_ensemble(zgrid, pdfs.astype(self.dtype, copy=False), pz_ensemble.ancil)
+        if self.dtype is np.float64:
+            return pz_ensemble
+        return grid_ensemble(xvals, np.asarray(yvals, dtype=self.dtype), pz_ensemble.ancil)
+
+    def convert(self, fluxes: Table) -> dict[str, np.ndarray]:
+        """Convert the input fluxes to the magnitudes used by the estimator
+
+        Parameters
+        ----------
+        fluxes
+            Input catalog, with the columns given by `col_names`
+
+        Returns
+        -------
+        mags
+            Magnitudes and magnitude errors, keyed by column name
+        """
+        mags = self._get_mags_and_errs(fluxes, self.config.mag_offset)
+        if self.dtype is np.float64:
+            return mags
+        return {key: np.asarray(mags[key], dtype=self.dtype) for key in mags.keys()}
+
+    def estimate_mags(self, pz_model: Model, mags: dict[str, np.ndarray], n_rows: int) -> qp.Ensemble:
+        """Run the estimator on already converted magnitudes
+
+        Parameters
+        ----------
+        pz_model
+            Model for the estimator
+
+        mags
+            Magnitudes and magnitude errors, as returned by `convert`
+
+        n_rows
+            Number of objects in ``mags``
+
+        Returns
+        -------
+        pz_ensemble
+            The p(z) estimates
+        """
+        return self._cast_ensemble(PZFactory.estimate_single_pz(self.get_stage(pz_model), mags, n_rows))
+
+    def estimate_mags_into(
+        self,
+        pz_model: Model,
+        mags: dict[str, np.ndarray],
+        n_rows: int,
+        out: np.ndarray,
+    ) -> qp.Ensemble:
+        """Run the estimator, storing its gridded PDFs in a preallocated array
+
+        This is for algorithms whose `estimate_mags` gives ``interp``
+        ensembles, so that a caller estimating many chunks can fill one
+        buffer rather than concatenate the chunks.  This copies the PDFs
+        into ``out`` once; sub-classes whose estimators can write into
+        ``out`` directly override it.
+
+        Parameters
+        ----------
+        pz_model
+            Model for the estimator
+
+        mags
+            Magnitudes and magnitude errors, as returned by `convert`
+
+        n_rows
+            Number of objects in ``mags``
+
+        out
+            Output PDF values, shape ``(n_rows, n_grid)``, where ``n_grid``
+            is the grid size of the ensembles of `estimate_mags`
+
+        Returns
+        -------
+        pz_ensemble
+            The p(z) estimates, an ensemble wrapping ``out``
+
+        Raises
+        ------
+        ValueError
+            Raised if the estimates are not gridded, or not on a grid of
+            the size of ``out``
+        """
+        pz_ensemble = self.estimate_mags(pz_model, mags, n_rows)
+        if pdf_name(pz_ensemble) != "interp":
+            raise ValueError(f"{self.config.stage_name} does not give gridded p(z)")
+        yvals = np.atleast_2d(pz_ensemble.objdata["yvals"])
+        if yvals.shape != out.shape:
+            raise ValueError(f"Got p(z) of shape {yvals.shape} for an output of shape {out.shape}")
+        out[...] = yvals
+        return grid_ensemble(pz_ensemble.metadata["xvals"], out, pz_ensemble.ancil)
+
+    def _finish_stage_output(
+        self,
+        stage: CatEstimator,
+        pz_ensemble: qp.Ensemble,
+        mags: dict[str, np.ndarray],
+        n_rows: int,
+    ) -> qp.Ensemble:
+        """Pass an ensemble computed outside the stage through its output step
+
+        For sub-classes that replace the stage's chunk processing: this adds
+        the point estimates and ancillary columns the stage would have
+        added at the end of its own processing.
+        """
+        stage.data_store.clear()
+        stage._input_length = n_rows
+        stage._do_chunk_output(pz_ensemble, 0, n_rows, True, data=mags)
+        return self._cast_ensemble(stage._output_handle.data)
+
+    def estimate(self, pz_model: Model, fluxes: Table) -> qp.Ensemble:
+        """Convert the input fluxes and run the estimator on them"""
+        return self.estimate_mags(pz_model, self.convert(fluxes), len(fluxes))
+
+    @property
+    def zgrid(self) -> np.ndarray:
+        """Redshift grid of the PDF values returned by `estimate_array`"""
+        if self._zgrid is None:
+            self._zgrid = np.linspace(self.config.zmin, self.config.zmax, self.config.nzbins)
+            self._zgrid.flags.writeable = False
+        return self._zgrid
+
+    @property
+    def output_zgrid(self) -> np.ndarray:
+        """Redshift grid of the gridded ensembles returned by `estimate_mags`
+
+        This is the grid read from ``zgrid_path`` if it is set, and
+        `zgrid` otherwise.  Estimators that can evaluate their densities
+        on any grid do so directly; the others are resampled onto it.
+        """
+        if self.config.zgrid_path is None:
+            return self.zgrid
+        if self._output_zgrid is None:
+            self._output_zgrid = read_zgrid(self.config.zgrid_path)
+            self._output_zgrid.flags.writeable = False
+        return self._output_zgrid
+
+    def bytes_per_object(self) -> int:
+        """Estimate the peak memory used per object by `estimate_mags`
+
+        This counts the PDF grid arrays, the converted photometry and a
+        fixed allowance for the per-object tables and ancillary data.
+        """
+        n_columns = 2 * len(self.config.bands_to_convert)
+        return 8 * (self.grid_arrays_per_object * self.zgrid.size + 4 * n_columns) + 512
+
+    def chunk_overhead_bytes(self) -> int:
+        """Estimate the peak memory used by `estimate_mags` whatever the
+        number of objects, e.g. fixed size scratch arrays
+
+        Chunks for ``memory_budget_mb`` are sized to leave this much room
+        on top of `bytes_per_object` per object.
+        """
+        return 0
+
+    def band_flags(self, mags: dict[str, np.ndarray]) -> np.ndarray:
+        """Flag the unusable bands of each object
+
+        Parameters
+        ----------
+        mags
+            Magnitudes and magnitude errors, as returned by `convert`
+
+        Returns
+        -------
+        flags
+            Bit ``i`` is set where the magnitude or error of band ``i`` of
+            `array_columns` is not finite, or is the non-detection value
+        """
+        nondetect_val = getattr(self.config, "nondetect_val", np.nan)
+        mag_names, err_names = self.array_columns()
+        flags = np.zeros(len(mags[mag_names[0]]), dtype=np.int32)
+        for bit, (mag_name, err_name) in enumerate(zip(mag_names, err_names)):
+            mag = np.asarray(mags[mag_name])
+            bad = ~np.isfinite(mag) | ~np.isfinite(np.asarray(mags[err_name]))
+            if np.isfinite(nondetect_val):
+                bad |= np.isclose(mag, nondetect_val)
+            flags |= bad.astype(np.int32) << bit
+        return flags
+
+    def array_columns(self) -> tuple[list[str], list[str]]:
+        """Return the magnitude and error column names, in array order
+
+        Column ``i`` of the arrays taken by `estimate_array` holds the
+        magnitudes or errors named by entry ``i`` of these lists.
+        """
+        return self.config.get_mag_name_list(), self.config.get_mag_err_name_list()
+
+    def estimate_array(
+        self,
+        pz_model: Model,
+        mags: np.ndarray,
+        mag_errs: np.ndarray,
+        out: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Estimate the PDFs of a small batch of converted magnitudes
+
+        This is meant for a few to a few hundred objects at a time, e.g.
+        in prompt processing, with a warm stage: it skips the catalog
+        and column handling of `estimate`.  Sub-classes with a fast path
+        also skip building a `qp.Ensemble`, and only allocate small
+        temporaries besides ``out``.
+
+        Parameters
+        ----------
+        pz_model
+            Model for the estimator
+
+        mags, mag_errs
+            Magnitudes and magnitude errors, as returned by `convert`,
+            with the columns ordered as `array_columns`; shape
+            ``(n_obj, n_bands)``.  They are not modified.
+
+        out
+            Optional preallocated output, shape ``(n_obj, len(zgrid))``
+
+        Returns
+        -------
+        pdfs
+            PDF values on `zgrid`, each normalized to unit integral
+        """
+        mag_names, err_names = self.array_columns()
+        # The estimator stages may replace non-detections in place
+        mag_dict = {name_: np.array(mags[:, idx_]) for idx_, name_ in enumerate(mag_names)}
+        mag_dict.update({name_: np.array(mag_errs[:, idx_]) for idx_, name_ in enumerate(err_names)})
+        pdfs = pdfs_on_grid(self.estimate_mags(pz_model, mag_dict, mags.shape[0]), self.zgrid)
+        if out is None:
+            return pdfs.astype(self.dtype, copy=False)
+        out[...] = pdfs
+        return out
+
+
+@dataclass
+class _QuantumStats:
+    """Throughput statistics of one run of an estimator task"""
+
+    n_objects: int = 0
+    n_skipped: int = 0
+    wall_seconds: float = 0.0
+    stage_seconds: dict[str, float] = field(default_factory=dict)
+
+
+class EstimatePZExtTaskConnections(EstimatePZTaskConnections):
+    pzNz = cT.Output(
+        doc="Stacked p(z) in bins of a configurable quantity, per quantum; named after "
+        "pzEnsemble, e.g. pz_nz_fzboost for pz_estimate_fzboost, unless set explicitly",
+        name=NZ_PREFIX,
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+
+    pzIndex = cT.Output(
+        doc="Object IDs of pzEnsemble, sorted, with the row of each, per quantum; named after "
+        "pzEnsemble, e.g. pz_index_fzboost for pz_estimate_fzboost, unless set explicitly",
+        name=INDEX_PREFIX,
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+
+    pzMags = cT.Input(
+        doc="Magnitudes converted by ConvertMagsTask, read instead of the object table "
+        "if use_converted_mags is set",
+        name="pz_mags",
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+        deferLoad=True,
+    )
+
+    def __init__(self, *, config: "EstimatePZExtTaskConfig"):
+        super().__init__(config=config)
+        if not config.do_accumulate_nz:
+            del self.pzNz
+        elif config.connections.pzNz == NZ_PREFIX:
+            self.pzNz = dataclasses.replace(self.pzNz, name=derived_name(self.pzEnsemble.name, NZ_PREFIX))
+        if not config.do_write_index:
+            del self.pzIndex
+        elif config.connections.pzIndex == INDEX_PREFIX:
+            self.pzIndex = dataclasses.replace(
+                self.pzIndex, name=derived_name(self.pzEnsemble.name, INDEX_PREFIX)
+            )
+        if config.n_subquanta > 1:
+            # Each sub-quantum writes its part under its own dataset type
+            self.pzEnsemble = dataclasses.replace(
+                self.pzEnsemble, name=part_name(self.pzEnsemble.name, config.subquantum_index)
+            )
+            if config.do_accumulate_nz:
+                self.pzNz = dataclasses.replace(
+                    self.pzNz, name=part_name(self.pzNz.name, config.subquantum_index)
+                )
+            if config.do_write_index:
+                self.pzIndex = dataclasses.replace(
+                    self.pzIndex, name=part_name(self.pzIndex.name, config.subquantum_index)
+                )
+        if config.use_converted_mags:
+            # The converted magnitudes replace the object table
+            for name_ in list(self.inputs - {"pzMags"}):
+                delattr(self, name_)
+        else:
+            del self.pzMags
+
+
+class EstimatePZExtTaskConfig(EstimatePZTaskConfig, pipelineConnections=EstimatePZExtTaskConnections):
+    """Config for the tasks that run the wrapped p(z) estimation algorithms"""
+
+    do_accumulate_nz = pexConfig.Field(
+        doc="Accumulate stacked p(z) histograms while estimating, and write them as pzNz",
+        dtype=bool,
+        default=False,
+    )
+    nz_accumulator = pexConfig.ConfigField(
+        doc="How to bin and grid the stacked p(z) histograms",
+        dtype=NzAccumulatorConfig,
+    )
+    do_write_index = pexConfig.Field(
+        doc="Write the object IDs of the estimates, sorted, with their rows, as pzIndex; the rows "
+        "of sub-quanta are those of the whole patch",
+        dtype=bool,
+        default=False,
+    )
+    index_id_column = pexConfig.Field(
+        doc="Object ID column of the catalog, for do_write_index",
+        dtype=str,
+        default="objectId",
+    )
+    use_converted_mags = pexConfig.Field(
+        doc="Read the magnitudes written by ConvertMagsTask rather than converting the fluxes of "
+        "the object table; that task must use the same conversion settings as pz_algo",
+        dtype=bool,
+        default=False,
+    )
+    memory_budget_mb = pexConfig.Field(
+        doc="Memory budget of a quantum, in MB; the catalog is estimated in chunks sized to stay "
+        "under it, shrinking as the resident memory grows.  0 estimates the catalog in one go",
+        dtype=float,
+        default=0.0,
+    )
+    min_chunk_size = pexConfig.Field(
+        doc="Smallest number of objects estimated together when chunking for memory_budget_mb",
+        dtype=int,
+        default=1000,
+    )
+    n_subquanta = pexConfig.Field(
+        doc="Number of row-range sub-quanta each patch is split into; with more than one, this "
+        "task only estimates the rows of sub-quantum subquantum_index, and MergePZSubquantaTask "
+        "joins the parts",
+        dtype=int,
+        default=1,
+    )
+    subquantum_index = pexConfig.Field(
+        doc="Index of the sub-quantum estimated by this task, from 0 to n_subquanta - 1",
+        dtype=int,
+        default=0,
+    )
+    metrics_textfile_dir = pexConfig.Field(
+        doc="Directory of the Prometheus / OpenMetrics textfiles, for a textfile collector; each "
+        "node keeps one file per algorithm and metrics_preset, which every quantum updates: "
+        "counters add up, gauges describe the last quantum.  The numbers of each quantum are "
+        "in the task metadata.  None writes nothing",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    metrics_preset = pexConfig.Field(
+        doc="Survey preset used as the preset label of the metrics, e.g. hsc",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    num_threads = pexConfig.Field(
+        doc="Maximum number of threads BLAS, OpenMP and similar libraries may use while "
+        "estimating; 0 leaves the library defaults, which usually use every core",
+        dtype=int,
+        default=0,
+    )
+
+    def validate(self) -> None:
+        super().validate()
+        if not 0 <= self.subquantum_index < self.n_subquanta:
+            raise ValueError(
+                f"subquantum_index={self.subquantum_index} is not in [0, n_subquanta={self.n_subquanta})"
+            )
+
+
+class EstimatePZExtTask(EstimatePZTask):
+    """Base class for the tasks running the wrapped estimation algorithms"""
+
+    ConfigClass = EstimatePZExtTaskConfig
+    _DefaultName = "estimatePZExt"
+
+    def __init__(self, initInputs: dict[str, Any] | None = None, **kwargs: Any):
+        super().__init__(initInputs=initInputs, **kwargs)
+        self._quantum_stats = _QuantumStats()
+
+    @contextmanager
+    def _timed(self, stage: str) -> Iterator[None]:
+        """Add the time spent in a block to the seconds of a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_seconds = self._quantum_stats.stage_seconds
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + time.perf_counter() - start
+
+    def _get_nz_bin_values(
+        self,
+        accumulator: NzAccumulator,
+        mags: dict[str, np.ndarray],
+        pz_ensemble: qp.Ensemble,
+    ) -> np.ndarray:
+        """Get the per-object values used to pick the n(z) bins"""
+        nz_config = self.config.nz_accumulator
+        if nz_config.bin_by == "ref_band_mag":
+            return np.asarray(mags[nz_config.ref_band or self.pz_algo.config.ref_band])
+        return accumulator.point_estimates(pz_ensemble, nz_config.point_estimate)
+
+    def runQuantum(
+        self,
+        butlerQC: QuantumContext,
+        inputRefs: InputQuantizedConnection,
+        outputRefs: OutputQuantizedConnection,
+    ) -> None:
+        self._quantum_stats = _QuantumStats()
+        config = self.config
+        if not config.use_converted_mags and config.n_subquanta == 1 and not config.do_write_index:
+            super().runQuantum(butlerQC, inputRefs, outputRefs)
+        else:
+            self._run_quantum_rows(butlerQC, inputRefs, outputRefs)
+        self._record_quantum_stats()
+        if self.config.metrics_textfile_dir is not None:
+            node = socket.gethostname()
+            file_name = metrics_file_name(
+                f"pz_{self.pz_algo.config.stage_name}", self.config.metrics_preset or "none", node
+            )
+            self.write_metrics(os.path.join(self.config.metrics_textfile_dir, file_name), dict(node=node))
+
+    def _record_quantum_stats(self) -> None:
+        """Put the throughput of the last run in the task metadata"""
+        stats = self._quantum_stats
+        self.metadata["n_objects"] = stats.n_objects
+        self.metadata["n_skipped"] = stats.n_skipped
+        self.metadata["wall_seconds"] = stats.wall_seconds
+        for stage, seconds in stats.stage_seconds.items():
+            self.metadata[f"{stage}_seconds"] = seconds
+        self.metadata["objects_per_second"] = (
+            stats.n_objects / stats.wall_seconds if stats.wall_seconds > 0 else 0.0
+        )
+        self.metadata["peak_rss_mb"] = peak_rss_bytes() / 1024**2
+
+    def _run_quantum_rows(
+        self,
+        butlerQC: QuantumContext,
+        inputRefs: InputQuantizedConnection,
+        outputRefs: OutputQuantizedConnection,
+    ) -> None:
+        """Run on converted magnitudes or a sub-quantum's rows, and write
+        the object ID index
+        """
+        inputs = butlerQC.get(inputRefs)
+        pz_model = inputs.pop("pzModel")
+        id_column = self.config.index_id_column
+        # What is left is the deferred handle to the catalog
+        (catalog_handle,) = inputs.values()
+        columns = None
+        if not self.config.use_converted_mags:
+            columns = list(self.pz_algo.col_names())
+            if self.config.do_write_index and id_column not in columns:
+                columns.append(id_column)
+        if self.config.do_write_index and id_column not in catalog_handle.get(component="columns"):
+            raise ValueError(f"Missing {id_column} column in the catalog, needed by do_write_index")
+        catalog, rows = read_subquantum_rows(
+            catalog_handle, self.config.n_subquanta, self.config.subquantum_index, columns
+        )
+        self.metadata["subquantum_rows"] = [rows.start, rows.stop]
+        if rows.start == rows.stop:
+            outputs = self._empty_outputs()
+        elif self.config.use_converted_mags:
+            outputs = self.run_converted(pz_model, catalog)
+        else:
+            outputs = self.run(pz_model, catalog)
+        if self.config.do_write_index:
+            outputs.pzIndex = make_index_table(catalog[id_column], rows.start, id_column)
+        butlerQC.put(outputs, outputRefs)
+
+    def metric_families(self) -> list[MetricFamily]:
+        """Return the throughput metrics of the last run
+
+        Counters are meant to be added up over runs by
+        `update_metrics_textfile`; gauges describe the last run.
+        """
+        stats = self._quantum_stats
+        stage_seconds = MetricFamily(
+            "pz_stage_seconds_total", "Wall time per estimation stage, in seconds", "counter"
+        )
+        for stage, seconds in stats.stage_seconds.items():
+            stage_seconds.add(seconds, stage=stage)
+        return [
+            MetricFamily("pz_quanta_total", "Quanta estimated", "counter").add(1),
+            MetricFamily("pz_objects_processed_total", "Objects estimated", "counter").add(stats.n_objects),
+            MetricFamily(
+                "pz_objects_skipped_total",
+                "Objects with no usable band, which get no informative estimate",
+                "counter",
+            ).add(stats.n_skipped),
+            stage_seconds,
+            MetricFamily("pz_run_seconds_total", "Wall time of the estimation, in seconds", "counter").add(
+                stats.wall_seconds
+            ),
+            MetricFamily("pz_objects_per_second", "Estimation throughput of the last quantum").add(
+                stats.n_objects / stats.wall_seconds if stats.wall_seconds > 0 else 0.0
+            ),
+            MetricFamily("pz_peak_rss_bytes", "Peak resident memory of the process").add(peak_rss_bytes()),
+            MetricFamily("pz_last_run_timestamp_seconds", "Unix time at which the metrics were written").add(
+                time.time()
+            ),
+        ]
+
+    def write_metrics(self, path: str, labels: dict[str, str] | None = None) -> None:
+        """Merge the metrics of the last run into a textfile
+
+        Parameters
+        ----------
+        path
+            Output path, normally ending in ``.prom``, shared by the runs
+            with the same labels
+
+        labels
+            Extra labels of every sample, e.g. the node; they should not
+            identify the quantum, whose own numbers are in the task
+            metadata
+        """
+        common_labels = dict(
+            algorithm=self.pz_algo.config.stage_name,
+            preset=self.config.metrics_preset or "none",
+            **(labels or {}),
+        )
+        update_metrics_textfile(path, self.metric_families(), common_labels)
+
+    def _empty_outputs(self) -> Struct:
+        """Outputs of a sub-quantum past the end of a small catalog"""
+        zgrid = self.pz_algo.output_zgrid
+        ret_struct = Struct(
+            pzEnsemble=qp.Ensemble(qp.interp, data=dict(xvals=zgrid, yvals=np.empty((0, zgrid.size))))
+        )
+        if self.config.do_accumulate_nz:
+            ret_struct.pzNz = NzAccumulator.from_config(self.config.nz_accumulator).to_table()
+        return ret_struct
+
+    def _estimate(self, pz_model: Model, mags: dict[str, np.ndarray], n_rows: int) -> Struct:
+        accumulator = None
+        if self.config.do_accumulate_nz:
+            accumulator = NzAccumulator.from_config(self.config.nz_accumulator)
+        load_seconds = self.pz_algo.model_load_seconds
+        if self.config.memory_budget_mb <= 0 or n_rows <= self.config.min_chunk_size:
+            pz_ensemble = self._estimate_chunk(pz_model, mags, n_rows, accumulator)
+        else:
+            pz_ensemble = self._estimate_chunked(pz_model, mags, n_rows, accumulator)
+
+        # The model is loaded by the first estimate, so move its time
+        stats = self._quantum_stats
+        load_seconds = self.pz_algo.model_load_seconds - load_seconds
+        stats.stage_seconds["model_load"] = load_seconds
+        stats.stage_seconds["estimate"] = stats.stage_seconds.get("estimate", 0.0) - load_seconds
+        stats.n_objects = n_rows
+        stats.n_skipped = int(
+            np.count_nonzero(self.pz_algo.band_flags(mags) == (1 << len(self.pz_algo.array_columns()[0])) - 1)
+        )
+
+        ret_struct = Struct(pzEnsemble=pz_ensemble)
+        if accumulator is not None:
+            ret_struct.pzNz = accumulator.to_table()
+        return ret_struct
+
+    def _estimate_chunk(
+        self,
+        pz_model: Model,
+        mags: dict[str, np.ndarray],
+        n_rows: int,
+        accumulator: NzAccumulator | None,
+        out: np.ndarray | None = None,
+    ) -> qp.Ensemble:
+        with self._timed("estimate"):
+            if out is None:
+                pz_ensemble = self.pz_algo.estimate_mags(pz_model, mags, n_rows)
+            else:
+                pz_ensemble = self.pz_algo.estimate_mags_into(pz_model, mags, n_rows, out)
+        if accumulator is not None:
+            with self._timed("nz"):
+                accumulator.add(pz_ensemble, self._get_nz_bin_values(accumulator, mags, pz_ensemble))
+        return pz_ensemble
+
+    def _estimate_chunked(
+        self,
+        pz_model: Model,
+        mags: dict[str, np.ndarray],
+        n_rows: int,
+        accumulator: NzAccumulator | None,
+    ) -> qp.Ensemble:
+        """Estimate in row chunks sized to stay under memory_budget_mb
+
+        Gridded estimates are written into one buffer for the whole
+        catalog, allocated after the first chunk, so the chunks do not
+        need to be concatenated at the end.
+        """
+        sizer = ChunkSizer(
+            int(self.config.memory_budget_mb * 1024**2),
+            self.pz_algo.bytes_per_object(),
+            min_chunk_size=self.config.min_chunk_size,
+            fixed_bytes=self.pz_algo.chunk_overhead_bytes(),
+        )
+        pieces = []
+        pdf_buffer = None
+        start = 0
+        while start < n_rows:
+            chunk_size = sizer.next_chunk_size(n_rows - start)
+            if sizer.over_budget:
+                self.log.warning(
+                    "Resident memory %.0f MB is close to the %.0f MB budget, estimating %d objects",
+                    current_rss_bytes() / 1024**2,
+                    self.config.memory_budget_mb,
+                    chunk_size,
+                )
+            stop = start + chunk_size
+            chunk_mags = {key: val[start:stop] for key, val in mags.items()}
+            out = None if pdf_buffer is None else pdf_buffer[start:stop]
+            pieces.append(self._estimate_chunk(pz_model, chunk_mags, chunk_size, accumulator, out=out))
+            if start == 0 and stop < n_rows and pdf_name(pieces[0]) == "interp":
+                yvals = np.atleast_2d(pieces[0].objdata["yvals"])
+                pdf_buffer = np.empty((n_rows, yvals.shape[1]), dtype=yvals.dtype)
+                pdf_buffer[:stop] = yvals
+                # Let the first chunk's own array go
+                pieces[0] = grid_ensemble(pieces[0].metadata["xvals"], pdf_buffer[:stop], pieces[0].ancil)
+            sizer.chunk_done()
+            start = stop
+        self.metadata["n_chunks"] = len(sizer.chunk_sizes)
+        self.metadata["min_chunk_rows"] = min(sizer.chunk_sizes, default=0)
+        self.metadata["max_chunk_rows"] = max(sizer.chunk_sizes, default=0)
+        self.metadata["peak_rss_mb"] = peak_rss_bytes() / 1024**2
+        if len(pieces) == 1:
+            return pieces[0]
+        if pdf_buffer is None:
+            return qp.concatenate(pieces)
+        ancil = None
+        if pieces[0].ancil:
+            ancil = {
+                key_: np.concatenate([np.asarray(piece_.ancil[key_]) for piece_ in pieces])
+                for key_ in pieces[0].ancil
+            }
+        return grid_ensemble(pieces[0].metadata["xvals"], pdf_buffer, ancil)
+
+    def run(self, pz_model: Model, fluxes: Table) -> Struct:
+        self._quantum_stats = _QuantumStats()
+        start = time.perf_counter()
+        with thread_budget(self.config.num_threads) as num_threads:
+            self.metadata["num_threads"] = num_threads
+            with self._timed("convert"):
+                mags = self.pz_algo.convert(fluxes)
+            ret_struct = self._estimate(pz_model, mags, len(fluxes))
+        self._quantum_stats.wall_seconds = time.perf_counter() - start
+        return ret_struct
+
+    def run_converted(self, pz_model: Model, pz_mags: Table) -> Struct:
+        """Run the estimator on magnitudes written by ConvertMagsTask
+
+        Parameters
+        ----------
+        pz_model
+            Model for the estimator
+
+        pz_mags
+            Converted magnitudes, with at least the columns returned by
+            ``pz_algo.array_columns``
+
+        Returns
+        -------
+        result
+            Struct with the same outputs as `run`
+        """
+        self._quantum_stats = _QuantumStats()
+        start = time.perf_counter()
+        mag_names, err_names = self.pz_algo.array_columns()
+        missing = [name_ for name_ in mag_names + err_names if name_ not in pz_mags.colnames]
+        if missing:
+            raise ValueError(f"Converted magnitudes are missing columns {missing}")
+        dtype = self.pz_algo.dtype
+        with self._timed("convert"):
+            mags = {
+                name_: np.asarray(pz_mags[name_], dtype=dtype)
+                if np.issubdtype(pz_mags[name_].dtype, np.floating)
+                else np.asarray(pz_mags[name_])
+                for name_ in pz_mags.colnames
+            }
+        with thread_budget(self.config.num_threads) as num_threads:
+            self.metadata["num_threads"] = num_threads
+            ret_struct = self._estimate(pz_model, mags, len(pz_mags))
+        self._quantum_stats.wall_seconds = time.perf_counter() - start
+        return ret_struct
@@ -0,0 +1,296 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Batched evaluation of FlexCode conditional density estimates.
+
+`flexcode.FlexCodeModel.predict` rebuilds the basis matrix on every call
+and post-processes the densities one row at a time with
+`numpy.apply_along_axis`.  The functions here do the same computation on
+a whole chunk at once: the basis matrix is cached per grid, and the
+normalization, bump removal and sharpening steps work on all the rows
+together.  They assume densities on the evenly spaced unit grid, as in
+flexcode, unless given the quadrature weights of another grid, see
+`unit_grid_weights`.
+"""
+
+__all__ = [
+    "BatchedFlexCodeModel",
+    "basis_matrix",
+    "normalize_cdes",
+    "remove_bumps_cdes",
+    "sharpen_cdes",
+    "unit_grid_weights",
+]
+
+from functools import lru_cache
+from typing import Any
+
+import numpy as np
+from flexcode.basis_functions import evaluate_basis
+from flexcode.helpers import make_grid
+
+
+@lru_cache(maxsize=16)
+def _basis_matrix(
+    n_grid: int,
+    best_basis: tuple[int, ...],
+    basis_system: str,
+    z_unit: tuple[float, ...] | None,
+) -> np.ndarray:
+    points = make_grid(n_grid, 0.0, 1.0) if z_unit is None else np.array(z_unit).reshape(-1, 1)
+    z_basis = evaluate_basis(points, max(best_basis) + 1, basis_system)
+    z_basis = np.ascontiguousarray(z_basis[:, list(best_basis)].T)
+    z_basis.flags.writeable = False
+    return z_basis
+
+
+def basis_matrix(
+    n_grid: int,
+    best_basis: Any,
+    basis_system: str,
+    z_unit: np.ndarray | None = None,
+) -> np.ndarray:
+    """Return the transposed basis matrix for a unit grid
+
+    The matrix has shape ``(n_basis, n_grid)``.  It is cached, and must
+    not be modified.
+
+    Parameters
+    ----------
+    n_grid
+        Number of points in the grid
+
+    best_basis
+        Indices of the basis functions kept by the model
+
+    basis_system
+        Name of the flexcode basis system
+
+    z_unit
+        Optional grid points in [0, 1], shape ``(n_grid,)``, replacing the
+        evenly spaced grid
+    """
+    if z_unit is not None:
+        z_unit = tuple(float(z_) for z_ in np.ravel(z_unit))
+        if len(z_unit) != n_grid:
+            raise ValueError(f"Got {len(z_unit)} grid points for a grid of {n_grid}")
+    return _basis_matrix(int(n_grid), tuple(int(idx_) for idx_ in best_basis), basis_system, z_unit)
+
+
+def unit_grid_weights(z_unit: np.ndarray) -> np.ndarray:
+    """Return trapezoid quadrature weights for points spanning [0, 1]
+
+    With these weights, the post-processing functions treat densities on
+    a non-uniform grid as flexcode treats densities on the evenly spaced
+    grid, whose weights are all ``1 / n_grid``.
+    """
+    dz = np.diff(np.asarray(z_unit, dtype=float))
+    weights = np.zeros(dz.size + 1)
+    weights[:-1] += 0.5 * dz
+    weights[1:] += 0.5 * dz
+    return weights
+
+
+def _grid_area(cdes: np.ndarray, weights: np.ndarray | None) -> np.ndarray:
+    """Area of each row of non-negative densities"""
+    if weights is None:
+        return np.mean(cdes, axis=1)
+    return cdes @ weights
+
+
+def normalize_cdes(
+    cdes: np.ndarray,
+    tol: float = 1e-6,
+    max_iter: int = 200,
+    weights: np.ndarray | None = None,
+) -> None:
+    """Make densities non-negative and integrate to one, in place
+
+    This matches `flexcode.post_processing.normalize` row by row: rows
+    with an area below one are rescaled, others are shifted down by a
+    bisection search.  The bisection runs on all the unconverged rows at
+    once.
+
+    Parameters
+    ----------
+    cdes
+        Densities on the unit grid, shape ``(n_obj, n_grid)``
+
+    tol
+        Tolerance on the area
+
+    max_iter
+        Maximum number of bisection steps
+
+    weights
+        Optional quadrature weights of the grid points, from
+        `unit_grid_weights`; by default the grid is evenly spaced
+    """
+    max_val = cdes.max(axis=1)
+    area = _grid_area(np.maximum(cdes, 0.0), weights)
+    # As in flexcode, densities with no positive values are replaced by
+    # a constant, which still goes through the bisection search
+    empty = area == 0.0
+    cdes[empty] = 1.0
+    rescale = ~empty & (area < 1.0)
+    cdes[rescale] /= area[rescale, np.newaxis]
+
+    rows = np.flatnonzero(~rescale)
+    if rows.size:
+        density = cdes[rows]
+        hi = max_val[rows]
+        lo = np.zeros_like(hi)
+        mid = np.zeros_like(hi)
+        active = np.arange(rows.size)
+        for _ in range(max_iter):
+            mid[active] = (hi[active] + lo[active]) / 2
+            area = _grid_area(np.maximum(density[active] - mid[active, np.newaxis], 0.0), weights)
+            unconverged = np.abs(1.0 - area) > tol
+            active, area = active[unconverged], area[unconverged]
+            if not active.size:
+                break
+            low_area = area < 1.0
+            hi[active[low_area]] = mid[active[low_area]]
+            lo[active[~low_area]] = mid[active[~low_area]]
+        cdes[rows] = density - mid[:, np.newaxis]
+    np.maximum(cdes, 0.0, out=cdes)
+
+
+def remove_bumps_cdes(cdes: np.ndarray, delta: float, weights: np.ndarray | None = None) -> None:
+    """Remove small isolated bumps from densities, in place
+
+    This matches `flexcode.post_processing.remove_bumps`: every run of
+    positive values whose area is below ``delta`` is zeroed, together
+    with the non-positive value ending it, and the densities are
+    normalized again.
+
+    Parameters
+    ----------
+    cdes
+        Densities on the unit grid, shape ``(n_obj, n_grid)``
+
+    delta
+        Area threshold below which a bump is removed
+
+    weights
+        Optional quadrature weights of the grid points, from
+        `unit_grid_weights`; by default the grid is evenly spaced
+    """
+    n_obj, n_grid = cdes.shape
+    positive = cdes > 0.0
+    # Each value belongs to the run ended by the next non-positive value
+    run_index = np.cumsum(~positive, axis=1) - ~positive
+    run_index += (n_grid + 1) * np.arange(n_obj)[:, np.newaxis]
+    point_weights = np.full(n_grid, 1.0 / n_grid) if weights is None else weights
+    run_area = np.bincount(
+        run_index.ravel(),
+        weights=(np.where(positive, cdes, 0.0) * point_weights).ravel(),
+        minlength=n_obj * (n_grid + 1),
+    )
+    cdes[run_area[run_index] < delta] = 0.0
+    normalize_cdes(cdes, max_iter=500, weights=weights)
+
+
+def sharpen_cdes(cdes: np.ndarray, alpha: float, weights: np.ndarray | None = None) -> None:
+    """Sharpen densities by raising them to a power and normalizing"""
+    cdes **= alpha
+    normalize_cdes(cdes, weights=weights)
+
+
+class BatchedFlexCodeModel:
+    """Trained `flexcode.FlexCodeModel` with a batched `predict`
+
+    Everything other than `predict` is forwarded to the wrapped model, so
+    this can replace the model of a `FlexZBoostEstimator` stage.
+
+    Parameters
+    ----------
+    model
+        The trained model
+
+    dtype
+        Floating point type of the densities
+    """
+
+    def __init__(self, model: Any, dtype: type[np.floating] = np.float64):
+        self._model = model
+        self.dtype = dtype
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._model, name)
+
+    def predict(
+        self,
+        x_new: np.ndarray,
+        n_grid: int,
+        out: np.ndarray | None = None,
+        z_grid: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Predict conditional densities, as `flexcode.FlexCodeModel.predict`
+
+        With a non-uniform ``z_grid``, the basis functions are evaluated
+        at its points, and the normalization and bump removal integrate
+        with trapezoid weights; the evaluation cost scales with ``n_grid``.
+
+        Parameters
+        ----------
+        x_new
+            Features, shape ``(n_obj, n_features)``
+
+        n_grid
+            Number of points in the redshift grid
+
+        out
+            Optional preallocated output, shape ``(n_obj, n_grid)``
+
+        z_grid
+            Optional redshift grid of ``n_grid`` increasing points from
+            ``z_min`` to ``z_max``, replacing the evenly spaced grid
+
+        Returns
+        -------
+        cdes
+            Densities on the redshift grid
+
+        z_grid
+            The redshift grid, shape ``(n_grid, 1)``
+        """
+        model = self._model
+        if x_new.ndim == 1:
+            x_new = x_new.reshape(-1, 1)
+        coefs = np.asarray(model.model.predict(x_new))[:, model.best_basis]
+        z_unit, weights = None, None
+        if z_grid is not None:
+            z_unit = (np.ravel(z_grid) - model.z_min) / (model.z_max - model.z_min)
+            weights = unit_grid_weights(z_unit)
+        z_basis = basis_matrix(n_grid, model.best_basis, model.basis_system, z_unit=z_unit)
+        dtype = out.dtype if out is not None else self.dtype
+        cdes = np.matmul(coefs.astype(dtype, copy=False), z_basis.astype(dtype, copy=False), out=out)
+
+        normalize_cdes(cdes, weights=weights)
+        if model.bump_threshold is not None:
+            remove_bumps_cdes(cdes, model.bump_threshold, weights=weights)
+        if model.sharpen_alpha is not None:
+            sharpen_cdes(cdes, model.sharpen_alpha, weights=weights)
+        cdes /= model.z_max - model.z_min
+        if z_grid is None:
+            return cdes, make_grid(n_grid, model.z_min, model.z_max)
+        return cdes, np.ravel(z_grid).reshape(-1, 1)
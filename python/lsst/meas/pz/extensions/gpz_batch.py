@@ -0,0 +1,287 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Batched prediction with a trained GPz model.
+
+This reproduces the prediction path of the GPz ``GP`` class used by
+`rail.estimation.algos.gpz.GPzEstimator`, without its per-basis-function
+python loops and without modifying the input columns.  Rows are
+processed in blocks written into preallocated outputs, so the
+temporaries stay bounded for any catalog size.  The prediction can run
+in float32, with the model parameters cast once per call.
+"""
+
+__all__ = [
+    "gaussian_mode",
+    "gaussian_pdfs",
+    "predict_gaussian",
+    "prepare_features",
+]
+
+from collections.abc import Mapping
+from typing import Any
+
+import numpy as np
+
+from .pdf_grid import normalize_pdfs
+
+
+def prepare_features(
+    mags: Mapping[str, np.ndarray],
+    bands: list[str],
+    err_bands: list[str],
+    nondetect_val: float,
+    mag_limits: Mapping[str, float],
+    log_errors: bool,
+    replace_error_vals: list[float],
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Build the GPz feature array: magnitudes then (log) magnitude errors
+
+    This gives the same features as the preparation of GPzEstimator:
+    non-finite magnitudes, and those close to ``nondetect_val``, are
+    replaced by the band limits, with an error feature of one set after
+    the log; errors that are not positive and finite are replaced by
+    ``replace_error_vals`` before the log.  Unlike GPzEstimator, the
+    inputs are left untouched.
+
+    Parameters
+    ----------
+    mags
+        Magnitudes and magnitude errors, keyed by column name
+
+    bands, err_bands
+        Names of the magnitude and magnitude error columns
+
+    nondetect_val
+        Magnitude value flagging a non-detection
+
+    mag_limits
+        Limiting magnitude of each band; as in GPzEstimator, the values
+        are taken in the order of ``bands``, whatever their keys
+
+    log_errors
+        Use the log of the magnitude errors as features
+
+    replace_error_vals
+        Error used for each band where the error is not positive and finite
+
+    out
+        Optional preallocated output, shape ``(n_obj, 2 * len(bands))``
+
+    Returns
+    -------
+    features
+        Feature array, shape ``(n_obj, 2 * len(bands))``
+    """
+    n_bands = len(bands)
+    n_obj = len(mags[bands[0]])
+    if out is None:
+        out = np.empty((n_obj, 2 * n_bands))
+    mag_part, err_part = out[:, :n_bands], out[:, n_bands:]
+    for i, (band, err_band) in enumerate(zip(bands, err_bands)):
+        mag_part[:, i] = mags[band]
+        err_part[:, i] = mags[err_band]
+
+    nondetect = np.isclose(mag_part, nondetect_val) | ~np.isfinite(mag_part)
+    limits = np.asarray(list(mag_limits.values())[:n_bands], dtype=out.dtype)
+    np.copyto(mag_part, limits, where=nondetect)
+    bad_err = (err_part <= 0.0) | ~np.isfinite(err_part)
+    np.copyto(err_part, np.asarray(replace_error_vals, dtype=out.dtype), where=bad_err)
+    if log_errors:
+        np.log(err_part, out=err_part)
+    err_part[nondetect] = 1.0
+    return out
+
+
+def _sq_dist(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Squared euclidean distances between the rows of two arrays"""
+    return np.sum(x**2, axis=1)[:, np.newaxis] + np.sum(y**2, axis=1)[np.newaxis, :] - 2.0 * (x @ y.T)
+
+
+def _decorrelate(pca: Any, x: np.ndarray) -> np.ndarray:
+    """Apply the whitening PCA of a GPz model in the floating point type
+    of ``x``
+
+    This is ``PCA.transform``, which would promote float32 rows to float64.
+    """
+    x_t = (x - pca.mean_.astype(x.dtype)) @ pca.components_.T.astype(x.dtype)
+    if pca.whiten:
+        x_t /= np.sqrt(pca.explained_variance_).astype(x.dtype)
+    return x_t
+
+
+def _basis_functions(gp: Any, theta: np.ndarray, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Evaluate the GPz basis functions and the log noise precision
+
+    This is ``GP.getPHI`` for all the sparse GP methods, with the loops over
+    basis functions replaced by matrix products.
+    """
+    n_obj, n_dim = x.shape
+    m, k, method = gp.m, gp.k, gp.method
+    a_dim = m + n_dim + 1 if gp.joint else m
+    centers = theta[: m * n_dim].reshape(m, n_dim)
+    offset = m * n_dim
+
+    if method == "GL":
+        gamma = theta[offset:offset + 1]
+        ln_phi = -0.5 * _sq_dist(x, centers) * gamma**2
+    elif method == "VL":
+        gamma = theta[offset:offset + m]
+        ln_phi = -0.5 * _sq_dist(x, centers) * gamma**2
+    elif method == "GD":
+        gamma = theta[offset:offset + n_dim]
+        ln_phi = -0.5 * _sq_dist(x * gamma, centers * gamma)
+    elif method == "VD":
+        gamma = theta[offset:offset + m * n_dim].reshape(m, n_dim)
+        gamma2 = gamma**2
+        ln_phi = -0.5 * (
+            x**2 @ gamma2.T - 2.0 * x @ (centers * gamma2).T + np.sum(centers**2 * gamma2, axis=1)
+        )
+    elif method == "GC":
+        gamma = theta[offset:offset + n_dim * n_dim].reshape(n_dim, n_dim)
+        ln_phi = -0.5 * _sq_dist(x @ gamma.T, centers @ gamma.T)
+    else:
+        gamma = theta[offset:offset + n_dim * n_dim * m].reshape(n_dim, n_dim, m)
+        # Project the objects and the centers with the matrix of each basis
+        # function
+        x_proj = np.einsum("nd,edm->nme", x, gamma)
+        x_proj -= np.einsum("md,edm->me", centers, gamma)
+        ln_phi = -0.5 * np.einsum("nme,nme->nm", x_proj, x_proj)
+
+    offset += gamma.size + a_dim * k
+    ln_beta = np.broadcast_to(theta[offset:offset + k], (n_obj, k))
+    phi = np.exp(ln_phi)
+    if gp.heteroscedastic:
+        ln_beta = ln_beta + phi @ theta[offset + k:offset + k + m * k].reshape(m, k)
+    if gp.joint:
+        phi = np.hstack([phi, x, np.ones((n_obj, 1), dtype=x.dtype)])
+    return phi, ln_beta
+
+
+def predict_gaussian(
+    gp: Any,
+    features: np.ndarray,
+    block_size: int = 10000,
+    out_mean: np.ndarray | None = None,
+    out_var: np.ndarray | None = None,
+    dtype: type[np.floating] = np.float64,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Predict the mean and total variance of the redshift with a GPz model
+
+    This gives the same ``mu`` and ``sigma`` as ``GP.predict``, to within
+    the rounding of ``dtype``; models using the "ANN" method go through
+    ``GP.predict`` itself, in float64.
+
+    Parameters
+    ----------
+    gp
+        Trained GPz ``GP`` model
+
+    features
+        Features from `prepare_features`, shape ``(n_obj, n_features)``
+
+    block_size
+        Number of objects processed together
+
+    out_mean, out_var
+        Optional preallocated outputs, shape ``(n_obj,)``
+
+    dtype
+        Floating point type of the arithmetic and of the outputs allocated
+        here
+
+    Returns
+    -------
+    mean, var
+        Predicted mean and variance of the first output of the model
+    """
+    n_obj = features.shape[0]
+    if out_mean is None:
+        out_mean = np.empty(n_obj, dtype=dtype)
+    if out_var is None:
+        out_var = np.empty(n_obj, dtype=dtype)
+    if gp.method != "ANN":
+        theta = gp.best_theta.astype(dtype, copy=False)
+        weights = gp.best_w[:, 0].astype(dtype)
+        linear_weights = gp.wL[:, 0].astype(dtype)
+        sigma_inv = gp.best_SIGMAi[:, :, 0].astype(dtype)
+
+    for start in range(0, n_obj, block_size):
+        stop = min(start + block_size, n_obj)
+        x = features[start:stop]
+        if gp.method == "ANN":
+            mu, sigma, _, _, _ = gp.predict(x)
+            out_mean[start:stop] = mu[:, 0]
+            out_var[start:stop] = sigma[:, 0]
+            continue
+        x = np.asarray(x, dtype=dtype)
+        if gp.decorrelate:
+            x = _decorrelate(gp.pca, x)
+        phi, ln_beta = _basis_functions(gp, theta, x)
+        out_mean[start:stop] = (phi @ weights) + (x @ linear_weights) + dtype(gp.muY[0])
+        model_var = np.einsum("ij,ij->i", phi @ sigma_inv, phi)
+        out_var[start:stop] = model_var + np.exp(-ln_beta[:, 0])
+    return out_mean, out_var
+
+
+def gaussian_mode(mean: np.ndarray, zgrid: np.ndarray) -> np.ndarray:
+    """Return the point of a sorted grid where Gaussians with these means peak
+
+    This is what `qp.Ensemble.mode` gives for a normal ensemble, without
+    evaluating the PDFs on the grid.
+    """
+    idx = np.clip(np.searchsorted(zgrid, mean), 1, zgrid.size - 1)
+    # On a tie the lower grid point wins, as with argmax
+    idx -= (mean - zgrid[idx - 1]) <= (zgrid[idx] - mean)
+    return zgrid[idx]
+
+
+def gaussian_pdfs(
+    mean: np.ndarray,
+    var: np.ndarray,
+    zgrid: np.ndarray,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Evaluate Gaussians on a grid, normalized to unit integral over it
+
+    This matches `pdf_grid.pdfs_on_grid` for a normal ensemble, without
+    building the ensemble, and without temporaries the size of the
+    output.
+
+    Parameters
+    ----------
+    mean, var
+        Means and variances, shape ``(n_obj,)``
+
+    zgrid
+        Grid points, shape ``(n_grid,)``
+
+    out
+        Optional preallocated output, shape ``(n_obj, n_grid)``
+    """
+    if out is None:
+        out = np.empty((mean.size, zgrid.size))
+    np.subtract(zgrid[np.newaxis, :], mean[:, np.newaxis], out=out)
+    out *= out
+    out /= (-2.0 * var)[:, np.newaxis]
+    np.exp(out, out=out)
+    return normalize_pdfs(out, zgrid)
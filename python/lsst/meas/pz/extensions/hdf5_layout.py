@@ -0,0 +1,394 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Chunked and compressed HDF5 layout for `qp.Ensemble` files.
+
+`qp.Ensemble.write_to` stores every table column as one contiguous,
+uncompressed dataset, so files are large, and reading a few rows of a
+compressed copy would mean decompressing whole columns.  The files
+written by `write_ensemble_hdf5` hold the same groups and datasets, and
+are read back by `qp.read`, but the per-object datasets are split in
+chunks of whole rows, each compressed on its own.  `read_ensemble_rows`
+then only decompresses the chunks overlapping the requested rows.
+
+The layout used is stored in the ``pz_hdf5_layout`` attribute of the
+file, see `read_hdf5_layout`.  The ``zstd`` and ``blosc_lz4`` filters
+need the ``hdf5plugin`` package, both to write and to read.
+
+This layout is only used by the offline writers of this package, the
+batch estimation of `batch_estimate` and the shards of
+`sharded_ensemble`.  The ``pz_estimate_*`` outputs of the pipeline tasks
+are written by the butler formatter of their storage class, which calls
+`qp.Ensemble.write_to`, so they keep the contiguous, uncompressed layout
+and `read_ensemble_rows` reads them without any speed-up.
+"""
+
+__all__ = [
+    "Hdf5LayoutConfig",
+    "LayoutBenchmarkResult",
+    "available_compressions",
+    "benchmark_layout",
+    "format_layout_benchmark",
+    "read_ensemble_rows",
+    "read_ensemble_selection",
+    "read_hdf5_layout",
+    "write_ensemble_hdf5",
+]
+
+import json
+import os
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Any
+
+import h5py
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from astropy.table import Table
+
+from .pdf_grid import resample_ensemble
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+LAYOUT_ATTRIBUTE = "pz_hdf5_layout"
+
+# Tables of qp.Ensemble.build_tables with one row per object
+_ROW_TABLES = ("data", "ancil")
+
+
+def available_compressions() -> list[str]:
+    """Return the compression filters usable in this environment"""
+    names = ["none", "lzf", "gzip"]
+    if hdf5plugin is not None:
+        names += ["zstd", "blosc_lz4"]
+    return names
+
+
+class Hdf5LayoutConfig(pexConfig.Config):
+    """Config for the HDF5 layout of ensemble files
+
+    Notes
+    -----
+    Only applies to the files written by `write_ensemble_hdf5`, not to
+    the pipeline ``pz_estimate_*`` outputs written by the butler.
+    """
+
+    chunk_rows = pexConfig.Field(
+        doc="Number of objects per HDF5 chunk, which is the smallest unit read and decompressed; "
+        "0 writes contiguous, uncompressed datasets as qp does",
+        dtype=int,
+        default=256,
+    )
+    compression = pexConfig.ChoiceField(
+        doc="Compression filter of the chunks",
+        dtype=str,
+        default="lzf",
+        allowed={
+            "none": "No compression",
+            "lzf": "Fast compression built in h5py",
+            "gzip": "Standard deflate; slower, but readable by any HDF5 library",
+            "zstd": "Zstandard, from hdf5plugin",
+            "blosc_lz4": "Blosc with LZ4 and byte shuffling, from hdf5plugin",
+        },
+    )
+    compression_level = pexConfig.Field(
+        doc="Compression level of gzip (0-9), zstd (1-22) or blosc (1-9); 0 is the filter default for "
+        "zstd and blosc",
+        dtype=int,
+        default=1,
+    )
+    shuffle = pexConfig.Field(
+        doc="Shuffle the bytes before compressing, which helps floating point data",
+        dtype=bool,
+        default=True,
+    )
+
+    def validate(self) -> None:
+        super().validate()
+        if self.chunk_rows < 0:
+            raise ValueError(f"chunk_rows must not be negative, got {self.chunk_rows}")
+        if self.compression not in available_compressions():
+            raise ValueError(f"Compression {self.compression} needs the hdf5plugin package")
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the layout as a json-able dict"""
+        return dict(
+            chunk_rows=self.chunk_rows,
+            compression=self.compression,
+            compression_level=self.compression_level,
+            shuffle=self.shuffle,
+        )
+
+    def dataset_options(self, shape: tuple[int, ...]) -> dict[str, Any]:
+        """Return the `h5py.Group.create_dataset` options for a per-object
+        dataset of a given shape
+        """
+        if self.chunk_rows == 0 or not shape or shape[0] == 0:
+            return {}
+        options: dict[str, Any] = dict(chunks=(min(self.chunk_rows, shape[0]),) + tuple(shape[1:]))
+        if self.compression == "lzf":
+            options.update(compression="lzf", shuffle=self.shuffle)
+        elif self.compression == "gzip":
+            options.update(compression="gzip", compression_opts=self.compression_level, shuffle=self.shuffle)
+        elif self.compression == "zstd":
+            options.update(hdf5plugin.Zstd(clevel=self.compression_level or 3), shuffle=self.shuffle)
+        elif self.compression == "blosc_lz4":
+            shuffle = hdf5plugin.Blosc.SHUFFLE if self.shuffle else hdf5plugin.Blosc.NOSHUFFLE
+            options.update(hdf5plugin.Blosc(cname="lz4", clevel=self.compression_level or 5, shuffle=shuffle))
+        return options
+
+
+def write_ensemble_hdf5(
+    ensemble: qp.Ensemble,
+    path: str,
+    layout: Hdf5LayoutConfig | None = None,
+) -> None:
+    """Write an ensemble to an HDF5 file readable by `qp.read`
+
+    Parameters
+    ----------
+    ensemble
+        The ensemble to write
+
+    path
+        Output file, replaced if it exists
+
+    layout
+        Chunking and compression of the per-object datasets; `None` uses
+        the defaults of `Hdf5LayoutConfig`
+
+    Notes
+    -----
+    This is not hooked into the butler: pipeline outputs are written by
+    the formatter of their storage class and do not use this layout.
+    """
+    if layout is None:
+        layout = Hdf5LayoutConfig()
+    layout.validate()
+    tables = ensemble.build_tables()
+    with h5py.File(path, "w") as fout:
+        fout.attrs[LAYOUT_ATTRIBUTE] = json.dumps(layout.to_dict())
+        for table_name, table in tables.items():
+            group = fout.create_group(table_name)
+            for key, val in table.items():
+                val = np.asarray(val)
+                options = layout.dataset_options(val.shape) if table_name in _ROW_TABLES else {}
+                group.create_dataset(key, data=val, **options)
+
+
+def read_hdf5_layout(path: str) -> dict[str, Any] | None:
+    """Return the layout recorded by `write_ensemble_hdf5`, or `None` for
+    files written otherwise
+    """
+    with h5py.File(path, "r") as fin:
+        layout = fin.attrs.get(LAYOUT_ATTRIBUTE)
+    return None if layout is None else json.loads(layout)
+
+
+def read_ensemble_rows(path: str, start: int, stop: int, grid: np.ndarray | None = None) -> qp.Ensemble:
+    """Read a contiguous range of rows of an ensemble file
+
+    Only the HDF5 chunks overlapping the rows are read, so this is cheap
+    for files from `write_ensemble_hdf5`; it also works for files from
+    `qp.Ensemble.write_to`.
+
+    Parameters
+    ----------
+    path
+        Ensemble file
+
+    start
+        First row (inclusive)
+
+    stop
+        Last row (exclusive); clipped to the number of rows
+
+    grid
+        Optional redshift grid to resample the PDFs onto, see
+        `pdf_grid.resample_ensemble`
+
+    Returns
+    -------
+    ensemble
+        The requested rows
+    """
+    ensemble = qp.from_tables(_read_tables(path, slice(start, stop)))
+    return ensemble if grid is None else resample_ensemble(ensemble, grid)
+
+
+def read_ensemble_selection(path: str, rows: np.ndarray, grid: np.ndarray | None = None) -> qp.Ensemble:
+    """Read arbitrary rows of an ensemble file
+
+    As with `read_ensemble_rows`, only the HDF5 chunks holding the rows
+    are read.
+
+    Parameters
+    ----------
+    path
+        Ensemble file
+
+    rows
+        Rows to read, in any order, possibly repeated
+
+    grid
+        Optional redshift grid to resample the PDFs onto, see
+        `pdf_grid.resample_ensemble`
+
+    Returns
+    -------
+    ensemble
+        The requested rows, in the order of ``rows``
+    """
+    # h5py needs increasing, unique indices
+    unique_rows, inverse = np.unique(np.asarray(rows, dtype=np.int64), return_inverse=True)
+    ensemble = qp.from_tables(_read_tables(path, unique_rows))
+    if grid is not None:
+        ensemble = resample_ensemble(ensemble, grid)
+    if np.array_equal(inverse, np.arange(inverse.size)):
+        return ensemble
+    return ensemble[inverse]
+
+
+def _read_tables(path: str, selection: slice | np.ndarray) -> dict[str, dict[str, np.ndarray]]:
+    """Read the ensemble tables of a file, with a selection of the rows"""
+    tables: dict[str, dict[str, np.ndarray]] = {}
+    with h5py.File(path, "r") as fin:
+        for table_name, group in fin.items():
+            if table_name in _ROW_TABLES:
+                tables[table_name] = {key: val[selection] for key, val in group.items()}
+            else:
+                tables[table_name] = {key: val[()] for key, val in group.items()}
+    return tables
+
+
+@dataclass
+class LayoutBenchmarkResult:
+    """Write and read costs of an ensemble file with one layout"""
+
+    layout: dict[str, Any]
+    """The layout, from `Hdf5LayoutConfig.to_dict`"""
+
+    n_rows: int
+    """Number of objects in the ensemble"""
+
+    write_seconds: float
+    """Time to write the file, in seconds"""
+
+    file_mb: float
+    """Size of the file, in MB"""
+
+    read_ms: float
+    """Median time to read a random range of rows, in milliseconds"""
+
+    rows_per_read: int
+    """Number of rows in each random read"""
+
+    @property
+    def write_rows_per_s(self) -> float:
+        """Write throughput, in objects per second"""
+        return self.n_rows / self.write_seconds if self.write_seconds > 0 else float("nan")
+
+
+def benchmark_layout(
+    ensemble: qp.Ensemble,
+    path: str,
+    layout: Hdf5LayoutConfig | None,
+    n_reads: int = 20,
+    rows_per_read: int = 1,
+    seed: int = 1234,
+) -> LayoutBenchmarkResult:
+    """Time the write and random reads of an ensemble file
+
+    Parameters
+    ----------
+    ensemble
+        The ensemble to write
+
+    path
+        File to write; it is left in place
+
+    layout
+        Layout to benchmark; `None` writes with `qp.Ensemble.write_to`
+
+    n_reads
+        Number of random reads timed
+
+    rows_per_read
+        Number of contiguous rows in each read
+
+    seed
+        Random seed for the start rows of the reads
+
+    Returns
+    -------
+    result
+        Timings and file size
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    start = time.perf_counter()
+    if layout is None:
+        # This is what the contiguous layout amounts to
+        layout = Hdf5LayoutConfig(chunk_rows=0, compression="none")
+        ensemble.write_to(path)
+    else:
+        write_ensemble_hdf5(ensemble, path, layout)
+    write_seconds = time.perf_counter() - start
+
+    rng = np.random.default_rng(seed)
+    read_times = []
+    for row in rng.integers(0, max(ensemble.npdf - rows_per_read, 0) + 1, size=n_reads):
+        start = time.perf_counter()
+        read_ensemble_rows(path, int(row), int(row) + rows_per_read)
+        read_times.append(time.perf_counter() - start)
+
+    return LayoutBenchmarkResult(
+        layout=layout.to_dict(),
+        n_rows=ensemble.npdf,
+        write_seconds=write_seconds,
+        file_mb=os.path.getsize(path) / 1024**2,
+        read_ms=1000.0 * float(np.median(read_times)) if read_times else float("nan"),
+        rows_per_read=rows_per_read,
+    )
+
+
+def format_layout_benchmark(results: Sequence[LayoutBenchmarkResult]) -> Table:
+    """Tabulate layout benchmark results, one row per layout"""
+    rows = [
+        dict(
+            chunk_rows=result.layout["chunk_rows"],
+            compression=result.layout["compression"],
+            write_s=result.write_seconds,
+            write_rows_s=result.write_rows_per_s,
+            file_mb=result.file_mb,
+            read_ms=result.read_ms,
+        )
+        for result in results
+    ]
+    table = Table(rows=rows)
+    for col_ in table.colnames[2:]:
+        table[col_].format = ".0f" if col_ == "write_rows_s" else ".3f"
+    return table
@@ -0,0 +1,159 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "NzAccumulator",
+    "NzAccumulatorConfig",
+]
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from astropy.table import Table
+
+
+class NzAccumulatorConfig(pexConfig.Config):
+    """Config for accumulating stacked p(z) histograms during estimation"""
+
+    bin_by = pexConfig.ChoiceField(
+        doc="Quantity used to assign objects to n(z) bins",
+        dtype=str,
+        default="point_estimate",
+        allowed={
+            "point_estimate": "Bin on a point estimate of the redshift",
+            "ref_band_mag": "Bin on the reference band magnitude",
+        },
+    )
+    bin_edges = pexConfig.ListField(
+        doc="Edges of the n(z) bins, in units of the bin_by quantity",
+        dtype=float,
+        default=[0.0, 0.3, 0.6, 0.9, 1.2, 1.5, 3.0],
+    )
+    point_estimate = pexConfig.Field(
+        doc="Ancillary column of the ensemble holding the point estimate; "
+        "if the ensemble does not have it, the mode on the n(z) grid is used",
+        dtype=str,
+        default="zmode",
+    )
+    ref_band = pexConfig.Field(
+        doc="Magnitude column to bin on; defaults to the ref_band of the estimator",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    zmin = pexConfig.Field(doc="Lower edge of the n(z) redshift grid", dtype=float, default=0.0)
+    zmax = pexConfig.Field(doc="Upper edge of the n(z) redshift grid", dtype=float, default=3.0)
+    nzbins = pexConfig.Field(doc="Number of points in the n(z) redshift grid", dtype=int, default=301)
+
+    def validate(self) -> None:
+        super().validate()
+        if len(self.bin_edges) < 2 or np.any(np.diff(self.bin_edges) <= 0):
+            raise ValueError(f"bin_edges must be increasing with at least two values, got {self.bin_edges}")
+
+
+class NzAccumulator:
+    """Running sum of p(z) over objects, split into bins
+
+    Parameters
+    ----------
+    zgrid
+        Redshift grid on which the PDFs are evaluated
+
+    bin_edges
+        Edges of the bins objects are assigned to
+    """
+
+    def __init__(self, zgrid: np.ndarray, bin_edges: np.ndarray):
+        self.zgrid = np.asarray(zgrid, dtype=float)
+        self.bin_edges = np.asarray(bin_edges, dtype=float)
+        self.nz = np.zeros((self.n_bins, self.zgrid.size))
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+
+    @classmethod
+    def from_config(cls, config: NzAccumulatorConfig) -> "NzAccumulator":
+        """Build an empty accumulator from its config"""
+        return cls(
+            zgrid=np.linspace(config.zmin, config.zmax, config.nzbins),
+            bin_edges=np.array(config.bin_edges),
+        )
+
+    @property
+    def n_bins(self) -> int:
+        """Number of bins"""
+        return self.bin_edges.size - 1
+
+    def point_estimates(self, ensemble: qp.Ensemble, key: str) -> np.ndarray:
+        """Get point estimates from the ensemble ancillary data, or its mode"""
+        if ensemble.ancil is not None and key in ensemble.ancil:
+            return np.asarray(ensemble.ancil[key]).ravel()
+        return np.asarray(ensemble.mode(grid=self.zgrid)).ravel()
+
+    def add(self, ensemble: qp.Ensemble, bin_values: np.ndarray) -> None:
+        """Add the PDFs of an ensemble to the running sums
+
+        Parameters
+        ----------
+        ensemble
+            PDFs to add
+
+        bin_values
+            Per-object value used to pick the bin; objects outside the bin
+            edges, or with non-finite values or PDFs, are not counted
+        """
+        pdfs = np.asarray(ensemble.pdf(self.zgrid))
+        bin_idx = np.digitize(bin_values, self.bin_edges) - 1
+        good = (bin_idx >= 0) & (bin_idx < self.n_bins) & np.all(np.isfinite(pdfs), axis=1)
+        bin_idx = bin_idx[good]
+        # One matrix product instead of a python loop or np.add.at over rows
+        membership = bin_idx[np.newaxis, :] == np.arange(self.n_bins)[:, np.newaxis]
+        self.nz += membership.astype(pdfs.dtype) @ pdfs[good]
+        self.counts += np.bincount(bin_idx, minlength=self.n_bins)
+
+    def merge(self, other: "NzAccumulator") -> None:
+        """Add the running sums of another accumulator to this one"""
+        if not np.array_equal(self.zgrid, other.zgrid) or not np.array_equal(
+            self.bin_edges, other.bin_edges
+        ):
+            raise ValueError("Can only merge n(z) accumulators with the same grid and bins")
+        self.nz += other.nz
+        self.counts += other.counts
+
+    def to_table(self) -> Table:
+        """Convert to a table with one row per bin"""
+        table = Table(
+            dict(
+                bin_min=self.bin_edges[:-1],
+                bin_max=self.bin_edges[1:],
+                count=self.counts,
+                nz=self.nz,
+            )
+        )
+        table.meta["zgrid"] = self.zgrid.tolist()
+        return table
+
+    @classmethod
+    def from_table(cls, table: Table) -> "NzAccumulator":
+        """Rebuild an accumulator from the output of `to_table`"""
+        bin_edges = np.append(np.asarray(table["bin_min"]), table["bin_max"][-1])
+        accumulator = cls(zgrid=np.array(table.meta["zgrid"]), bin_edges=bin_edges)
+        accumulator.nz[:] = np.asarray(table["nz"])
+        accumulator.counts[:] = np.asarray(table["count"])
+        return accumulator
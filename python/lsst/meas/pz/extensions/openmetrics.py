@@ -0,0 +1,236 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Throughput metrics in the Prometheus / OpenMetrics text format.
+
+The files are meant for a textfile collector, such as the one of the
+Prometheus node exporter, which exposes every ``*.prom`` file of
+a directory.  They are written to a temporary file and renamed, so
+a collector never reads a partial file.  `update_metrics_textfile` lets
+successive runs share one file, adding up their counters, so that the
+number of files and series does not grow with the number of runs.
+"""
+
+__all__ = [
+    "MetricFamily",
+    "format_metrics",
+    "metrics_file_name",
+    "read_metrics_textfile",
+    "update_metrics_textfile",
+    "write_metrics_textfile",
+]
+
+import fcntl
+import math
+import os
+import re
+import tempfile
+from collections.abc import Iterable, Mapping
+from dataclasses import dataclass, field
+
+_INVALID_NAME_CHARS = re.compile(r"[^A-Za-z0-9_]")
+_SAMPLE_LINE = re.compile(r"^([A-Za-z_:][A-Za-z0-9_:]*)(?:\{(.*)\})? (\S+)$")
+_LABEL = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+_Samples = list[tuple[dict[str, str], float]]
+
+
+@dataclass
+class MetricFamily:
+    """_Samples of one metric, with their labels
+
+    Parameters
+    ----------
+    name
+        Metric name; counters should end in ``_total``
+
+    help
+        One line description of the metric
+
+    metric_type
+        ``gauge`` or ``counter``
+
+    samples
+        ``(labels, value)`` pairs
+    """
+
+    name: str
+    help: str
+    metric_type: str = "gauge"
+    samples: list[tuple[dict[str, str], float]] = field(default_factory=list)
+
+    def add(self, value: float, **labels: str) -> "MetricFamily":
+        """Add a sample, and return the family for chaining"""
+        self.samples.append((labels, value))
+        return self
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _unescape_label(value: str) -> str:
+    return re.sub(r"\\(.)", lambda match: "\n" if match.group(1) == "n" else match.group(1), value)
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def format_metrics(
+    families: Iterable[MetricFamily],
+    common_labels: Mapping[str, str] | None = None,
+) -> str:
+    """Format metric families as Prometheus text exposition
+
+    Parameters
+    ----------
+    families
+        Metrics to format
+
+    common_labels
+        Labels added to every sample, before the sample's own labels
+
+    Returns
+    -------
+    text
+        The exposition text, ending with a newline
+    """
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.metric_type}")
+        for labels, value in family.samples:
+            all_labels = {**(common_labels or {}), **labels}
+            label_text = ",".join(f'{key}="{_escape_label(val)}"' for key, val in all_labels.items())
+            name = f"{family.name}{{{label_text}}}" if label_text else family.name
+            lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_file_name(prefix: str, *parts: object) -> str:
+    """Return a textfile name, e.g. ``pz_gpz_hsc_9813_42.prom``
+
+    Characters other than letters, digits and underscores are replaced
+    by underscores.
+    """
+    stem = "_".join(str(part_) for part_ in (prefix, *parts))
+    return f"{_INVALID_NAME_CHARS.sub('_', stem)}.prom"
+
+
+def write_metrics_textfile(path: str, text: str) -> None:
+    """Atomically write a metrics textfile
+
+    Parameters
+    ----------
+    path
+        Output path, normally ending in ``.prom``
+
+    text
+        Text to write, e.g. from `format_metrics`
+    """
+    out_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as fout:
+            fout.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_metrics_textfile(path: str) -> dict[str, _Samples]:
+    """Read the samples of a textfile written by `write_metrics_textfile`
+
+    Parameters
+    ----------
+    path
+        Path of the textfile
+
+    Returns
+    -------
+    samples
+        ``(labels, value)`` pairs keyed by metric name; empty if the file
+        does not exist
+    """
+    samples: dict[str, _Samples] = {}
+    if not os.path.exists(path):
+        return samples
+    with open(path) as fin:
+        for line in fin:
+            match = _SAMPLE_LINE.match(line.rstrip("\n"))
+            if line.startswith("#") or match is None:
+                continue
+            name, label_text, value = match.groups()
+            labels = {key_: _unescape_label(val_) for key_, val_ in _LABEL.findall(label_text or "")}
+            samples.setdefault(name, []).append((labels, float(value)))
+    return samples
+
+
+def update_metrics_textfile(
+    path: str,
+    families: Iterable[MetricFamily],
+    common_labels: Mapping[str, str] | None = None,
+) -> None:
+    """Merge metrics into a textfile shared by successive runs
+
+    Counter samples are added to those already in the file, which are
+    kept even when this run has no such sample; gauges replace theirs.
+    Processes updating the same file take turns, through a lock on
+    ``{path}.lock``.
+
+    Parameters
+    ----------
+    path
+        Output path, normally ending in ``.prom``
+
+    families
+        Metrics of this run
+
+    common_labels
+        Labels added to every sample, before the sample's own labels
+    """
+    common_labels = dict(common_labels or {})
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        previous = read_metrics_textfile(path)
+        merged = []
+        for family in families:
+            if family.metric_type != "counter":
+                merged.append(family)
+                continue
+            totals = {
+                tuple(sorted(labels_.items())): (labels_, val_)
+                for labels_, val_ in previous.get(family.name, [])
+            }
+            for labels, value in family.samples:
+                all_labels = {**common_labels, **labels}
+                key = tuple(sorted(all_labels.items()))
+                totals[key] = (all_labels, totals.get(key, (all_labels, 0.0))[1] + value)
+            merged.append(MetricFamily(family.name, family.help, family.metric_type, list(totals.values())))
+        write_metrics_textfile(path, format_metrics(merged, common_labels))
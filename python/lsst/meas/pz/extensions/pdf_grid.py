@@ -0,0 +1,309 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Vectorized helpers for putting p(z) estimates on a redshift grid"""
+
+__all__ = [
+    "adaptive_zgrid",
+    "compare_ensembles",
+    "grid_ensemble",
+    "interp_to_grid",
+    "normalize_pdfs",
+    "pdf_name",
+    "pdfs_on_grid",
+    "read_zgrid",
+    "resample_ensemble",
+]
+
+import numpy as np
+import qp
+
+
+def pdf_name(ensemble: qp.Ensemble) -> str:
+    """Return the name of the parameterization of an ensemble, e.g. interp"""
+    name = np.asarray(ensemble.metadata["pdf_name"]).ravel()[0]
+    return name.decode() if isinstance(name, bytes) else str(name)
+
+
+def adaptive_zgrid(
+    redshifts: np.ndarray,
+    zmin: float,
+    zmax: float,
+    n_grid: int,
+    uniform_fraction: float = 0.25,
+    smoothing: float = 0.05,
+) -> np.ndarray:
+    """Build a redshift grid that is denser where a sample has support
+
+    The points are spaced as the quantiles of a mixture of the smoothed
+    n(z) of ``redshifts`` and of a uniform distribution, so that the
+    spacing never exceeds ``(zmax - zmin) / (uniform_fraction *
+    (n_grid - 1))``, even where the sample has no objects.
+
+    Parameters
+    ----------
+    redshifts
+        Redshifts of the sample, e.g. the training set of an estimator;
+        values outside of ``[zmin, zmax]`` are ignored
+
+    zmin, zmax
+        First and last grid points
+
+    n_grid
+        Number of grid points
+
+    uniform_fraction
+        Fraction of the points spread uniformly, in ``(0, 1]``; 1 gives
+        the uniform grid
+
+    smoothing
+        Width of the Gaussian smoothing of the n(z), in redshift
+
+    Returns
+    -------
+    zgrid
+        Strictly increasing grid, shape ``(n_grid,)``
+    """
+    if not 0.0 < uniform_fraction <= 1.0:
+        raise ValueError(f"uniform_fraction must be in (0, 1], not {uniform_fraction}")
+    if n_grid < 2 or zmax <= zmin:
+        raise ValueError(f"Bad grid of {n_grid} points over [{zmin}, {zmax}]")
+    n_fine = max(10 * n_grid, 1000)
+    edges = np.linspace(zmin, zmax, n_fine + 1)
+    counts, _ = np.histogram(np.asarray(redshifts, dtype=float), bins=edges)
+    if smoothing > 0.0:
+        # The kernel must not be longer than the histogram for mode="same"
+        half_width = min(int(np.ceil(4.0 * smoothing / (edges[1] - edges[0]))), (n_fine - 1) // 2)
+        offsets = np.arange(-half_width, half_width + 1) * (edges[1] - edges[0])
+        counts = np.convolve(counts, np.exp(-0.5 * (offsets / smoothing) ** 2), mode="same")
+    density = np.full(n_fine, uniform_fraction / n_fine)
+    if counts.sum() > 0:
+        density += (1.0 - uniform_fraction) * counts / counts.sum()
+    cdf = np.concatenate([[0.0], np.cumsum(density)])
+    zgrid = np.interp(np.linspace(0.0, cdf[-1], n_grid), cdf, edges)
+    zgrid[[0, -1]] = zmin, zmax
+    return zgrid
+
+
+def read_zgrid(path: str) -> np.ndarray:
+    """Read a redshift grid saved with `numpy.save`
+
+    Raises
+    ------
+    ValueError
+        Raised if the file does not hold a strictly increasing grid of at
+        least two points
+    """
+    zgrid = np.asarray(np.load(path), dtype=float).ravel()
+    if zgrid.size < 2 or np.any(np.diff(zgrid) <= 0.0):
+        raise ValueError(f"{path} does not hold a strictly increasing redshift grid")
+    return zgrid
+
+
+def grid_ensemble(
+    xvals: np.ndarray,
+    pdfs: np.ndarray,
+    ancil: dict[str, np.ndarray] | None = None,
+) -> qp.Ensemble:
+    """Wrap normalized PDFs on a grid in an ``interp`` ensemble, without
+    copying them
+
+    The ensemble keeps a reference to ``pdfs``, e.g. a slice of a
+    preallocated buffer, which must not be modified afterwards.
+
+    Parameters
+    ----------
+    xvals
+        Grid points, shape ``(n_grid,)``
+
+    pdfs
+        PDF values, already normalized, shape ``(n_pdf, n_grid)``
+
+    ancil
+        Optional ancillary data, one row per PDF
+    """
+    pz_ensemble = qp.Ensemble(
+        qp.interp,
+        data=dict(xvals=np.asarray(xvals, dtype=pdfs.dtype).ravel(), yvals=pdfs, check_input=False),
+    )
+    if ancil:
+        pz_ensemble.set_ancil(ancil)
+    return pz_ensemble
+
+
+def interp_to_grid(xvals: np.ndarray, yvals: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """Linearly interpolate many PDFs sharing the same abscissa onto a grid
+
+    This is equivalent to calling `numpy.interp` on each row, with zero
+    outside of ``xvals``, but the interpolation weights are computed once
+    and applied to all rows at the same time.
+
+    Parameters
+    ----------
+    xvals
+        Shared abscissa of the input PDFs, shape ``(n_x,)``, increasing
+
+    yvals
+        PDF values, shape ``(n_pdf, n_x)``
+
+    grid
+        Points to interpolate to, shape ``(n_grid,)``
+
+    Returns
+    -------
+    values
+        Interpolated PDF values, shape ``(n_pdf, n_grid)``
+    """
+    xvals = np.asarray(xvals)
+    yvals = np.asarray(yvals)
+    grid = np.asarray(grid)
+    idx = np.clip(np.searchsorted(xvals, grid, side="right") - 1, 0, xvals.size - 2)
+    weight = (grid - xvals[idx]) / (xvals[idx + 1] - xvals[idx])
+    inside = (grid >= xvals[0]) & (grid <= xvals[-1])
+    weight = np.where(inside, weight, 0.0).astype(yvals.dtype, copy=False)
+    values = yvals[:, idx] * (1.0 - weight) + yvals[:, idx + 1] * weight
+    values[:, ~inside] = 0.0
+    return values
+
+
+def normalize_pdfs(pdfs: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """Normalize PDFs sampled on a grid to unit integral, in place
+
+    Rows that integrate to zero (or are not finite) are left as zeros.
+
+    Parameters
+    ----------
+    pdfs
+        PDF values, shape ``(n_pdf, n_grid)``
+
+    grid
+        Grid points, shape ``(n_grid,)``
+
+    Returns
+    -------
+    pdfs
+        The input array, normalized
+    """
+    dz = np.diff(grid)
+    norms = 0.5 * ((pdfs[:, 1:] + pdfs[:, :-1]) @ dz)
+    good = np.isfinite(norms) & (norms > 0)
+    pdfs[good] /= norms[good, np.newaxis]
+    pdfs[~good] = 0.0
+    return pdfs
+
+
+def pdfs_on_grid(ensemble: qp.Ensemble, grid: np.ndarray, normalize: bool = True) -> np.ndarray:
+    """Evaluate all the PDFs of an ensemble on a grid
+
+    Gridded (``interp``) ensembles that share an abscissa are resampled
+    with `interp_to_grid`; other parameterizations fall back to
+    `qp.Ensemble.pdf`.
+
+    Parameters
+    ----------
+    ensemble
+        Input PDFs
+
+    grid
+        Points to evaluate at
+
+    normalize
+        If True, normalize each PDF to unit integral over the grid
+
+    Returns
+    -------
+    pdfs
+        PDF values, shape ``(npdf, n_grid)``
+    """
+    if pdf_name(ensemble) == "interp":
+        xvals = np.asarray(ensemble.metadata["xvals"]).ravel()
+        pdfs = interp_to_grid(xvals, np.atleast_2d(ensemble.objdata["yvals"]), grid)
+    else:
+        pdfs = np.atleast_2d(np.array(ensemble.pdf(grid), dtype=float))
+    if normalize:
+        normalize_pdfs(pdfs, grid)
+    return pdfs
+
+
+def resample_ensemble(ensemble: qp.Ensemble, grid: np.ndarray) -> qp.Ensemble:
+    """Put the PDFs of an ensemble on a grid, keeping its ancillary data
+
+    Ensembles already on ``grid`` are returned as they are, so this is
+    cheap to apply on read, e.g. to bring estimates stored on an adaptive
+    grid back to the standard grid.
+
+    Parameters
+    ----------
+    ensemble
+        Input PDFs
+
+    grid
+        Grid points
+
+    Returns
+    -------
+    ensemble
+        ``interp`` ensemble on ``grid``, with each PDF normalized over it
+    """
+    grid = np.asarray(grid, dtype=float)
+    if pdf_name(ensemble) == "interp":
+        xvals = np.asarray(ensemble.metadata["xvals"]).ravel()
+        if xvals.shape == grid.shape and np.allclose(xvals, grid):
+            return ensemble
+    return grid_ensemble(grid, pdfs_on_grid(ensemble, grid), ensemble.ancil)
+
+
+def compare_ensembles(
+    reference: qp.Ensemble,
+    other: qp.Ensemble,
+    grid: np.ndarray,
+) -> dict[str, float]:
+    """Summarize the differences between two sets of estimates
+
+    Parameters
+    ----------
+    reference
+        Reference PDFs, e.g. from an exact computation
+
+    other
+        PDFs to compare, e.g. from an approximate computation
+
+    grid
+        Evenly spaced redshift grid the PDFs are compared on
+
+    Returns
+    -------
+    metrics
+        Median and maximum of the difference of the modes, in units of
+        1 + z, and mean and maximum L1 distance between the PDFs
+    """
+    pdfs_ref = pdfs_on_grid(reference, grid)
+    pdfs_other = pdfs_on_grid(other, grid)
+    zmode_ref = grid[np.argmax(pdfs_ref, axis=1)]
+    zmode_other = grid[np.argmax(pdfs_other, axis=1)]
+    delta_z = np.abs(zmode_other - zmode_ref) / (1.0 + zmode_ref)
+    l1_dist = np.abs(pdfs_other - pdfs_ref).sum(axis=1) * (grid[1] - grid[0])
+    return dict(
+        median_delta_z=float(np.median(delta_z)),
+        max_delta_z=float(np.max(delta_z)),
+        mean_l1=float(np.mean(l1_dist)),
+        max_l1=float(np.max(l1_dist)),
+    )
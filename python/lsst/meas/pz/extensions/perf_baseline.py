@@ -0,0 +1,394 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Throughput and memory regression checks.
+
+Every measurement is compared with that of the stock RAIL estimator
+stage of the same algorithm, run on the same catalog in the same
+process by `measure_stock_estimate`, so the check needs no recorded
+numbers and holds on any machine: a wrapper must not be slower, or use
+more memory, than the stage it wraps, beyond the tolerances.
+
+That check cannot catch a slowdown shared by both paths, e.g. in RAIL,
+qp or the magnitude conversion, so measurements can also be compared
+with recorded baselines.  A baseline file is a versioned YAML document
+holding, for each measurement key (e.g. ``tpz/hsc``), the throughput and
+peak memory recorded on a reference machine, plus the tolerances used
+to compare new measurements with them::
+
+    version: 1
+    tolerances:
+      rows_per_s: 0.3       # may drop by at most 30%
+      norm_rows_per_s: 0.3
+      peak_mem_mb: 0.25     # may grow by at most 25%
+    entries:
+      tpz/hsc:
+        rows_per_s: 12345.0
+        norm_rows_per_s: 0.0123
+        peak_mem_mb: 56.7
+        machine: ...
+
+``norm_rows_per_s`` is the throughput divided by the speed of a fixed
+numpy workload timed in the same process by `machine_speed`, so it can
+be compared across machines; the raw ``rows_per_s`` is only compared on
+the machine that recorded it.  Entries can override the tolerances with
+a ``tolerances`` mapping of their own.  Baselines are only ever written
+by `record_baseline`, i.e. deliberately, never as a side effect of a
+failing comparison.
+"""
+
+__all__ = [
+    "BASELINE_VERSION",
+    "DEFAULT_TOLERANCES",
+    "compare_to_baseline",
+    "compare_to_stock",
+    "format_regression",
+    "load_baseline",
+    "machine_description",
+    "machine_speed",
+    "make_synthetic_catalog",
+    "measure_estimate",
+    "measure_stock_estimate",
+    "record_baseline",
+]
+
+import os
+import platform
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Any
+
+import numpy as np
+import yaml
+from astropy.table import Table
+from rail.core.model import Model
+from rail.interfaces import PZFactory
+
+from .estimate_pz_task_base import EstimatePZExtAlgoTask
+
+BASELINE_VERSION = 1
+
+DEFAULT_TOLERANCES = dict(rows_per_s=0.3, norm_rows_per_s=0.3, peak_mem_mb=0.25)
+"""Allowed relative drop in throughput and growth in peak memory"""
+
+# Whether a larger value of each metric is better
+_HIGHER_IS_BETTER = dict(rows_per_s=True, norm_rows_per_s=True, peak_mem_mb=False)
+
+
+def machine_description() -> str:
+    """Describe the current machine, to tell baselines apart"""
+    return f"{platform.node()} {platform.machine()} {os.cpu_count()} cpus, python {platform.python_version()}"
+
+
+def machine_speed(n_repeat: int = 5) -> float:
+    """Time a fixed numpy workload, to normalize throughputs by
+
+    The workload, a matrix product, a sort and some transcendental
+    functions on fixed random arrays, mixes the kinds of arithmetic of
+    the estimators.
+
+    Returns
+    -------
+    speed
+        Runs of the workload per second, for the fastest of ``n_repeat``
+    """
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(256, 256))
+    values = rng.uniform(0.1, 10.0, 2**18)
+
+    best_time = np.inf
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        matrix @ matrix
+        np.sort(values)
+        np.exp(-np.log(values) ** 2)
+        best_time = min(best_time, time.perf_counter() - start)
+    return 1.0 / best_time
+
+
+def make_synthetic_catalog(algo_task: EstimatePZExtAlgoTask, n_rows: int, seed: int = 1) -> Table:
+    """Make a reproducible catalog with the input columns of an algorithm
+
+    Magnitudes are uniform between 18 and 25, with 5% flux errors at 20
+    growing towards the faint end.  Input columns that are not fluxes,
+    e.g. the extinction, are set to zero.
+
+    Parameters
+    ----------
+    algo_task
+        Algorithm SubTask, which gives the column names and flux zero point
+
+    n_rows
+        Number of objects
+
+    seed
+        Random seed
+    """
+    config = algo_task.config
+    rng = np.random.default_rng(seed)
+    columns = {col_: np.zeros(n_rows) for col_ in algo_task.col_names()}
+    for band in config.bands_to_convert:
+        mags = rng.uniform(18.0, 25.0, n_rows)
+        fluxes = 10.0 ** (-0.4 * (mags - config.mag_offset))
+        columns[config.flux_column_template.format(band=band)] = fluxes
+        columns[config.flux_err_column_template.format(band=band)] = fluxes * 0.05 * 10.0 ** (
+            0.2 * (mags - 20.0)
+        )
+    return Table(columns)
+
+
+def measure_estimate(
+    algo_task: EstimatePZExtAlgoTask,
+    pz_model: Model,
+    fluxes: Table,
+    n_repeat: int = 3,
+) -> dict[str, float]:
+    """Measure the throughput and peak memory of the p(z) estimation
+
+    The model is loaded beforehand.  The throughput is that of the
+    fastest of ``n_repeat`` runs; the peak memory, that of the python
+    and numpy allocations in one more run under `tracemalloc`.
+
+    Returns
+    -------
+    measurement
+        ``rows_per_s``, ``norm_rows_per_s``, i.e. ``rows_per_s`` over
+        `machine_speed`, and ``peak_mem_mb``
+    """
+    stage = algo_task.get_stage(pz_model)
+    if stage.model is None:
+        stage.open_model(**stage.config)
+    measurement = _measure(lambda: algo_task.estimate(pz_model, fluxes), len(fluxes), n_repeat)
+    measurement["norm_rows_per_s"] = measurement["rows_per_s"] / machine_speed()
+    return measurement
+
+
+def measure_stock_estimate(
+    algo_task: EstimatePZExtAlgoTask,
+    pz_model: Model,
+    fluxes: Table,
+    n_repeat: int = 3,
+) -> dict[str, float]:
+    """Measure the stock RAIL estimator stage of an algorithm
+
+    This is `measure_estimate` for a fresh stage configured as that of
+    ``algo_task``, run through `rail.interfaces.PZFactory` without any of
+    the changes the wrapper makes to it, on the magnitudes converted by
+    ``algo_task``; only ``rows_per_s`` and ``peak_mem_mb`` are measured.
+    """
+    config = algo_task.config
+    stage = PZFactory.build_stage_instance(
+        f"{config.stage_name}_stock",
+        config.estimator_class(),
+        model_path=pz_model.data,
+        **algo_task._get_stage_config(),
+    )
+    if stage.model is None:
+        stage.open_model(**stage.config)
+
+    def run() -> None:
+        PZFactory.estimate_single_pz(stage, algo_task.convert(fluxes), len(fluxes))
+
+    return _measure(run, len(fluxes), n_repeat)
+
+
+def _measure(run: Callable[[], Any], n_rows: int, n_repeat: int) -> dict[str, float]:
+    best_time = np.inf
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        run()
+        best_time = min(best_time, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(rows_per_s=n_rows / best_time, peak_mem_mb=peak / 2**20)
+
+
+def load_baseline(path: str) -> dict[str, Any]:
+    """Read a baseline file; a missing file gives an empty baseline
+
+    Raises
+    ------
+    ValueError
+        If the file was written with another format version
+    """
+    if not os.path.exists(path):
+        return dict(version=BASELINE_VERSION, tolerances=dict(DEFAULT_TOLERANCES), entries={})
+    with open(path) as fin:
+        baseline = yaml.safe_load(fin) or {}
+    if baseline.get("version") != BASELINE_VERSION:
+        raise ValueError(
+            f"{path} has baseline version {baseline.get('version')}, expected {BASELINE_VERSION}"
+        )
+    baseline.setdefault("tolerances", dict(DEFAULT_TOLERANCES))
+    if baseline.get("entries") is None:
+        baseline["entries"] = {}
+    return baseline
+
+
+def record_baseline(path: str, key: str, measurement: dict[str, float]) -> None:
+    """Store a measurement as the baseline for a key
+
+    Other entries, any tolerances of this one, and the comments at the
+    top of the file are kept.
+
+    Parameters
+    ----------
+    path
+        Baseline file, created if needed
+
+    key
+        Measurement key, e.g. ``tpz/hsc``
+
+    measurement
+        Values from `measure_estimate`
+    """
+    baseline = load_baseline(path)
+    entry = baseline["entries"].setdefault(key, {})
+    entry.update({name_: float(val_) for name_, val_ in measurement.items()})
+    entry["machine"] = machine_description()
+
+    # Keep the comment block at the top of the file
+    header = []
+    if os.path.exists(path):
+        with open(path) as fin:
+            for line in fin:
+                if not line.startswith("#"):
+                    break
+                header.append(line)
+    with open(path, "w") as fout:
+        fout.writelines(header)
+        yaml.safe_dump(baseline, fout, sort_keys=True)
+
+
+def compare_to_baseline(
+    key: str,
+    measurement: dict[str, float],
+    baseline: dict[str, Any],
+) -> list[str]:
+    """Compare a measurement with its baseline
+
+    Parameters
+    ----------
+    key
+        Measurement key, e.g. ``tpz/hsc``
+
+    measurement
+        Values from `measure_estimate`
+
+    baseline
+        Baseline from `load_baseline`; it must have an entry for ``key``
+
+    Returns
+    -------
+    problems
+        One line per metric beyond its tolerance, plus a note if the
+        baseline comes from another machine; empty if all is well
+    """
+    entry = baseline["entries"][key]
+    tolerances = {**DEFAULT_TOLERANCES, **baseline["tolerances"], **entry.get("tolerances", {})}
+    other_machine = entry.get("machine", machine_description()) != machine_description()
+    if other_machine and "norm_rows_per_s" in entry:
+        # Raw throughputs of different machines cannot be compared
+        entry = {name_: val_ for name_, val_ in entry.items() if name_ != "rows_per_s"}
+    problems = _compare(key, measurement, entry, tolerances, "baseline")
+    if problems and other_machine:
+        problems.append(f"{key:24s} baseline measured on another machine: {entry['machine']}")
+    return problems
+
+
+def compare_to_stock(
+    key: str,
+    measurement: dict[str, float],
+    stock: dict[str, float],
+    tolerances: dict[str, float] | None = None,
+) -> list[str]:
+    """Compare a measurement with that of the stock estimator stage
+
+    Parameters
+    ----------
+    key
+        Measurement key, e.g. ``tpz/hsc``
+
+    measurement
+        Values from `measure_estimate`
+
+    stock
+        Values from `measure_stock_estimate`, on the same catalog
+
+    tolerances
+        Allowed relative drop in throughput and growth in peak memory;
+        default `DEFAULT_TOLERANCES`
+
+    Returns
+    -------
+    problems
+        One line per metric beyond its tolerance; empty if all is well
+    """
+    return _compare(key, measurement, stock, tolerances or DEFAULT_TOLERANCES, "stock")
+
+
+def _compare(
+    key: str,
+    measurement: dict[str, float],
+    reference: dict[str, Any],
+    tolerances: dict[str, float],
+    label: str,
+) -> list[str]:
+    problems = []
+    for name, higher_is_better in _HIGHER_IS_BETTER.items():
+        if name not in reference or name not in measurement:
+            continue
+        ref_value, value = float(reference[name]), float(measurement[name])
+        change = value / ref_value - 1.0
+        if (-change if higher_is_better else change) > tolerances[name]:
+            sign = "-" if higher_is_better else "+"
+            problems.append(
+                f"{key:24s} {name:12s} {label:8s} {ref_value:12.1f}  now {value:12.1f}  "
+                f"({change:+.1%}, tolerance {sign}{tolerances[name]:.0%})"
+            )
+    return problems
+
+
+def format_regression(problems: list[str], baseline_path: str, refresh_command: str) -> str:
+    """Build the failure message for a list of problems
+
+    Parameters
+    ----------
+    problems
+        Lines from `compare_to_baseline`
+
+    baseline_path
+        Baseline file used for the comparison
+
+    refresh_command
+        Command that records new baselines, for when a change in
+        performance is intended
+    """
+    lines = [f"Performance regression with respect to {baseline_path}:", *problems]
+    lines += [f"Measured on: {machine_description()}", "If this is intended, refresh the baseline with:"]
+    lines.append(f"    {refresh_command}")
+    return "\n".join(lines)
@@ -0,0 +1,318 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Pipeline-scale benchmark of the p(z) estimation on a synthetic butler.
+
+This measures what the unit level benchmarks miss: the cost of building
+the quantum graph and of executing it with ``pipetask`` over many
+patches.  A local SQLite butler is filled with synthetic patches of the
+input catalog and with the models, the pipeline is run with several
+``-j`` values, and the graph build time, the per-task wall time taken
+from the task metadata and the scaling efficiency are reported.
+Everything runs offline.
+"""
+
+__all__ = [
+    "PipelineBenchmarkResult",
+    "format_benchmark",
+    "make_synthetic_repo",
+    "run_pipeline_benchmark",
+]
+
+import os
+import subprocess
+import time
+from collections import defaultdict
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import lsst.sphgeom
+import numpy as np
+from astropy.table import Table
+from lsst.daf.butler import Butler, CollectionType, DatasetRef, DatasetType, FileDataset
+from lsst.pipe.base import Pipeline
+
+from .perf_baseline import make_synthetic_catalog
+
+SKYMAP = "pz_benchmark"
+INSTRUMENT = "PZBenchmarkCam"
+INPUT_RUN = "pz_benchmark/inputs"
+
+
+@dataclass
+class PipelineBenchmarkResult:
+    """Timings of one execution of the pipeline"""
+
+    n_jobs: int
+    """Number of ``pipetask`` processes"""
+
+    graph_seconds: float
+    """Time to build and save the quantum graph"""
+
+    run_seconds: float
+    """Time to execute the quantum graph"""
+
+    n_quanta: dict[str, int] = field(default_factory=dict)
+    """Number of quanta executed, per task label"""
+
+    task_seconds: dict[str, float] = field(default_factory=dict)
+    """Summed quantum wall time, per task label"""
+
+
+def _patch_region(index: int) -> lsst.sphgeom.ConvexPolygon:
+    """Return a 0.2 degree square region, one per patch along the equator"""
+    corners = [
+        lsst.sphgeom.UnitVector3d(lsst.sphgeom.LonLat.fromDegrees(0.2 * (index + dx_), 0.2 * dy_))
+        for dx_, dy_ in [(0, 0), (1, 0), (1, 1), (0, 1)]
+    ]
+    return lsst.sphgeom.ConvexPolygon(corners)
+
+
+def _insert_dimension_records(butler: Butler, n_patches: int) -> None:
+    registry = butler.registry
+    registry.insertDimensionData(
+        "instrument",
+        dict(
+            name=INSTRUMENT,
+            visit_max=1,
+            exposure_max=1,
+            detector_max=1,
+            class_name="lsst.obs.base.Instrument",
+        ),
+    )
+    registry.insertDimensionData(
+        "skymap",
+        dict(name=SKYMAP, hash=SKYMAP.encode(), tract_max=1, patch_nx_max=n_patches, patch_ny_max=1),
+    )
+    tract_corners = [
+        lsst.sphgeom.UnitVector3d(lsst.sphgeom.LonLat.fromDegrees(0.2 * n_patches * dx_, 0.2 * dy_))
+        for dx_, dy_ in [(0, 0), (1, 0), (1, 1), (0, 1)]
+    ]
+    registry.insertDimensionData(
+        "tract", dict(skymap=SKYMAP, id=0, region=lsst.sphgeom.ConvexPolygon(tract_corners))
+    )
+    registry.insertDimensionData(
+        "patch",
+        *[
+            dict(skymap=SKYMAP, tract=0, id=index, cell_x=index, cell_y=0, region=_patch_region(index))
+            for index in range(n_patches)
+        ],
+    )
+
+
+def make_synthetic_repo(
+    root: str,
+    pipeline_uri: str,
+    model_files: Mapping[str, str],
+    n_patches: int = 16,
+    rows_per_patch: int = 10000,
+    seed: int = 1,
+) -> Butler:
+    """Make a local SQLite butler with the inputs of a p(z) pipeline
+
+    The catalog input of the pipeline gets ``n_patches`` synthetic
+    patches, with the input columns of every task, and each model input
+    the file given in ``model_files``, all in the `INPUT_RUN` collection.
+
+    Parameters
+    ----------
+    root
+        Directory of the new repository
+
+    pipeline_uri
+        Pipeline, with an optional ``#label,...`` subset
+
+    model_files
+        Model file for each model dataset type, e.g. ``pzModel_gpz``
+
+    n_patches
+        Number of patches, all in tract 0
+
+    rows_per_patch
+        Number of objects per patch
+
+    seed
+        Random seed of the first patch; patch ``i`` uses ``seed + i``
+
+    Returns
+    -------
+    butler
+        Writeable butler on the new repository
+    """
+    butler = Butler.from_config(Butler.makeRepo(root), writeable=True)
+    _insert_dimension_records(butler, n_patches)
+    butler.registry.registerCollection(INPUT_RUN, CollectionType.RUN)
+
+    graph = Pipeline.from_uri(pipeline_uri).to_graph()
+    graph.resolve(butler.registry)
+    algo_tasks = [
+        task_node.task_class(config=task_node.config).pz_algo for task_node in graph.tasks.values()
+    ]
+
+    def make_catalog(index: int, n_rows: int) -> Table:
+        """One catalog with the input columns of every task"""
+        catalog = Table()
+        for algo_task in algo_tasks:
+            synthetic = make_synthetic_catalog(algo_task, n_rows, seed=seed + index)
+            for col_ in synthetic.colnames:
+                if col_ not in catalog.colnames:
+                    catalog[col_] = synthetic[col_]
+        catalog["objectId"] = np.arange(n_rows, dtype=np.int64) + index * rows_per_patch
+        return catalog
+
+    for name, node in graph.iter_overall_inputs():
+        dataset_type: DatasetType = node.dataset_type
+        butler.registry.registerDatasetType(dataset_type)
+        if name in model_files:
+            data_id = butler.registry.expandDataId(instrument=INSTRUMENT)
+            ref = DatasetRef(dataset_type, data_id, run=INPUT_RUN)
+            butler.ingest(FileDataset(os.path.abspath(model_files[name]), ref))
+        elif dataset_type.storageClass_name != "ArrowAstropy":
+            raise ValueError(f"No synthetic data for input {name} of the pipeline")
+        elif "patch" in dataset_type.dimensions.names:
+            for index in range(n_patches):
+                butler.put(
+                    make_catalog(index, rows_per_patch),
+                    dataset_type,
+                    skymap=SKYMAP,
+                    tract=0,
+                    patch=index,
+                    run=INPUT_RUN,
+                )
+        else:
+            # A per-tract catalog holding all the patches
+            butler.put(
+                make_catalog(0, n_patches * rows_per_patch),
+                dataset_type,
+                skymap=SKYMAP,
+                tract=0,
+                run=INPUT_RUN,
+            )
+    return butler
+
+
+def _task_timings(butler: Butler, labels: Sequence[str], run: str) -> tuple[dict, dict]:
+    """Sum the quantum wall times recorded in the task metadata"""
+    n_quanta: dict[str, int] = defaultdict(int)
+    task_seconds: dict[str, float] = defaultdict(float)
+    for label in labels:
+        for ref in butler.registry.queryDatasets(f"{label}_metadata", collections=run):
+            quantum_md = butler.get(ref)["quantum"]
+            start = datetime.fromisoformat(quantum_md["startUtc"].replace("Z", "+00:00"))
+            end = datetime.fromisoformat(quantum_md["endUtc"].replace("Z", "+00:00"))
+            n_quanta[label] += 1
+            task_seconds[label] += (end - start).total_seconds()
+    return dict(n_quanta), dict(task_seconds)
+
+
+def run_pipeline_benchmark(
+    root: str,
+    pipeline_uri: str,
+    jobs: Sequence[int] = (1, 2, 4),
+    pipetask: str = "pipetask",
+) -> list[PipelineBenchmarkResult]:
+    """Build and execute the quantum graph once per number of processes
+
+    Each execution writes to its own output run, so the repository
+    made by `make_synthetic_repo` can be reused.
+
+    Parameters
+    ----------
+    root
+        Repository made by `make_synthetic_repo`
+
+    pipeline_uri
+        Pipeline, with an optional ``#label,...`` subset
+
+    jobs
+        Numbers of processes to run ``pipetask`` with
+
+    pipetask
+        The ``pipetask`` executable
+
+    Returns
+    -------
+    results
+        Timings of each execution, in the order of ``jobs``
+    """
+    labels = list(Pipeline.from_uri(pipeline_uri).to_graph().tasks.keys())
+    results = []
+    for n_jobs in jobs:
+        output = f"pz_benchmark/j{n_jobs}"
+        output_run = f"{output}/{time.strftime('%Y%m%dT%H%M%S')}"
+        qgraph_path = os.path.join(root, f"pz_benchmark_j{n_jobs}.qgraph")
+        common = ["-b", root, "-i", INPUT_RUN, "-o", output, "--output-run", output_run]
+
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                pipetask,
+                "qgraph",
+                *common,
+                "-p",
+                pipeline_uri,
+                "-d",
+                f"skymap='{SKYMAP}'",
+                "--save-qgraph",
+                qgraph_path,
+            ],
+            check=True,
+        )
+        graph_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        subprocess.run(
+            [pipetask, "run", *common, "-g", qgraph_path, "--register-dataset-types", "-j", str(n_jobs)],
+            check=True,
+        )
+        run_seconds = time.perf_counter() - start
+
+        n_quanta, task_seconds = _task_timings(Butler.from_config(root), labels, output_run)
+        results.append(PipelineBenchmarkResult(n_jobs, graph_seconds, run_seconds, n_quanta, task_seconds))
+    return results
+
+
+def format_benchmark(results: Sequence[PipelineBenchmarkResult]) -> Table:
+    """Tabulate benchmark results, with the scaling efficiency
+
+    The efficiency of a run with ``j`` processes is its speed-up with
+    respect to the run with the fewest processes, divided by the ratio of
+    the numbers of processes, so 1 is perfect scaling.
+    """
+    reference = min(results, key=lambda result_: result_.n_jobs)
+    labels = sorted({label_ for result_ in results for label_ in result_.task_seconds})
+    rows = []
+    for result in results:
+        speedup = reference.run_seconds / result.run_seconds
+        row = dict(
+            n_jobs=result.n_jobs,
+            graph_s=result.graph_seconds,
+            run_s=result.run_seconds,
+            speedup=speedup,
+            efficiency=speedup * reference.n_jobs / result.n_jobs,
+        )
+        row.update({f"{label_}_s": result.task_seconds.get(label_, 0.0) for label_ in labels})
+        rows.append(row)
+    table = Table(rows=rows)
+    for col_ in table.colnames[1:]:
+        table[col_].format = ".3f"
+    return table
@@ -0,0 +1,153 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Survey presets for the column names and band setup of the estimators.
+
+Each preset sets up the config of an algorithm SubTask, e.g.
+``config.pz_algo`` of an `EstimatePZTask`, for the object tables of one
+survey.  Options that the algorithm does not have are skipped.
+"""
+
+__all__ = [
+    "apply_preset",
+    "com_cam_preset",
+    "dc2_preset",
+    "hsc_preset",
+    "survey_presets",
+]
+
+from collections.abc import Callable
+from typing import Any
+
+from lsst.meas.pz.estimate_pz_task import EstimatePZAlgoConfigBase
+from rail.utils.catalog_utils import (
+    ComCamCatalogConfig,
+    Dc2CatalogConfig,
+    HscCatalogConfig,
+)
+
+
+def _set_config(config: EstimatePZAlgoConfigBase, config_dict: dict[str, Any]) -> None:
+    """Add key,value pairs from a dict to a PexConfig ojbect"""
+
+    for key, val in config_dict.items():
+        try:
+            setattr(config, key, val)
+        except AttributeError:
+            pass
+
+
+def hsc_preset(config: EstimatePZAlgoConfigBase) -> None:
+    """Set up config for HSC column names"""
+    _set_config(config, HscCatalogConfig.build_base_dict())
+    config.bands_to_convert = ["g", "r", "i", "z", "y"]
+    # We should be using these for constencty
+    # but there are some infinites, so for now we use gaap1p0
+    # config.flux_column_template = "{band}_cModelFlux"
+    # config.flux_err_column_template = "{band}_cModelFluxErr"
+    config.flux_column_template = "{band}_gaap1p0Flux"
+    config.flux_err_column_template = "{band}_gaap1p0FluxErr"
+    config.mag_template = "HSC{band}_cmodel_dered"
+    config.mag_err_template = "{band}_cmodel_magerr"
+    config.deredden = False
+    _set_config(
+        config,
+        dict(
+            ref_band="HSCi_cmodel_dered",
+            bands=config.get_mag_name_list(),
+            err_bands=config.get_mag_err_name_list(),
+            mag_limits=config.get_mag_lim_dict(),
+            band_a_env=config.get_band_a_env_dict(),
+            filter_list=[
+                "DC2LSST_g",
+                "DC2LSST_r",
+                "DC2LSST_i",
+                "DC2LSST_z",
+                "DC2LSST_y",
+            ],
+        )
+    )
+
+
+def dc2_preset(config: EstimatePZAlgoConfigBase) -> None:
+    """Set up config for DC2 column names"""
+    _set_config(config, Dc2CatalogConfig.build_base_dict())
+    config.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+    config.flux_column_template = "{band}_cModelFlux"
+    config.flux_err_column_template = "{band}_cModelFluxErr"
+    config.mag_template = "mag_{band}_cModel_obj_dered"
+    config.mag_err_template = "magerr_{band}_cModel_obj"
+    _set_config(
+        config,
+        dict(
+            ref_band="mag_i_cModel_obj_dered",
+            bands=config.get_mag_name_list(),
+            err_bands=config.get_mag_err_name_list(),
+            mag_limits=config.get_mag_lim_dict(),
+            band_a_env=config.get_band_a_env_dict(),
+        )
+    )
+
+
+def com_cam_preset(config: EstimatePZAlgoConfigBase) -> None:
+    """Set up config for com cam column names"""
+    _set_config(config, ComCamCatalogConfig.build_base_dict())
+    config.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
+    config.flux_column_template = "{band}_cModelFlux"
+    config.flux_err_column_template = "{band}_cModelFluxErr"
+    config.mag_template = "{band}_cModelMag"
+    config.mag_err_template = "{band}_cModelMagErr"
+    _set_config(
+        config,
+        dict(
+            ref_band="i_cModelMag",
+            bands=config.get_mag_name_list(),
+            err_bands=config.get_mag_err_name_list(),
+            mag_limits=config.get_mag_lim_dict(),
+            band_a_env=config.get_band_a_env_dict(),
+        )
+    )
+
+
+survey_presets: dict[str, Callable[[EstimatePZAlgoConfigBase], None]] = dict(
+    hsc=hsc_preset,
+    dc2=dc2_preset,
+    com_cam=com_cam_preset,
+)
+"""Survey presets, by name"""
+
+
+def apply_preset(config: EstimatePZAlgoConfigBase, preset: str) -> None:
+    """Set up an algorithm config with one of the `survey_presets`
+
+    Parameters
+    ----------
+    config
+        Config of the algorithm SubTask
+
+    preset
+        Name of the preset
+    """
+    try:
+        preset_func = survey_presets[preset]
+    except KeyError:
+        raise ValueError(f"Unknown preset {preset}, expected one of {sorted(survey_presets)}") from None
+    preset_func(config)
@@ -0,0 +1,323 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Hot path profiling of the wrapped p(z) estimators.
+
+`profile_call` runs a function under either `cProfile`, which counts
+every call, or a sampling profiler, which records the stack of the
+profiled thread at a fixed interval.  The sampling profiler has a much
+lower overhead, and writes collapsed stacks, the input format of
+``flamegraph.pl`` and speedscope.  Both give a top-N table in which
+each function is assigned to the part of the code it belongs to: our
+wrappers, the RAIL estimators, qp, or anything else.
+"""
+
+__all__ = [
+    "CODE_CATEGORIES",
+    "ProfileResult",
+    "code_category",
+    "profile_call",
+    "profile_estimate",
+]
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from types import FrameType
+from typing import Any
+
+from astropy.table import Table
+from rail.core.model import Model
+
+from .estimate_pz_task_base import EstimatePZExtAlgoTask
+
+CODE_CATEGORIES: dict[str, str] = {
+    "meas_pz": f"{os.sep}lsst{os.sep}meas{os.sep}pz{os.sep}",
+    "rail": f"{os.sep}rail{os.sep}",
+    "qp": f"{os.sep}qp{os.sep}",
+}
+"""Path fragment identifying the source files of each category"""
+
+
+def code_category(filename: str) -> str:
+    """Return the category of a source file, or ``other``
+
+    Parameters
+    ----------
+    filename
+        Path of the source file of a function, as in its code object
+    """
+    for category, fragment in CODE_CATEGORIES.items():
+        if fragment in filename:
+            return category
+    return "other"
+
+
+def _short_path(filename: str) -> str:
+    """Strip the installation prefix from a source file path"""
+    for marker in ("site-packages", "python"):
+        head, sep, tail = filename.rpartition(f"{os.sep}{marker}{os.sep}")
+        if sep:
+            return tail
+    return filename
+
+
+def _func_label(filename: str, lineno: int, func_name: str) -> str:
+    """Label a function, avoiding the separators of collapsed stacks"""
+    return f"{func_name} ({_short_path(filename)}:{lineno})".replace(";", ":")
+
+
+@dataclass
+class ProfileResult:
+    """Outcome of a profiled call"""
+
+    mode: str
+    """Profiler used, ``deterministic`` or ``sampling``"""
+
+    elapsed: float
+    """Wall clock time of the call, in seconds"""
+
+    value: Any = None
+    """Return value of the profiled function"""
+
+    stats: pstats.Stats | None = None
+    """Call statistics, in deterministic mode"""
+
+    stacks: Counter = field(default_factory=Counter)
+    """Sample count of every stack, root first, in sampling mode"""
+
+    sample_interval: float = 0.0
+    """Time between samples, in seconds, in sampling mode"""
+
+    def top_table(self, n_top: int = 20) -> Table:
+        """Return the most expensive functions of each category
+
+        Parameters
+        ----------
+        n_top
+            Number of functions kept per category
+
+        Returns
+        -------
+        table
+            One row per function, with its category, its own time and
+            the time including its callees, in seconds, sorted by
+            category and decreasing inclusive time.  Rows with a function
+            name of ``TOTAL`` give the own time summed over the category,
+            i.e. how the run time splits between the categories.  Call
+            counts are only known in deterministic mode, and are 0
+            otherwise.
+        """
+        own_time: Counter = Counter()
+        total_time: Counter = Counter()
+        n_calls: Counter = Counter()
+        if self.stats is not None:
+            for (filename, lineno, func_name), (_, nc, tt, ct, _) in self.stats.stats.items():
+                key = (filename, lineno, func_name)
+                own_time[key] += tt
+                total_time[key] += ct
+                n_calls[key] += nc
+        else:
+            for stack, count in self.stacks.items():
+                own_time[stack[-1]] += count * self.sample_interval
+                # Count recursive functions once per sample
+                for key in set(stack):
+                    total_time[key] += count * self.sample_interval
+
+        rows = []
+        for category in [*CODE_CATEGORIES, "other"]:
+            keys = [key_ for key_ in total_time if code_category(key_[0]) == category]
+            keys.sort(key=lambda key_: total_time[key_], reverse=True)
+            category_time = sum(own_time[key_] for key_ in keys)
+            rows.append((category, "TOTAL", category_time, category_time, 0))
+            for key in keys[:n_top]:
+                rows.append((category, _func_label(*key), own_time[key], total_time[key], n_calls[key]))
+        table = Table(
+            rows=rows,
+            names=["category", "function", "own_time", "total_time", "n_calls"],
+            dtype=[str, str, float, float, int],
+        )
+        table["own_time"].format = table["total_time"].format = ".4f"
+        return table
+
+    def write(self, prefix: str, n_top: int = 20) -> list[str]:
+        """Write the profile and its top-N table
+
+        In deterministic mode the statistics go to ``<prefix>.prof``,
+        readable with `pstats`, snakeviz or flameprof; in sampling mode the
+        collapsed stacks go to ``<prefix>.folded``.  The table goes to
+        ``<prefix>_top.txt``.
+
+        Parameters
+        ----------
+        prefix
+            Path prefix of the output files
+
+        n_top
+            Number of functions kept per category in the table
+
+        Returns
+        -------
+        paths
+            Paths of the files written
+        """
+        paths = []
+        if self.stats is not None:
+            paths.append(f"{prefix}.prof")
+            self.stats.dump_stats(paths[-1])
+        else:
+            paths.append(f"{prefix}.folded")
+            with open(paths[-1], "w") as fout:
+                for stack, count in self.stacks.most_common():
+                    fout.write(";".join(_func_label(*key_) for key_ in stack) + f" {count}\n")
+        paths.append(f"{prefix}_top.txt")
+        self.top_table(n_top).write(paths[-1], format="ascii.fixed_width_two_line", overwrite=True)
+        return paths
+
+
+class _StackSampler(threading.Thread):
+    """Thread recording the stack of another thread at a fixed interval
+
+    Only the frames called from ``root_frame`` are recorded.
+    """
+
+    def __init__(self, target_id: int, interval: float, root_frame: FrameType):
+        super().__init__(daemon=True)
+        self.target_id = target_id
+        self.interval = interval
+        self.root_frame: FrameType | None = root_frame
+        self.stacks: Counter = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_id)
+            stack = []
+            while frame is not None and frame is not self.root_frame:
+                code = frame.f_code
+                if code is _StackSampler.stop.__code__:
+                    # The profiled call has returned
+                    stack = []
+                    break
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+        self.root_frame = None
+
+
+def profile_call(
+    func: Callable[..., Any],
+    *args: Any,
+    mode: str = "sampling",
+    interval: float = 0.005,
+    **kwargs: Any,
+) -> ProfileResult:
+    """Call a function under a profiler
+
+    Parameters
+    ----------
+    func
+        Function to profile, called with ``args`` and ``kwargs``
+
+    mode
+        ``deterministic`` to use `cProfile`, or ``sampling``
+
+    interval
+        Time between samples, in seconds, in sampling mode.  Samples are
+        only taken when the profiled thread releases the GIL, which pure
+        python code does every few milliseconds.
+
+    Returns
+    -------
+    result
+        The profile, and the return value of ``func``
+    """
+    if mode == "deterministic":
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        value = profiler.runcall(func, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        return ProfileResult(mode=mode, elapsed=elapsed, value=value, stats=pstats.Stats(profiler))
+    if mode != "sampling":
+        raise ValueError(f"Unknown profiling mode {mode}, expected deterministic or sampling")
+
+    sampler = _StackSampler(threading.get_ident(), interval, sys._getframe())
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        value = func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+    return ProfileResult(
+        mode=mode, elapsed=elapsed, value=value, stacks=sampler.stacks, sample_interval=interval
+    )
+
+
+def profile_estimate(
+    algo_task: EstimatePZExtAlgoTask,
+    pz_model: Model,
+    fluxes: Table,
+    mode: str = "sampling",
+    interval: float = 0.005,
+    include_setup: bool = False,
+) -> ProfileResult:
+    """Profile the p(z) estimation of a catalog
+
+    Parameters
+    ----------
+    algo_task
+        Algorithm SubTask
+
+    pz_model
+        Model for the algorithm
+
+    fluxes
+        Input catalog, with the columns given by ``algo_task.col_names()``
+
+    mode, interval
+        Profiler settings, see `profile_call`
+
+    include_setup
+        Also profile building the estimator stage and loading the model,
+        which are otherwise done beforehand
+
+    Returns
+    -------
+    result
+        The profile; its value is the output `qp.Ensemble`
+    """
+    if not include_setup:
+        stage = algo_task.get_stage(pz_model)
+        if stage.model is None:
+            stage.open_model(**stage.config)
+    return profile_call(algo_task.estimate, pz_model, fluxes, mode=mode, interval=interval)
@@ -0,0 +1,396 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Object ID index of the p(z) estimates.
+
+With ``do_write_index``, the estimator tasks write a ``pz_index_<algo>``
+table next to their ``pz_estimate_<algo>`` ensemble of each quantum: its
+object IDs, sorted, with the row of each object in the ensemble.
+`ReducePZIndexTractTask` merges them into one ``pz_index_tract_<algo>``
+table per tract, which also records the patch of each object, and
+writes the smallest and largest object ID of the tract as a one-row
+``pz_index_range_<algo>`` table.
+
+`PZIndex` finds objects in such a table by binary search, and
+`lookup_pdfs` reads the p(z) of a list of objects through a butler.  It
+only reads the indices of the tracts whose ID range holds some of the
+objects, and only their rows of the ensembles, so the cost of a query
+grows with the number of objects requested rather than with the size of
+the release.  The ID ranges can be read once with `read_index_ranges`
+for many queries.
+"""
+
+__all__ = [
+    "PZIndex",
+    "ReducePZIndexTractConfig",
+    "ReducePZIndexTractTask",
+    "lookup_pdfs",
+    "make_index_table",
+    "read_index_ranges",
+]
+
+from collections.abc import Iterable
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from astropy.table import Table, vstack
+from lsst.meas.pz.estimate_pz_task import EstimatePZTaskConnections
+from lsst.pipe.base import (
+    InputQuantizedConnection,
+    NoWorkFound,
+    OutputQuantizedConnection,
+    PipelineTask,
+    PipelineTaskConfig,
+    PipelineTaskConnections,
+    QuantumContext,
+    Struct,
+)
+from lsst.pipe.base import connectionTypes as cT
+
+from .dataset_names import INDEX_RANGE_PREFIX, INDEX_TRACT_PREFIX, derived_name
+from .hdf5_layout import read_ensemble_selection
+
+ROW_COLUMN = "row"
+MIN_ID_COLUMN = "min_id"
+MAX_ID_COLUMN = "max_id"
+
+# Dimensions of an estimation quantum that a tract index records per object
+_LOCATION_DIMENSIONS = tuple(
+    dim_ for dim_ in EstimatePZTaskConnections.dimensions if dim_ not in ("skymap", "tract")
+)
+
+
+def make_index_table(object_ids: Any, row_offset: int = 0, id_column: str = "objectId") -> Table:
+    """Build the index of one ensemble
+
+    Parameters
+    ----------
+    object_ids
+        Object ID of each row of the ensemble
+
+    row_offset
+        Row of the ensemble of the first ID, for a part of an ensemble
+
+    id_column
+        Name of the object ID column
+
+    Returns
+    -------
+    index
+        The object IDs, sorted, and their rows in the ensemble
+    """
+    object_ids = np.asarray(object_ids)
+    order = np.argsort(object_ids, kind="stable")
+    return Table({id_column: object_ids[order], ROW_COLUMN: order.astype(np.int64) + row_offset})
+
+
+class PZIndex:
+    """Binary search over an index table
+
+    Parameters
+    ----------
+    table
+        Index table, from `make_index_table` or `ReducePZIndexTractTask`;
+        it is sorted if needed
+
+    id_column
+        Name of the object ID column
+    """
+
+    def __init__(self, table: Table, id_column: str = "objectId"):
+        ids = np.asarray(table[id_column])
+        if ids.size > 1 and np.any(ids[1:] < ids[:-1]):
+            table = table[np.argsort(ids, kind="stable")]
+            ids = np.asarray(table[id_column])
+        self.table = table
+        self.id_column = id_column
+        self._ids = ids
+
+    def __len__(self) -> int:
+        return self._ids.size
+
+    @property
+    def location_columns(self) -> list[str]:
+        """Columns other than the ID and row, e.g. the patch"""
+        return [name_ for name_ in self.table.colnames if name_ not in (self.id_column, ROW_COLUMN)]
+
+    def locate(self, object_ids: Any) -> tuple[np.ndarray, np.ndarray]:
+        """Find objects in the index
+
+        Parameters
+        ----------
+        object_ids
+            IDs to look for
+
+        Returns
+        -------
+        positions
+            Row of the index table of each object; only meaningful where
+            ``found`` is set
+
+        found
+            Whether each object is in the index
+        """
+        object_ids = np.asarray(object_ids)
+        if not self._ids.size:
+            return np.zeros(object_ids.shape, dtype=np.int64), np.zeros(object_ids.shape, dtype=bool)
+        positions = np.minimum(np.searchsorted(self._ids, object_ids), self._ids.size - 1)
+        return positions, self._ids[positions] == object_ids
+
+
+def _range_key(data_id: Any) -> tuple:
+    """Hashable form of the data ID of a tract index"""
+    return tuple(sorted((name_, np.asarray(val_).item()) for name_, val_ in dict(data_id).items()))
+
+
+def read_index_ranges(
+    butler: Any,
+    ensemble_dataset_type: str,
+    range_dataset_type: str | None = None,
+) -> Table:
+    """Read the object ID range of every tract index
+
+    Parameters
+    ----------
+    butler
+        Butler with the ID ranges in its default collections
+
+    ensemble_dataset_type
+        Dataset type of the p(z) ensembles, e.g. ``pz_estimate_fzboost``
+
+    range_dataset_type
+        Dataset type of the ID ranges; default the one named after
+        ``ensemble_dataset_type``, e.g. ``pz_index_range_fzboost``
+
+    Returns
+    -------
+    index_ranges
+        The data ID of each tract index, with its ``min_id`` and
+        ``max_id``
+    """
+    if range_dataset_type is None:
+        range_dataset_type = derived_name(ensemble_dataset_type, INDEX_RANGE_PREFIX)
+    rows = []
+    for range_ref in butler.registry.queryDatasets(range_dataset_type, findFirst=True):
+        row = butler.get(range_ref)
+        for name, value in dict(range_ref.dataId.required).items():
+            row[name] = [value]
+        rows.append(row)
+    if not rows:
+        return Table({MIN_ID_COLUMN: np.zeros(0, dtype=np.int64), MAX_ID_COLUMN: np.zeros(0, dtype=np.int64)})
+    return vstack(rows)
+
+
+def lookup_pdfs(
+    butler: Any,
+    object_ids: Any,
+    ensemble_dataset_type: str,
+    index_dataset_type: str | None = None,
+    id_column: str = "objectId",
+    index_refs: Iterable[Any] | None = None,
+    index_ranges: Table | None = None,
+) -> tuple[qp.Ensemble | None, np.ndarray]:
+    """Read the p(z) of a list of objects, anywhere in a release
+
+    Parameters
+    ----------
+    butler
+        Butler with the ensembles and tract indices in its default
+        collections
+
+    object_ids
+        IDs of the objects
+
+    ensemble_dataset_type
+        Dataset type of the p(z) ensembles, e.g. ``pz_estimate_fzboost``
+
+    index_dataset_type
+        Dataset type of the tract indices; default the one named after
+        ``ensemble_dataset_type``, e.g. ``pz_index_tract_fzboost``
+
+    id_column
+        Name of the object ID column of the indices
+
+    index_refs
+        References to the tract indices to search; default all of them
+
+    index_ranges
+        Object ID range of the tract indices, from `read_index_ranges`;
+        read through the butler by default.  The indices whose range
+        holds none of the objects are not read; those without a range
+        always are.
+
+    Returns
+    -------
+    ensemble
+        The p(z) of the objects found, in the order of ``object_ids``,
+        with their IDs as ancillary data; `None` if none was found
+
+    found
+        Whether each object was found
+    """
+    object_ids = np.asarray(object_ids)
+    found = np.zeros(object_ids.size, dtype=bool)
+    if index_dataset_type is None:
+        index_dataset_type = derived_name(ensemble_dataset_type, INDEX_TRACT_PREFIX)
+    if index_refs is None:
+        index_refs = butler.registry.queryDatasets(index_dataset_type, findFirst=True)
+    if index_ranges is None:
+        index_ranges = read_index_ranges(butler, ensemble_dataset_type)
+    data_columns = [
+        name_ for name_ in index_ranges.colnames if name_ not in (MIN_ID_COLUMN, MAX_ID_COLUMN)
+    ]
+    ranges = {
+        _range_key({name_: row_[name_] for name_ in data_columns}): (row_[MIN_ID_COLUMN], row_[MAX_ID_COLUMN])
+        for row_ in index_ranges
+    }
+
+    pieces = []
+    requests = []
+    for index_ref in index_refs:
+        id_range = ranges.get(_range_key(index_ref.dataId.required))
+        if id_range is not None:
+            wanted = object_ids[~found]
+            if not np.any((wanted >= id_range[0]) & (wanted <= id_range[1])):
+                continue
+        index = PZIndex(butler.get(index_ref), id_column)
+        positions, hits = index.locate(object_ids)
+        hits &= ~found
+        if not hits.any():
+            continue
+        found |= hits
+        matches = index.table[positions[hits]]
+        matches["_request"] = np.flatnonzero(hits)
+        location_columns = index.location_columns
+        for group in matches.group_by(location_columns).groups:
+            data_id = dict(index_ref.dataId.required)
+            data_id.update({name_: group[name_][0].item() for name_ in location_columns})
+            uri = butler.getURI(ensemble_dataset_type, dataId=data_id)
+            with uri.as_local() as local_uri:
+                pieces.append(read_ensemble_selection(local_uri.ospath, group[ROW_COLUMN]))
+            requests.append(np.asarray(group["_request"]))
+
+    if not pieces:
+        return None, found
+    ensemble = pieces[0] if len(pieces) == 1 else qp.concatenate(pieces)
+    ensemble = ensemble[np.argsort(np.concatenate(requests))]
+    if ensemble.ancil is None:
+        ensemble.set_ancil({id_column: object_ids[found]})
+    else:
+        ensemble.add_to_ancil({id_column: object_ids[found]})
+    return ensemble, found
+
+
+class ReducePZIndexTractConnections(
+    PipelineTaskConnections,
+    dimensions=("skymap", "tract"),
+    defaultTemplates={"algo": "fzboost"},
+):
+    pzIndexInputs = cT.Input(
+        doc="Object ID index of the p(z) estimates, per estimation quantum",
+        name="pz_index_{algo}",
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+        multiple=True,
+    )
+    pzIndex = cT.Output(
+        doc="Object ID index of the p(z) estimates of a tract, with the patch of each object",
+        name="pz_index_tract_{algo}",
+        storageClass="ArrowAstropy",
+        dimensions=("skymap", "tract"),
+    )
+    pzIndexRange = cT.Output(
+        doc="Smallest and largest object ID of pzIndex, which lookups read to skip the tract",
+        name="pz_index_range_{algo}",
+        storageClass="ArrowAstropy",
+        dimensions=("skymap", "tract"),
+    )
+
+
+class ReducePZIndexTractConfig(PipelineTaskConfig, pipelineConnections=ReducePZIndexTractConnections):
+    """Config for ReducePZIndexTractTask
+
+    Set ``connections.algo`` to the estimator whose indices are merged,
+    e.g. ``dnf`` for the ``pz_index_dnf`` outputs of the estimator writing
+    ``pz_estimate_dnf``.
+    """
+
+    id_column = pexConfig.Field(doc="Name of the object ID column", dtype=str, default="objectId")
+
+
+class ReducePZIndexTractTask(PipelineTask):
+    """Merge the object ID indices of all the estimation quanta in a tract"""
+
+    ConfigClass = ReducePZIndexTractConfig
+    _DefaultName = "reducePZIndexTract"
+
+    def runQuantum(
+        self,
+        butlerQC: QuantumContext,
+        inputRefs: InputQuantizedConnection,
+        outputRefs: OutputQuantizedConnection,
+    ) -> None:
+        inputs = butlerQC.get(inputRefs)
+        locations = [
+            {dim_: ref_.dataId[dim_] for dim_ in _LOCATION_DIMENSIONS} for ref_ in inputRefs.pzIndexInputs
+        ]
+        butlerQC.put(self.run(inputs["pzIndexInputs"], locations), outputRefs)
+
+    def run(self, pzIndexInputs: list[Table], locations: list[dict[str, int]]) -> Struct:
+        """Merge indices
+
+        Parameters
+        ----------
+        pzIndexInputs
+            Index of each quantum
+
+        locations
+            Data ID values of each quantum to record with its objects,
+            e.g. its patch
+
+        Returns
+        -------
+        result
+            Struct with ``pzIndex``, sorted by object ID, and its ID range
+            ``pzIndexRange``
+        """
+        if not pzIndexInputs:
+            raise NoWorkFound("No p(z) index inputs")
+        id_column = self.config.id_column
+        columns = {
+            id_column: np.concatenate([np.asarray(table_[id_column]) for table_ in pzIndexInputs]),
+        }
+        for name in locations[0]:
+            columns[name] = np.concatenate(
+                [np.full(len(table_), loc_[name]) for table_, loc_ in zip(pzIndexInputs, locations)]
+            )
+        columns[ROW_COLUMN] = np.concatenate([np.asarray(table_[ROW_COLUMN]) for table_ in pzIndexInputs])
+        order = np.argsort(columns[id_column], kind="stable")
+        pz_index = Table({name_: val_[order] for name_, val_ in columns.items()})
+        ids = np.asarray(pz_index[id_column])
+        # An empty index gets an empty range
+        id_range = (ids[0], ids[-1]) if ids.size else (1, 0)
+        return Struct(
+            pzIndex=pz_index,
+            pzIndexRange=Table({MIN_ID_COLUMN: [id_range[0]], MAX_ID_COLUMN: [id_range[1]]}),
+        )
@@ -0,0 +1,571 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Long-lived local p(z) estimation service holding warm models.
+
+`PZService` keeps one estimator per algorithm, with its model loaded
+and its stage built, and a worker thread per algorithm that serves a
+bounded queue of requests.  Requests that arrive while the worker is
+busy, or within ``batch_wait_ms`` of each other, are estimated together
+as one batch, up to ``max_batch_rows`` objects, and the output ensemble
+is split back between them.  If a batch fails, each of its requests is
+estimated alone, so that one malformed request fails only itself.  When
+a queue is full new requests are rejected at once, rather than piling
+up.
+
+`PZServiceHTTPServer` exposes a service over HTTP, on localhost or on a
+Unix socket:
+
+``POST /estimate/<algo>``
+    Body: ``{"columns": {name: [values]}, "output": "point" | "pdf"}``.
+    Returns the ancillary point estimates of the objects, or their PDFs
+    on the redshift grid of the algorithm (``zgrid`` and ``pdf``), plus
+    the ``timing`` of the request.  A full queue gives a 503.
+``GET /metrics``
+    Request counts and latency quantiles per algorithm.
+``GET /health``
+    The algorithms served.
+"""
+
+__all__ = [
+    "LatencyStats",
+    "PZService",
+    "PZServiceBusyError",
+    "PZServiceConfig",
+    "PZServiceHTTPServer",
+]
+
+import functools
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import qp
+from astropy.table import Table, vstack
+from rail.core.model import Model
+
+from .batch_estimate import make_algo_task
+from .pdf_grid import pdfs_on_grid
+
+# Longest time a worker waits for a request before checking whether the
+# service is closing
+_STOP_POLL_SECONDS = 0.1
+
+
+class PZServiceConfig(pexConfig.Config):
+    """Config for a `PZService` and its HTTP server"""
+
+    models = pexConfig.DictField(
+        doc="Path of the pickled model for each algorithm served, keyed by algorithm name",
+        keytype=str,
+        itemtype=str,
+        default={},
+    )
+    preset = pexConfig.Field(
+        doc="Survey preset for the column names of all the algorithms",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    host = pexConfig.Field(doc="Address the HTTP server listens on", dtype=str, default="127.0.0.1")
+    port = pexConfig.Field(doc="HTTP port; 0 picks a free one", dtype=int, default=0)
+    socket_path = pexConfig.Field(
+        doc="Serve HTTP on this Unix socket instead of host and port",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    max_queue = pexConfig.Field(
+        doc="Maximum number of requests waiting per algorithm; further requests are rejected",
+        dtype=int,
+        default=64,
+    )
+    max_batch_rows = pexConfig.Field(
+        doc="Maximum number of objects estimated together in one batch",
+        dtype=int,
+        default=10000,
+    )
+    batch_wait_ms = pexConfig.Field(
+        doc="Time to wait for more requests to batch with the first one, in milliseconds",
+        dtype=float,
+        default=2.0,
+    )
+
+    def validate(self) -> None:
+        super().validate()
+        if self.max_queue < 1 or self.max_batch_rows < 1 or self.batch_wait_ms < 0:
+            raise ValueError("max_queue and max_batch_rows must be positive, batch_wait_ms non-negative")
+
+
+class PZServiceBusyError(RuntimeError):
+    """Raised when the queue of an algorithm is full"""
+
+
+class LatencyStats:
+    """Request counts and recent latencies of one algorithm
+
+    Parameters
+    ----------
+    window
+        Number of recent requests kept for the latency quantiles
+    """
+
+    def __init__(self, window: int = 10000):
+        self._lock = threading.Lock()
+        self._latencies: dict[str, deque] = {
+            name_: deque(maxlen=window) for name_ in ("queue_ms", "compute_ms", "total_ms")
+        }
+        self.n_requests = 0
+        self.n_rows = 0
+        self.n_batches = 0
+        self.n_rejected = 0
+        self.n_failed = 0
+
+    def add_request(self, timing: dict[str, float], n_rows: int) -> None:
+        with self._lock:
+            self.n_requests += 1
+            self.n_rows += n_rows
+            for name, latencies in self._latencies.items():
+                latencies.append(timing[name])
+
+    def add_batch(self) -> None:
+        with self._lock:
+            self.n_batches += 1
+
+    def add_rejected(self) -> None:
+        with self._lock:
+            self.n_rejected += 1
+
+    def add_failed(self) -> None:
+        with self._lock:
+            self.n_failed += 1
+
+    def summary(self) -> dict[str, Any]:
+        """Return the counts and the p50, p95, p99 and max latencies"""
+        with self._lock:
+            summary: dict[str, Any] = dict(
+                n_requests=self.n_requests,
+                n_rows=self.n_rows,
+                n_batches=self.n_batches,
+                n_rejected=self.n_rejected,
+                n_failed=self.n_failed,
+            )
+            for name, latencies in self._latencies.items():
+                if not latencies:
+                    continue
+                values = np.fromiter(latencies, dtype=float)
+                quantiles = np.quantile(values, [0.5, 0.95, 0.99])
+                summary[name] = dict(
+                    p50=quantiles[0], p95=quantiles[1], p99=quantiles[2], max=values.max()
+                )
+        return summary
+
+
+@dataclass
+class _Request:
+    """A request waiting for, or done with, its estimation"""
+
+    fluxes: Table
+    enqueued: float = field(default_factory=time.perf_counter)
+    done: threading.Event = field(default_factory=threading.Event)
+    started: float = 0.0
+    finished: float = 0.0
+    result: qp.Ensemble | None = None
+    error: BaseException | None = None
+
+
+class _AlgoWorker(threading.Thread):
+    """Thread estimating the queued requests of one algorithm in batches"""
+
+    def __init__(
+        self,
+        algo_name: str,
+        estimate: Callable[[Table], qp.Ensemble],
+        config: PZServiceConfig,
+    ):
+        super().__init__(name=f"pz-service-{algo_name}", daemon=True)
+        self.estimate = estimate
+        self.max_batch_rows = config.max_batch_rows
+        self.batch_wait = config.batch_wait_ms / 1000.0
+        self.requests: queue.Queue = queue.Queue(maxsize=config.max_queue)
+        self.stopping = threading.Event()
+        self.stats = LatencyStats()
+
+    def stop(self) -> None:
+        """Stop once the queued requests are done, without blocking"""
+        self.stopping.set()
+        try:
+            # Wake the worker if it waits for a request
+            self.requests.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _next_batch(self) -> list[_Request] | None:
+        """Wait for a request, then gather the ones that can join it"""
+        while True:
+            try:
+                first = self.requests.get(timeout=_STOP_POLL_SECONDS)
+            except queue.Empty:
+                first = None
+            if first is not None:
+                break
+            if self.stopping.is_set() and self.requests.empty():
+                return None
+        batch, n_rows = [first], len(first.fluxes)
+        deadline = time.perf_counter() + self.batch_wait
+        while n_rows < self.max_batch_rows:
+            try:
+                # Take what is already queued even after the deadline
+                request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0.0))
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            batch.append(request)
+            n_rows += len(request.fluxes)
+        return batch
+
+    def _estimate_alone(self, request: _Request) -> None:
+        try:
+            request.result = self.estimate(request.fluxes)
+        except Exception as err:
+            request.error = err
+            self.stats.add_failed()
+
+    def run(self) -> None:
+        while (batch := self._next_batch()) is not None:
+            started = time.perf_counter()
+            if len(batch) == 1:
+                self._estimate_alone(batch[0])
+            else:
+                try:
+                    pz_ensemble = self.estimate(vstack([req_.fluxes for req_ in batch]))
+                except Exception:
+                    # Find out which requests fail
+                    for request in batch:
+                        self._estimate_alone(request)
+                else:
+                    start = 0
+                    for request in batch:
+                        stop = start + len(request.fluxes)
+                        request.result = pz_ensemble[start:stop]
+                        start = stop
+            finished = time.perf_counter()
+            self.stats.add_batch()
+
+            for request in batch:
+                request.started, request.finished = started, finished
+                request.done.set()
+
+
+class PZService:
+    """Estimators with warm models, serving batched requests
+
+    Parameters
+    ----------
+    estimators
+        Function estimating the p(z) of a catalog, for each algorithm
+        served; see `from_config` for the wrapped algorithms
+
+    config
+        Queue and batching parameters
+
+    zgrids
+        Redshift grid on which the PDFs of each algorithm are returned
+        by `render`
+    """
+
+    def __init__(
+        self,
+        estimators: dict[str, Callable[[Table], qp.Ensemble]],
+        config: PZServiceConfig,
+        zgrids: dict[str, np.ndarray] | None = None,
+    ):
+        config.validate()
+        self.config = config
+        self.zgrids = zgrids or {}
+        self._workers = {
+            algo_name: _AlgoWorker(algo_name, estimate, config) for algo_name, estimate in estimators.items()
+        }
+        for worker in self._workers.values():
+            worker.start()
+
+    @classmethod
+    def from_config(cls, config: PZServiceConfig) -> "PZService":
+        """Load the models and build the estimators of a config
+
+        The algorithm names are those of
+        `lsst.meas.pz.extensions.algo_registry.pz_algo_registry`.
+        """
+        estimators = {}
+        zgrids = {}
+        for algo_name, model_path in config.models.items():
+            algo_task = make_algo_task(algo_name, config.preset)
+            pz_model = Model.read(model_path)
+            stage = algo_task.get_stage(pz_model)
+            if stage.model is None:
+                stage.open_model(**stage.config)
+            estimators[algo_name] = functools.partial(algo_task.estimate, pz_model)
+            zgrids[algo_name] = np.linspace(
+                algo_task.config.zmin, algo_task.config.zmax, algo_task.config.nzbins
+            )
+        return cls(estimators, config, zgrids)
+
+    @property
+    def algorithms(self) -> list[str]:
+        """Names of the algorithms served"""
+        return sorted(self._workers)
+
+    def estimate(
+        self,
+        algo_name: str,
+        fluxes: Table,
+        timeout: float | None = None,
+    ) -> tuple[qp.Ensemble, dict[str, float]]:
+        """Estimate the p(z) of a catalog, batched with other requests
+
+        Parameters
+        ----------
+        algo_name
+            Algorithm to use
+
+        fluxes
+            Input catalog, with the input columns of the algorithm
+
+        timeout
+            Maximum time to wait for the result, in seconds
+
+        Returns
+        -------
+        pz_ensemble
+            The p(z) estimates
+
+        timing
+            ``queue_ms``, ``compute_ms`` (of the whole batch) and
+            ``total_ms`` spent on the request
+
+        Raises
+        ------
+        KeyError
+            If the algorithm is not served
+        PZServiceBusyError
+            If the queue of the algorithm is full, or the service is closing
+        TimeoutError
+            If the result is not ready in time
+        """
+        worker = self._workers[algo_name]
+        if worker.stopping.is_set():
+            raise PZServiceBusyError(f"Service of {algo_name} is closing")
+        request = _Request(fluxes=fluxes)
+        try:
+            worker.requests.put_nowait(request)
+        except queue.Full:
+            worker.stats.add_rejected()
+            raise PZServiceBusyError(f"Queue of {algo_name} is full") from None
+        if not request.done.wait(timeout):
+            raise TimeoutError(f"No {algo_name} estimate after {timeout} s")
+        if request.error is not None:
+            raise request.error
+
+        timing = dict(
+            queue_ms=1000.0 * (request.started - request.enqueued),
+            compute_ms=1000.0 * (request.finished - request.started),
+            total_ms=1000.0 * (time.perf_counter() - request.enqueued),
+        )
+        worker.stats.add_request(timing, len(fluxes))
+        return request.result, timing
+
+    def render(self, algo_name: str, pz_ensemble: qp.Ensemble, output: str) -> dict[str, Any]:
+        """Convert estimates to json-able lists
+
+        Parameters
+        ----------
+        algo_name
+            Algorithm that made the estimates
+
+        pz_ensemble
+            The p(z) estimates
+
+        output
+            ``point`` for the ancillary point estimates, or ``pdf`` for the
+            PDFs on the redshift grid of the algorithm
+        """
+        if output == "point":
+            return {
+                key_: np.asarray(val_).tolist()
+                for key_, val_ in (pz_ensemble.ancil or {}).items()
+                if np.ndim(val_) == 1
+            }
+        if output == "pdf":
+            zgrid = self.zgrids.get(algo_name, np.linspace(0.0, 3.0, 301))
+            return dict(zgrid=zgrid.tolist(), pdf=pdfs_on_grid(pz_ensemble, zgrid).tolist())
+        raise ValueError(f"Unknown output {output}, expected point or pdf")
+
+    def metrics(self) -> dict[str, Any]:
+        """Return the request counts and latencies of each algorithm"""
+        return {
+            algo_name: dict(queue_size=worker.requests.qsize(), **worker.stats.summary())
+            for algo_name, worker in self._workers.items()
+        }
+
+    def close(self) -> None:
+        """Stop the workers once the queued requests are done"""
+        for worker in self._workers.values():
+            worker.stop()
+        for worker in self._workers.values():
+            worker.join()
+            # Requests that raced with the shutdown
+            while True:
+                try:
+                    request = worker.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    request.error = PZServiceBusyError(f"Service of {worker.name} is closed")
+                    request.done.set()
+
+
+class _PZServiceHandler(BaseHTTPRequestHandler):
+    """HTTP handler forwarding requests to the server's `PZService`"""
+
+    server: "PZServiceHTTPServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Per-request logging would dominate the latency of small requests
+        pass
+
+    def _reply(self, status: HTTPStatus, body: dict[str, Any]) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        service = self.server.service
+        if self.path == "/health":
+            self._reply(HTTPStatus.OK, dict(status="ok", algorithms=service.algorithms))
+        elif self.path == "/metrics":
+            self._reply(HTTPStatus.OK, service.metrics())
+        else:
+            self._reply(HTTPStatus.NOT_FOUND, dict(error=f"Unknown path {self.path}"))
+
+    def do_POST(self) -> None:
+        service = self.server.service
+        prefix, _, algo_name = self.path.rpartition("/")
+        if prefix != "/estimate" or algo_name not in service.algorithms:
+            self._reply(HTTPStatus.NOT_FOUND, dict(error=f"Unknown path {self.path}"))
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            fluxes = Table({key_: np.asarray(val_) for key_, val_ in body["columns"].items()})
+            output = body.get("output", "point")
+            if output not in ("point", "pdf"):
+                raise ValueError(f"Unknown output {output}, expected point or pdf")
+        except (ValueError, KeyError, TypeError) as err:
+            self._reply(HTTPStatus.BAD_REQUEST, dict(error=f"Bad request: {err}"))
+            return
+        try:
+            pz_ensemble, timing = service.estimate(algo_name, fluxes)
+            reply = service.render(algo_name, pz_ensemble, output)
+        except PZServiceBusyError as err:
+            self._reply(HTTPStatus.SERVICE_UNAVAILABLE, dict(error=str(err)))
+            return
+        except Exception as err:
+            self._reply(HTTPStatus.INTERNAL_SERVER_ERROR, dict(error=f"{type(err).__name__}: {err}"))
+            return
+        reply["timing"] = timing
+        self._reply(HTTPStatus.OK, reply)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self) -> tuple[Any, Any]:
+        # BaseHTTPRequestHandler expects an address tuple
+        connection, _ = super().get_request()
+        return connection, ("local", 0)
+
+
+class PZServiceHTTPServer:
+    """HTTP front end of a `PZService`
+
+    Parameters
+    ----------
+    service
+        The service to expose
+
+    config
+        Gives the address: ``socket_path`` if set, else ``host`` and
+        ``port``
+    """
+
+    def __init__(self, service: PZService, config: PZServiceConfig):
+        if config.socket_path is not None:
+            if os.path.exists(config.socket_path):
+                os.unlink(config.socket_path)
+            self._server = _UnixHTTPServer(config.socket_path, _PZServiceHandler)
+        else:
+            self._server = ThreadingHTTPServer((config.host, config.port), _PZServiceHandler)
+            self._server.daemon_threads = True
+        self._server.service = service
+        self.service = service
+        self.config = config
+        self._thread: threading.Thread | None = None
+
+    @property
+    def address(self) -> str:
+        """URL of the server, or path of its Unix socket"""
+        if self.config.socket_path is not None:
+            return self.config.socket_path
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        """Serve requests in this thread, until `shutdown`"""
+        self._server.serve_forever()
+
+    def start(self) -> None:
+        """Serve requests in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        """Stop serving, then stop the service"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+        self._server.server_close()
+        if self.config.socket_path is not None and os.path.exists(self.config.socket_path):
+            os.unlink(self.config.socket_path)
+        self.service.close()
@@ -0,0 +1,122 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+__all__ = [
+    "ReduceNzTractConfig",
+    "ReduceNzTractTask",
+    "ReduceNzSurveyConfig",
+    "ReduceNzSurveyTask",
+]
+
+from astropy.table import Table
+from lsst.meas.pz.estimate_pz_task import EstimatePZTaskConnections
+from lsst.pipe.base import (
+    NoWorkFound,
+    PipelineTask,
+    PipelineTaskConfig,
+    PipelineTaskConnections,
+    Struct,
+)
+from lsst.pipe.base import connectionTypes as cT
+
+from .nz_accumulator import NzAccumulator
+
+
+class ReduceNzTractConnections(
+    PipelineTaskConnections,
+    dimensions=("skymap", "tract"),
+    defaultTemplates={"algo": "fzboost"},
+):
+    pzNzInputs = cT.Input(
+        doc="Stacked p(z) per estimation quantum, of the estimator named by the algo template",
+        name="pz_nz_{algo}",
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+        multiple=True,
+    )
+    pzNz = cT.Output(
+        doc="Stacked p(z) per tract",
+        name="pz_nz_tract_{algo}",
+        storageClass="ArrowAstropy",
+        dimensions=("skymap", "tract"),
+    )
+
+
+class ReduceNzSurveyConnections(
+    PipelineTaskConnections,
+    dimensions=("skymap",),
+    defaultTemplates={"algo": "fzboost"},
+):
+    pzNzInputs = cT.Input(
+        doc="Stacked p(z) per tract",
+        name="pz_nz_tract_{algo}",
+        storageClass="ArrowAstropy",
+        dimensions=("skymap", "tract"),
+        multiple=True,
+    )
+    pzNz = cT.Output(
+        doc="Stacked p(z) for the whole survey",
+        name="pz_nz_survey_{algo}",
+        storageClass="ArrowAstropy",
+        dimensions=("skymap",),
+    )
+
+
+class ReduceNzTractConfig(PipelineTaskConfig, pipelineConnections=ReduceNzTractConnections):
+    """Config for ReduceNzTractTask
+
+    Set ``connections.algo`` to the estimator whose stacked p(z) are
+    summed, e.g. ``dnf`` for the ``pz_nz_dnf`` outputs of the estimator
+    writing ``pz_estimate_dnf``.
+    """
+
+
+class ReduceNzSurveyConfig(PipelineTaskConfig, pipelineConnections=ReduceNzSurveyConnections):
+    """Config for ReduceNzSurveyTask
+
+    ``connections.algo`` must match that of the ReduceNzTractTask label.
+    """
+
+
+class _ReduceNzTaskBase(PipelineTask):
+    """Sum stacked p(z) histograms written by the estimation tasks"""
+
+    def run(self, pzNzInputs: list[Table]) -> Struct:
+        if not pzNzInputs:
+            raise NoWorkFound("No stacked p(z) inputs")
+        accumulator = NzAccumulator.from_table(pzNzInputs[0])
+        for table_ in pzNzInputs[1:]:
+            accumulator.merge(NzAccumulator.from_table(table_))
+        return Struct(pzNz=accumulator.to_table())
+
+
+class ReduceNzTractTask(_ReduceNzTaskBase):
+    """Sum the stacked p(z) of all the estimation quanta in a tract"""
+
+    ConfigClass = ReduceNzTractConfig
+    _DefaultName = "reduceNzTract"
+
+
+class ReduceNzSurveyTask(_ReduceNzTaskBase):
+    """Sum the per-tract stacked p(z) over the whole survey"""
+
+    ConfigClass = ReduceNzSurveyConfig
+    _DefaultName = "reduceNzSurvey"
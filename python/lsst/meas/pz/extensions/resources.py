@@ -0,0 +1,198 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Control of the compute resources used inside the estimation tasks"""
+
+__all__ = [
+    "ChunkSizer",
+    "current_rss_bytes",
+    "current_thread_count",
+    "peak_rss_bytes",
+    "thread_budget",
+]
+
+import os
+import resource
+import sys
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+try:
+    from threadpoolctl import threadpool_info, threadpool_limits
+except ImportError:
+    threadpool_info = None
+    threadpool_limits = None
+
+# Read by OpenMP, the BLAS implementations and numexpr when they start
+# their thread pools, e.g. when a library is first imported or
+# a subprocess is spawned.
+_THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+def current_thread_count() -> int:
+    """Return the largest thread pool size among the loaded native libraries
+
+    This uses `threadpoolctl` when it is available; otherwise it falls back
+    to ``OMP_NUM_THREADS`` or the number of CPUs.
+    """
+    if threadpool_info is not None:
+        pool_sizes = [info_["num_threads"] for info_ in threadpool_info()]
+        if pool_sizes:
+            return max(pool_sizes)
+    if os.environ.get("OMP_NUM_THREADS", "").isdigit():
+        return int(os.environ["OMP_NUM_THREADS"])
+    return os.cpu_count() or 1
+
+
+@contextmanager
+def thread_budget(n_threads: int) -> Iterator[int]:
+    """Limit the threads used by BLAS, OpenMP and friends inside a block
+
+    Already loaded libraries are limited with `threadpoolctl`, when it is
+    available, and the usual environment variables are set for libraries
+    that start their thread pools later.  Everything is restored on exit.
+
+    Parameters
+    ----------
+    n_threads
+        Maximum number of threads; zero or less leaves everything as is
+
+    Yields
+    ------
+    effective_threads
+        The thread count in effect inside the block
+    """
+    if n_threads <= 0:
+        yield current_thread_count()
+        return
+
+    saved_env = {var_: os.environ.get(var_) for var_ in _THREAD_ENV_VARS}
+    os.environ.update({var_: str(n_threads) for var_ in _THREAD_ENV_VARS})
+    try:
+        if threadpool_limits is not None:
+            with threadpool_limits(limits=n_threads):
+                yield min(current_thread_count(), n_threads)
+        else:
+            yield n_threads
+    finally:
+        for var_, val_ in saved_env.items():
+            if val_ is None:
+                os.environ.pop(var_, None)
+            else:
+                os.environ[var_] = val_
+
+
+def peak_rss_bytes() -> int:
+    """Return the peak resident set size of this process, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes, except on macOS
+    return peak if sys.platform == "darwin" else 1024 * peak
+
+
+def current_rss_bytes() -> int:
+    """Return the resident set size of this process, in bytes
+
+    This reads ``/proc/self/statm`` where it exists, and falls back to the
+    peak resident set size elsewhere, which can only overestimate.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+class ChunkSizer:
+    """Pick chunk sizes that keep the resident memory under a budget
+
+    Each chunk gets the rows that fit in the memory left under
+    ``headroom * budget_bytes``, at the current estimate of the bytes
+    needed per row.  That estimate is raised whenever the process peak
+    grows by more than it predicted during a chunk, so the chunks shrink
+    as the resident memory nears the budget or when the initial estimate
+    was too low.
+
+    Parameters
+    ----------
+    budget_bytes
+        Memory budget of the whole process, in bytes
+
+    bytes_per_row
+        Initial estimate of the peak memory needed per row of a chunk
+
+    min_chunk_size
+        Smallest chunk returned, even when over the budget
+
+    headroom
+        Fraction of the budget the chunks may fill
+
+    fixed_bytes
+        Peak memory needed by each chunk whatever its number of rows,
+        e.g. scratch space of a fixed number of rows per thread
+    """
+
+    def __init__(
+        self,
+        budget_bytes: int,
+        bytes_per_row: float,
+        min_chunk_size: int = 1000,
+        headroom: float = 0.8,
+        fixed_bytes: int = 0,
+    ):
+        self.budget_bytes = budget_bytes
+        self.bytes_per_row = float(bytes_per_row)
+        self.min_chunk_size = max(min_chunk_size, 1)
+        self.headroom = headroom
+        self.fixed_bytes = fixed_bytes
+        self.chunk_sizes: list[int] = []
+        self.over_budget = False
+        self._start_rss = 0
+        self._start_peak = 0
+
+    def next_chunk_size(self, n_remaining: int) -> int:
+        """Return the number of rows of the next chunk
+
+        Parameters
+        ----------
+        n_remaining
+            Number of rows left to process
+        """
+        self._start_rss = current_rss_bytes()
+        self._start_peak = peak_rss_bytes()
+        available = self.headroom * self.budget_bytes - self._start_rss - self.fixed_bytes
+        self.over_budget = available < self.min_chunk_size * self.bytes_per_row
+        chunk_size = int(max(available, 0.0) / self.bytes_per_row)
+        chunk_size = min(max(chunk_size, self.min_chunk_size), n_remaining)
+        self.chunk_sizes.append(chunk_size)
+        return chunk_size
+
+    def chunk_done(self) -> None:
+        """Update the bytes per row estimate after processing a chunk"""
+        peak = peak_rss_bytes()
+        if peak > self._start_peak and self.chunk_sizes:
+            observed = (peak - self._start_rss - self.fixed_bytes) / self.chunk_sizes[-1]
+            self.bytes_per_row = max(self.bytes_per_row, observed)
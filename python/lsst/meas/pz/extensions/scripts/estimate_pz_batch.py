@@ -0,0 +1,208 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Command line interface of `lsst.meas.pz.extensions.batch_estimate`"""
+
+__all__ = [
+    "build_argparser",
+    "main",
+]
+
+import argparse
+import ast
+import logging
+import os
+import sys
+from typing import Any
+
+from ..batch_estimate import check_output_names, find_input_files, run_batch
+from ..distributed import DistributedEstimator, LocalBackend, ManagerBackend
+from ..hdf5_layout import Hdf5LayoutConfig, available_compressions
+from ..presets import survey_presets
+
+AUTHKEY_ENV_VAR = "PZ_WORKER_AUTHKEY"
+
+
+def _parse_override(text: str) -> tuple[str, Any]:
+    """Parse a ``key=value`` config override, value as a python literal"""
+    key, sep, value = text.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(f"Expected key=value, got {text}")
+    try:
+        return key.strip(), ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return key.strip(), value
+
+
+def _parse_address(text: str) -> tuple[str, int]:
+    """Parse a ``host:port`` address"""
+    host, sep, port = text.rpartition(":")
+    if not sep or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"Expected host:port, got {text}")
+    return host, int(port)
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    """Build the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Estimate p(z) for the objects of parquet files with one of the wrapped "
+        "algorithms, without a butler. Writes a sharded ensemble and a point estimate "
+        "table per input file; files with existing outputs are skipped.",
+    )
+    parser.add_argument("algo_name", help="Algorithm name, e.g. dnf, fzboost, gpz, tpz")
+    parser.add_argument("model", help="Pickled model for the algorithm")
+    parser.add_argument("inputs", nargs="+", help="Input parquet files or glob patterns")
+    parser.add_argument("-o", "--output-dir", required=True, help="Directory for the outputs")
+    parser.add_argument(
+        "-p", "--preset", choices=sorted(survey_presets), default=None, help="Survey column name preset"
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        dest="overrides",
+        type=_parse_override,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override an algorithm config field, after the preset; may be repeated",
+    )
+    parser.add_argument("-j", "--processes", type=int, default=1, help="Number of worker processes")
+    parser.add_argument(
+        "--executor",
+        choices=["files", "chunks", "remote"],
+        default="files",
+        help="files spreads the files over the local workers; chunks spreads the chunks of each "
+        "file over them; remote serves the chunks to pz_chunk_worker.py workers on any node, "
+        f"with the shared secret in ${AUTHKEY_ENV_VAR}",
+    )
+    parser.add_argument(
+        "--listen",
+        type=_parse_address,
+        default=("", 0),
+        metavar="HOST:PORT",
+        help="Address the remote workers connect to; default any free port",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Threads per worker for BLAS, OpenMP, etc.; 0 splits the CPUs between the workers",
+    )
+    parser.add_argument("--chunk-size", type=int, default=100000, help="Rows estimated at once")
+    parser.add_argument(
+        "--write-queue",
+        type=int,
+        default=2,
+        help="Estimated chunks waiting to be written while the next is estimated; 0 for none",
+    )
+    parser.add_argument(
+        "--hdf5-chunk-rows",
+        type=int,
+        default=0,
+        help="Objects per HDF5 chunk of the ensemble shards; 0 writes them as qp does, unchunked",
+    )
+    parser.add_argument(
+        "--hdf5-compression",
+        choices=available_compressions(),
+        default="lzf",
+        help="Compression of the HDF5 chunks, with --hdf5-chunk-rows",
+    )
+    parser.add_argument(
+        "--id-column", default="objectId", help="Object ID column copied to the outputs; empty for none"
+    )
+    parser.add_argument("--overwrite", action="store_true", help="Redo files with existing outputs")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every file")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the batch estimation, returning the number of failed files"""
+    args = build_argparser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    input_paths = find_input_files(args.inputs)
+    if not input_paths:
+        print(f"No input files match {args.inputs}", file=sys.stderr)
+        return 1
+    try:
+        check_output_names(input_paths)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+
+    layout = None
+    if args.hdf5_chunk_rows > 0:
+        layout = Hdf5LayoutConfig(chunk_rows=args.hdf5_chunk_rows, compression=args.hdf5_compression)
+
+    executor = None
+    if args.executor != "files":
+        if args.executor == "chunks":
+            backend = LocalBackend(args.processes)
+        elif not os.environ.get(AUTHKEY_ENV_VAR):
+            print(f"The remote executor needs a shared secret in ${AUTHKEY_ENV_VAR}", file=sys.stderr)
+            return 1
+        else:
+            backend = ManagerBackend(
+                args.listen, os.environ[AUTHKEY_ENV_VAR].encode(), n_workers=args.processes
+            )
+        executor = DistributedEstimator(
+            backend,
+            args.algo_name,
+            args.model,
+            preset=args.preset,
+            overrides=dict(args.overrides),
+            num_threads=args.threads or max(1, (os.cpu_count() or 1) // max(args.processes, 1)),
+        )
+        executor.start()
+        if args.executor == "remote":
+            host, port = backend.address
+            print(f"Serving chunks on {host}:{port}", file=sys.stderr)
+
+    try:
+        results = run_batch(
+            input_paths,
+            args.algo_name,
+            args.model,
+            args.output_dir,
+            preset=args.preset,
+            overrides=dict(args.overrides),
+            n_workers=args.processes,
+            num_threads=args.threads,
+            chunk_size=args.chunk_size,
+            id_column=args.id_column or None,
+            overwrite=args.overwrite,
+            executor=executor,
+            write_queue_size=args.write_queue,
+            layout=layout,
+        )
+    finally:
+        if executor is not None:
+            executor.close()
+    n_failed = sum(result_.error is not None for result_ in results)
+    n_skipped = sum(result_.skipped for result_ in results)
+    n_rows = sum(result_.n_rows for result_ in results)
+    print(
+        f"{len(results) - n_failed - n_skipped} files done ({n_rows} objects), "
+        f"{n_skipped} skipped, {n_failed} failed"
+    )
+    return n_failed
@@ -0,0 +1,101 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Command line interface of `lsst.meas.pz.extensions.profiling`"""
+
+__all__ = [
+    "build_argparser",
+    "main",
+]
+
+import argparse
+
+from astropy.table import Table
+from rail.core.model import Model
+
+from ..batch_estimate import make_algo_task
+from ..presets import survey_presets
+from ..profiling import profile_estimate
+from .estimate_pz_batch import _parse_override
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    """Build the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Profile p(z) estimation of a parquet catalog with one of the wrapped "
+        "algorithms, and report where the time goes: meas_pz wrappers, RAIL or qp.",
+    )
+    parser.add_argument("algo_name", help="Algorithm name, e.g. dnf, fzboost, gpz, tpz")
+    parser.add_argument("model", help="Pickled model for the algorithm")
+    parser.add_argument("catalog", help="Input parquet catalog")
+    parser.add_argument(
+        "-o", "--output-prefix", default=None, help="Path prefix of the outputs; default pz_profile_<algo>"
+    )
+    parser.add_argument(
+        "-p", "--preset", choices=sorted(survey_presets), default=None, help="Survey column name preset"
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        dest="overrides",
+        type=_parse_override,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override an algorithm config field, after the preset; may be repeated",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=["sampling", "deterministic"],
+        default="sampling",
+        help="sampling writes collapsed stacks for flame graphs; deterministic uses cProfile",
+    )
+    parser.add_argument("--interval", type=float, default=0.005, help="Sampling interval, in seconds")
+    parser.add_argument("--rows", type=int, default=None, help="Only estimate the first ROWS objects")
+    parser.add_argument("--top", type=int, default=20, help="Functions listed per category")
+    parser.add_argument(
+        "--include-setup", action="store_true", help="Also profile loading the model and building the stage"
+    )
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Profile the estimation, and print the top-N table"""
+    args = build_argparser().parse_args(argv)
+    algo_task = make_algo_task(args.algo_name, args.preset, dict(args.overrides))
+    fluxes = Table.read(args.catalog, format="parquet", include_names=algo_task.col_names())
+    if args.rows is not None:
+        fluxes = fluxes[: args.rows]
+    pz_model = Model.read(args.model)
+
+    result = profile_estimate(
+        algo_task,
+        pz_model,
+        fluxes,
+        mode=args.mode,
+        interval=args.interval,
+        include_setup=args.include_setup,
+    )
+    paths = result.write(args.output_prefix or f"pz_profile_{args.algo_name}", n_top=args.top)
+    result.top_table(args.top).pprint_all()
+    print(f"{len(fluxes)} objects in {result.elapsed:.2f} s; wrote {', '.join(paths)}")
+    return 0
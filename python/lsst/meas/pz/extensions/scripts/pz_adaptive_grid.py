@@ -0,0 +1,105 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Build an adaptive redshift grid from the n(z) of a training set, see
+`lsst.meas.pz.extensions.pdf_grid.adaptive_zgrid`
+
+The grid is saved with `numpy.save`, for the ``zgrid_path`` option of the
+estimator configs.
+"""
+
+__all__ = [
+    "build_argparser",
+    "main",
+]
+
+import argparse
+
+import numpy as np
+import qp
+from astropy.table import Table
+
+from ..pdf_grid import adaptive_zgrid, compare_ensembles, grid_ensemble, pdfs_on_grid, resample_ensemble
+
+
+def _read_redshifts(path: str, column: str) -> np.ndarray:
+    if path.endswith(".npy"):
+        return np.load(path).ravel()
+    return np.asarray(Table.read(path, include_names=[column])[column], dtype=float)
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    """Build the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Build a redshift grid that is denser where the training n(z) has support, and "
+        "report how well p(z) of training-like objects survive being stored on it.",
+    )
+    parser.add_argument("training", help="Training catalog, any format astropy reads, or a .npy array")
+    parser.add_argument("output", help="Output .npy file for the grid")
+    parser.add_argument("--column", default="redshift", help="Redshift column of the training catalog")
+    parser.add_argument("--zmin", type=float, default=0.0, help="First point of the grid")
+    parser.add_argument("--zmax", type=float, default=3.0, help="Last point of the grid")
+    parser.add_argument("--nzbins", type=int, default=301, help="Points of the standard, uniform grid")
+    parser.add_argument("--n-grid", type=int, default=101, help="Points of the adaptive grid")
+    parser.add_argument(
+        "--uniform-fraction", type=float, default=0.25, help="Fraction of the points spread uniformly"
+    )
+    parser.add_argument("--smoothing", type=float, default=0.05, help="Smoothing width of the n(z)")
+    parser.add_argument(
+        "--test-width",
+        type=float,
+        default=0.03,
+        help="Width, in units of 1 + z, of the Gaussian p(z) used to check the accuracy",
+    )
+    parser.add_argument("--test-rows", type=int, default=10000, help="Number of p(z) used to check")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Build and save the grid, and print its accuracy"""
+    args = build_argparser().parse_args(argv)
+    redshifts = _read_redshifts(args.training, args.column)
+    zgrid = adaptive_zgrid(
+        redshifts,
+        args.zmin,
+        args.zmax,
+        args.n_grid,
+        uniform_fraction=args.uniform_fraction,
+        smoothing=args.smoothing,
+    )
+    np.save(args.output, zgrid)
+
+    # Gaussian p(z) at training redshifts, stored on the adaptive grid and
+    # read back on the standard grid
+    standard = np.linspace(args.zmin, args.zmax, args.nzbins)
+    rng = np.random.default_rng(1234)
+    locs = rng.choice(redshifts[(redshifts >= args.zmin) & (redshifts <= args.zmax)], args.test_rows)
+    locs = locs[:, np.newaxis]
+    reference = qp.Ensemble(qp.stats.norm, data=dict(loc=locs, scale=args.test_width * (1.0 + locs)))
+    stored = grid_ensemble(zgrid, pdfs_on_grid(reference, zgrid))
+    metrics = compare_ensembles(reference, resample_ensemble(stored, standard), standard)
+
+    spacing = np.diff(zgrid)
+    print(f"Wrote {zgrid.size} points to {args.output}, {zgrid.size / standard.size:.0%} of standard")
+    print(f"Spacing {spacing.min():.4f} to {spacing.max():.4f}, standard {standard[1] - standard[0]:.4f}")
+    for name, value in metrics.items():
+        print(f"{name}: {value:.4g}")
+    return 0
@@ -0,0 +1,56 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Worker of ``estimate_pz_batch.py --executor remote``, for any node"""
+
+__all__ = [
+    "build_argparser",
+    "main",
+]
+
+import argparse
+import os
+import sys
+
+from ..distributed import run_remote_worker
+from .estimate_pz_batch import AUTHKEY_ENV_VAR, _parse_address
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    """Build the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Estimate chunks served by estimate_pz_batch.py --executor remote until it ends. "
+        f"The shared secret is read from ${AUTHKEY_ENV_VAR}.",
+    )
+    parser.add_argument("address", type=_parse_address, metavar="HOST:PORT", help="Address of the driver")
+    parser.add_argument("--worker-id", default=None, help="Name in the driver's logs; default host-pid")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Connect to the driver and estimate chunks until it closes"""
+    args = build_argparser().parse_args(argv)
+    authkey = os.environ.get(AUTHKEY_ENV_VAR)
+    if not authkey:
+        print(f"Set the shared secret of the driver in ${AUTHKEY_ENV_VAR}", file=sys.stderr)
+        return 1
+    run_remote_worker(args.address, authkey.encode(), worker_id=args.worker_id)
+    return 0
@@ -0,0 +1,108 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare HDF5 layouts of an ensemble file, see
+`lsst.meas.pz.extensions.hdf5_layout`
+"""
+
+__all__ = [
+    "build_argparser",
+    "main",
+]
+
+import argparse
+import json
+import os
+import tempfile
+from dataclasses import asdict
+
+import numpy as np
+import qp
+
+from ..hdf5_layout import Hdf5LayoutConfig, available_compressions, benchmark_layout, format_layout_benchmark
+
+
+def _parse_list(value: str) -> list[str]:
+    return value.split(",")
+
+
+def synthetic_ensemble(n_rows: int, n_grid: int, seed: int = 1234) -> qp.Ensemble:
+    """Make an interpolated ensemble of Gaussian p(z), with IDs and modes
+    as ancillary data like the estimator outputs
+    """
+    rng = np.random.default_rng(seed)
+    zgrid = np.linspace(0.0, 3.0, n_grid)
+    zmode = rng.uniform(0.1, 2.5, n_rows)
+    width = rng.uniform(0.02, 0.2, n_rows)
+    yvals = np.exp(-0.5 * ((zgrid - zmode[:, np.newaxis]) / width[:, np.newaxis]) ** 2)
+    ancil = dict(objectId=np.arange(n_rows, dtype=np.int64) + 10**15, zmode=zmode)
+    return qp.Ensemble(qp.interp, data=dict(xvals=zgrid, yvals=yvals), ancil=ancil)
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    """Build the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Write an ensemble with several HDF5 chunk sizes and compression filters, and "
+        "report the write throughput, file size and latency of random row reads.",
+    )
+    parser.add_argument("--input", default=None, help="Ensemble file to rewrite; default a synthetic one")
+    parser.add_argument("--rows", type=int, default=100000, help="Objects in the synthetic ensemble")
+    parser.add_argument("--grid", type=int, default=301, help="Grid points of the synthetic ensemble")
+    parser.add_argument(
+        "--chunk-rows",
+        type=lambda value: [int(val_) for val_ in value.split(",")],
+        default=[64, 256, 1024, 4096],
+        help="Chunk sizes to compare, e.g. 256,1024",
+    )
+    parser.add_argument(
+        "--compression",
+        type=_parse_list,
+        default=available_compressions(),
+        help="Compression filters to compare, e.g. none,lzf",
+    )
+    parser.add_argument("--reads", type=int, default=50, help="Number of timed random reads")
+    parser.add_argument("--read-rows", type=int, default=1, help="Rows in each random read")
+    parser.add_argument("--directory", default=None, help="Where to write the files; default a temporary one")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the benchmark and print the results"""
+    args = build_argparser().parse_args(argv)
+    ensemble = qp.read(args.input) if args.input else synthetic_ensemble(args.rows, args.grid)
+    layouts: list[Hdf5LayoutConfig | None] = [None]
+    for compression in args.compression:
+        for chunk_rows in args.chunk_rows:
+            layouts.append(Hdf5LayoutConfig(chunk_rows=chunk_rows, compression=compression))
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        path = os.path.join(directory, "pz_layout_benchmark.hdf5")
+        results = [
+            benchmark_layout(ensemble, path, layout_, n_reads=args.reads, rows_per_read=args.read_rows)
+            for layout_ in layouts
+        ]
+    format_layout_benchmark(results).pprint_all()
+    print(f"{ensemble.npdf} objects, {args.read_rows} rows per read; the first row is qp.Ensemble.write_to")
+    if args.json is not None:
+        with open(args.json, "w") as fout:
+            json.dump([asdict(result_) for result_ in results], fout, indent=2)
+    return 0
@@ -0,0 +1,81 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Command line interface of `lsst.meas.pz.extensions.pipeline_benchmark`"""
+
+__all__ = [
+    "build_argparser",
+    "main",
+]
+
+import argparse
+import json
+import os
+import tempfile
+from dataclasses import asdict
+
+from ..pipeline_benchmark import format_benchmark, make_synthetic_repo, run_pipeline_benchmark
+
+DEFAULT_MODEL_TEMPLATE = "${TESTDATA_RAIL_DIR}/models/dc2/model_inform_{algo}_wrap.pickle"
+ALGORITHMS = ["bpz", "cmnn", "dnf", "fzboost", "gpz", "lephare", "tpz"]
+
+
+def _parse_jobs(value: str) -> list[int]:
+    return [int(val_) for val_ in value.split(",")]
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    """Build the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Run a p(z) pipeline over synthetic patches in a local butler with several "
+        "numbers of processes, and report graph build time, per-task wall time and scaling.",
+    )
+    parser.add_argument("pipeline", help="Pipeline, with an optional #subset, e.g. pipeline.yaml#all_pz")
+    parser.add_argument(
+        "-b", "--repo", default=None, help="Directory of the synthetic repository; default a temporary one"
+    )
+    parser.add_argument("-j", "--jobs", type=_parse_jobs, default=[1, 2, 4], help="e.g. 1,2,4")
+    parser.add_argument("--patches", type=int, default=16, help="Number of synthetic patches")
+    parser.add_argument("--rows", type=int, default=10000, help="Objects per patch")
+    parser.add_argument(
+        "--model-template",
+        default=DEFAULT_MODEL_TEMPLATE,
+        help="Model file of each pzModel_{algo} input; environment variables are expanded",
+    )
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Make the repository, run the benchmark and print the results"""
+    args = build_argparser().parse_args(argv)
+    root = args.repo or tempfile.mkdtemp(prefix="pz_pipeline_benchmark_")
+    model_files = {
+        f"pzModel_{algo_}": os.path.expandvars(args.model_template.format(algo=algo_)) for algo_ in ALGORITHMS
+    }
+    make_synthetic_repo(root, args.pipeline, model_files, n_patches=args.patches, rows_per_patch=args.rows)
+    results = run_pipeline_benchmark(root, args.pipeline, jobs=args.jobs)
+    format_benchmark(results).pprint_all()
+    print(f"{args.patches} patches of {args.rows} objects, repository {root}")
+    if args.json is not None:
+        with open(args.json, "w") as fout:
+            json.dump([asdict(result_) for result_ in results], fout, indent=2)
+    return 0
@@ -0,0 +1,101 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Command line interface of `lsst.meas.pz.extensions.pz_service`"""
+
+__all__ = [
+    "build_argparser",
+    "main",
+]
+
+import argparse
+
+from ..presets import survey_presets
+from ..pz_service import PZService, PZServiceConfig, PZServiceHTTPServer
+
+
+def _parse_model(text: str) -> tuple[str, str]:
+    """Parse an ``algo=path`` model argument"""
+    algo_name, sep, model_path = text.partition("=")
+    if not sep or not algo_name or not model_path:
+        raise argparse.ArgumentTypeError(f"Expected algo=path, got {text}")
+    return algo_name, model_path
+
+
+def build_argparser() -> argparse.ArgumentParser:
+    """Build the parser for the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Serve p(z) estimates over HTTP from warm models of the wrapped algorithms.",
+    )
+    parser.add_argument("-C", "--config-file", default=None, help="PZServiceConfig override file")
+    parser.add_argument(
+        "-m",
+        "--model",
+        dest="models",
+        type=_parse_model,
+        action="append",
+        default=[],
+        metavar="ALGO=PATH",
+        help="Serve an algorithm with a pickled model; may be repeated",
+    )
+    parser.add_argument(
+        "-p", "--preset", choices=sorted(survey_presets), default=None, help="Survey column name preset"
+    )
+    parser.add_argument("--host", default=None, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=None, help="Port to listen on; 0 picks a free one")
+    parser.add_argument("--socket", default=None, help="Listen on this Unix socket instead")
+    parser.add_argument("--max-queue", type=int, default=None, help="Requests waiting per algorithm")
+    parser.add_argument("--max-batch-rows", type=int, default=None, help="Objects estimated at once")
+    parser.add_argument("--batch-wait-ms", type=float, default=None, help="Time to wait to batch requests")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Load the models and serve until interrupted"""
+    args = build_argparser().parse_args(argv)
+    config = PZServiceConfig()
+    if args.config_file is not None:
+        config.load(args.config_file)
+    config.models.update(dict(args.models))
+    for key, val in dict(
+        preset=args.preset,
+        host=args.host,
+        port=args.port,
+        socket_path=args.socket,
+        max_queue=args.max_queue,
+        max_batch_rows=args.max_batch_rows,
+        batch_wait_ms=args.batch_wait_ms,
+    ).items():
+        if val is not None:
+            setattr(config, key, val)
+    if not config.models:
+        print("No models to serve; use --model ALGO=PATH or a config file")
+        return 1
+
+    server = PZServiceHTTPServer(PZService.from_config(config), config)
+    print(f"Serving {', '.join(server.service.algorithms)} on {server.address}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
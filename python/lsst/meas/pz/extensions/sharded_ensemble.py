@@ -0,0 +1,447 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Row-range sharded storage for `qp.Ensemble` p(z) estimates.
+
+A sharded ensemble is a set of HDF5 files, each holding a contiguous
+range of rows, plus a small JSON manifest that records the row offsets,
+the object ID range and the PDF parameterization of every shard.
+
+Writers can produce shards independently (e.g. one per chunk worker);
+each shard is accompanied by a sidecar file describing it, and
+`finalize_manifest` merges the sidecars into the manifest without
+touching the PDF data.
+"""
+
+__all__ = [
+    "ShardInfo",
+    "ShardedEnsemble",
+    "finalize_manifest",
+    "manifest_path",
+    "shard_path",
+    "write_ensemble_shard",
+    "write_sharded_ensemble",
+]
+
+import copy
+import glob
+import json
+import os
+import re
+from collections.abc import Iterator
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import numpy as np
+import qp
+
+from .hdf5_layout import Hdf5LayoutConfig, read_ensemble_rows, write_ensemble_hdf5
+from .pdf_grid import resample_ensemble
+
+MANIFEST_VERSION = 1
+
+_SHARD_SUFFIX = ".hdf5"
+_SIDECAR_SUFFIX = ".shard.json"
+
+
+@dataclass
+class ShardInfo:
+    """Description of a single shard of a sharded ensemble"""
+
+    path: str
+    """Shard file name, relative to the manifest directory"""
+
+    start: int
+    """First row (inclusive) of the full ensemble held in this shard"""
+
+    stop: int
+    """Last row (exclusive) of the full ensemble held in this shard"""
+
+    min_id: int | None = None
+    """Smallest object ID in the shard, if IDs were provided"""
+
+    max_id: int | None = None
+    """Largest object ID in the shard, if IDs were provided"""
+
+    @property
+    def n_rows(self) -> int:
+        """Number of rows in the shard"""
+        return self.stop - self.start
+
+
+def shard_path(base_path: str, index: int) -> str:
+    """Return the path of shard ``index`` for a sharded ensemble
+
+    Parameters
+    ----------
+    base_path
+        Path prefix of the sharded ensemble, e.g. ``out/pz_estimate_dnf``
+
+    index
+        Shard index
+
+    Returns
+    -------
+    path
+        Path to the shard file
+    """
+    return f"{base_path}_{index:04d}{_SHARD_SUFFIX}"
+
+
+def manifest_path(base_path: str) -> str:
+    """Return the path of the manifest for a sharded ensemble"""
+    return f"{base_path}_manifest.json"
+
+
+def _to_jsonable(value: Any) -> Any:
+    """Convert ensemble metadata values to something json can write"""
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, list):
+        return [_to_jsonable(val_) for val_ in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _describe_pdf(ensemble: qp.Ensemble) -> dict[str, Any]:
+    """Build a json-able description of the ensemble parameterization"""
+    return {key: _to_jsonable(val) for key, val in ensemble.metadata.items()}
+
+
+def write_ensemble_shard(
+    ensemble: qp.Ensemble,
+    base_path: str,
+    index: int,
+    row_offset: int,
+    object_ids: np.ndarray | None = None,
+    id_column: str = "objectId",
+    layout: Hdf5LayoutConfig | None = None,
+) -> ShardInfo:
+    """Write one shard of a sharded ensemble, together with its sidecar
+
+    This only touches the files belonging to this shard, so it is
+    safe to call from independent workers.
+
+    Parameters
+    ----------
+    ensemble
+        The rows of the full ensemble that go in this shard
+
+    base_path
+        Path prefix of the sharded ensemble
+
+    index
+        Shard index
+
+    row_offset
+        Row of the full ensemble that corresponds to the first row
+        of ``ensemble``
+
+    object_ids
+        Object IDs for the rows in ``ensemble``.  These are stored in
+        the shard ancillary data.  If `None` they are taken from the
+        ensemble ancillary data, if present.
+
+    id_column
+        Name of the ancillary column holding the object IDs
+
+    layout
+        Chunking and compression of the shard file; `None` writes it
+        with `qp.Ensemble.write_to`
+
+    Returns
+    -------
+    shard_info
+        Description of the shard that was written
+    """
+    if object_ids is None and ensemble.ancil is not None and id_column in ensemble.ancil:
+        object_ids = np.asarray(ensemble.ancil[id_column])
+    elif object_ids is not None:
+        object_ids = np.asarray(object_ids)
+        if object_ids.size != ensemble.npdf:
+            raise ValueError(
+                f"Got {object_ids.size} object IDs for a shard with {ensemble.npdf} rows"
+            )
+        # Give the IDs to a shallow copy, so the caller's ensemble and
+        # ancillary data are left alone
+        ensemble = copy.copy(ensemble)
+        ensemble.set_ancil({**(ensemble.ancil or {}), id_column: object_ids})
+
+    path = shard_path(base_path, index)
+    if layout is None:
+        ensemble.write_to(path)
+    else:
+        write_ensemble_hdf5(ensemble, path, layout)
+
+    shard_info = ShardInfo(
+        path=os.path.basename(path),
+        start=int(row_offset),
+        stop=int(row_offset + ensemble.npdf),
+        min_id=None if object_ids is None or not object_ids.size else int(object_ids.min()),
+        max_id=None if object_ids is None or not object_ids.size else int(object_ids.max()),
+    )
+    sidecar = dict(shard=asdict(shard_info), pdf=_describe_pdf(ensemble), id_column=id_column)
+    with open(f"{path}{_SIDECAR_SUFFIX}", "w") as fout:
+        json.dump(sidecar, fout)
+    return shard_info
+
+
+def finalize_manifest(base_path: str, remove_sidecars: bool = True) -> str:
+    """Merge the shard sidecars of a sharded ensemble into its manifest
+
+    Parameters
+    ----------
+    base_path
+        Path prefix of the sharded ensemble
+
+    remove_sidecars
+        If True, remove the sidecar files once the manifest is written
+
+    Returns
+    -------
+    path
+        Path to the manifest
+
+    Raises
+    ------
+    ValueError
+        If there are no shards, the shards do not tile a contiguous
+        row range, or they do not share a PDF parameterization
+    """
+    # Only shard indices, so that the shards of e.g. "foo_bar" are not
+    # taken for those of "foo"
+    shard_name = re.compile(
+        rf"{re.escape(os.path.basename(base_path))}_\d+{re.escape(_SHARD_SUFFIX + _SIDECAR_SUFFIX)}"
+    )
+    sidecar_paths = sorted(
+        path_
+        for path_ in glob.glob(f"{glob.escape(base_path)}_*{_SHARD_SUFFIX}{_SIDECAR_SUFFIX}")
+        if shard_name.fullmatch(os.path.basename(path_))
+    )
+    if not sidecar_paths:
+        raise ValueError(f"No shards found for {base_path}")
+
+    sidecars = []
+    for sidecar_path in sidecar_paths:
+        with open(sidecar_path) as fin:
+            sidecars.append(json.load(fin))
+    sidecars.sort(key=lambda sidecar_: sidecar_["shard"]["start"])
+
+    pdf = sidecars[0]["pdf"]
+    id_column = sidecars[0]["id_column"]
+    expected_start = 0
+    for sidecar in sidecars:
+        if sidecar["pdf"] != pdf:
+            raise ValueError(f"Shard {sidecar['shard']['path']} has a different PDF parameterization")
+        if sidecar["shard"]["start"] != expected_start:
+            raise ValueError(
+                f"Shard {sidecar['shard']['path']} starts at row {sidecar['shard']['start']}, "
+                f"expected {expected_start}"
+            )
+        expected_start = sidecar["shard"]["stop"]
+
+    manifest = dict(
+        version=MANIFEST_VERSION,
+        n_rows=expected_start,
+        id_column=id_column,
+        pdf=pdf,
+        shards=[sidecar_["shard"] for sidecar_ in sidecars],
+    )
+    out_path = manifest_path(base_path)
+    with open(out_path, "w") as fout:
+        json.dump(manifest, fout, indent=1)
+
+    if remove_sidecars:
+        for sidecar_path in sidecar_paths:
+            os.unlink(sidecar_path)
+    return out_path
+
+
+def write_sharded_ensemble(
+    ensemble: qp.Ensemble,
+    base_path: str,
+    n_shards: int,
+    object_ids: np.ndarray | None = None,
+    id_column: str = "objectId",
+    layout: Hdf5LayoutConfig | None = None,
+) -> str:
+    """Split an ensemble into row-range shards and write them with a manifest
+
+    Parameters
+    ----------
+    ensemble
+        The full ensemble
+
+    base_path
+        Path prefix of the sharded ensemble
+
+    n_shards
+        Number of shards to write; the rows are split as evenly as possible
+
+    object_ids
+        Object IDs for the rows in ``ensemble``
+
+    id_column
+        Name of the ancillary column holding the object IDs
+
+    layout
+        Chunking and compression of the shard files; `None` writes them
+        with `qp.Ensemble.write_to`
+
+    Returns
+    -------
+    path
+        Path to the manifest
+    """
+    if n_shards < 1:
+        raise ValueError(f"n_shards must be positive, got {n_shards}")
+    bounds = np.linspace(0, ensemble.npdf, min(n_shards, max(ensemble.npdf, 1)) + 1).astype(int)
+    for index, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        write_ensemble_shard(
+            ensemble[start:stop],
+            base_path,
+            index,
+            row_offset=int(start),
+            object_ids=None if object_ids is None else object_ids[start:stop],
+            id_column=id_column,
+            layout=layout,
+        )
+    return finalize_manifest(base_path)
+
+
+class ShardedEnsemble:
+    """Lazy reader for a sharded ensemble
+
+    Opening a sharded ensemble only reads the manifest; shard files are
+    read on demand.
+
+    Parameters
+    ----------
+    path
+        Path to the manifest
+    """
+
+    def __init__(self, path: str):
+        with open(path) as fin:
+            manifest = json.load(fin)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported sharded ensemble manifest version {manifest.get('version')}")
+        self._directory = os.path.dirname(os.path.abspath(path))
+        self._manifest = manifest
+        self.shards = [ShardInfo(**shard_) for shard_ in manifest["shards"]]
+        self._starts = np.array([shard_.start for shard_ in self.shards])
+
+    @property
+    def npdf(self) -> int:
+        """Total number of rows over all the shards"""
+        return self._manifest["n_rows"]
+
+    @property
+    def n_shards(self) -> int:
+        """Number of shards"""
+        return len(self.shards)
+
+    @property
+    def id_column(self) -> str:
+        """Name of the ancillary column holding the object IDs"""
+        return self._manifest["id_column"]
+
+    @property
+    def pdf_metadata(self) -> dict[str, Any]:
+        """Description of the PDF parameterization shared by all shards"""
+        return self._manifest["pdf"]
+
+    def shard_for_row(self, row: int) -> int:
+        """Return the index of the shard that holds a given row"""
+        if row < 0 or row >= self.npdf:
+            raise IndexError(f"Row {row} out of range for sharded ensemble with {self.npdf} rows")
+        return int(np.searchsorted(self._starts, row, side="right") - 1)
+
+    def read_shard(self, index: int) -> qp.Ensemble:
+        """Read a single shard
+
+        Parameters
+        ----------
+        index
+            Shard index
+
+        Returns
+        -------
+        ensemble
+            The rows held in that shard
+        """
+        return qp.read(os.path.join(self._directory, self.shards[index].path))
+
+    def iter_shards(self) -> Iterator[tuple[ShardInfo, qp.Ensemble]]:
+        """Iterate over the shards, reading one at a time"""
+        for index, shard_info in enumerate(self.shards):
+            yield shard_info, self.read_shard(index)
+
+    def read_rows(self, start: int, stop: int, grid: np.ndarray | None = None) -> qp.Ensemble:
+        """Read a contiguous range of rows, opening only the needed shards
+
+        Shards written with a chunked layout are only decompressed around
+        the requested rows.
+
+        Parameters
+        ----------
+        start
+            First row (inclusive)
+
+        stop
+            Last row (exclusive)
+
+        grid
+            Optional redshift grid to resample the PDFs onto, e.g. the
+            standard grid for estimates stored on an adaptive grid
+
+        Returns
+        -------
+        ensemble
+            The requested rows
+        """
+        stop = min(stop, self.npdf)
+        if start < 0 or start >= stop:
+            raise IndexError(f"Bad row range [{start}, {stop}) for sharded ensemble with {self.npdf} rows")
+        pieces = []
+        for index in range(self.shard_for_row(start), self.shard_for_row(stop - 1) + 1):
+            shard_info = self.shards[index]
+            lo = max(start, shard_info.start) - shard_info.start
+            hi = min(stop, shard_info.stop) - shard_info.start
+            if lo == 0 and hi == shard_info.n_rows:
+                pieces.append(self.read_shard(index))
+            else:
+                pieces.append(read_ensemble_rows(os.path.join(self._directory, shard_info.path), lo, hi))
+        ensemble = pieces[0] if len(pieces) == 1 else qp.concatenate(pieces)
+        return ensemble if grid is None else resample_ensemble(ensemble, grid)
+
+    def shards_for_ids(self, object_ids: np.ndarray) -> list[int]:
+        """Return the indices of the shards whose ID range may hold the IDs"""
+        object_ids = np.asarray(object_ids)
+        return [
+            index
+            for index, shard_info in enumerate(self.shards)
+            if shard_info.min_id is None
+            or np.any((object_ids >= shard_info.min_id) & (object_ids <= shard_info.max_id))
+        ]
@@ -0,0 +1,314 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Splitting of the estimation of a patch into row-range sub-quanta.
+
+An estimator task with ``n_subquanta`` greater than one only estimates
+the rows ``subquantum_slice(n_rows, n_subquanta, subquantum_index)`` of
+its input catalog, and writes them as ``<pzEnsemble name>_part<index>``.
+A pipeline runs one estimator label per index, so a dense patch is
+spread over ``n_subquanta`` quanta, and `MergePZSubquantaTask` joins the
+parts back into the usual per-patch outputs.
+"""
+
+__all__ = [
+    "MergePZSubquantaConfig",
+    "MergePZSubquantaConnections",
+    "MergePZSubquantaTask",
+    "part_name",
+    "read_subquantum_rows",
+    "subquantum_slice",
+]
+
+import dataclasses
+
+import lsst.pex.config as pexConfig
+import numpy as np
+import pyarrow.parquet as pq
+import qp
+from astropy.table import Table, vstack
+from lsst.daf.butler import DeferredDatasetHandle
+from lsst.daf.butler.formatters.parquet import arrow_to_astropy
+from lsst.meas.pz.estimate_pz_task import EstimatePZTaskConnections
+from lsst.pipe.base import (
+    InputQuantizedConnection,
+    OutputQuantizedConnection,
+    PipelineTask,
+    PipelineTaskConfig,
+    PipelineTaskConnections,
+    QuantumContext,
+    Struct,
+)
+from lsst.pipe.base import connectionTypes as cT
+
+from .dataset_names import INDEX_PREFIX, NZ_PREFIX, derived_name
+from .nz_accumulator import NzAccumulator
+from .pz_index import PZIndex
+
+
+def subquantum_slice(n_rows: int, n_subquanta: int, index: int) -> slice:
+    """Return the rows of a catalog estimated by one sub-quantum
+
+    The rows are split in contiguous ranges whose sizes differ by at most
+    one, so concatenating the parts in index order restores the catalog
+    order.
+
+    Parameters
+    ----------
+    n_rows
+        Number of rows of the catalog
+
+    n_subquanta
+        Number of sub-quanta the catalog is split into
+
+    index
+        Index of the sub-quantum, from 0 to ``n_subquanta - 1``
+    """
+    if not 0 <= index < n_subquanta:
+        raise ValueError(f"Bad sub-quantum index {index} for {n_subquanta} sub-quanta")
+    bounds = np.linspace(0, n_rows, n_subquanta + 1).astype(int)
+    return slice(int(bounds[index]), int(bounds[index + 1]))
+
+
+def read_subquantum_rows(
+    catalog_handle: DeferredDatasetHandle,
+    n_subquanta: int,
+    index: int,
+    columns: list[str] | None = None,
+) -> tuple[Table, slice]:
+    """Read the rows of a parquet catalog estimated by one sub-quantum
+
+    The number of rows comes from the ``rowcount`` component, and only
+    the row groups holding the sub-quantum's rows are read, so the
+    sub-quanta of a patch do not each read the whole catalog.
+
+    Parameters
+    ----------
+    catalog_handle
+        Deferred handle to a catalog stored as parquet
+
+    n_subquanta
+        Number of sub-quanta the catalog is split into
+
+    index
+        Index of the sub-quantum, from 0 to ``n_subquanta - 1``
+
+    columns
+        Columns to read; all of them if `None`
+
+    Returns
+    -------
+    catalog
+        The rows of the sub-quantum
+
+    rows
+        Their range in the whole catalog
+    """
+    rows = subquantum_slice(catalog_handle.get(component="rowcount"), n_subquanta, index)
+    uri = catalog_handle.butler.getURI(catalog_handle.ref)
+    with uri.open("rb") as fin:
+        parquet_file = pq.ParquetFile(fin)
+        metadata = parquet_file.metadata
+        group_starts = np.cumsum(
+            [0] + [metadata.row_group(group).num_rows for group in range(metadata.num_row_groups)]
+        )
+        first = int(np.searchsorted(group_starts, rows.start, side="right")) - 1
+        stop = int(np.searchsorted(group_starts, rows.stop, side="left"))
+        arrow_table = parquet_file.read_row_groups(range(first, max(stop, first)), columns=columns)
+    arrow_table = arrow_table.slice(rows.start - int(group_starts[first]), rows.stop - rows.start)
+    return arrow_to_astropy(arrow_table), rows
+
+
+def part_name(dataset_type_name: str, index: int) -> str:
+    """Return the name of the dataset type of one sub-quantum's output"""
+    return f"{dataset_type_name}_part{index}"
+
+
+class MergePZSubquantaConnections(
+    PipelineTaskConnections,
+    dimensions=EstimatePZTaskConnections.dimensions,
+):
+    pzEnsemble = cT.Output(
+        doc="Per-object p(z) estimates of the whole patch; the parts are read from the "
+        "dataset types with the same name and a _part<index> suffix",
+        name="pz_estimate",
+        storageClass="QPEnsemble",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+    pzNz = cT.Output(
+        doc="Stacked p(z) of the whole patch, only written if do_merge_nz is set; named "
+        "after pzEnsemble as for the estimator tasks, unless set explicitly",
+        name=NZ_PREFIX,
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+    pzIndex = cT.Output(
+        doc="Object ID index of the whole patch, only written if do_merge_index is set; named "
+        "after pzEnsemble as for the estimator tasks, unless set explicitly",
+        name=INDEX_PREFIX,
+        storageClass="ArrowAstropy",
+        dimensions=EstimatePZTaskConnections.dimensions,
+    )
+
+    def __init__(self, *, config: "MergePZSubquantaConfig"):
+        super().__init__(config=config)
+        if config.connections.pzNz == NZ_PREFIX:
+            self.pzNz = dataclasses.replace(self.pzNz, name=derived_name(self.pzEnsemble.name, NZ_PREFIX))
+        if config.connections.pzIndex == INDEX_PREFIX:
+            self.pzIndex = dataclasses.replace(
+                self.pzIndex, name=derived_name(self.pzEnsemble.name, INDEX_PREFIX)
+            )
+        for index in range(config.n_subquanta):
+            setattr(
+                self,
+                f"pzEnsemble_part{index}",
+                cT.Input(
+                    doc=f"Per-object p(z) estimates of sub-quantum {index}",
+                    name=part_name(self.pzEnsemble.name, index),
+                    storageClass="QPEnsemble",
+                    dimensions=EstimatePZTaskConnections.dimensions,
+                ),
+            )
+            if config.do_merge_nz:
+                setattr(
+                    self,
+                    f"pzNz_part{index}",
+                    cT.Input(
+                        doc=f"Stacked p(z) of sub-quantum {index}",
+                        name=part_name(self.pzNz.name, index),
+                        storageClass="ArrowAstropy",
+                        dimensions=EstimatePZTaskConnections.dimensions,
+                    ),
+                )
+            if config.do_merge_index:
+                setattr(
+                    self,
+                    f"pzIndex_part{index}",
+                    cT.Input(
+                        doc=f"Object ID index of sub-quantum {index}",
+                        name=part_name(self.pzIndex.name, index),
+                        storageClass="ArrowAstropy",
+                        dimensions=EstimatePZTaskConnections.dimensions,
+                    ),
+                )
+        if not config.do_merge_nz:
+            del self.pzNz
+        if not config.do_merge_index:
+            del self.pzIndex
+
+
+class MergePZSubquantaConfig(PipelineTaskConfig, pipelineConnections=MergePZSubquantaConnections):
+    """Config for MergePZSubquantaTask
+
+    ``n_subquanta``, ``index_id_column`` and the ``pzEnsemble``, ``pzNz``
+    and ``pzIndex`` connection names must match those of the estimator
+    labels being merged.
+    """
+
+    n_subquanta = pexConfig.Field(
+        doc="Number of sub-quanta each patch was split into",
+        dtype=int,
+        default=2,
+    )
+    do_merge_nz = pexConfig.Field(
+        doc="Also sum the stacked p(z) of the sub-quanta, for estimators with do_accumulate_nz",
+        dtype=bool,
+        default=False,
+    )
+    do_merge_index = pexConfig.Field(
+        doc="Also merge the object ID indices of the sub-quanta, for estimators with do_write_index",
+        dtype=bool,
+        default=False,
+    )
+    index_id_column = pexConfig.Field(
+        doc="Object ID column of the indices, for do_merge_index",
+        dtype=str,
+        default="objectId",
+    )
+
+    def validate(self) -> None:
+        super().validate()
+        if self.n_subquanta < 1:
+            raise ValueError(f"n_subquanta must be at least 1, not {self.n_subquanta}")
+
+
+class MergePZSubquantaTask(PipelineTask):
+    """Join the outputs of the sub-quanta of each patch"""
+
+    ConfigClass = MergePZSubquantaConfig
+    _DefaultName = "mergePZSubquanta"
+
+    def runQuantum(
+        self,
+        butlerQC: QuantumContext,
+        inputRefs: InputQuantizedConnection,
+        outputRefs: OutputQuantizedConnection,
+    ) -> None:
+        inputs = butlerQC.get(inputRefs)
+        n_parts = self.config.n_subquanta
+        outputs = self.run(
+            [inputs[f"pzEnsemble_part{index}"] for index in range(n_parts)],
+            [inputs[f"pzNz_part{index}"] for index in range(n_parts)] if self.config.do_merge_nz else None,
+            (
+                [inputs[f"pzIndex_part{index}"] for index in range(n_parts)]
+                if self.config.do_merge_index
+                else None
+            ),
+        )
+        butlerQC.put(outputs, outputRefs)
+
+    def run(
+        self,
+        ensembles: list[qp.Ensemble],
+        nz_tables: list[Table] | None = None,
+        index_tables: list[Table] | None = None,
+    ) -> Struct:
+        """Join the sub-quanta outputs of one patch
+
+        Parameters
+        ----------
+        ensembles
+            p(z) estimates of each sub-quantum, in index order
+
+        nz_tables
+            Optional stacked p(z) of each sub-quantum
+
+        index_tables
+            Optional object ID index of each sub-quantum
+
+        Returns
+        -------
+        result
+            Struct with ``pzEnsemble``, ``pzNz`` if ``nz_tables`` is given
+            and ``pzIndex`` if ``index_tables`` is given
+        """
+        # Parts past the end of a small catalog are empty placeholders
+        ensembles = [ens_ for ens_ in ensembles if ens_.npdf > 0] or ensembles[:1]
+        ret_struct = Struct(pzEnsemble=ensembles[0] if len(ensembles) == 1 else qp.concatenate(ensembles))
+        if nz_tables is not None:
+            accumulator = NzAccumulator.from_table(nz_tables[0])
+            for table_ in nz_tables[1:]:
+                accumulator.merge(NzAccumulator.from_table(table_))
+            ret_struct.pzNz = accumulator.to_table()
+        if index_tables is not None:
+            # The rows of the parts are already those of the whole patch
+            ret_struct.pzIndex = PZIndex(vstack(index_tables), self.config.index_id_column).table
+        return ret_struct
@@ -0,0 +1,393 @@
+# This file is part of meas_pz_extensions.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Vectorized template fitting against a precomputed model magnitude grid.
+
+The grid holds the magnitude of every template at every redshift in every
+band.  It is stored as a ``.npy`` file, so that it can be memory-mapped
+and shared by every process on a node, plus a small json file with the
+redshifts and band names.  `build_lephare_grid` materializes it from the
+magnitude library of a prepared Lephare run.  The json file also holds a
+key of the Lephare configuration the grid was built from, see
+`library_key`, so that a grid is not reused with another library.
+
+For each object the template amplitude is fit analytically in flux space,
+so the chi-square of all the (template, redshift) pairs for a block of
+objects comes from two matrix products per block of templates.  Only one
+block of model fluxes is held at a time, in the floating point type of
+the fit, so a memory-mapped grid is never copied whole.
+"""
+
+__all__ = [
+    "TemplateGrid",
+    "build_lephare_grid",
+    "fit_block_bytes",
+    "fit_template_grid",
+    "library_key",
+    "template_grid_from_library",
+]
+
+import hashlib
+import json
+import os
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+
+try:
+    import lephare as lp
+except ImportError:
+    lp = None
+
+from .pdf_grid import interp_to_grid, normalize_pdfs
+
+# Magnitude zero point used to keep fluxes of order one, which matters
+# for float32 arithmetic
+_FLUX_ZERO_POINT = 25.0
+
+# Number of (template, redshift) rows of model fluxes fit at once
+_MODEL_BLOCK_ROWS = 4096
+
+# Number of (objects, model rows) arrays alive at once in _fit_block
+_FIT_BLOCK_TEMPORARIES = 6
+
+
+class TemplateGrid:
+    """Model magnitudes of a set of templates, on a redshift grid
+
+    Parameters
+    ----------
+    mags
+        Model magnitudes, shape ``(n_templates, n_z, n_bands)``
+
+    zgrid
+        Redshifts of the grid, shape ``(n_z,)``
+
+    bands
+        Names of the magnitude columns matching the last axis of ``mags``
+
+    key
+        Key of the library the grid was built from, see `library_key`, or
+        `None` if unknown
+    """
+
+    _cache: dict[str, "TemplateGrid"] = {}
+
+    def __init__(self, mags: np.ndarray, zgrid: np.ndarray, bands: list[str], key: str | None = None):
+        if mags.ndim != 3 or mags.shape[1] != len(zgrid) or mags.shape[2] != len(bands):
+            raise ValueError(
+                f"Template grid of shape {mags.shape} does not match {len(zgrid)} redshifts "
+                f"and {len(bands)} bands"
+            )
+        self.mags = mags
+        self.zgrid = np.asarray(zgrid, dtype=float)
+        self.bands = list(bands)
+        self.key = key
+
+    @property
+    def n_templates(self) -> int:
+        """Number of templates"""
+        return self.mags.shape[0]
+
+    def model_fluxes(self, start: int, stop: int, dtype: type[np.floating] = np.float64) -> np.ndarray:
+        """Return the model fluxes of some templates
+
+        Parameters
+        ----------
+        start, stop
+            Range of templates
+
+        dtype
+            Floating point type of the result
+
+        Returns
+        -------
+        fluxes
+            Model fluxes, shape ``((stop - start) * n_z, n_bands)``.  Each
+            row is scaled to a maximum of one; the fit amplitude absorbs
+            the scaling.  Non-finite model magnitudes give zero flux.
+        """
+        with np.errstate(over="ignore"):
+            fluxes = np.power(10.0, -0.4 * (np.asarray(self.mags[start:stop]) - _FLUX_ZERO_POINT))
+        fluxes = np.where(np.isfinite(fluxes), fluxes, 0.0).reshape(-1, len(self.bands))
+        max_flux = fluxes.max(axis=1, keepdims=True)
+        return (fluxes / np.where(max_flux > 0, max_flux, 1.0)).astype(dtype, copy=False)
+
+    def save(self, path: str) -> None:
+        """Write the grid as ``{path}.npy`` and ``{path}.json``
+
+        Each file is written under a temporary name and then moved in
+        place, the ``.npy`` file last, so a process that finds it can load
+        the grid even while another one is saving the same grid.
+        """
+        tmp_suffix = f".tmp{os.getpid()}"
+        with open(f"{path}.json{tmp_suffix}", "w") as fout:
+            json.dump(dict(zgrid=self.zgrid.tolist(), bands=self.bands, key=self.key), fout)
+        os.replace(f"{path}.json{tmp_suffix}", f"{path}.json")
+        with open(f"{path}.npy{tmp_suffix}", "wb") as fout:
+            np.save(fout, np.asarray(self.mags))
+        os.replace(f"{path}.npy{tmp_suffix}", f"{path}.npy")
+
+    @classmethod
+    def load(cls, path: str) -> "TemplateGrid":
+        """Memory-map a grid written by `save`
+
+        Grids are cached by path, so repeated calls in the same process
+        share the mapping.
+        """
+        path = os.path.abspath(path)
+        if path not in cls._cache:
+            with open(f"{path}.json") as fin:
+                grid_info = json.load(fin)
+            cls._cache[path] = cls(
+                np.load(f"{path}.npy", mmap_mode="r"),
+                np.array(grid_info["zgrid"]),
+                grid_info["bands"],
+                grid_info.get("key"),
+            )
+        return cls._cache[path]
+
+
+def library_key(lephare_config: dict[str, Any], bands: list[str]) -> str:
+    """Return a key identifying the grid of a Lephare library
+
+    Parameters
+    ----------
+    lephare_config
+        Lephare keywords of the run the library was prepared with
+
+    bands
+        Names of the magnitude columns matching the filters of the library
+
+    Returns
+    -------
+    key
+        Hex digest of the keywords and bands; grids with the same key
+        hold the same model magnitudes
+    """
+    payload = json.dumps(
+        dict(config={str(key_): str(val_) for key_, val_ in lephare_config.items()}, bands=list(bands)),
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def template_grid_from_library(
+    library: Iterable[Any], bands: list[str], key: str | None = None
+) -> TemplateGrid:
+    """Arrange the entries of a Lephare magnitude library in a grid
+
+    Parameters
+    ----------
+    library
+        Library entries, e.g. `lephare.GalSED`, with the ``nummod``,
+        ``extlawId``, ``ebv``, ``age``, ``red`` and ``mag`` of one
+        template at one redshift
+
+    bands
+        Names of the magnitude columns matching the filters of the library
+
+    key
+        Key of the library, see `library_key`
+
+    Returns
+    -------
+    grid
+        The grid, with one template per distinct model, extinction law,
+        E(B-V) and age; redshifts a template lacks have infinite
+        magnitudes, and so zero model flux
+    """
+    entries = [
+        ((sed_.nummod, sed_.extlawId, sed_.ebv, sed_.age), sed_.red, np.asarray(sed_.mag, dtype=float))
+        for sed_ in library
+    ]
+    if not entries:
+        raise ValueError("Empty template library")
+    keys = sorted({key_ for key_, _, _ in entries})
+    key_index = {key_: idx_ for idx_, key_ in enumerate(keys)}
+    zgrid = np.unique([red_ for _, red_, _ in entries])
+    mags = np.full((len(keys), zgrid.size, len(bands)), np.inf)
+    for entry_key, red, mag in entries:
+        if mag.size != len(bands):
+            raise ValueError(f"Library magnitudes in {mag.size} filters do not match {len(bands)} bands")
+        mags[key_index[entry_key], np.searchsorted(zgrid, red)] = mag
+    return TemplateGrid(mags, zgrid, bands, key)
+
+
+def build_lephare_grid(lephare_config: dict[str, Any], bands: list[str]) -> TemplateGrid:
+    """Read the galaxy magnitude library of a prepared Lephare run
+
+    Parameters
+    ----------
+    lephare_config
+        Lephare keywords of the run, e.g. those of a RAIL Lephare model;
+        the library is read from the Lephare work directory, which must
+        be the one the library was prepared in
+
+    bands
+        Names of the magnitude columns matching the filters of the library
+
+    Returns
+    -------
+    grid
+        The model magnitudes of the galaxy templates, see
+        `template_grid_from_library`
+    """
+    if lp is None:
+        raise ImportError("The lephare package is needed to read a Lephare library")
+    photz = lp.PhotoZ(lp.all_types_to_keymap(lephare_config))
+    return template_grid_from_library(
+        [sed_ for sed_ in photz.fullLib if sed_.is_gal()], bands, library_key(lephare_config, bands)
+    )
+
+
+def fit_block_bytes(block_size: int, n_z: int = 0, dtype: type[np.floating] = np.float64) -> int:
+    """Estimate the temporary memory of fitting one block of objects
+
+    Parameters
+    ----------
+    block_size
+        Number of objects fit together
+
+    n_z
+        Number of redshifts of the template grid, if known; only matters
+        when it exceeds the number of model rows fit at once
+
+    dtype
+        Floating point type of the fit
+
+    Returns
+    -------
+    n_bytes
+        Bytes of the ``(block_size, n_model_rows)`` arrays held at once by
+        one thread of `fit_template_grid`
+    """
+    n_model_rows = max(_MODEL_BLOCK_ROWS, n_z)
+    return _FIT_BLOCK_TEMPORARIES * block_size * n_model_rows * np.dtype(dtype).itemsize
+
+
+def _fit_block(
+    grid: TemplateGrid,
+    mags: np.ndarray,
+    mag_errs: np.ndarray,
+    nondetect_val: float,
+    dtype: type[np.floating],
+) -> np.ndarray:
+    """Return the template-marginalized likelihood on grid.zgrid"""
+    missing = ~np.isfinite(mags) | ~np.isfinite(mag_errs) | (mags >= nondetect_val) | (mag_errs <= 0)
+    mags = np.where(missing, _FLUX_ZERO_POINT, mags)
+    fluxes = np.power(10.0, -0.4 * (mags - _FLUX_ZERO_POINT)).astype(dtype)
+    flux_errs = (fluxes * (0.4 * np.log(10.0)) * np.where(missing, 1.0, mag_errs)).astype(dtype)
+    weights = np.where(missing, 0.0, 1.0 / flux_errs**2).astype(dtype)
+    weighted_fluxes = fluxes * weights
+    data_norm = np.sum(fluxes**2 * weights, axis=1, keepdims=True)
+
+    n_obj, n_z = mags.shape[0], grid.zgrid.size
+    likelihood = np.zeros((n_obj, n_z), dtype=dtype)
+    # Likelihoods are relative to the lowest chi-square seen so far, and
+    # rescaled when a later block of templates has a lower one
+    chi2_ref = np.full((n_obj, 1), np.inf, dtype=dtype)
+    templates_per_block = max(1, _MODEL_BLOCK_ROWS // n_z)
+    for start in range(0, grid.n_templates, templates_per_block):
+        stop = min(start + templates_per_block, grid.n_templates)
+        model = grid.model_fluxes(start, stop, dtype)
+        cross = weighted_fluxes @ model.T
+        model_norm = weights @ (model**2).T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chi2 = data_norm - cross**2 / model_norm
+        # Negative amplitudes, and models with no overlap with the data,
+        # are not allowed
+        chi2 = np.where((cross > 0) & (model_norm > 0), chi2, np.inf)
+
+        new_ref = np.minimum(chi2_ref, chi2.min(axis=1, keepdims=True))
+        with np.errstate(invalid="ignore"):
+            likelihood *= np.where(np.isfinite(chi2_ref), np.exp(-0.5 * (chi2_ref - new_ref)), 0.0)
+        block = np.exp(-0.5 * (chi2 - np.where(np.isfinite(new_ref), new_ref, 0.0)))
+        likelihood += block.reshape(n_obj, stop - start, n_z).sum(axis=1)
+        chi2_ref = new_ref
+    return likelihood
+
+
+def fit_template_grid(
+    grid: TemplateGrid,
+    mags: np.ndarray,
+    mag_errs: np.ndarray,
+    zgrid: np.ndarray,
+    nondetect_val: float = 99.0,
+    block_size: int = 10000,
+    n_workers: int = 1,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Compute p(z) for many objects by chi-square fitting a template grid
+
+    Parameters
+    ----------
+    grid
+        Model magnitude grid; its bands must match the columns of ``mags``
+
+    mags
+        Observed magnitudes, shape ``(n_obj, n_bands)``
+
+    mag_errs
+        Observed magnitude errors, shape ``(n_obj, n_bands)``
+
+    zgrid
+        Redshift grid of the output PDFs
+
+    nondetect_val
+        Magnitudes at or above this value are treated as missing
+
+    block_size
+        Number of objects fit together; sets the size of the temporaries,
+        see `fit_block_bytes`
+
+    n_workers
+        Number of threads fitting blocks in parallel; the heavy lifting
+        happens in numpy, which releases the GIL
+
+    out
+        Optional preallocated output, shape ``(n_obj, len(zgrid))``
+
+    Returns
+    -------
+    pdfs
+        Normalized PDFs on ``zgrid``
+    """
+    n_obj = mags.shape[0]
+    dtype = out.dtype if out is not None else np.float64
+    if out is None:
+        out = np.zeros((n_obj, zgrid.size), dtype=dtype)
+
+    def _do_block(start: int) -> None:
+        stop = min(start + block_size, n_obj)
+        likelihood = _fit_block(grid, mags[start:stop], mag_errs[start:stop], nondetect_val, dtype)
+        out[start:stop] = normalize_pdfs(interp_to_grid(grid.zgrid, likelihood, zgrid), zgrid)
+
+    starts = range(0, n_obj, block_size)
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            list(pool.map(_do_block, starts))
+    else:
+        for start in starts:
+            _do_block(start)
+    return out
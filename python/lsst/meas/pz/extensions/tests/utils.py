@@ -1,99 +1,31 @@
+import json
 import os
+import time
 from collections.abc import Callable
-from typing import Any
 
+import numpy as np
 import qp
 from astropy.table import Table
 from lsst.daf.butler import Butler
 from lsst.meas.pz.estimate_pz_task import EstimatePZTask, EstimatePZTaskConfig
+from lsst.meas.pz.extensions import presets
+from lsst.meas.pz.extensions.pdf_grid import compare_ensembles
 from rail.core.model import Model as PZModel
-from rail.utils.catalog_utils import (
-    ComCamCatalogConfig,
-    Dc2CatalogConfig,
-    HscCatalogConfig,
-)
-
-
-def _set_config(config: EstimatePZTaskConfig, config_dict: dict[str, Any]) -> None:
-    """Add key,value pairs from a dict to a PexConfig ojbect"""
-
-    for key, val in config_dict.items():
-        try:
-            setattr(config, key, val)
-        except AttributeError:
-            pass
 
 
 def hsc_config_callback(config: EstimatePZTaskConfig) -> None:
     """Set up config for HSC column names"""
-    _set_config(config.pz_algo, HscCatalogConfig.build_base_dict())
-    config.pz_algo.bands_to_convert = ["g", "r", "i", "z", "y"]
-    # We should be using these for constencty
-    # but there are some infinites, so for now we use gaap1p0
-    # config.pz_algo.flux_column_template = "{band}_cModelFlux"
-    # config.pz_algo.flux_err_column_template = "{band}_cModelFluxErr"
-    config.pz_algo.flux_column_template = "{band}_gaap1p0Flux"
-    config.pz_algo.flux_err_column_template = "{band}_gaap1p0FluxErr"
-    config.pz_algo.mag_template = "HSC{band}_cmodel_dered"
-    config.pz_algo.mag_err_template = "{band}_cmodel_magerr"
-    config.pz_algo.deredden = False
-    _set_config(
-        config.pz_algo,
-        dict(
-            ref_band="HSCi_cmodel_dered",
-            bands=config.pz_algo.get_mag_name_list(),
-            err_bands=config.pz_algo.get_mag_err_name_list(),
-            mag_limits=config.pz_algo.get_mag_lim_dict(),
-            band_a_env=config.pz_algo.get_band_a_env_dict(),
-            filter_list=[
-                "DC2LSST_g",
-                "DC2LSST_r",
-                "DC2LSST_i",
-                "DC2LSST_z",
-                "DC2LSST_y",
-            ],
-        )
-    )
+    presets.hsc_preset(config.pz_algo)
 
 
 def dc2_config_callback(config: EstimatePZTaskConfig) -> None:
     """Set up config for DC2 column names"""
-    _set_config(config.pz_algo, Dc2CatalogConfig.build_base_dict())
-    config.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-    config.pz_algo.flux_column_template = "{band}_cModelFlux"
-    config.pz_algo.flux_err_column_template = "{band}_cModelFluxErr"
-    config.pz_algo.mag_template = "mag_{band}_cModel_obj_dered"
-    config.pz_algo.mag_err_template = "magerr_{band}_cModel_obj"
-    _set_config(
-        config.pz_algo,
-        dict(
-            ref_band="mag_i_cModel_obj_dered",
-            bands=config.pz_algo.get_mag_name_list(),
-            err_bands=config.pz_algo.get_mag_err_name_list(),
-            mag_limits=config.pz_algo.get_mag_lim_dict(),
-            band_a_env=config.pz_algo.get_band_a_env_dict(),
-        )
-    )
+    presets.dc2_preset(config.pz_algo)
 
 
 def com_cam_config_callback(config: EstimatePZTaskConfig) -> None:
     """Set up config for com cam column names"""
-    _set_config(config.pz_algo, ComCamCatalogConfig.build_base_dict())
-    config.pz_algo.bands_to_convert = ["u", "g", "r", "i", "z", "y"]
-    config.pz_algo.flux_column_template = "{band}_cModelFlux"
-    config.pz_algo.flux_err_column_template = "{band}_cModelFluxErr"
-    config.pz_algo.mag_template = "{band}_cModelMag"
-    config.pz_algo.mag_err_template = "{band}_cModelMagErr"
-    _set_config(
-        config.pz_algo,
-        dict(
-            ref_band="i_cModelMag",
-            bands=config.pz_algo.get_mag_name_list(),
-            err_bands=config.pz_algo.get_mag_err_name_list(),
-            mag_limits=config.pz_algo.get_mag_lim_dict(),
-            band_a_env=config.pz_algo.get_band_a_env_dict(),
-        )
-    )
+    presets.com_cam_preset(config.pz_algo)
 
 
 def hsc_check_callback(output: qp.Ensemble) -> None:
@@ -181,3 +113,86 @@ def run_pz_task_s3df(
     dc2_butler_check_callback(test_out)
     for fdel_ in to_delete:
         os.unlink(fdel_)
+
+
+def compare_precision(
+    model_file: str,
+    data: Table,
+    estimator_class: type[EstimatePZTask],
+    config_callback: Callable | None = None,
+) -> dict[str, float]:
+    """Run an estimator task in float64 and float32 and compare the outputs
+
+    Returns a dict with the scatter of the float32 modes with respect to the
+    float64 ones, in units of 1+z, the L1 distance between the PDFs, and the
+    time spent in each run.
+    """
+    modelpath = os.path.abspath(
+        os.path.expandvars(
+            os.path.join("${TESTDATA_RAIL_DIR}", model_file),
+        )
+    )
+    pz_model = PZModel.read(modelpath)
+    outputs = {}
+    timings = {}
+    for precision in ["float64", "float32"]:
+        task_config = estimator_class.ConfigClass()
+        if config_callback:
+            config_callback(task_config)
+        task_config.pz_algo.precision = precision
+        task = estimator_class(True, config=task_config)
+        start = time.perf_counter()
+        outputs[precision] = task.run(pz_model, data).pzEnsemble
+        timings[precision] = time.perf_counter() - start
+
+    metrics = compare_ensembles(outputs["float64"], outputs["float32"], np.linspace(0.0, 3.0, 301))
+    metrics.update(time_float64=timings["float64"], time_float32=timings["float32"])
+    return metrics
+
+
+def compare_neighbor_search(
+    model_file: str,
+    data: Table,
+    estimator_class: type[EstimatePZTask],
+    config_callback: Callable | None = None,
+    n_probe_values: tuple[int, ...] = (1, 4, 16),
+    report_path: str | None = None,
+) -> dict[str, dict[str, float]]:
+    """Run a kNN estimator task with exact and approximate neighbour search
+
+    Returns, for each number of probed index cells, the same metrics as
+    `compare_precision` with respect to the exact search, and the speed-up.
+    The report is also written as json to ``report_path``, if given.
+    """
+    modelpath = os.path.abspath(
+        os.path.expandvars(
+            os.path.join("${TESTDATA_RAIL_DIR}", model_file),
+        )
+    )
+    pz_model = PZModel.read(modelpath)
+
+    def _run(n_probe: int | None) -> tuple[qp.Ensemble, float]:
+        task_config = estimator_class.ConfigClass()
+        if config_callback:
+            config_callback(task_config)
+        if n_probe is not None:
+            task_config.pz_algo.approx_neighbors.enabled = True
+            task_config.pz_algo.approx_neighbors.n_probe = n_probe
+        task = estimator_class(True, config=task_config)
+        # Build the estimator stage, and the index, outside of the timed run
+        task.pz_algo.get_stage(pz_model)
+        start = time.perf_counter()
+        pz_ensemble = task.run(pz_model, data).pzEnsemble
+        return pz_ensemble, time.perf_counter() - start
+
+    exact, exact_time = _run(None)
+    report = {}
+    for n_probe in n_probe_values:
+        approx, approx_time = _run(n_probe)
+        metrics = compare_ensembles(exact, approx, np.linspace(0.0, 3.0, 301))
+        metrics.update(time_exact=exact_time, time_approx=approx_time, speedup=exact_time / approx_time)
+        report[f"n_probe={n_probe}"] = {key_: float(val_) for key_, val_ in metrics.items()}
+    if report_path is not None:
+        with open(report_path, "w") as fout:
+            json.dump(report, fout, indent=2)
+    return report
@@ -0,0 +1,122 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Unit tests for the adaptive redshift grid"""
+
+import os
+
+import numpy as np
+import pytest
+
+from lsst.meas.pz.extensions import hdf5_layout, pdf_grid
+from lsst.meas.pz.extensions.scripts import pz_adaptive_grid
+
+
+def _training_redshifts(n_obj: int = 20000) -> np.ndarray:
+    rng = np.random.default_rng(7)
+    return np.concatenate([rng.normal(0.6, 0.25, n_obj), rng.normal(1.4, 0.2, n_obj // 4)])
+
+
+def _gaussian_pdfs(locs: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    width = 0.03 * (1.0 + locs[:, np.newaxis])
+    return pdf_grid.normalize_pdfs(np.exp(-0.5 * ((grid - locs[:, np.newaxis]) / width) ** 2), grid)
+
+
+def test_adaptive_zgrid() -> None:
+    redshifts = _training_redshifts()
+    zgrid = pdf_grid.adaptive_zgrid(redshifts, 0.0, 3.0, 101, uniform_fraction=0.25)
+    assert zgrid.size == 101
+    assert zgrid[0] == 0.0 and zgrid[-1] == 3.0
+    spacing = np.diff(zgrid)
+    assert np.all(spacing > 0.0)
+    assert spacing.max() <= 3.0 / (0.25 * 100) * (1.0 + 1e-6)
+    # Denser where the training set has support than in the tails
+    assert np.interp(0.6, zgrid[1:], spacing) < 0.5 * np.interp(2.8, zgrid[1:], spacing)
+
+    uniform = pdf_grid.adaptive_zgrid(redshifts, 0.0, 3.0, 31, uniform_fraction=1.0)
+    assert np.allclose(uniform, np.linspace(0.0, 3.0, 31))
+    with pytest.raises(ValueError):
+        pdf_grid.adaptive_zgrid(redshifts, 0.0, 3.0, 101, uniform_fraction=0.0)
+
+
+def test_adaptive_zgrid_accuracy() -> None:
+    """With a third of the standard points, the adaptive grid stores
+    training-like p(z) more accurately than a uniform grid of that size
+    """
+    redshifts = _training_redshifts()
+    standard = np.linspace(0.0, 3.0, 301)
+    locs = np.random.default_rng(3).choice(redshifts[(redshifts > 0.0) & (redshifts < 3.0)], 500)
+    reference = pdf_grid.grid_ensemble(standard, _gaussian_pdfs(locs, standard))
+
+    errors = {}
+    for name, zgrid in [
+        ("adaptive", pdf_grid.adaptive_zgrid(redshifts, 0.0, 3.0, 101)),
+        ("uniform", np.linspace(0.0, 3.0, 101)),
+    ]:
+        stored = pdf_grid.grid_ensemble(zgrid, _gaussian_pdfs(locs, zgrid))
+        resampled = pdf_grid.resample_ensemble(stored, standard)
+        assert np.allclose(resampled.metadata["xvals"], standard)
+        errors[name] = pdf_grid.compare_ensembles(reference, resampled, standard)
+    assert errors["adaptive"]["mean_l1"] < 0.75 * errors["uniform"]["mean_l1"]
+    assert errors["adaptive"]["mean_l1"] < 0.02
+    assert errors["adaptive"]["median_delta_z"] < 0.005
+
+
+def test_resample_ensemble() -> None:
+    zgrid = pdf_grid.adaptive_zgrid(_training_redshifts(), 0.0, 3.0, 51)
+    ensemble = pdf_grid.grid_ensemble(zgrid, _gaussian_pdfs(np.array([0.5, 1.0]), zgrid))
+    ensemble.set_ancil(dict(objectId=np.array([3, 4])))
+    assert pdf_grid.resample_ensemble(ensemble, zgrid) is ensemble
+
+    standard = np.linspace(0.0, 3.0, 301)
+    resampled = pdf_grid.resample_ensemble(ensemble, standard)
+    assert resampled.objdata["yvals"].shape == (2, 301)
+    assert np.all(resampled.ancil["objectId"] == [3, 4])
+    yvals = resampled.objdata["yvals"]
+    assert np.allclose(0.5 * (yvals[:, 1:] + yvals[:, :-1]) @ np.diff(standard), 1.0)
+
+
+def test_read_on_standard_grid(tmp_path: str) -> None:
+    zgrid = pdf_grid.adaptive_zgrid(_training_redshifts(), 0.0, 3.0, 51)
+    locs = np.linspace(0.2, 2.0, 40)
+    ensemble = pdf_grid.grid_ensemble(zgrid, _gaussian_pdfs(locs, zgrid))
+    path = os.path.join(tmp_path, "pz_adaptive.hdf5")
+    hdf5_layout.write_ensemble_hdf5(ensemble, path, hdf5_layout.Hdf5LayoutConfig(chunk_rows=16))
+
+    standard = np.linspace(0.0, 3.0, 301)
+    rows = hdf5_layout.read_ensemble_rows(path, 5, 15, grid=standard)
+    assert rows.objdata["yvals"].shape == (10, 301)
+    selection = hdf5_layout.read_ensemble_selection(path, np.array([12, 7]), grid=standard)
+    assert np.allclose(selection.objdata["yvals"], rows.objdata["yvals"][[7, 2]])
+
+
+def test_adaptive_grid_script(tmp_path: str) -> None:
+    training = os.path.join(tmp_path, "training.npy")
+    np.save(training, _training_redshifts())
+    output = os.path.join(tmp_path, "zgrid.npy")
+    assert pz_adaptive_grid.main([training, output, "--n-grid", "61", "--test-rows", "200"]) == 0
+    zgrid = pdf_grid.read_zgrid(output)
+    assert zgrid.size == 61
+
+    np.save(output, zgrid[::-1])
+    with pytest.raises(ValueError):
+        pdf_grid.read_zgrid(output)
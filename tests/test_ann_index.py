@@ -0,0 +1,107 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the approximate nearest neighbour index"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from lsst.meas.pz.extensions.ann_index import IVFIndex
+from lsst.meas.pz.extensions.cmnn_approx import cmnn_estimate
+
+
+def _make_points(n_points: int, n_dim: int = 5) -> np.ndarray:
+    rng = np.random.default_rng(42)
+    centers = rng.uniform(-2.0, 2.0, size=(20, n_dim))
+    return centers[rng.integers(0, 20, n_points)] + rng.normal(scale=0.3, size=(n_points, n_dim))
+
+
+def _exact_neighbors(points: np.ndarray, queries: np.ndarray, n_neighbors: int) -> np.ndarray:
+    dist = np.sum((queries[:, np.newaxis, :] - points[np.newaxis, :, :]) ** 2, axis=2)
+    return np.argsort(dist, axis=1)[:, :n_neighbors]
+
+
+def test_ivf_index_recall() -> None:
+    points = _make_points(5000)
+    queries = _make_points(200) + 0.05
+    index = IVFIndex(points, n_cells=50)
+    exact = _exact_neighbors(points, queries, 10)
+
+    recalls = []
+    for n_probe in [1, 4, 50]:
+        dist, idx = index.kneighbors(queries, n_neighbors=10, n_probe=n_probe)
+        assert np.all(np.diff(dist, axis=1) >= 0)
+        recalls.append(np.mean([np.isin(exact[i_], idx[i_]).mean() for i_ in range(len(queries))]))
+    assert recalls[0] <= recalls[1] <= recalls[2]
+    assert recalls[1] > 0.8
+    # Probing every cell is an exact search
+    assert recalls[2] == 1.0
+
+
+def test_ivf_index_too_few_candidates() -> None:
+    points = _make_points(500)
+    index = IVFIndex(points, n_cells=50, n_probe=1)
+    idx = index.kneighbors(points[:20], n_neighbors=100, return_distance=False)
+    assert np.all(np.sort(idx, axis=1) == np.sort(_exact_neighbors(points, points[:20], 100), axis=1))
+
+
+def test_ivf_index_nan() -> None:
+    points = _make_points(500)
+    points[::7, 2] = np.nan
+    index = IVFIndex(points, n_cells=20)
+    # The points are not copied, and NaN coordinates count as the mean
+    assert index.points is points
+    filled = np.where(np.isnan(points), np.nanmean(points, axis=0), points)
+    idx = index.kneighbors(filled[:20], n_neighbors=5, return_distance=False, n_probe=20)
+    assert np.all(np.sort(idx, axis=1) == np.sort(_exact_neighbors(filled, filled[:20], 5), axis=1))
+
+    queries = points[:10].copy()
+    queries[3, 0] = np.nan
+    with pytest.raises(ValueError, match="NaN"):
+        index.kneighbors(queries)
+
+
+def test_cmnn_estimate() -> None:
+    train_color = _make_points(3000)
+    truez = np.linspace(0.0, 3.0, 3000)
+    test_color = train_color[:50] + 0.01
+    test_err = np.full_like(test_color, 0.05)
+    config = SimpleNamespace(
+        bands=[f"mag_{band}" for band in "ugrizy"],
+        ppf_value=0.68,
+        selection_mode=1,
+        min_n=25,
+        min_thresh=0.0001,
+        min_dist=0.0001,
+        bad_redshift_val=99.0,
+        bad_redshift_err=10.0,
+    )
+    index = IVFIndex(train_color, n_cells=30)
+    estimates = cmnn_estimate(index, truez, True, test_color, test_err, config, seed=66)
+    full = cmnn_estimate(IVFIndex(train_color, n_cells=1), truez, True, test_color, test_err, config, seed=66)
+
+    # With a single cell the search is exact, and the nearest match is the
+    # training galaxy the test colors were made from
+    assert np.allclose(full["zmode"], truez[:50])
+    assert np.mean(estimates["zmode"] == full["zmode"]) > 0.9
+    assert np.all(estimates["ncolors"] == 5)
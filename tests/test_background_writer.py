@@ -0,0 +1,81 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the background writer"""
+
+import threading
+import time
+
+import pytest
+
+from lsst.meas.pz.extensions.background_writer import BackgroundWriter
+
+
+@pytest.mark.parametrize("max_pending", [0, 1, 3])
+def test_writes_in_order(max_pending: int) -> None:
+    written = []
+    with BackgroundWriter(max_pending) as writer:
+        for idx in range(10):
+            writer.submit(written.append, idx)
+    assert written == list(range(10))
+    assert writer.write_seconds >= 0.0
+
+
+def test_overlap() -> None:
+    release = threading.Event()
+    written = []
+
+    def slow_write(idx: int) -> None:
+        release.wait(5.0)
+        written.append(idx)
+
+    writer = BackgroundWriter(2)
+    # Both calls are queued while the first is still running
+    writer.submit(slow_write, 0)
+    writer.submit(slow_write, 1)
+    assert written == []
+    release.set()
+    writer.close()
+    assert written == [0, 1]
+
+
+def test_error() -> None:
+    written = []
+
+    def failing_write(idx: int) -> None:
+        if idx == 1:
+            raise OSError("disk full")
+        written.append(idx)
+
+    writer = BackgroundWriter(1)
+    with pytest.raises(OSError, match="disk full"):
+        for idx in range(5):
+            writer.submit(failing_write, idx)
+            time.sleep(0.01)
+        writer.close()
+    # Calls after the failing one are dropped
+    assert written == [0]
+
+    # An error in the estimation is not hidden by one from the writer
+    with pytest.raises(KeyError):
+        with BackgroundWriter(1) as writer:
+            writer.submit(failing_write, 1)
+            raise KeyError("estimate")
@@ -0,0 +1,142 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the batch estimation command line tool"""
+
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import qp
+from lsst.meas.pz.extensions import batch_estimate
+from lsst.meas.pz.extensions.algo_registry import pz_algo_registry
+from lsst.meas.pz.extensions.scripts.estimate_pz_batch import _parse_override, main
+from lsst.meas.pz.extensions.sharded_ensemble import ShardedEnsemble, manifest_path
+
+
+def test_parse_override() -> None:
+    assert _parse_override("nzbins=101") == ("nzbins", 101)
+    assert _parse_override("precision=float32") == ("precision", "float32")
+    assert _parse_override("bands=['a', 'b']") == ("bands", ["a", "b"])
+
+
+def test_point_estimates(tmp_path: str) -> None:
+    input_path = os.path.join(tmp_path, "objectTable.parq")
+    pq.write_table(pa.table(dict(objectId=np.arange(3, dtype=np.int64), flux=np.ones(3))), input_path)
+    with pq.ParquetFile(input_path) as parquet_file:
+        schema = batch_estimate._point_schema(parquet_file, "objectId")
+    assert schema.names == ["objectId", "zmode"]
+
+    zgrid = np.linspace(0.0, 3.0, 301)
+    ens = qp.Ensemble(qp.stats.norm, data=dict(loc=np.array([[0.5], [1.0]]), scale=np.full((2, 1), 0.1)))
+    # Every chunk gets the same schema, whatever its ancillary data
+    points = batch_estimate._point_estimates(ens, np.array([7, 8]), schema, zgrid)
+    assert points.schema == schema
+    assert np.allclose(points["zmode"].to_numpy(), [0.5, 1.0])
+    ens.set_ancil(dict(zmode=np.array([0.4, 0.9], dtype=np.float32), zmean=np.array([0.5, 1.0])))
+    points = batch_estimate._point_estimates(ens, np.array([7, 8]), schema, zgrid)
+    assert points.schema == schema
+    assert points["objectId"].to_pylist() == [7, 8]
+
+
+def test_duplicate_names(tmp_path: str) -> None:
+    input_paths = [os.path.join(tmp_path, dir_, "objectTable.parq") for dir_ in ("a", "b")]
+    with pytest.raises(ValueError, match="same name"):
+        batch_estimate.run_batch(input_paths, "tpz", "model.pickle", os.path.join(tmp_path, "outputs"))
+    assert not os.path.exists(os.path.join(tmp_path, "outputs"))
+
+
+@pytest.mark.parametrize("executor, n_workers", [("files", 1), ("files", 2), ("chunks", 2)])
+def test_batch_estimate_hsc(tmp_path: str, executor: str, n_workers: int) -> None:
+    if "tpz" not in pz_algo_registry:
+        pytest.skip("Missing tpz in env")
+    input_dir = os.path.join(tmp_path, "inputs")
+    output_dir = os.path.join(tmp_path, "outputs")
+    os.makedirs(input_dir)
+    datapath = os.path.expandvars("${TESTDATA_RAIL_DIR}/data/objectTable_hsc_9813_40_reduced.parq")
+    for idx in range(2):
+        shutil.copy(datapath, os.path.join(input_dir, f"objectTable_{idx}.parq"))
+    model_path = os.path.expandvars("${TESTDATA_RAIL_DIR}/models/hsc/model_inform_tpz_wrap.pickle")
+    argv = [
+        "tpz",
+        model_path,
+        os.path.join(input_dir, "*.parq"),
+        "-o",
+        output_dir,
+        "-p",
+        "hsc",
+        "-j",
+        str(n_workers),
+        "--executor",
+        executor,
+        "--chunk-size",
+        "300",
+        "--id-column",
+        "",
+    ]
+    assert main(argv) == 0
+
+    for idx in range(2):
+        base_path, point_path = batch_estimate.output_paths(
+            os.path.join(input_dir, f"objectTable_{idx}.parq"), output_dir
+        )
+        reader = ShardedEnsemble(manifest_path(base_path))
+        assert reader.npdf == 1000
+        assert reader.n_shards == 4
+        assert pq.read_table(point_path).num_rows == 1000
+
+    # Finished files are skipped on a second run
+    results = batch_estimate.run_batch(
+        batch_estimate.find_input_files([os.path.join(input_dir, "*.parq")]),
+        "tpz",
+        model_path,
+        output_dir,
+        preset="hsc",
+    )
+    assert all(result_.skipped for result_ in results)
+
+
+def test_batch_estimate_empty_file(tmp_path: str) -> None:
+    if "tpz" not in pz_algo_registry:
+        pytest.skip("Missing tpz in env")
+    datapath = os.path.expandvars("${TESTDATA_RAIL_DIR}/data/objectTable_hsc_9813_40_reduced.parq")
+    input_path = os.path.join(tmp_path, "empty.parq")
+    pq.write_table(pq.read_table(datapath).slice(0, 0), input_path)
+    model_path = os.path.expandvars("${TESTDATA_RAIL_DIR}/models/hsc/model_inform_tpz_wrap.pickle")
+    output_dir = os.path.join(tmp_path, "outputs")
+
+    results = batch_estimate.run_batch(
+        [input_path], "tpz", model_path, output_dir, preset="hsc", id_column=None
+    )
+    assert results[0].error is None and results[0].n_rows == 0
+    base_path, point_path = batch_estimate.output_paths(input_path, output_dir)
+    points = pq.read_table(point_path)
+    assert points.num_rows == 0
+    assert points.column_names == ["zmode"]
+    assert not os.path.exists(manifest_path(base_path))
+
+    results = batch_estimate.run_batch(
+        [input_path], "tpz", model_path, output_dir, preset="hsc", id_column=None
+    )
+    assert results[0].skipped
@@ -0,0 +1,64 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the multi-algorithm consensus p(z)"""
+
+import numpy as np
+import qp
+
+from lsst.meas.pz.extensions.consensus import combine_pdfs
+from lsst.meas.pz.extensions.pdf_grid import interp_to_grid, pdfs_on_grid
+
+
+def test_interp_to_grid() -> None:
+    rng = np.random.default_rng(1234)
+    xvals = np.linspace(0.0, 3.0, 31)
+    yvals = rng.uniform(size=(10, xvals.size))
+    grid = np.linspace(-0.5, 3.5, 97)
+    values = interp_to_grid(xvals, yvals, grid)
+    expected = np.array([np.interp(grid, xvals, row_, left=0.0, right=0.0) for row_ in yvals])
+    assert np.allclose(values, expected)
+
+
+def test_combine_pdfs() -> None:
+    zgrid = np.linspace(0.0, 3.0, 301)
+    locs = np.array([0.5, 1.0, 2.0])
+    gauss = qp.Ensemble(qp.stats.norm, data=dict(loc=locs[:, np.newaxis], scale=np.full((3, 1), 0.05)))
+    xvals = np.linspace(0.0, 3.0, 151)
+    gridded = qp.Ensemble(qp.interp, data=dict(xvals=xvals, yvals=gauss.pdf(xvals)))
+
+    pdfs = dict(a=pdfs_on_grid(gauss, zgrid), b=pdfs_on_grid(gridded, zgrid))
+    # Make algorithm "b" disagree on the last object, and fail on the first
+    pdfs["b"][2] = np.roll(pdfs["b"][2], -50)
+    pdfs["b"][0] = 0.0
+
+    consensus, metrics = combine_pdfs(pdfs, zgrid, dict(a=1.0, b=3.0))
+    assert consensus.shape == (3, zgrid.size)
+    norms = consensus.sum(axis=1) * (zgrid[1] - zgrid[0])
+    assert np.allclose(norms, 1.0, atol=1e-2)
+
+    assert np.allclose(metrics["z_consensus_mode"][:2], locs[:2], atol=0.02)
+    assert np.isnan(metrics["z_mode_b"][0])
+    assert metrics["z_mode_max_sep"][1] < 0.02
+    assert np.isclose(metrics["z_mode_max_sep"][2], 0.5 / (1.0 + metrics["z_consensus_mode"][2]), atol=0.02)
+    assert np.isclose(metrics["z_mode_std"][2], 0.25 / 2.75, atol=0.01)
+    assert metrics["z_mode_std"][0] == 0.0
+    assert metrics["hellinger_max"][2] > metrics["hellinger_max"][1]
@@ -0,0 +1,192 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Unit tests for the ordering and re-queuing of distributed chunks"""
+
+import os
+from collections import deque
+from typing import Any
+
+import numpy as np
+import pytest
+import qp
+
+from lsst.meas.pz.extensions.distributed import DistributedEstimator, QueueBackend
+
+
+def _tables(mags: dict[str, np.ndarray]) -> dict[str, Any]:
+    return qp.Ensemble(qp.stats.norm, data=dict(loc=mags["mag_r"][:, np.newaxis], scale=0.1)).build_tables()
+
+
+class FakeBackend(QueueBackend):
+    """Two in-process workers; the first chunk taken by ``w0`` kills it"""
+
+    heartbeat_timeout = 60.0
+
+    def __init__(self) -> None:
+        self.tasks: deque = deque()
+        self.events: deque = deque()
+        self.lost: set[str] = set()
+        self.setup: dict[str, Any] = {}
+        self.job_ids: list[str] = []
+        self.n_taken = 0
+
+    def start(self, setup: dict[str, Any]) -> None:
+        self.setup = setup
+
+    def put_task(self, item: Any) -> None:
+        if item[0] not in self.job_ids:
+            self.job_ids.append(item[0])
+        self.tasks.append(item)
+
+    def drain_tasks(self) -> int:
+        n_tasks = len(self.tasks)
+        self.tasks.clear()
+        return n_tasks
+
+    def get_event(self, timeout: float) -> tuple | None:
+        if self.events:
+            return self.events.popleft()
+        if not self.tasks:
+            return None
+        job_id, chunk_index, mags = self.tasks.pop()  # out of order on purpose
+        worker_id = "w0" if self.n_taken == 0 else "w1"
+        self.n_taken += 1
+        self.events.append(("started", worker_id, job_id, chunk_index, None))
+        if worker_id == "w0":
+            self.lost.add("w0")
+        else:
+            self.events.append(("done", worker_id, job_id, chunk_index, _tables(mags)))
+        return self.events.popleft()
+
+    def lost_workers(self) -> set[str]:
+        return set(self.lost)
+
+    @property
+    def n_workers(self) -> int:
+        return 2
+
+
+class InOrderBackend(FakeBackend):
+    """One worker taking the chunks in order
+
+    Parameters
+    ----------
+    drop_first
+        The first chunk is taken by a worker that stops before reporting
+        it as started
+
+    fail_chunks
+        Indices of the chunks whose estimation fails
+    """
+
+    heartbeat_timeout = 0.05
+
+    def __init__(self, drop_first: bool = False, fail_chunks: tuple[int, ...] = ()) -> None:
+        super().__init__()
+        self.drop_first = drop_first
+        self.fail_chunks = set(fail_chunks)
+
+    def start(self, setup: dict[str, Any]) -> None:
+        super().start(setup)
+        self.events.append(("ready", "w1", None, None, None))
+
+    def get_event(self, timeout: float) -> tuple | None:
+        if self.events:
+            return self.events.popleft()
+        if not self.tasks:
+            return ("heartbeat", "w1", None, None, None)
+        job_id, chunk_index, mags = self.tasks.popleft()
+        self.n_taken += 1
+        if self.drop_first and self.n_taken == 1:
+            return None
+        if chunk_index in self.fail_chunks:
+            self.events.append(("error", "w1", job_id, chunk_index, "ValueError: bad"))
+        else:
+            self.events.append(("done", "w1", job_id, chunk_index, _tables(mags)))
+        return ("started", "w1", job_id, chunk_index, None)
+
+
+class SilentBackend(FakeBackend):
+    """Workers that never take anything"""
+
+    def get_event(self, timeout: float) -> tuple | None:
+        return None
+
+
+def test_distributed_order_and_requeue(tmp_path: str) -> None:
+    model_path = os.path.join(tmp_path, "model.pickle")
+    with open(model_path, "wb") as fout:
+        fout.write(b"model")
+    backend = FakeBackend()
+    chunks = [dict(mag_r=np.arange(3) + 10.0 * index) for index in range(5)]
+    with DistributedEstimator(backend, "gpz", model_path) as estimator:
+        assert backend.setup["model_bytes"] == b"model"
+        ensembles = list(estimator.estimate_chunks(chunks, max_in_flight=3))
+    assert estimator.n_requeued == 1
+    assert [ens_.npdf for ens_ in ensembles] == [3] * 5
+    for index, ens in enumerate(ensembles):
+        assert np.allclose(np.asarray(ens.mean()).ravel(), chunks[index]["mag_r"])
+
+
+def test_distributed_error(tmp_path: str) -> None:
+    model_path = os.path.join(tmp_path, "model.pickle")
+    with open(model_path, "wb") as fout:
+        fout.write(b"model")
+    backend = InOrderBackend(fail_chunks=(0,))
+    chunks = [dict(mag_r=np.arange(3) + 10.0 * index) for index in range(4)]
+    with DistributedEstimator(backend, "gpz", model_path) as estimator:
+        with pytest.raises(RuntimeError, match="bad"):
+            list(estimator.estimate_chunks(chunks, max_in_flight=3))
+        # The chunks left by the failed job are not estimated for the next
+        assert not backend.tasks
+
+        # Nor are late results of the failed job taken for the next one's
+        backend.fail_chunks.clear()
+        stale = _tables(dict(mag_r=np.full(3, -1.0)))
+        backend.events.append(("done", "w0", backend.job_ids[0], 0, stale))
+        ensembles = list(estimator.estimate_chunks(chunks, max_in_flight=3))
+    assert len(backend.job_ids) == 2
+    for index, ens in enumerate(ensembles):
+        assert np.allclose(np.asarray(ens.mean()).ravel(), chunks[index]["mag_r"])
+
+
+def test_distributed_taken_not_started(tmp_path: str) -> None:
+    model_path = os.path.join(tmp_path, "model.pickle")
+    with open(model_path, "wb") as fout:
+        fout.write(b"model")
+    chunks = [dict(mag_r=np.arange(3) + 10.0 * index) for index in range(3)]
+    for max_in_flight in [1, 3]:
+        with DistributedEstimator(InOrderBackend(drop_first=True), "gpz", model_path) as estimator:
+            ensembles = list(estimator.estimate_chunks(chunks, max_in_flight=max_in_flight))
+        assert estimator.n_requeued == 1
+        for index, ens in enumerate(ensembles):
+            assert np.allclose(np.asarray(ens.mean()).ravel(), chunks[index]["mag_r"])
+
+
+def test_distributed_no_progress(tmp_path: str) -> None:
+    model_path = os.path.join(tmp_path, "model.pickle")
+    with open(model_path, "wb") as fout:
+        fout.write(b"model")
+    with pytest.raises(RuntimeError, match="No chunk started"):
+        with DistributedEstimator(SilentBackend(), "gpz", model_path, progress_timeout=0.05) as estimator:
+            list(estimator.estimate_chunks([dict(mag_r=np.zeros(2))]))
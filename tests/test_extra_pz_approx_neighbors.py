@@ -0,0 +1,117 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Accuracy and speed of approximate with respect to exact neighbour search"""
+
+import os
+from collections.abc import Callable
+
+import pytest
+from astropy.table import Table
+from lsst.meas.pz.estimate_pz_task import EstimatePZTask
+
+try:
+    from lsst.meas.pz.estimate_pz_task_cmnn import EstimatePZCMNNTask
+except ImportError:
+    EstimatePZCMNNTask = None
+
+try:
+    from lsst.meas.pz.estimate_pz_task_dnf import EstimatePZDNFTask
+except ImportError:
+    EstimatePZDNFTask = None
+
+from lsst.meas.pz.extensions.tests import utils
+
+# Mode scatter, in units of 1+z, and mean L1 distance between the PDFs,
+# when probing the most index cells
+MAX_MEDIAN_DELTA_Z = 1e-2
+MAX_MEAN_L1 = 1e-1
+
+ALGOS = [
+    ("cmnn", "model_inform_cmnn_wrap.pickle", EstimatePZCMNNTask),
+    ("dnf", "model_inform_dnf_wrap.pickle", EstimatePZDNFTask),
+]
+
+
+def _check_approx_neighbors(
+    survey: str,
+    algo_name: str,
+    model_file: str,
+    estimator_class: type[EstimatePZTask],
+    data: Table,
+    config_callback: Callable,
+    report_dir: str,
+) -> None:
+    if estimator_class is None:
+        pytest.skip(f"Missing {algo_name} in env")
+    report_path = os.path.join(report_dir, f"approx_neighbors_{survey}_{algo_name}.json")
+    report = utils.compare_neighbor_search(
+        model_file=f"models/{survey}/{model_file}",
+        data=data,
+        estimator_class=estimator_class,
+        config_callback=config_callback,
+        report_path=report_path,
+    )
+    message = "\n".join(
+        [f"{survey} {algo_name} approximate vs exact, report in {report_path}:"]
+        + [f"{n_probe_}: {metrics_}" for n_probe_, metrics_ in report.items()]
+    )
+    metrics = list(report.values())[-1]
+    assert metrics["median_delta_z"] < MAX_MEDIAN_DELTA_Z, message
+    assert metrics["mean_l1"] < MAX_MEAN_L1, message
+
+
+@pytest.mark.parametrize("algo_name,model_file,estimator_class", ALGOS)
+def test_approx_neighbors_hsc(
+    hsc_dataset: Table,
+    algo_name: str,
+    model_file: str,
+    estimator_class: type[EstimatePZTask],
+    tmp_path: str,
+) -> None:
+    _check_approx_neighbors(
+        "hsc",
+        algo_name,
+        model_file,
+        estimator_class,
+        hsc_dataset,
+        utils.hsc_config_callback,
+        tmp_path,
+    )
+
+
+@pytest.mark.parametrize("algo_name,model_file,estimator_class", ALGOS)
+def test_approx_neighbors_dc2(
+    dc2_dataset: Table,
+    algo_name: str,
+    model_file: str,
+    estimator_class: type[EstimatePZTask],
+    tmp_path: str,
+) -> None:
+    _check_approx_neighbors(
+        "dc2",
+        algo_name,
+        model_file,
+        estimator_class,
+        dc2_dataset,
+        utils.dc2_config_callback,
+        tmp_path,
+    )
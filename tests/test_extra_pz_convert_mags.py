@@ -0,0 +1,84 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Estimation from the magnitudes written by ConvertMagsTask"""
+
+import os
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from lsst.meas.pz.convert_mags_task import ConvertMagsTask
+from lsst.meas.pz.extensions import presets
+from lsst.meas.pz.extensions.pdf_grid import pdfs_on_grid
+from rail.core.model import Model as PZModel
+
+try:
+    from lsst.meas.pz.estimate_pz_task_dnf import EstimatePZDNFTask
+except ImportError:
+    EstimatePZDNFTask = None
+
+try:
+    from lsst.meas.pz.estimate_pz_task_gpz import EstimatePZGPZTask
+except ImportError:
+    EstimatePZGPZTask = None
+
+
+@pytest.mark.parametrize(
+    "algo_name,estimator_class",
+    [
+        ("dnf", EstimatePZDNFTask),
+        ("gpz", EstimatePZGPZTask),
+    ],
+)
+def test_convert_mags_hsc(hsc_dataset: Table, algo_name: str, estimator_class: type | None) -> None:
+    if estimator_class is None:
+        pytest.skip(f"Missing {algo_name} in env")
+    pz_model = PZModel.read(
+        os.path.expandvars(f"${{TESTDATA_RAIL_DIR}}/models/hsc/model_inform_{algo_name}_wrap.pickle")
+    )
+
+    convert_config = ConvertMagsTask.ConfigClass()
+    convert_config.pz_algo.name = algo_name
+    presets.hsc_preset(convert_config.pz_algo.active)
+    convert_config.precision = "float64"
+    convert_config.id_column = None
+    pz_mags = ConvertMagsTask(config=convert_config).run(hsc_dataset).pzMags
+    assert len(pz_mags) == len(hsc_dataset)
+    assert pz_mags.meta["pz_bands"] == list(convert_config.pz_algo.active.bands_to_convert)
+    assert np.all(pz_mags[convert_config.flag_column] >= 0)
+
+    task_config = estimator_class.ConfigClass()
+    presets.hsc_preset(task_config.pz_algo)
+    expected = estimator_class(True, config=task_config).run(pz_model, hsc_dataset).pzEnsemble
+
+    task_config = estimator_class.ConfigClass()
+    presets.hsc_preset(task_config.pz_algo)
+    task_config.use_converted_mags = True
+    task = estimator_class(True, config=task_config)
+    output = task.run_converted(pz_model, pz_mags).pzEnsemble
+    assert output.npdf == expected.npdf
+    zgrid = task.pz_algo.zgrid
+    assert np.allclose(pdfs_on_grid(output, zgrid), pdfs_on_grid(expected, zgrid))
+
+    with pytest.raises(ValueError):
+        task.run_converted(pz_model, pz_mags[pz_mags.colnames[:1]])
@@ -0,0 +1,73 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Chunked estimation under a memory budget"""
+
+import os
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from lsst.meas.pz.extensions import presets
+from lsst.meas.pz.extensions.pdf_grid import pdfs_on_grid
+from rail.core.model import Model as PZModel
+
+try:
+    from lsst.meas.pz.estimate_pz_task_gpz import EstimatePZGPZTask
+except ImportError:
+    EstimatePZGPZTask = None
+
+try:
+    from lsst.meas.pz.estimate_pz_task_fzboost import EstimatePZFZBoostTask
+except ImportError:
+    EstimatePZFZBoostTask = None
+
+
+@pytest.mark.parametrize(
+    "algo_name, task_class",
+    [("gpz", EstimatePZGPZTask), ("fzboost", EstimatePZFZBoostTask)],
+)
+def test_memory_budget_hsc(hsc_dataset: Table, algo_name: str, task_class: type | None) -> None:
+    if task_class is None:
+        pytest.skip(f"Missing {algo_name} in env")
+    pz_model = PZModel.read(
+        os.path.expandvars(f"${{TESTDATA_RAIL_DIR}}/models/hsc/model_inform_{algo_name}_wrap.pickle")
+    )
+    task_config = task_class.ConfigClass()
+    presets.hsc_preset(task_config.pz_algo)
+    task_config.do_accumulate_nz = True
+    expected = task_class(True, config=task_config).run(pz_model, hsc_dataset)
+
+    # A budget below the current footprint forces the smallest chunks
+    task_config.memory_budget_mb = 1.0
+    task_config.min_chunk_size = 300
+    task = task_class(True, config=task_config)
+    output = task.run(pz_model, hsc_dataset)
+    assert task.metadata["n_chunks"] == 4
+    assert task.metadata["max_chunk_rows"] == 300
+    assert output.pzEnsemble.npdf == expected.pzEnsemble.npdf
+    zgrid = task.pz_algo.zgrid
+    assert np.allclose(pdfs_on_grid(output.pzEnsemble, zgrid), pdfs_on_grid(expected.pzEnsemble, zgrid))
+    assert np.allclose(np.asarray(output.pzNz["nz"]), np.asarray(expected.pzNz["nz"]))
+    assert np.allclose(
+        np.ravel(output.pzEnsemble.ancil["zmode"]), np.ravel(expected.pzEnsemble.ancil["zmode"])
+    )
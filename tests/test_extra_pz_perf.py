@@ -0,0 +1,117 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Throughput and memory of the wrapped estimators
+
+Every measurement is compared with that of the stock RAIL stage of the
+same algorithm on the same catalog, which needs no recorded numbers.
+Measurements with an entry in tests/data/perf_baseline.yaml, which has
+none yet, are also compared with it, in machine-normalized units;
+entries are recorded, or refreshed after an intended change, by running
+this file with MEAS_PZ_REFRESH_PERF_BASELINE=1.
+
+The latency of `estimate_array` on small batches depends on the load of
+the machine more than the throughput does, so it is only checked against
+the ``small_batch_latency_ms`` target of each algorithm when
+MEAS_PZ_CHECK_LATENCY=1 is set.
+"""
+
+import os
+import time
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from lsst.meas.pz.extensions import perf_baseline
+from lsst.meas.pz.extensions.algo_registry import pz_algo_registry
+from lsst.meas.pz.extensions.batch_estimate import make_algo_task
+from rail.core.model import Model as PZModel
+
+TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+BASELINE_PATH = os.path.join(TEST_DIR, "data", "perf_baseline.yaml")
+REFRESH = bool(os.environ.get("MEAS_PZ_REFRESH_PERF_BASELINE"))
+REFRESH_COMMAND = "MEAS_PZ_REFRESH_PERF_BASELINE=1 pytest tests/test_extra_pz_perf.py"
+CHECK_LATENCY = bool(os.environ.get("MEAS_PZ_CHECK_LATENCY"))
+
+N_SYNTHETIC_ROWS = 20000
+LATENCY_BATCH_SIZES = [1, 10, 100]
+N_LATENCY_CALLS = 50
+
+
+@pytest.mark.parametrize("catalog", ["synthetic", "hsc"])
+@pytest.mark.parametrize("algo_name", ["cmnn", "dnf", "fzboost", "gpz", "lephare", "tpz"])
+def test_perf_regression(hsc_dataset: Table, algo_name: str, catalog: str) -> None:
+    if algo_name not in pz_algo_registry:
+        pytest.skip(f"Missing {algo_name} in env")
+    key = f"{algo_name}/{catalog}"
+    baseline = perf_baseline.load_baseline(BASELINE_PATH)
+
+    algo_task = make_algo_task(algo_name, "hsc")
+    pz_model = PZModel.read(
+        os.path.expandvars(f"${{TESTDATA_RAIL_DIR}}/models/hsc/model_inform_{algo_name}_wrap.pickle")
+    )
+    if catalog == "synthetic":
+        fluxes = perf_baseline.make_synthetic_catalog(algo_task, N_SYNTHETIC_ROWS)
+    else:
+        fluxes = hsc_dataset
+    measurement = perf_baseline.measure_estimate(algo_task, pz_model, fluxes)
+
+    if REFRESH:
+        perf_baseline.record_baseline(BASELINE_PATH, key, measurement)
+        return
+    stock = perf_baseline.measure_stock_estimate(algo_task, pz_model, fluxes)
+    problems = perf_baseline.compare_to_stock(key, measurement, stock, baseline["tolerances"])
+    assert not problems, "\n".join(["Slower or larger than the stock RAIL stage:", *problems])
+
+    if key in baseline["entries"]:
+        problems = perf_baseline.compare_to_baseline(key, measurement, baseline)
+        assert not problems, perf_baseline.format_regression(problems, BASELINE_PATH, REFRESH_COMMAND)
+
+
+@pytest.mark.skipif(not CHECK_LATENCY, reason="Set MEAS_PZ_CHECK_LATENCY=1 to check latencies")
+@pytest.mark.parametrize("algo_name", ["fzboost", "gpz"])
+def test_small_batch_latency(hsc_dataset: Table, algo_name: str) -> None:
+    if algo_name not in pz_algo_registry:
+        pytest.skip(f"Missing {algo_name} in env")
+    algo_task = make_algo_task(algo_name, "hsc")
+    assert algo_task.small_batch_latency_ms is not None
+    pz_model = PZModel.read(
+        os.path.expandvars(f"${{TESTDATA_RAIL_DIR}}/models/hsc/model_inform_{algo_name}_wrap.pickle")
+    )
+    converted = algo_task.convert(hsc_dataset[: max(LATENCY_BATCH_SIZES)])
+    mag_names, err_names = algo_task.array_columns()
+    mags = np.column_stack([converted[name_] for name_ in mag_names])
+    mag_errs = np.column_stack([converted[name_] for name_ in err_names])
+    out = np.empty((mags.shape[0], algo_task.zgrid.size), dtype=algo_task.dtype)
+    # Warm the stage
+    algo_task.estimate_array(pz_model, mags, mag_errs, out=out)
+
+    slow = []
+    for n_obj in LATENCY_BATCH_SIZES:
+        latencies = []
+        for _ in range(N_LATENCY_CALLS):
+            start = time.perf_counter()
+            algo_task.estimate_array(pz_model, mags[:n_obj], mag_errs[:n_obj], out=out[:n_obj])
+            latencies.append(1000.0 * (time.perf_counter() - start))
+        median = np.median(latencies)
+        if median >= algo_task.small_batch_latency_ms:
+            slow.append(f"{n_obj} objects: {median:.2f} ms median")
+    assert not slow, f"{algo_name} is over {algo_task.small_batch_latency_ms} ms on " + ", ".join(slow)
@@ -0,0 +1,69 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Pipeline benchmark on a small synthetic butler"""
+
+import os
+import shutil
+
+import pytest
+from lsst.meas.pz.extensions.pipeline_benchmark import (
+    PipelineBenchmarkResult,
+    format_benchmark,
+    make_synthetic_repo,
+    run_pipeline_benchmark,
+)
+
+TEST_DATA_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "extras")
+PIPELINE = os.path.join(TEST_DATA_DIR, "pz_pipeline_all_lsst.yaml") + "#pz_dnf,pz_gpz"
+
+
+def test_format_benchmark() -> None:
+    results = [
+        PipelineBenchmarkResult(1, 2.0, 40.0, dict(pz_gpz=4), dict(pz_gpz=36.0)),
+        PipelineBenchmarkResult(4, 2.5, 12.5, dict(pz_gpz=4), dict(pz_gpz=38.0)),
+    ]
+    table = format_benchmark(results)
+    assert table["speedup"][1] == pytest.approx(3.2)
+    assert table["efficiency"][1] == pytest.approx(0.8)
+    assert table["pz_gpz_s"][0] == 36.0
+
+
+@pytest.mark.skipif(shutil.which("pipetask") is None, reason="pipetask not available")
+def test_pipeline_benchmark(tmp_path: str) -> None:
+    model_files = {
+        f"pzModel_{algo_}": os.path.expandvars(
+            f"${{TESTDATA_RAIL_DIR}}/models/dc2/model_inform_{algo_}_wrap.pickle"
+        )
+        for algo_ in ["dnf", "gpz"]
+    }
+    root = os.path.join(tmp_path, "repo")
+    make_synthetic_repo(root, PIPELINE, model_files, n_patches=2, rows_per_patch=200)
+    results = run_pipeline_benchmark(root, PIPELINE, jobs=[1, 2])
+    table = format_benchmark(results)
+    report_path = os.path.join(tmp_path, "pipeline_benchmark.ecsv")
+    table.write(report_path)
+    message = f"Benchmark report in {report_path}:\n{table}"
+    assert [result_.n_jobs for result_ in results] == [1, 2], message
+    for result in results:
+        assert result.graph_seconds > 0.0, message
+        assert result.n_quanta == dict(pz_dnf=2, pz_gpz=2), message
@@ -0,0 +1,140 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Accuracy of the float32 inference mode with respect to float64"""
+
+from collections.abc import Callable
+
+import pytest
+from astropy.table import Table
+from lsst.meas.pz.estimate_pz_task import EstimatePZTask
+
+try:
+    from lsst.meas.pz.estimate_pz_task_cmnn import EstimatePZCMNNTask
+except ImportError:
+    EstimatePZCMNNTask = None
+
+try:
+    from lsst.meas.pz.estimate_pz_task_dnf import EstimatePZDNFTask
+except ImportError:
+    EstimatePZDNFTask = None
+
+try:
+    from lsst.meas.pz.estimate_pz_task_fzboost import EstimatePZFZBoostTask
+except ImportError:
+    EstimatePZFZBoostTask = None
+
+try:
+    from lsst.meas.pz.estimate_pz_task_gpz import EstimatePZGPZTask
+except ImportError:
+    EstimatePZGPZTask = None
+
+from lsst.meas.pz.extensions.tests import utils
+
+# Largest median mode shift, in units of 1+z, and mean and maximum L1
+# distances between the float32 and float64 PDFs, per algorithm.
+#
+# On the 20449 objects of the RAIL DC2 validation catalog, with models
+# trained on the matching training catalog, the batched FZBoost modes did
+# not move and the L1 distances were 4e-7 on average and 2e-6 at most;
+# for the batched GPZ prediction 3 modes moved by one grid step, and the
+# L1 distances were 3e-5 on average and 4e-4 at most.  The limits leave a
+# factor of about 10 to 30 for other models and catalogs.
+TOLERANCES = dict(
+    fzboost=(0.0, 1e-5, 1e-4),
+    gpz=(0.0, 3e-4, 5e-3),
+)
+
+ALGOS = [
+    ("fzboost", "model_inform_fzboost_wrap.pickle", EstimatePZFZBoostTask),
+    ("gpz", "model_inform_gpz_wrap.pickle", EstimatePZGPZTask),
+]
+
+
+def _check_precision(
+    survey: str,
+    algo_name: str,
+    model_file: str,
+    estimator_class: type[EstimatePZTask],
+    data: Table,
+    config_callback: Callable,
+) -> None:
+    if estimator_class is None:
+        pytest.skip(f"Missing {algo_name} in env")
+    metrics = utils.compare_precision(
+        model_file=f"models/{survey}/{model_file}",
+        data=data,
+        estimator_class=estimator_class,
+        config_callback=config_callback,
+    )
+    max_median_delta_z, max_mean_l1, max_l1 = TOLERANCES[algo_name]
+    assert metrics["median_delta_z"] <= max_median_delta_z
+    assert metrics["mean_l1"] <= max_mean_l1
+    assert metrics["max_l1"] <= max_l1
+
+
+@pytest.mark.parametrize("algo_name,model_file,estimator_class", ALGOS)
+def test_precision_hsc(
+    hsc_dataset: Table,
+    algo_name: str,
+    model_file: str,
+    estimator_class: type[EstimatePZTask],
+) -> None:
+    _check_precision("hsc", algo_name, model_file, estimator_class, hsc_dataset, utils.hsc_config_callback)
+
+
+@pytest.mark.parametrize("algo_name,model_file,estimator_class", ALGOS)
+def test_precision_dc2(
+    dc2_dataset: Table,
+    algo_name: str,
+    model_file: str,
+    estimator_class: type[EstimatePZTask],
+) -> None:
+    _check_precision("dc2", algo_name, model_file, estimator_class, dc2_dataset, utils.dc2_config_callback)
+
+
+@pytest.mark.parametrize("algo_name,model_file,estimator_class", ALGOS)
+def test_precision_com_cam(
+    com_cam_dataset: Table,
+    algo_name: str,
+    model_file: str,
+    estimator_class: type[EstimatePZTask],
+) -> None:
+    _check_precision(
+        "com_cam", algo_name, model_file, estimator_class, com_cam_dataset, utils.com_cam_config_callback
+    )
+
+
+@pytest.mark.parametrize(
+    "algo_name,estimator_class",
+    [("cmnn", EstimatePZCMNNTask), ("dnf", EstimatePZDNFTask), ("gpz", EstimatePZGPZTask)],
+)
+def test_precision_rejected(algo_name: str, estimator_class: type[EstimatePZTask]) -> None:
+    if estimator_class is None:
+        pytest.skip(f"Missing {algo_name} in env")
+    task_config = estimator_class.ConfigClass()
+    task_config.pz_algo.precision = "float32"
+    if algo_name == "gpz":
+        # Only the batched prediction runs in float32
+        task_config.validate()
+        task_config.pz_algo.batched_predict = False
+    with pytest.raises(ValueError):
+        task_config.validate()
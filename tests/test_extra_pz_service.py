@@ -0,0 +1,53 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local p(z) estimation service with a real model"""
+
+import os
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from lsst.meas.pz.extensions.algo_registry import pz_algo_registry
+from lsst.meas.pz.extensions.batch_estimate import make_algo_task
+from lsst.meas.pz.extensions.pz_service import PZService, PZServiceConfig
+from rail.core.model import Model as PZModel
+
+
+def test_service_matches_task(hsc_dataset: Table) -> None:
+    if "tpz" not in pz_algo_registry:
+        pytest.skip("Missing tpz in env")
+    model_path = os.path.expandvars("${TESTDATA_RAIL_DIR}/models/hsc/model_inform_tpz_wrap.pickle")
+    config = PZServiceConfig()
+    config.models = dict(tpz=model_path)
+    config.preset = "hsc"
+    service = PZService.from_config(config)
+    try:
+        algo_task = make_algo_task("tpz", "hsc")
+        fluxes = hsc_dataset[:20]
+        expected = algo_task.estimate(PZModel.read(model_path), fluxes)
+        for start in range(0, 20, 5):
+            pz_ensemble, timing = service.estimate("tpz", fluxes[start:start + 5])
+            assert pz_ensemble.npdf == 5
+            assert np.allclose(pz_ensemble.ancil["zmode"], expected.ancil["zmode"][start:start + 5])
+        assert service.metrics()["tpz"]["n_requests"] == 4
+    finally:
+        service.close()
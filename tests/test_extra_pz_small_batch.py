@@ -0,0 +1,61 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Small-batch fast path: agreement with the full path
+
+The latency of the fast path is checked in tests/test_extra_pz_perf.py.
+"""
+
+import os
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from lsst.meas.pz.extensions.algo_registry import pz_algo_registry
+from lsst.meas.pz.extensions.batch_estimate import make_algo_task
+from lsst.meas.pz.extensions.pdf_grid import pdfs_on_grid
+from rail.core.model import Model as PZModel
+
+BATCH_SIZES = [1, 10, 100]
+
+
+@pytest.mark.parametrize("algo_name", ["dnf", "fzboost", "gpz", "tpz"])
+def test_small_batch_hsc(hsc_dataset: Table, algo_name: str) -> None:
+    if algo_name not in pz_algo_registry:
+        pytest.skip(f"Missing {algo_name} in env")
+    algo_task = make_algo_task(algo_name, "hsc")
+    pz_model = PZModel.read(
+        os.path.expandvars(f"${{TESTDATA_RAIL_DIR}}/models/hsc/model_inform_{algo_name}_wrap.pickle")
+    )
+    fluxes = hsc_dataset[: max(BATCH_SIZES)]
+    converted = algo_task.convert(fluxes)
+    mag_names, err_names = algo_task.array_columns()
+    mags = np.column_stack([converted[name_] for name_ in mag_names])
+    mag_errs = np.column_stack([converted[name_] for name_ in err_names])
+
+    expected = pdfs_on_grid(algo_task.estimate(pz_model, fluxes), algo_task.zgrid)
+    out = np.empty((len(fluxes), algo_task.zgrid.size), dtype=algo_task.dtype)
+    pdfs = algo_task.estimate_array(pz_model, mags, mag_errs, out=out)
+    assert pdfs is out
+    assert np.allclose(pdfs, expected, rtol=1e-4, atol=1e-4)
+    for n_obj in BATCH_SIZES[:-1]:
+        pdfs = algo_task.estimate_array(pz_model, mags[:n_obj], mag_errs[:n_obj], out=out[:n_obj])
+        assert np.allclose(pdfs, expected[:n_obj], rtol=1e-4, atol=1e-4)
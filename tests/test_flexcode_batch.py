@@ -0,0 +1,116 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the batched FlexCode density evaluation"""
+
+import numpy as np
+from flexcode import FlexCodeModel
+from flexcode.post_processing import normalize, remove_bumps
+
+from lsst.meas.pz.extensions import flexcode_batch
+
+
+class _LinearRegression:
+    """Stand-in for the trained booster, predicting linear coefficients"""
+
+    def __init__(self, n_features: int, n_basis: int):
+        self.weights = np.random.default_rng(11).normal(size=(n_features, n_basis))
+
+    def predict(self, x_new: np.ndarray) -> np.ndarray:
+        return x_new @ self.weights
+
+
+def _make_cdes(n_obj: int, n_grid: int) -> np.ndarray:
+    rng = np.random.default_rng(3)
+    z_grid = np.linspace(0.0, 1.0, n_grid)
+    locs = rng.uniform(0.1, 0.9, size=(n_obj, 2))
+    cdes = np.exp(-0.5 * ((z_grid - locs[:, :1]) / 0.05) ** 2)
+    cdes += 0.1 * np.exp(-0.5 * ((z_grid - locs[:, 1:]) / 0.01) ** 2)
+    cdes += rng.normal(scale=0.05, size=cdes.shape)
+    # Include an all-negative row and a row with a small total area
+    cdes[0] = -1.0
+    cdes[1] *= 0.01
+    return cdes * 4.0
+
+
+def test_normalize_cdes() -> None:
+    cdes = _make_cdes(50, 201)
+    expected = cdes.copy()
+    normalize(expected)
+    flexcode_batch.normalize_cdes(cdes)
+    assert np.allclose(cdes, expected)
+
+
+def test_remove_bumps_cdes() -> None:
+    cdes = _make_cdes(50, 201)
+    normalize(cdes)
+    expected = cdes.copy()
+    remove_bumps(expected, 0.05)
+    flexcode_batch.remove_bumps_cdes(cdes, 0.05)
+    assert np.allclose(cdes, expected)
+
+
+def test_batched_predict() -> None:
+    n_features, max_basis = 6, 20
+    model = FlexCodeModel(
+        lambda *args: _LinearRegression(n_features, max_basis), max_basis, z_min=0.0, z_max=3.0
+    )
+    model.best_basis = np.arange(15)
+    model.bump_threshold = 0.05
+    model.sharpen_alpha = 1.2
+    x_new = np.random.default_rng(5).normal(size=(40, n_features))
+
+    expected, expected_grid = model.predict(x_new, n_grid=301)
+    batched = flexcode_batch.BatchedFlexCodeModel(model)
+    cdes, z_grid = batched.predict(x_new, n_grid=301)
+    assert np.allclose(z_grid, expected_grid)
+    assert np.allclose(cdes, expected)
+    assert batched.z_max == 3.0
+
+    out = np.empty((40, 301), dtype=np.float32)
+    cdes32, _ = batched.predict(x_new, n_grid=301, out=out)
+    assert cdes32 is out
+    assert np.allclose(cdes32, expected, atol=1e-3)
+
+
+def test_batched_predict_on_grid() -> None:
+    n_features, max_basis = 6, 20
+    model = FlexCodeModel(
+        lambda *args: _LinearRegression(n_features, max_basis), max_basis, z_min=0.0, z_max=3.0
+    )
+    model.best_basis = np.arange(15)
+    model.bump_threshold = 0.05
+    model.sharpen_alpha = None
+    x_new = np.random.default_rng(5).normal(size=(40, n_features))
+    batched = flexcode_batch.BatchedFlexCodeModel(model)
+    dense, dense_grid = batched.predict(x_new, n_grid=3001)
+
+    # A non-uniform grid gives the dense densities at its points
+    z_grid = 3.0 * np.linspace(0.0, 1.0, 101) ** 1.5
+    cdes, grid = batched.predict(x_new, n_grid=101, z_grid=z_grid)
+    assert np.allclose(grid.ravel(), z_grid)
+    expected = np.array([np.interp(z_grid, dense_grid.ravel(), row_) for row_ in dense])
+    assert np.allclose(cdes, expected, atol=0.02 * expected.max())
+
+    # On the evenly spaced grid, only the quadrature differs from flexcode
+    even, _ = batched.predict(x_new, n_grid=301)
+    weighted, _ = batched.predict(x_new, n_grid=301, z_grid=np.linspace(0.0, 3.0, 301))
+    assert np.allclose(weighted, even, atol=0.02 * even.max())
@@ -0,0 +1,157 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the batched GPz prediction"""
+
+import copy
+import os
+import pickle
+
+import numpy as np
+import pytest
+import qp
+from rail.estimation.algos._gpz_util import GP
+from rail.estimation.algos.gpz import GPzEstimator, _prepare_data
+from rail.interfaces import PZFactory
+
+from lsst.meas.pz.extensions import gpz_batch
+from lsst.meas.pz.extensions.pdf_grid import pdfs_on_grid
+
+BANDS = ["mag_g", "mag_r", "mag_i"]
+ERR_BANDS = ["magerr_g", "magerr_r", "magerr_i"]
+MAG_LIMITS = dict(mag_g=27.0, mag_r=26.5, mag_i=26.0)
+REPLACE_ERROR_VALS = [0.1, 0.2, 0.3]
+
+
+def _make_mags(n_obj: int) -> dict[str, np.ndarray]:
+    rng = np.random.default_rng(7)
+    mags = {band: rng.uniform(20.0, 25.0, n_obj) for band in BANDS}
+    mags.update({err_band: rng.uniform(0.01, 0.2, n_obj) for err_band in ERR_BANDS})
+    mags["mag_g"][:5] = 99.0
+    mags["mag_r"][5:10] = np.nan
+    mags["magerr_i"][10:15] = -1.0
+    mags["magerr_g"][15:18] = np.nan
+    mags["mag_i"][18:20] = np.inf
+    # Non-detections with invalid errors too
+    mags["magerr_g"][:2] = 0.0
+    mags["magerr_r"][5:7] = np.nan
+    return mags
+
+
+def test_prepare_features() -> None:
+    mags = _make_mags(50)
+    features = gpz_batch.prepare_features(mags, BANDS, ERR_BANDS, 99.0, MAG_LIMITS, True, REPLACE_ERROR_VALS)
+
+    assert np.all(features[:5, 0] == 27.0)
+    assert np.all(features[:5, 3] == 1.0)
+    assert np.all(features[5:10, 1] == 26.5)
+    assert np.allclose(features[10:15, 5], np.log(0.3))
+    assert np.allclose(features[20:, 4], np.log(mags["magerr_r"][20:]))
+    # The inputs are not modified
+    assert np.all(mags["magerr_i"][10:15] == -1.0)
+
+
+@pytest.mark.parametrize("log_errors", [True, False])
+def test_prepare_features_as_gpz(log_errors: bool) -> None:
+    mags = _make_mags(50)
+    # GPzEstimator takes the limits in order, whatever their keys
+    mag_limits = dict(lim_0=27.0, lim_1=26.5, lim_2=26.0)
+    expected = _prepare_data(
+        copy.deepcopy(mags), BANDS, ERR_BANDS, 99.0, mag_limits, log_errors, REPLACE_ERROR_VALS
+    )
+    features = gpz_batch.prepare_features(
+        mags, BANDS, ERR_BANDS, 99.0, mag_limits, log_errors, REPLACE_ERROR_VALS
+    )
+    np.testing.assert_array_equal(features, expected)
+
+
+def test_predict_as_gpz_estimator(tmp_path: str) -> None:
+    # A small model trained on clean magnitudes, applied by the stock
+    # estimator and the batched path to rows with non-detections and NaNs
+    rng = np.random.default_rng(3)
+    train = {band: rng.uniform(20.0, 25.0, 300) for band in BANDS}
+    train.update({err_band: rng.uniform(0.01, 0.2, 300) for err_band in ERR_BANDS})
+    train_features = _prepare_data(
+        copy.deepcopy(train), BANDS, ERR_BANDS, 99.0, MAG_LIMITS, True, REPLACE_ERROR_VALS
+    )
+    redshifts = 0.1 * (train["mag_r"] - 19.0)[:, np.newaxis] + rng.normal(0.0, 0.02, (300, 1))
+    gp = GP(8, method="VC", joint=True, heteroscedastic=True, decorrelate=True)
+    gp.train(train_features, redshifts, maxIter=5)
+    model_path = os.path.join(tmp_path, "gpz.pkl")
+    with open(model_path, "wb") as fout:
+        pickle.dump(gp, fout)
+
+    mags = _make_mags(50)
+    stage = PZFactory.build_stage_instance(
+        "gpz_stock_test",
+        GPzEstimator,
+        model_path=model_path,
+        bands=BANDS,
+        err_bands=ERR_BANDS,
+        ref_band="mag_i",
+        mag_limits=MAG_LIMITS,
+        nondetect_val=99.0,
+        replace_error_vals=REPLACE_ERROR_VALS,
+    )
+    stock = PZFactory.estimate_single_pz(stage, copy.deepcopy(mags), 50)
+
+    features = gpz_batch.prepare_features(mags, BANDS, ERR_BANDS, 99.0, MAG_LIMITS, True, REPLACE_ERROR_VALS)
+    mean, var = gpz_batch.predict_gaussian(gp, features)
+    assert np.allclose(mean, np.ravel(stock.objdata["loc"]))
+    assert np.allclose(np.sqrt(var), np.ravel(stock.objdata["scale"]))
+
+
+@pytest.mark.parametrize("method", ["GL", "VL", "GD", "VD", "GC", "VC"])
+def test_predict_gaussian(method: str) -> None:
+    rng = np.random.default_rng(1)
+    features = rng.normal(size=(200, 4))
+    redshifts = (0.5 + 0.2 * features[:, :1] + 0.1 * features[:, 1:2] ** 2) + rng.normal(0.0, 0.05, (200, 1))
+    gp = GP(8, method=method, decorrelate=True)
+    gp.train(features, redshifts, maxIter=5)
+
+    expected_mean, expected_var, _, _, _ = gp.predict(features)
+    mean, var = gpz_batch.predict_gaussian(gp, features, block_size=64)
+    assert np.allclose(mean, expected_mean[:, 0])
+    assert np.allclose(var, expected_var[:, 0])
+
+    # In float32 the arithmetic stays in float32
+    mean, var = gpz_batch.predict_gaussian(gp, features.astype(np.float32), block_size=64, dtype=np.float32)
+    assert mean.dtype == np.float32 and var.dtype == np.float32
+    assert np.allclose(mean, expected_mean[:, 0], rtol=1e-4, atol=1e-4)
+    assert np.allclose(var, expected_var[:, 0], rtol=1e-3, atol=1e-5)
+
+
+def test_gaussian_mode() -> None:
+    zgrid = np.linspace(0.0, 3.0, 301)
+    mean = np.array([-0.5, 0.0, 0.1234, 1.005, 2.999, 3.7])
+    ens = qp.Ensemble(qp.stats.norm, data=dict(loc=mean[:, np.newaxis], scale=np.full((6, 1), 0.1)))
+    assert np.allclose(gpz_batch.gaussian_mode(mean, zgrid), np.ravel(ens.mode(grid=zgrid)))
+
+
+def test_gaussian_pdfs() -> None:
+    mean = np.array([0.3, 1.2, 2.9])
+    var = np.array([0.01, 0.04, 0.09])
+    zgrid = np.linspace(0.0, 3.0, 301)
+    ens = qp.Ensemble(qp.stats.norm, data=dict(loc=mean[:, np.newaxis], scale=np.sqrt(var)[:, np.newaxis]))
+    out = np.empty((3, 301), dtype=np.float32)
+    pdfs = gpz_batch.gaussian_pdfs(mean, var, zgrid, out=out)
+    assert pdfs is out
+    assert np.allclose(pdfs, pdfs_on_grid(ens, zgrid), rtol=1e-5, atol=1e-5)
@@ -0,0 +1,94 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the chunked HDF5 layout of ensembles"""
+
+import os
+
+import numpy as np
+import pytest
+import qp
+
+from lsst.meas.pz.extensions import hdf5_layout, sharded_ensemble
+
+
+def _make_ensemble(npdf: int) -> qp.Ensemble:
+    xvals = np.linspace(0.0, 3.0, 51)
+    locs = np.linspace(0.1, 2.5, npdf)
+    yvals = np.exp(-0.5 * ((xvals[np.newaxis, :] - locs[:, np.newaxis]) / 0.1) ** 2)
+    ancil = dict(objectId=np.arange(npdf) + 1000, zmode=locs)
+    return qp.Ensemble(qp.interp, data=dict(xvals=xvals, yvals=yvals), ancil=ancil)
+
+
+@pytest.mark.parametrize("compression", hdf5_layout.available_compressions())
+def test_round_trip(tmp_path: str, compression: str) -> None:
+    ens = _make_ensemble(103)
+    path = os.path.join(tmp_path, "pz_estimate.hdf5")
+    layout = hdf5_layout.Hdf5LayoutConfig(chunk_rows=16, compression=compression)
+    hdf5_layout.write_ensemble_hdf5(ens, path, layout)
+
+    assert hdf5_layout.read_hdf5_layout(path) == layout.to_dict()
+    ens_read = qp.read(path)
+    assert ens_read.npdf == 103
+    assert np.allclose(ens_read.objdata["yvals"], ens.objdata["yvals"])
+    assert np.all(ens_read.ancil["objectId"] == ens.ancil["objectId"])
+
+    rows = hdf5_layout.read_ensemble_rows(path, 20, 40)
+    assert rows.npdf == 20
+    assert np.allclose(rows.objdata["yvals"], ens[20:40].objdata["yvals"])
+    assert np.all(rows.ancil["objectId"] == ens.ancil["objectId"][20:40])
+
+
+def test_qp_files(tmp_path: str) -> None:
+    ens = _make_ensemble(30)
+    path = os.path.join(tmp_path, "pz_estimate.hdf5")
+    ens.write_to(path)
+    assert hdf5_layout.read_hdf5_layout(path) is None
+    assert hdf5_layout.read_ensemble_rows(path, 25, 100).npdf == 5
+
+
+def test_sharded_layout(tmp_path: str) -> None:
+    ens = _make_ensemble(103)
+    base_path = os.path.join(tmp_path, "pz_estimate_test")
+    layout = hdf5_layout.Hdf5LayoutConfig(chunk_rows=8)
+    path = sharded_ensemble.write_sharded_ensemble(ens, base_path, 4, layout=layout)
+    reader = sharded_ensemble.ShardedEnsemble(path)
+    assert hdf5_layout.read_hdf5_layout(sharded_ensemble.shard_path(base_path, 2)) == layout.to_dict()
+    rows = reader.read_rows(20, 60)
+    assert np.allclose(rows.objdata["yvals"], ens[20:60].objdata["yvals"])
+
+
+def test_benchmark(tmp_path: str) -> None:
+    ens = _make_ensemble(200)
+    path = os.path.join(tmp_path, "pz_estimate.hdf5")
+    results = [
+        hdf5_layout.benchmark_layout(ens, path, layout_, n_reads=3, rows_per_read=5)
+        for layout_ in [None, hdf5_layout.Hdf5LayoutConfig(chunk_rows=32)]
+    ]
+    assert results[0].layout["chunk_rows"] == 0
+    assert all(result_.file_mb > 0.0 and result_.n_rows == 200 for result_ in results)
+    table = hdf5_layout.format_layout_benchmark(results)
+    assert len(table) == 2
+
+
+def test_validate() -> None:
+    with pytest.raises(ValueError):
+        hdf5_layout.Hdf5LayoutConfig(chunk_rows=-1).validate()
@@ -0,0 +1,84 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for streaming n(z) accumulation"""
+
+import numpy as np
+import qp
+
+from lsst.meas.pz.extensions.dataset_names import NZ_PREFIX, derived_name
+from lsst.meas.pz.extensions.nz_accumulator import NzAccumulator, NzAccumulatorConfig
+from lsst.meas.pz.extensions.reduce_nz_task import ReduceNzTractTask
+
+
+def _make_ensemble(locs: np.ndarray) -> qp.Ensemble:
+    scales = np.full((locs.size, 1), 0.05)
+    return qp.Ensemble(qp.stats.norm, data=dict(loc=locs[:, np.newaxis], scale=scales))
+
+
+def test_nz_accumulator() -> None:
+    config = NzAccumulatorConfig()
+    config.bin_edges = [0.0, 0.5, 1.0, 2.0]
+    config.validate()
+
+    locs = np.array([0.2, 0.3, 0.7, 1.5, 1.6, 5.0])
+    ens = _make_ensemble(locs)
+
+    whole = NzAccumulator.from_config(config)
+    whole.add(ens, locs)
+    assert np.all(whole.counts == [2, 1, 2])
+
+    # Accumulating in chunks and merging gives the same answer
+    first = NzAccumulator.from_config(config)
+    first.add(ens[:3], locs[:3])
+    second = NzAccumulator.from_config(config)
+    second.add(ens[3:], locs[3:])
+    first.merge(second)
+    assert np.all(first.counts == whole.counts)
+    assert np.allclose(first.nz, whole.nz)
+
+    # Each bin integrates to its object count
+    integrals = whole.nz.sum(axis=1) * (whole.zgrid[1] - whole.zgrid[0])
+    assert np.allclose(integrals, whole.counts, rtol=1e-3)
+
+    round_trip = NzAccumulator.from_table(whole.to_table())
+    assert np.allclose(round_trip.nz, whole.nz)
+    assert np.all(round_trip.bin_edges == whole.bin_edges)
+
+
+def test_reduce_nz() -> None:
+    config = NzAccumulatorConfig()
+    locs = np.array([0.2, 0.7, 1.1])
+    tables = []
+    for _ in range(3):
+        accumulator = NzAccumulator.from_config(config)
+        accumulator.add(_make_ensemble(locs), locs)
+        tables.append(accumulator.to_table())
+
+    task = ReduceNzTractTask()
+    reduced = NzAccumulator.from_table(task.run(tables).pzNz)
+    assert reduced.counts.sum() == 9
+
+
+def test_derived_nz_name() -> None:
+    assert derived_name("pz_estimate_fzboost", NZ_PREFIX) == "pz_nz_fzboost"
+    assert derived_name("pz_estimate", NZ_PREFIX) == "pz_nz"
+    assert derived_name("my_pz", NZ_PREFIX) == "my_pz_pz_nz"
@@ -0,0 +1,93 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Unit tests for the metrics textfiles"""
+
+import math
+import os
+
+from lsst.meas.pz.extensions.openmetrics import (
+    MetricFamily,
+    format_metrics,
+    metrics_file_name,
+    read_metrics_textfile,
+    update_metrics_textfile,
+    write_metrics_textfile,
+)
+
+
+def test_format_metrics() -> None:
+    families = [
+        MetricFamily("pz_objects_processed_total", "Objects estimated", "counter").add(1000),
+        MetricFamily("pz_stage_seconds", "Wall time per stage").add(1.5, stage="convert").add(
+            math.nan, stage="estimate"
+        ),
+    ]
+    text = format_metrics(families, dict(algorithm="gpz", patch='a"b'))
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    assert lines[0] == "# HELP pz_objects_processed_total Objects estimated"
+    assert lines[1] == "# TYPE pz_objects_processed_total counter"
+    assert lines[2] == 'pz_objects_processed_total{algorithm="gpz",patch="a\\"b"} 1000'
+    assert lines[5] == 'pz_stage_seconds{algorithm="gpz",patch="a\\"b",stage="convert"} 1.5'
+    assert lines[6].endswith("} NaN")
+    assert format_metrics([MetricFamily("x", "No labels").add(2.0)]).splitlines()[-1] == "x 2"
+
+
+def test_write_metrics_textfile(tmp_path: str) -> None:
+    file_name = metrics_file_name("pz_gpz", "hsc", "hsc_rings_v1", 9813, 42)
+    assert file_name == "pz_gpz_hsc_hsc_rings_v1_9813_42.prom"
+    assert metrics_file_name("pz_gpz", None, "a/b") == "pz_gpz_None_a_b.prom"
+
+    path = os.path.join(tmp_path, "textfiles", file_name)
+    write_metrics_textfile(path, "x 1\n")
+    write_metrics_textfile(path, "x 2\n")
+    with open(path) as fin:
+        assert fin.read() == "x 2\n"
+    assert os.listdir(os.path.dirname(path)) == [file_name]
+
+
+def test_update_metrics_textfile(tmp_path: str) -> None:
+    path = os.path.join(tmp_path, metrics_file_name("pz_gpz", "hsc", "node-1"))
+    labels = dict(algorithm="gpz", node='node "1"')
+
+    def _families(n_objects: int, stage: str, rate: float) -> list[MetricFamily]:
+        return [
+            MetricFamily("pz_objects_processed_total", "Objects estimated", "counter").add(n_objects),
+            MetricFamily("pz_stage_seconds_total", "Wall time per stage", "counter").add(2.0, stage=stage),
+            MetricFamily("pz_objects_per_second", "Throughput").add(rate),
+        ]
+
+    update_metrics_textfile(path, _families(1000, "convert", 500.0), labels)
+    update_metrics_textfile(path, _families(300, "estimate", 100.0), labels)
+    update_metrics_textfile(path, _families(200, "estimate", math.inf), labels)
+    samples = read_metrics_textfile(path)
+    # Counters add up, also for samples missing from the later runs;
+    # gauges hold the last value
+    assert samples["pz_objects_processed_total"] == [(labels, 1500.0)]
+    assert sorted(samples["pz_stage_seconds_total"], key=lambda sample_: sample_[0]["stage"]) == [
+        (dict(labels, stage="convert"), 2.0),
+        (dict(labels, stage="estimate"), 4.0),
+    ]
+    assert samples["pz_objects_per_second"] == [(labels, math.inf)]
+    assert sorted(os.listdir(tmp_path)) == ["pz_gpz_hsc_node_1.prom", "pz_gpz_hsc_node_1.prom.lock"]
+    assert read_metrics_textfile(os.path.join(tmp_path, "missing.prom")) == {}
@@ -0,0 +1,87 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the performance baseline comparisons"""
+
+import os
+
+import pytest
+
+from lsst.meas.pz.extensions import perf_baseline
+
+
+def test_record_and_compare(tmp_path: str) -> None:
+    path = os.path.join(tmp_path, "baseline.yaml")
+    with open(path, "w") as fout:
+        fout.write("# Keep me\nversion: 1\nentries: {}\n")
+    perf_baseline.record_baseline(path, "tpz/hsc", dict(rows_per_s=1000.0, peak_mem_mb=100.0))
+    with open(path) as fin:
+        assert fin.readline() == "# Keep me\n"
+
+    baseline = perf_baseline.load_baseline(path)
+    assert baseline["tolerances"] == perf_baseline.DEFAULT_TOLERANCES
+    ok = dict(rows_per_s=800.0, peak_mem_mb=110.0)
+    assert not perf_baseline.compare_to_baseline("tpz/hsc", ok, baseline)
+
+    slow = dict(rows_per_s=300.0, peak_mem_mb=200.0)
+    problems = perf_baseline.compare_to_baseline("tpz/hsc", slow, baseline)
+    assert len(problems) == 2
+    assert "-70.0%" in problems[0] and "+100.0%" in problems[1]
+    message = perf_baseline.format_regression(problems, path, "refresh-me")
+    assert message.endswith("    refresh-me")
+
+    baseline["entries"]["tpz/hsc"]["tolerances"] = dict(rows_per_s=0.8)
+    assert len(perf_baseline.compare_to_baseline("tpz/hsc", slow, baseline)) == 1
+
+
+def test_baseline_version(tmp_path: str) -> None:
+    path = os.path.join(tmp_path, "baseline.yaml")
+    assert perf_baseline.load_baseline(path)["entries"] == {}
+    with open(path, "w") as fout:
+        fout.write("version: 0\n")
+    with pytest.raises(ValueError):
+        perf_baseline.load_baseline(path)
+
+
+def test_compare_to_stock() -> None:
+    stock = dict(rows_per_s=1000.0, peak_mem_mb=100.0)
+    assert not perf_baseline.compare_to_stock("tpz/hsc", dict(rows_per_s=5000.0, peak_mem_mb=90.0), stock)
+    problems = perf_baseline.compare_to_stock("tpz/hsc", dict(rows_per_s=500.0, peak_mem_mb=90.0), stock)
+    assert len(problems) == 1 and "stock" in problems[0] and "-50.0%" in problems[0]
+    assert not perf_baseline.compare_to_stock(
+        "tpz/hsc", dict(rows_per_s=500.0, peak_mem_mb=90.0), stock, dict(rows_per_s=0.6, peak_mem_mb=0.25)
+    )
+
+
+def test_compare_across_machines(tmp_path: str) -> None:
+    path = os.path.join(tmp_path, "baseline.yaml")
+    recorded = dict(rows_per_s=1000.0, norm_rows_per_s=0.5, peak_mem_mb=100.0)
+    perf_baseline.record_baseline(path, "tpz/hsc", recorded)
+    baseline = perf_baseline.load_baseline(path)
+    baseline["entries"]["tpz/hsc"]["machine"] = "elsewhere"
+
+    # A slower machine is only judged on the normalized throughput
+    slower_machine = dict(rows_per_s=400.0, norm_rows_per_s=0.45, peak_mem_mb=100.0)
+    assert not perf_baseline.compare_to_baseline("tpz/hsc", slower_machine, baseline)
+    slower_code = dict(rows_per_s=400.0, norm_rows_per_s=0.2, peak_mem_mb=100.0)
+    problems = perf_baseline.compare_to_baseline("tpz/hsc", slower_code, baseline)
+    assert len(problems) == 2 and "norm_rows_per_s" in problems[0] and "elsewhere" in problems[1]
+    assert perf_baseline.machine_speed(n_repeat=1) > 0
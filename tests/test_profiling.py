@@ -0,0 +1,68 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the profiling helpers"""
+
+import os
+
+import numpy as np
+import pytest
+import qp
+
+from lsst.meas.pz.extensions.profiling import code_category, profile_call
+
+
+def _make_ensemble(npdf: int) -> qp.Ensemble:
+    locs = np.linspace(0.1, 2.5, npdf)[:, np.newaxis]
+    ens = None
+    # Busy ourselves for long enough to be sampled
+    for _ in range(20):
+        ens = qp.Ensemble(qp.stats.norm, data=dict(loc=locs, scale=np.full_like(locs, 0.1)))
+        ens.pdf(np.linspace(0.0, 3.0, 301))
+    return ens
+
+
+def test_code_category() -> None:
+    assert code_category(qp.__file__) == "qp"
+    assert code_category(code_category.__code__.co_filename) == "meas_pz"
+    assert code_category(np.__file__) == "other"
+
+
+@pytest.mark.parametrize("mode", ["deterministic", "sampling"])
+def test_profile_call(tmp_path: str, mode: str) -> None:
+    result = profile_call(_make_ensemble, 2000, mode=mode, interval=0.001)
+    assert result.value.npdf == 2000
+    assert result.elapsed > 0.0
+
+    table = result.top_table(n_top=5)
+    totals = table[table["function"] == "TOTAL"]
+    assert list(totals["category"]) == ["meas_pz", "rail", "qp", "other"]
+    assert totals["own_time"][2] > 0.0
+    funcs = table[table["function"] != "TOTAL"]
+    assert np.all(funcs["own_time"] <= funcs["total_time"] + 1e-9)
+
+    paths = result.write(os.path.join(tmp_path, "profile"), n_top=5)
+    assert all(os.path.exists(path_) for path_ in paths)
+    if mode == "sampling":
+        with open(paths[0]) as fin:
+            stack, count = fin.readline().rsplit(" ", 1)
+        assert int(count) > 0
+        assert "_make_ensemble" in stack
@@ -0,0 +1,162 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the object ID index of the p(z) estimates"""
+
+import os
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any
+
+import numpy as np
+import qp
+from astropy.table import Table
+from lsst.resources import ResourcePath
+
+from lsst.meas.pz.extensions import pz_index
+from lsst.meas.pz.extensions.hdf5_layout import Hdf5LayoutConfig, write_ensemble_hdf5
+
+
+def _make_ensemble(locs: np.ndarray) -> qp.Ensemble:
+    xvals = np.linspace(0.0, 3.0, 31)
+    yvals = np.exp(-0.5 * ((xvals[np.newaxis, :] - locs[:, np.newaxis]) / 0.1) ** 2)
+    return qp.Ensemble(qp.interp, data=dict(xvals=xvals, yvals=yvals))
+
+
+class _FakeButler:
+    """Just enough of a butler for lookup_pdfs: tract indices and ID ranges
+    in memory, ensemble files on disk
+    """
+
+    def __init__(
+        self,
+        indices: dict[int, Table],
+        ranges: dict[int, Table],
+        paths: dict[tuple[int, int], str],
+    ):
+        self._indices = indices
+        self.ranges = ranges
+        self._paths = paths
+        self.index_reads: Counter = Counter()
+        self.queried: list[str] = []
+        self.registry = SimpleNamespace(queryDatasets=self._query_datasets)
+
+    def _query_datasets(self, dataset_type: str, findFirst: bool) -> list[Any]:
+        self.queried.append(dataset_type)
+        if dataset_type.startswith("pz_index_range"):
+            return self._refs(self.ranges, "range")
+        return self.index_refs()
+
+    def get(self, ref: Any) -> Table:
+        tract = ref.dataId.required["tract"]
+        if ref.kind == "range":
+            return self.ranges[tract].copy()
+        self.index_reads[tract] += 1
+        return self._indices[tract]
+
+    def getURI(self, dataset_type: str, dataId: dict[str, Any]) -> ResourcePath:
+        return ResourcePath(self._paths[dataId["tract"], dataId["patch"]])
+
+    def index_refs(self) -> list[Any]:
+        return self._refs(self._indices, "index")
+
+    @staticmethod
+    def _refs(tables: dict[int, Table], kind: str) -> list[Any]:
+        return [
+            SimpleNamespace(kind=kind, dataId=SimpleNamespace(required=dict(skymap="sky", tract=tract_)))
+            for tract_ in tables
+        ]
+
+
+def test_make_index_table() -> None:
+    table = pz_index.make_index_table(np.array([30, 10, 20]), row_offset=5)
+    assert list(table["objectId"]) == [10, 20, 30]
+    assert list(table["row"]) == [6, 7, 5]
+
+    index = pz_index.PZIndex(Table(dict(objectId=[3, 1, 2], row=[0, 1, 2])))
+    positions, found = index.locate(np.array([2, 4, 1]))
+    assert list(found) == [True, False, True]
+    assert list(index.table["row"][positions[found]]) == [2, 1]
+    assert not pz_index.PZIndex(pz_index.make_index_table(np.array([], dtype=int))).locate([1])[1].any()
+
+
+def test_reduce_and_lookup(tmp_path: str) -> None:
+    rng = np.random.default_rng(4)
+    task = pz_index.ReducePZIndexTractTask(config=pz_index.ReducePZIndexTractConfig())
+    indices = {}
+    ranges = {}
+    paths = {}
+    ensembles = {}
+    for tract in [1, 2]:
+        quantum_indices = []
+        for patch in range(3):
+            object_ids = rng.permutation(1000)[:20] + 1000 * (10 * tract + patch)
+            ensemble = _make_ensemble(rng.uniform(0.1, 2.5, 20))
+            paths[tract, patch] = os.path.join(tmp_path, f"pz_estimate_{tract}_{patch}.hdf5")
+            write_ensemble_hdf5(ensemble, paths[tract, patch], Hdf5LayoutConfig(chunk_rows=4))
+            quantum_indices.append(pz_index.make_index_table(object_ids))
+            for row, object_id in enumerate(object_ids):
+                ensembles[object_id] = (ensemble, row)
+        result = task.run(quantum_indices, [dict(patch=patch_) for patch_ in range(3)])
+        indices[tract] = result.pzIndex
+        ranges[tract] = result.pzIndexRange
+    assert len(indices[1]) == 60
+    assert np.all(np.diff(indices[1]["objectId"]) > 0)
+    assert set(indices[1].colnames) == {"objectId", "patch", "row"}
+    assert ranges[1]["min_id"][0] == indices[1]["objectId"][0]
+    assert ranges[1]["max_id"][0] == indices[1]["objectId"][-1]
+
+    butler = _FakeButler(indices, ranges, paths)
+    wanted = np.array(list(ensembles))[[5, 100, 42, 7]]
+    wanted = np.append(wanted, -1)
+    ensemble, found = pz_index.lookup_pdfs(butler, wanted, "pz_estimate", index_refs=butler.index_refs())
+    assert list(found) == [True, True, True, True, False]
+    assert list(ensemble.ancil["objectId"]) == list(wanted[:4])
+    for idx, object_id in enumerate(wanted[:4]):
+        source, row = ensembles[object_id]
+        assert np.allclose(ensemble.objdata["yvals"][idx], source.objdata["yvals"][row])
+
+    ensemble, found = pz_index.lookup_pdfs(butler, [-1], "pz_estimate", index_refs=butler.index_refs())
+    assert ensemble is None and not found.any()
+
+    # The tract indices are found by the name derived from the ensemble's
+    ensemble, found = pz_index.lookup_pdfs(butler, wanted[:2], "pz_estimate_fzboost")
+    assert found.all()
+    assert butler.queried[-2:] == ["pz_index_tract_fzboost", "pz_index_range_fzboost"]
+
+    # Only the indices of the tracts holding the objects are read
+    butler.index_reads.clear()
+    tract_2_ids = np.asarray(indices[2]["objectId"][[3, 30]])
+    ensemble, found = pz_index.lookup_pdfs(butler, tract_2_ids, "pz_estimate_fzboost")
+    assert found.all()
+    assert butler.index_reads == Counter({2: 1})
+    index_ranges = pz_index.read_index_ranges(butler, "pz_estimate_fzboost")
+    assert list(index_ranges["tract"]) == [1, 2]
+    butler.index_reads.clear()
+    ensemble, found = pz_index.lookup_pdfs(butler, [-1], "pz_estimate", index_ranges=index_ranges)
+    assert not found.any() and not butler.index_reads
+
+    # Indices without a range are always read
+    del butler.ranges[1]
+    butler.index_reads.clear()
+    ensemble, found = pz_index.lookup_pdfs(butler, tract_2_ids, "pz_estimate_fzboost")
+    assert found.all()
+    assert butler.index_reads == Counter({1: 1, 2: 1})
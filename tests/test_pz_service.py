@@ -0,0 +1,219 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the local p(z) estimation service"""
+
+import http.client
+import json
+import os
+import socket
+import threading
+
+import numpy as np
+import pytest
+import qp
+from astropy.table import Table
+
+from lsst.meas.pz.extensions.pz_service import (
+    PZService,
+    PZServiceBusyError,
+    PZServiceConfig,
+    PZServiceHTTPServer,
+)
+
+
+class _Estimator:
+    """Gaussian p(z) centered on the "mag" column, counting its calls"""
+
+    def __init__(self) -> None:
+        self.batch_sizes: list[int] = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, fluxes: Table) -> qp.Ensemble:
+        self.batch_sizes.append(len(fluxes))
+        self.started.set()
+        self.release.wait()
+        if np.any(np.asarray(fluxes["mag"]) < 0.0):
+            raise ValueError("Negative magnitude")
+        locs = np.asarray(fluxes["mag"], dtype=float)[:, np.newaxis] / 10.0
+        ens = qp.Ensemble(qp.stats.norm, data=dict(loc=locs, scale=np.full_like(locs, 0.1)))
+        ens.set_ancil(dict(zmode=locs.ravel()))
+        return ens
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__("localhost")
+        self.socket_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def _request(conn: http.client.HTTPConnection, method: str, path: str, body: dict | None = None) -> tuple:
+    conn.request(method, path, body=None if body is None else json.dumps(body))
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@pytest.mark.parametrize("use_socket", [False, True])
+def test_http_round_trip(tmp_path: str, use_socket: bool) -> None:
+    config = PZServiceConfig()
+    if use_socket:
+        config.socket_path = os.path.join(tmp_path, "pz.sock")
+    estimator = _Estimator()
+    server = PZServiceHTTPServer(PZService(dict(fake=estimator), config), config)
+    server.start()
+    try:
+        if use_socket:
+            conn = _UnixHTTPConnection(server.address)
+        else:
+            conn = http.client.HTTPConnection(server.address.removeprefix("http://"))
+
+        assert _request(conn, "GET", "/health")[1]["algorithms"] == ["fake"]
+        status, reply = _request(conn, "POST", "/estimate/fake", dict(columns=dict(mag=[10.0, 20.0])))
+        assert status == 200
+        assert np.allclose(reply["zmode"], [1.0, 2.0])
+        assert reply["timing"]["total_ms"] >= reply["timing"]["compute_ms"]
+
+        body = dict(columns=dict(mag=[10.0]), output="pdf")
+        status, reply = _request(conn, "POST", "/estimate/fake", body)
+        assert status == 200
+        zgrid, pdf = np.array(reply["zgrid"]), np.array(reply["pdf"])
+        assert pdf.shape == (1, zgrid.size)
+        assert zgrid[np.argmax(pdf[0])] == pytest.approx(1.0, abs=0.01)
+
+        assert _request(conn, "POST", "/estimate/other", body)[0] == 404
+        assert _request(conn, "POST", "/estimate/fake", dict(rows=[]))[0] == 400
+        metrics = _request(conn, "GET", "/metrics")[1]["fake"]
+        assert metrics["n_requests"] == 2
+        assert metrics["n_rows"] == 3
+        assert metrics["total_ms"]["max"] > 0.0
+    finally:
+        server.shutdown()
+
+
+def test_batching_and_bounded_queue() -> None:
+    config = PZServiceConfig()
+    config.max_queue = 2
+    config.batch_wait_ms = 0.0
+    estimator = _Estimator()
+    estimator.release.clear()
+    service = PZService(dict(fake=estimator), config)
+    results = {}
+
+    def _submit(idx: int) -> None:
+        results[idx] = service.estimate("fake", Table(dict(mag=[10.0 * idx])), timeout=10.0)[0]
+
+    # The first request keeps the worker busy, the next two fill the queue
+    threads = [threading.Thread(target=_submit, args=(0,))]
+    threads[0].start()
+    assert estimator.started.wait(10.0)
+    for idx in (1, 2):
+        threads.append(threading.Thread(target=_submit, args=(idx,)))
+        threads[-1].start()
+    while service.metrics()["fake"]["queue_size"] < 2:
+        pass
+    with pytest.raises(PZServiceBusyError):
+        service.estimate("fake", Table(dict(mag=[0.0])))
+
+    estimator.release.set()
+    for thread in threads:
+        thread.join()
+    service.close()
+
+    # The queued requests were estimated together, and split back
+    assert estimator.batch_sizes == [1, 2]
+    for idx in range(3):
+        assert results[idx].npdf == 1
+        assert results[idx].ancil["zmode"][0] == pytest.approx(idx)
+    metrics = service.metrics()["fake"]
+    assert metrics["n_rejected"] == 1
+    assert metrics["n_batches"] == 2
+
+
+def test_failed_batch() -> None:
+    config = PZServiceConfig()
+    config.batch_wait_ms = 0.0
+    estimator = _Estimator()
+    estimator.release.clear()
+    service = PZService(dict(fake=estimator), config)
+    results: dict[int, object] = {}
+
+    def _submit(idx: int, mag: float) -> None:
+        try:
+            results[idx] = service.estimate("fake", Table(dict(mag=[mag])), timeout=10.0)[0]
+        except ValueError as err:
+            results[idx] = err
+
+    threads = [threading.Thread(target=_submit, args=(0, 10.0))]
+    threads[0].start()
+    assert estimator.started.wait(10.0)
+    # A malformed request batched with a good one
+    for idx, mag in ((1, -1.0), (2, 20.0)):
+        threads.append(threading.Thread(target=_submit, args=(idx, mag)))
+        threads[-1].start()
+    while service.metrics()["fake"]["queue_size"] < 2:
+        pass
+    estimator.release.set()
+    for thread in threads:
+        thread.join()
+    service.close()
+
+    # The failed batch of two was retried one request at a time
+    assert estimator.batch_sizes == [1, 2, 1, 1]
+    assert isinstance(results[1], ValueError)
+    assert results[2].ancil["zmode"][0] == pytest.approx(2.0)
+    assert service.metrics()["fake"]["n_failed"] == 1
+
+
+def test_close_with_full_queue() -> None:
+    config = PZServiceConfig()
+    config.max_queue = 1
+    estimator = _Estimator()
+    estimator.release.clear()
+    service = PZService(dict(fake=estimator), config)
+    threads = [
+        threading.Thread(target=service.estimate, args=("fake", Table(dict(mag=[10.0 * idx]))))
+        for idx in range(2)
+    ]
+    threads[0].start()
+    assert estimator.started.wait(10.0)
+    threads[1].start()
+    while service.metrics()["fake"]["queue_size"] < 1:
+        pass
+
+    # Closing waits for the busy worker, but not for room in the queue
+    closer = threading.Thread(target=service.close)
+    closer.start()
+    closer.join(1.0)
+    assert closer.is_alive()
+    with pytest.raises(PZServiceBusyError):
+        service.estimate("fake", Table(dict(mag=[0.0])))
+    estimator.release.set()
+    closer.join(10.0)
+    assert not closer.is_alive()
+    for thread in threads:
+        thread.join()
+    assert estimator.batch_sizes == [1, 1]
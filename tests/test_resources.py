@@ -0,0 +1,74 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the thread budget and memory budget control"""
+
+import os
+
+import numpy as np
+
+from lsst.meas.pz.extensions.resources import ChunkSizer, current_rss_bytes, peak_rss_bytes, thread_budget
+
+
+def test_thread_budget() -> None:
+    before = os.environ.get("OMP_NUM_THREADS")
+    with thread_budget(2) as num_threads:
+        assert num_threads <= 2
+        assert os.environ["OMP_NUM_THREADS"] == "2"
+        assert os.environ["OPENBLAS_NUM_THREADS"] == "2"
+    assert os.environ.get("OMP_NUM_THREADS") == before
+
+    with thread_budget(0) as num_threads:
+        assert num_threads >= 1
+
+
+def test_rss() -> None:
+    # The two are measured differently, so only check they are sensible
+    assert current_rss_bytes() > 1024**2
+    assert peak_rss_bytes() > 1024**2
+
+
+def test_chunk_sizer() -> None:
+    rss = current_rss_bytes()
+    # Room for about 1000 rows of 1 MB above the current footprint
+    sizer = ChunkSizer(int((rss + 1000 * 1024**2) / 0.8), 1024**2, min_chunk_size=10)
+    assert 900 <= sizer.next_chunk_size(100000) <= 1100
+    assert not sizer.over_budget
+    assert sizer.next_chunk_size(50) == 50
+
+    # Memory needed whatever the chunk size leaves room for fewer rows
+    sizer = ChunkSizer(
+        int((rss + 1000 * 1024**2) / 0.8), 1024**2, min_chunk_size=10, fixed_bytes=500 * 1024**2
+    )
+    assert 400 <= sizer.next_chunk_size(100000) <= 600
+
+    # Already over budget: fall back to the smallest chunks
+    sizer = ChunkSizer(rss // 2, 1024, min_chunk_size=10)
+    assert sizer.next_chunk_size(100000) == 10
+    assert sizer.over_budget
+
+    # A chunk using more memory than estimated raises the estimate
+    sizer = ChunkSizer(rss + 1024**3, 1.0, min_chunk_size=10)
+    n_rows = sizer.next_chunk_size(1000)
+    block = np.ones((n_rows, 64 * 1024))
+    sizer.chunk_done()
+    del block
+    assert sizer.bytes_per_row > 1.0
@@ -0,0 +1,102 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for sharded ensemble output"""
+
+import os
+
+import numpy as np
+import pytest
+import qp
+
+from lsst.meas.pz.extensions import sharded_ensemble
+
+
+def _make_ensemble(npdf: int) -> qp.Ensemble:
+    xvals = np.linspace(0.0, 3.0, 51)
+    locs = np.linspace(0.1, 2.5, npdf)
+    yvals = np.exp(-0.5 * ((xvals[np.newaxis, :] - locs[:, np.newaxis]) / 0.1) ** 2)
+    return qp.Ensemble(qp.interp, data=dict(xvals=xvals, yvals=yvals))
+
+
+def test_sharded_round_trip(tmp_path: str) -> None:
+    ens = _make_ensemble(103)
+    object_ids = np.arange(1000, 1103)
+    base_path = os.path.join(tmp_path, "pz_estimate_test")
+
+    path = sharded_ensemble.write_sharded_ensemble(ens, base_path, 4, object_ids=object_ids)
+    reader = sharded_ensemble.ShardedEnsemble(path)
+
+    assert reader.npdf == 103
+    assert reader.n_shards == 4
+    assert reader.shards[0].start == 0
+    assert reader.shards[-1].stop == 103
+    assert reader.shard_for_row(102) == 3
+
+    shard = reader.read_shard(1)
+    assert shard.npdf == reader.shards[1].n_rows
+    assert np.all(shard.ancil["objectId"] == object_ids[reader.shards[1].start:reader.shards[1].stop])
+
+    rows = reader.read_rows(20, 60)
+    assert rows.npdf == 40
+    assert np.allclose(rows.objdata["yvals"], ens[20:60].objdata["yvals"])
+
+    assert reader.shards_for_ids(np.array([1000])) == [0]
+    assert not os.path.exists(f"{sharded_ensemble.shard_path(base_path, 0)}.shard.json")
+
+
+def test_independent_shard_writers(tmp_path: str) -> None:
+    ens = _make_ensemble(30)
+    base_path = os.path.join(tmp_path, "pz_estimate_test")
+
+    # Write shards out of order, as independent workers would
+    sharded_ensemble.write_ensemble_shard(ens[10:30], base_path, 1, row_offset=10)
+    sharded_ensemble.write_ensemble_shard(ens[0:10], base_path, 0, row_offset=0)
+    # The shards of another ensemble whose name starts the same way
+    sharded_ensemble.write_ensemble_shard(ens[0:5], f"{base_path}_bar", 0, row_offset=0)
+    reader = sharded_ensemble.ShardedEnsemble(sharded_ensemble.finalize_manifest(base_path))
+    assert reader.npdf == 30
+    assert reader.read_rows(5, 15).npdf == 10
+
+
+def test_shard_leaves_ensemble_alone(tmp_path: str) -> None:
+    ens = _make_ensemble(10)
+    ens.set_ancil(dict(zmode=np.arange(10.0)))
+    ancil = ens.ancil
+    base_path = os.path.join(tmp_path, "pz_estimate_test")
+
+    sharded_ensemble.write_ensemble_shard(ens, base_path, 0, row_offset=0, object_ids=np.arange(10, 20))
+    assert ens.ancil is ancil
+    assert list(ens.ancil) == ["zmode"]
+    reader = sharded_ensemble.ShardedEnsemble(sharded_ensemble.finalize_manifest(base_path))
+    shard = reader.read_shard(0)
+    assert np.all(shard.ancil["objectId"] == np.arange(10, 20))
+    assert np.all(shard.ancil["zmode"] == np.arange(10.0))
+
+
+def test_gap_in_shards(tmp_path: str) -> None:
+    ens = _make_ensemble(30)
+    base_path = os.path.join(tmp_path, "pz_estimate_test")
+
+    sharded_ensemble.write_ensemble_shard(ens[0:10], base_path, 0, row_offset=0)
+    sharded_ensemble.write_ensemble_shard(ens[20:30], base_path, 2, row_offset=20)
+    with pytest.raises(ValueError):
+        sharded_ensemble.finalize_manifest(base_path)
@@ -0,0 +1,125 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Unit tests for the splitting of patches into sub-quanta"""
+
+import os
+from types import SimpleNamespace
+from typing import Any
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import qp
+from lsst.resources import ResourcePath
+
+from lsst.meas.pz.extensions.nz_accumulator import NzAccumulator
+from lsst.meas.pz.extensions.pz_index import make_index_table
+from lsst.meas.pz.extensions.subquanta import (
+    MergePZSubquantaTask,
+    part_name,
+    read_subquantum_rows,
+    subquantum_slice,
+)
+
+
+class _ParquetHandle:
+    """Stand-in for the deferred handle of a parquet catalog"""
+
+    def __init__(self, path: str, n_rows: int):
+        self._n_rows = n_rows
+        self.ref = path
+        self.butler = SimpleNamespace(getURI=ResourcePath)
+
+    def get(self, component: str) -> Any:
+        assert component == "rowcount"
+        return self._n_rows
+
+
+def _make_ensemble(locs: np.ndarray) -> qp.Ensemble:
+    xvals = np.linspace(0.0, 3.0, 31)
+    yvals = np.exp(-0.5 * ((xvals[np.newaxis, :] - locs[:, np.newaxis]) / 0.1) ** 2)
+    return qp.Ensemble(qp.interp, data=dict(xvals=xvals, yvals=yvals))
+
+
+def test_subquantum_slice() -> None:
+    slices = [subquantum_slice(10, 3, index) for index in range(3)]
+    assert [(slice_.start, slice_.stop) for slice_ in slices] == [(0, 3), (3, 6), (6, 10)]
+    assert subquantum_slice(1, 3, 0) == slice(0, 0)
+    assert subquantum_slice(1, 3, 2) == slice(0, 1)
+    with pytest.raises(ValueError):
+        subquantum_slice(10, 3, 3)
+    assert part_name("pz_estimate_gpz", 1) == "pz_estimate_gpz_part1"
+
+
+def test_read_subquantum_rows(tmp_path: str) -> None:
+    path = os.path.join(tmp_path, "catalog.parq")
+    pq.write_table(pa.table(dict(objectId=np.arange(10), mag=np.arange(10) / 10.0)), path, row_group_size=3)
+    handle = _ParquetHandle(path, 10)
+    for index in range(3):
+        catalog, rows = read_subquantum_rows(handle, 3, index, ["objectId"])
+        assert rows == subquantum_slice(10, 3, index)
+        assert catalog.colnames == ["objectId"]
+        assert list(catalog["objectId"]) == list(range(10))[rows]
+
+    # Sub-quanta past the end of a small catalog read no rows
+    path = os.path.join(tmp_path, "small.parq")
+    pq.write_table(pa.table(dict(objectId=[7], mag=[0.5])), path)
+    catalog, rows = read_subquantum_rows(_ParquetHandle(path, 1), 3, 0)
+    assert rows == slice(0, 0)
+    assert len(catalog) == 0 and catalog.colnames == ["objectId", "mag"]
+
+
+def test_merge_subquanta() -> None:
+    locs = np.linspace(0.1, 2.5, 10)
+    parts = [_make_ensemble(locs[subquantum_slice(10, 3, index)]) for index in range(3)]
+    zgrid = np.linspace(0.0, 3.0, 31)
+    nz_tables = []
+    for part in parts:
+        accumulator = NzAccumulator(zgrid=zgrid, bin_edges=np.array([0.0, 5.0]))
+        accumulator.add(part, np.ones(part.npdf))
+        nz_tables.append(accumulator.to_table())
+
+    task = MergePZSubquantaTask(config=MergePZSubquantaTask.ConfigClass())
+    merged = task.run(parts, nz_tables)
+    assert merged.pzEnsemble.npdf == 10
+    assert np.allclose(merged.pzEnsemble.objdata["yvals"], _make_ensemble(locs).objdata["yvals"])
+    assert np.asarray(merged.pzNz["count"])[0] == 10
+
+    index_tables = [
+        make_index_table(np.arange(10)[::-1][slice_], slice_.start)
+        for slice_ in [subquantum_slice(10, 3, index) for index in range(3)]
+    ]
+    merged = task.run(parts, index_tables=index_tables)
+    assert list(merged.pzIndex["objectId"]) == list(range(10))
+    assert list(merged.pzIndex["row"]) == list(range(10))[::-1]
+
+    # The configured ID column is used whatever the column order
+    config = MergePZSubquantaTask.ConfigClass()
+    config.index_id_column = "id"
+    task = MergePZSubquantaTask(config=config)
+    index_tables = [make_index_table(table_["objectId"], 0, "id")["row", "id"] for table_ in index_tables]
+    assert list(task.run(parts, index_tables=index_tables).pzIndex["id"]) == list(range(10))
+
+    empty = qp.Ensemble(qp.interp, data=dict(xvals=zgrid, yvals=np.empty((0, zgrid.size))))
+    assert task.run([parts[0], empty]).pzEnsemble.npdf == parts[0].npdf
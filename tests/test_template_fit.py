@@ -0,0 +1,149 @@
+# This file is part of meas_pz
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (http://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for vectorized template grid fitting"""
+
+import os
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from lsst.meas.pz.extensions import template_fit
+from lsst.meas.pz.extensions.template_fit import (
+    TemplateGrid,
+    fit_block_bytes,
+    fit_template_grid,
+    library_key,
+    template_grid_from_library,
+)
+
+
+def _make_grid() -> TemplateGrid:
+    zgrid = np.linspace(0.0, 3.0, 151)
+    band_idx = np.arange(6) - 2.5
+    mags = np.empty((3, zgrid.size, band_idx.size))
+    for itempl in range(3):
+        mags[itempl] = (
+            22.0
+            + band_idx[np.newaxis, :] * zgrid[:, np.newaxis] * (0.5 + 0.3 * itempl)
+            + 0.5 * np.sin(3.0 * zgrid[:, np.newaxis] + band_idx[np.newaxis, :])
+        )
+    return TemplateGrid(mags, zgrid, [f"mag_{band_}_lsst" for band_ in "ugrizy"])
+
+
+def test_template_fit(tmp_path: str) -> None:
+    grid = _make_grid()
+    path = os.path.join(tmp_path, "templates")
+    grid.save(path)
+    loaded = TemplateGrid.load(path)
+    assert isinstance(loaded.mags, np.memmap)
+    assert loaded.bands == grid.bands
+    assert loaded.key is None
+
+    rng = np.random.default_rng(42)
+    true_iz = np.array([20, 50, 100, 120])
+    mags = grid.mags[1, true_iz] + 0.7 + rng.normal(scale=0.01, size=(4, 6))
+    errs = np.full_like(mags, 0.01)
+    # A missing band should just be ignored
+    mags[0, 0] = 99.0
+
+    zgrid = np.linspace(0.0, 3.0, 301)
+    pdfs = fit_template_grid(loaded, mags, errs, zgrid, block_size=3)
+    zmode = zgrid[np.argmax(pdfs, axis=1)]
+    assert np.allclose(zmode, grid.zgrid[true_iz], atol=0.05)
+    assert np.allclose(pdfs.sum(axis=1) * (zgrid[1] - zgrid[0]), 1.0, atol=1e-2)
+
+    out = np.zeros((4, zgrid.size))
+    parallel = fit_template_grid(loaded, mags, errs, zgrid, block_size=1, n_workers=4, out=out)
+    assert parallel is out
+    assert np.allclose(parallel, pdfs)
+
+
+def test_template_blocks(monkeypatch: pytest.MonkeyPatch) -> None:
+    grid = _make_grid()
+    rng = np.random.default_rng(7)
+    mags = grid.mags[2, [10, 80]] + 0.3 + rng.normal(scale=0.05, size=(2, 6))
+    errs = np.full_like(mags, 0.05)
+    zgrid = np.linspace(0.0, 3.0, 301)
+    pdfs = fit_template_grid(grid, mags, errs, zgrid)
+    # One template at a time gives the same likelihoods
+    monkeypatch.setattr(template_fit, "_MODEL_BLOCK_ROWS", 1)
+    assert np.allclose(fit_template_grid(grid, mags, errs, zgrid), pdfs)
+    out = np.zeros((2, zgrid.size), dtype=np.float32)
+    assert np.allclose(fit_template_grid(grid, mags, errs, zgrid, out=out), pdfs, rtol=1e-3, atol=1e-3)
+
+
+def test_template_grid_from_library() -> None:
+    grid = _make_grid()
+    # Two extinctions of each template, in no particular order
+    library = [
+        SimpleNamespace(
+            nummod=itempl + 1, extlawId=0, ebv=ebv, age=0.0, red=red, mag=grid.mags[itempl, iz] + ebv
+        )
+        for ebv in (0.1, 0.0)
+        for iz, red in reversed(list(enumerate(grid.zgrid)))
+        for itempl in range(grid.n_templates)
+    ]
+    built = template_grid_from_library(library[1:], grid.bands)
+    assert built.mags.shape == (2 * grid.n_templates, grid.zgrid.size, 6)
+    assert np.allclose(built.zgrid, grid.zgrid)
+    assert np.allclose(built.mags[0::2], grid.mags)
+    assert np.allclose(built.mags[3::2], grid.mags[1:] + 0.1)
+    # The entry left out has no model flux
+    assert np.all(np.isinf(built.mags[1, -1]))
+    assert np.allclose(built.mags[1, :-1], grid.mags[0, :-1] + 0.1)
+    with pytest.raises(ValueError):
+        template_grid_from_library(library, grid.bands[:-1])
+
+
+def test_library_key(tmp_path: str) -> None:
+    grid = _make_grid()
+    config = dict(ZPHOTLIB="CE_COSMOS,BC03_COSMOS", Z_STEP="0.01,0.,3.", EXTINC_LAW="SB_calzetti.dat")
+    grid.key = library_key(config, grid.bands)
+    path = os.path.join(tmp_path, "keyed")
+    grid.save(path)
+    assert TemplateGrid.load(path).key == library_key(dict(reversed(config.items())), grid.bands)
+    assert library_key(dict(config, Z_STEP="0.02,0.,3."), grid.bands) != grid.key
+    assert library_key(config, grid.bands[:-1]) != grid.key
+
+
+def test_fit_block_bytes() -> None:
+    grid = _make_grid()
+    rng = np.random.default_rng(3)
+    n_obj = 200
+    mags = grid.mags[1, rng.integers(0, grid.zgrid.size, n_obj)] + rng.normal(scale=0.05, size=(n_obj, 6))
+    errs = np.full_like(mags, 0.05)
+    zgrid = np.linspace(0.0, 3.0, 301)
+    out = np.zeros((n_obj, zgrid.size))
+    fit_template_grid(grid, mags, errs, zgrid, block_size=n_obj, out=out)
+    tracemalloc.start()
+    try:
+        fit_template_grid(grid, mags, errs, zgrid, block_size=n_obj, out=out)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # The estimate bounds the temporaries without overstating them much
+    n_model_rows = grid.n_templates * grid.zgrid.size
+    estimate = fit_block_bytes(n_obj, grid.zgrid.size) * n_model_rows // max(4096, grid.zgrid.size)
+    assert peak <= estimate
+    assert peak >= estimate / 4